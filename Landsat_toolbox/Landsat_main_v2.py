@@ -2,15 +2,19 @@ import concurrent.futures
 import traceback
 from itertools import repeat
 import pandas as pd
-from .built_in_index import built_in_index
+from .built_in_index import built_in_index, convert_fused_index_func
 import matplotlib.pyplot as plt
 import tarfile
+import gc
 from datetime import date
 from scipy.optimize import curve_fit
 import glob
 from lxml import etree
 from RSDatacube.utils import *
+from RSDatacube.tiling import iter_dc_blocks, Tile_scheduler
 from Landsat_toolbox.utils import *
+from Landsat_toolbox.slc_gap import iter_slc_filled_blocks, fill_slc_gap_stack, footprint_cache
+import layer_codec
 
 global topts
 topts = gdal.TranslateOptions(creationOptions=['COMPRESS=LZW', 'PREDICTOR=2'])
@@ -36,6 +40,7 @@ class Landsat_l2_ds(object):
         self._cloud_removal_para = False
         self._overwritten_para = False
         self._scan_line_correction = False
+        self._block_size = None
         self.vi_output_path_dic = {}
         self.construction_issue_factor = False
         self.construction_failure_files = []
@@ -85,7 +90,7 @@ class Landsat_l2_ds(object):
         bf.create_folder(self.trash_folder)
 
         # Constant
-        self._band_output_list = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B10', 'QA_PIXEL', 'gap_mask']
+        self._band_output_list = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B10', 'QA_PIXEL']
         self._all_supported_index_list = ['RGB', 'QI', 'all_band', '4visual', 'NDVI', 'MNDWI', 'EVI', 'EVI2', 'OSAVI',
                                           'GNDVI', 'NDVI_RE', 'NDVI_RE2', 'AWEI', 'AWEInsh', 'SVVI', 'TCGREENESS',
                                           'BLUE', 'GREEN', 'RED', 'NIR', 'SWIR', 'SWIR2']
@@ -329,7 +334,7 @@ class Landsat_l2_ds(object):
         # Detect whether all the indicators are valid
         for kwarg_indicator in kwargs.keys():
             if kwarg_indicator not in ('ROI', 'ROI_name', 'size_control_factor', 'cloud_removal_para', 'scan_line_correction',
-                                       'main_coordinate_system', 'overwritten_factor', 'metadata_range', 'issued_files', 'harmonising_data'):
+                                       'main_coordinate_system', 'overwritten_factor', 'metadata_range', 'issued_files', 'harmonising_data', 'block_size'):
                 raise NameError(f'{kwarg_indicator} is not supported kwargs! Please double check!')
 
         # process harmonising data parameter
@@ -368,6 +373,15 @@ class Landsat_l2_ds(object):
         else:
             self._scan_line_correction = False
 
+        # process block size parameter (rows per block for the windowed construction, None for the whole scene)
+        if 'block_size' in kwargs.keys():
+            if kwargs['block_size'] is None or (type(kwargs['block_size']) is int and kwargs['block_size'] > 0):
+                self._block_size = kwargs['block_size']
+            else:
+                raise TypeError('Please mention the block_size should be a positive int or None!')
+        else:
+            self._block_size = None
+
         # process size control parameter
         if 'size_control_factor' in kwargs.keys():
             if type(kwargs['size_control_factor']) is bool:
@@ -450,12 +464,14 @@ class Landsat_l2_ds(object):
         ROI_name: The name of ROI user specified or the file name of ROI will be used;
         size_control_factor: Whether converted the float type arr into int16 to save the storage space or not;
         cloud_removal_para: Whether used the QA_pixel layer to remove the cloud-contaminated pixels or not;
-        scan_line_correction: Whether fixed the scanline correction error for Landsat 7 ETM+ or not;
+        scan_line_correction: Whether kept the SLC-off gap of Landsat 7 ETM+ from the cloud removal or not, the gap is left as the nodata
+        and filled over the whole stack by the Landsat_dc.fill_slc_gap during the ds2landsatdc;
         main_coordinate_system: The ESPG style coordinate system for output raster;
         overwritten_factor Whether overwritten the current result;
         'metadata_range';
         issued_files: Do not change the value unless you manually encounter some issued files;
-        'harmonising_data: Whether harmonising the Landsat OLI sensor data into Landsat TM range or not'
+        'harmonising_data: Whether harmonising the Landsat OLI sensor data into Landsat TM range or not';
+        block_size: The rows per block to stream the bands and construct all the indices block by block, None for reading the whole scene
         """
         # Metadata check
         if self.Landsat_metadata is None:
@@ -518,7 +534,9 @@ class Landsat_l2_ds(object):
             issue_files.writelines(['#' * 50 + 'Construction issue files' + '#' * 50])
             issue_files.close()
 
-    def _safe_retrieve_band_arr(self, band_name_list, tiffile_serial_num):
+    def _safe_retrieve_band_arr(self, band_name_list, tiffile_serial_num, ds_only: bool = False):
+
+        # With ds_only, the opened ds of the bands are returned instead of the arrays for the windowed reading
 
         # Define local var
         sensing_date = self.Landsat_metadata['Date'][tiffile_serial_num]
@@ -554,18 +572,10 @@ class Landsat_l2_ds(object):
                             print(f'The {str(band_temp)} of \033[1;31m Date:{str(sensing_date)} Tile:{str(tile_num)}\033[0m might be corrupted!')
                             raise Exception(-1)
 
-                        arr_dic[band_temp] = ds_temp.GetRasterBand(1).ReadAsArray().astype(np.float32)
-                        nodata_value = ds_temp.GetRasterBand(1).GetNoDataValue()
-
-                        # Reset the nodata value
-                        if nodata_value is None:
-                            pass
-                        elif ~np.isnan(nodata_value):
-                            arr_dic[band_temp][arr_dic[band_temp] == nodata_value] = np.nan
-
-                        # harmonise the Landsat 8
-                        if self._harmonising_data and sensor_type in ['LC08'] and band_temp not in ['QA_PIXEL', 'gap_mask']:
-                            arr_dic[band_temp] = arr_dic[band_temp] * self._OLI2ETM_harmonised_factor[f'{band_temp}_band_OLS'][0] + self._OLI2ETM_harmonised_factor[f'{band_temp}_band_OLS'][1]
+                        if ds_only:
+                            arr_dic[band_temp] = ds_temp
+                        else:
+                            arr_dic[band_temp] = self._read_band_window(ds_temp, band_temp, sensor_type)
 
                         if bound_temp is None:
                             ulx_temp, xres_temp, xskew_temp, uly_temp, yskew_temp, yres_temp = ds_temp.GetGeoTransform()
@@ -599,6 +609,24 @@ class Landsat_l2_ds(object):
                 print(f"The file {self.Landsat_metadata['File_Path'][tiffile_serial_num]} is corrupted")
                 return None, None, None
     
+    def _read_band_window(self, ds_temp, band_temp, sensor_type, yoff: int = 0, ysize: int = None):
+
+        # Read the rows [yoff, yoff + ysize) of the band (the whole band if ysize is None)
+        ysize = ds_temp.RasterYSize - yoff if ysize is None else ysize
+        arr = ds_temp.GetRasterBand(1).ReadAsArray(0, yoff, ds_temp.RasterXSize, ysize).astype(np.float32)
+        nodata_value = ds_temp.GetRasterBand(1).GetNoDataValue()
+
+        # Reset the nodata value
+        if nodata_value is None:
+            pass
+        elif ~np.isnan(nodata_value):
+            arr[arr == nodata_value] = np.nan
+
+        # harmonise the Landsat 8
+        if self._harmonising_data and sensor_type in ['LC08'] and band_temp != 'QA_PIXEL':
+            arr = arr * self._OLI2ETM_harmonised_factor[f'{band_temp}_band_OLS'][0] + self._OLI2ETM_harmonised_factor[f'{band_temp}_band_OLS'][1]
+        return arr
+
     def construct_landsat_index(self, index_list, i, *args, **kwargs):
 
         try:
@@ -639,17 +667,7 @@ class Landsat_l2_ds(object):
                     bf.create_folder(self.vi_output_path_dic[_])
 
                     if _ in self._index_exprs_dic.keys():
-                        dep_list = self._index_exprs_dic[_][0]
-                        dep_list = [str(dep) for dep in dep_list]
-                        if 'LE07' in fileid:
-                            dep_list = [self._band_tab['LE07_bandnum'][self._band_tab['LE07_bandname'].index(dep_t)] for dep_t in dep_list]
-                        elif 'LT05' in fileid or 'LT04' in fileid:
-                            dep_list = [self._band_tab['LT05_bandnum'][self._band_tab['LT05_bandname'].index(dep_t)] for dep_t in dep_list]
-                        elif 'LC08' in fileid or 'LC09' in fileid:
-                            dep_list = [self._band_tab['LC08_bandnum'][self._band_tab['LC08_bandname'].index(dep_t)] for dep_t in dep_list]
-                        else:
-                            raise Exception('The Original Tiff files are not belonging to Landsat 5, 7, 8 OR 9')
-                        dep_dic[_] = dep_list
+                        dep_dic[_] = self._expr_dep2band(self._index_exprs_dic[_][0], fileid)
                     else:
                         raise Exception(f'Code error: the {str(_)} for {str(filedate)}_{str(tile_num)} is not in the index expression dic')
 
@@ -660,8 +678,14 @@ class Landsat_l2_ds(object):
                     if __ not in unique_dep_list:
                         unique_dep_list.append(__)
 
+            # Construct all the indices block by block
+            construct_list = [_ for _ in index_list if not os.path.exists(f'{self.vi_output_path_dic[_]}{str(filedate)}_{str(tile_num)}_{str(_)}.TIF') or self._overwritten_para]
+            if self._block_size is not None:
+                if len(unique_dep_list) > 0 and len(construct_list) > 0:
+                    bound_temp, ds_temp = self._construct_index_by_block(construct_list, unique_dep_list, i)
+
             # Read all unique tif files and QA files
-            if len(unique_dep_list) > 0:
+            elif len(unique_dep_list) > 0:
                 arr_dic, bound_temp, ds_temp = self._safe_retrieve_band_arr(unique_dep_list, i)
                 if arr_dic is None:
                     raise Exception(f'Error during the retrival of Band Array of {fileid}')
@@ -676,43 +700,32 @@ class Landsat_l2_ds(object):
                     QI_arr = QA_dic['QA_PIXEL']
                     QI_arr = self._process_QA_band(QI_arr, i)
 
+                # Generate the output arr of all the indices with the fused kernel
+                if len(construct_list) > 0:
+                    fused_dep_list, fused_func = self._fused_index_func(construct_list, fileid)
+                    output_dic = dict(zip(construct_list, fused_func(*[arr_dic[__] for __ in fused_dep_list])))
+
             # Calculate each index
             for _ in index_list:
                 file_name = f'{str(filedate)}_{str(tile_num)}_{str(_)}.TIF'
                 if not os.path.exists(f'{self.vi_output_path_dic[_]}{str(filedate)}_{str(tile_num)}_{str(_)}.TIF') or self._overwritten_para:
 
-                    # Generate the output arr
-                    output_array = self._index_exprs_dic[_][1](*[arr_dic[__] for __ in dep_dic[_]])
+                    data_type, nodata_value = self._index_output_type(_)
+                    if self._block_size is None:
 
-                    # Cloud removal procedure
-                    if self._cloud_removal_para:
-                        try:
-                            output_array = QI_arr * output_array
-                            # bf.write_raster(ds_list[0], output_array, qi_folder, file_name + '.TIF', raster_datatype=gdal.GDT_Int16)
-                        except ValueError:
-                            raise ValueError(f'QI and BAND array for {str(tile_num)} {str(filedate)} {str(sensor_type)} is not compatible')
+                        # Retrieve the output arr
+                        output_array = output_dic.pop(_)
 
-                    if self._scan_line_correction:
-                        fill_landsat7_gap(output_array)
-                        pass
+                        # Cloud removal procedure
+                        if self._cloud_removal_para:
+                            try:
+                                output_array = QI_arr * output_array
+                                # bf.write_raster(ds_list[0], output_array, qi_folder, file_name + '.TIF', raster_datatype=gdal.GDT_Int16)
+                            except ValueError:
+                                raise ValueError(f'QI and BAND array for {str(tile_num)} {str(filedate)} {str(sensor_type)} is not compatible')
 
-                    if _ in self._band_sup:
-                        output_array[np.isnan(output_array)] = 0
-                        output_array.astype(np.uint16)
-                        bf.write_raster(ds_temp, output_array, '/vsimem/', file_name + '.TIF', raster_datatype=gdal.GDT_UInt16)
-                        data_type = gdal.GDT_UInt16
-                        nodata_value = 0
-                    elif self._size_control_factor:
-                        output_array[np.isnan(output_array)] = -3.2768
-                        output_array = output_array * 10000
-                        output_array.astype(np.int16)
-                        bf.write_raster(ds_temp, output_array, '/vsimem/', file_name + '.TIF', raster_datatype=gdal.GDT_Int16)
-                        data_type = gdal.GDT_Int16
-                        nodata_value = -32768
-                    else:
-                        bf.write_raster(ds_temp, output_array, '/vsimem/', file_name + '.TIF', raster_datatype=gdal.GDT_Float32)
-                        data_type = gdal.GDT_Float32
-                        nodata_value = np.nan
+                        output_array = self._postprocess_index_arr(_, output_array)
+                        bf.write_raster(ds_temp, output_array, '/vsimem/', file_name + '.TIF', raster_datatype=data_type)
 
                     if self.ROI is not None:
                         gdal.Warp('/vsimem/' + file_name + '2.TIF', '/vsimem/' + file_name + '.TIF', xRes=30, yRes=30, dstSRS=self.main_coordinate_system, cutlineDSName=self.ROI, cropToCutline=True, outputType=data_type, outputBounds=bound_temp, srcNodata =nodata_value, dstNodata =nodata_value)
@@ -787,7 +800,123 @@ class Landsat_l2_ds(object):
             # return i
             return None
 
-    def _process_QA_band(self, QI_temp_array, tiffile_serial_num):
+    def _expr_dep2band(self, dep_list, fileid):
+
+        # Convert the dep of the index expression into the band number of the sensor
+        dep_list = [str(dep) for dep in dep_list]
+        if 'LE07' in fileid:
+            return [self._band_tab['LE07_bandnum'][self._band_tab['LE07_bandname'].index(dep_t)] for dep_t in dep_list]
+        elif 'LT05' in fileid or 'LT04' in fileid:
+            return [self._band_tab['LT05_bandnum'][self._band_tab['LT05_bandname'].index(dep_t)] for dep_t in dep_list]
+        elif 'LC08' in fileid or 'LC09' in fileid:
+            return [self._band_tab['LC08_bandnum'][self._band_tab['LC08_bandname'].index(dep_t)] for dep_t in dep_list]
+        else:
+            raise Exception('The Original Tiff files are not belonging to Landsat 5, 7, 8 OR 9')
+
+    def _fused_index_func(self, construct_list, fileid):
+
+        # Compile all the indices to be constructed into one fused kernel (common subexpressions are evaluated once)
+        dep_list, fused_func = convert_fused_index_func([self._index_exprs_dic[_][2] for _ in construct_list])
+        return self._expr_dep2band(dep_list, fileid), fused_func
+
+    def _index_output_type(self, index):
+
+        # The datatype and nodata value of the output index
+        if index in self._band_sup:
+            return gdal.GDT_UInt16, 0
+        elif self._size_control_factor:
+            return gdal.GDT_Int16, -32768
+        else:
+            return gdal.GDT_Float32, np.nan
+
+    def _postprocess_index_arr(self, index, output_array):
+
+        # Convert the index arr into the output datatype
+        if index in self._band_sup:
+            output_array[np.isnan(output_array)] = 0
+        elif self._size_control_factor:
+            output_array = index_arr2int16(output_array, 10000, -32768)
+        return output_array
+
+    def _construct_index_by_block(self, construct_list, unique_dep_list, i):
+
+        # Stream the aligned blocks of all the dependent bands (and QA_PIXEL) and construct all the indices in one pass
+        # (1) The block is full-width and its rows are aligned with the natural block of the band
+        # (2) The QA_PIXEL is read with a halo of 7 rows for the 15 * 15 neighbourhood in the _process_QA_band
+        # (3) The output of each index is written block by block into the /vsimem/ tif
+        filedate = self.Landsat_metadata['Date'][i]
+        tile_num = self.Landsat_metadata['Tile_Num'][i]
+        sensor_type = self.Landsat_metadata['Sensor_Type'][i]
+        fileid = self.Landsat_metadata.FileID[i]
+
+        ds_dic, bound_temp, ds_temp = self._safe_retrieve_band_arr(unique_dep_list, i, ds_only=True)
+        if ds_dic is None:
+            raise Exception(f'Error during the retrival of Band Array of {fileid}')
+
+        qa_ds, gap_mask, halo = None, None, 0
+        if self._cloud_removal_para:
+            qa_dic, bound_temp, ds_temp = self._safe_retrieve_band_arr(['QA_PIXEL'], i, ds_only=True)
+            if qa_dic is None:
+                raise Exception(f'Error during the retrieval of QA_PIXEL file for {fileid}')
+            qa_ds, halo = qa_dic['QA_PIXEL'], 7
+            if sensor_type == 'LE07' and self._scan_line_correction:
+                gap_mask = self._retrieve_gap_mask(i, qa_ds=qa_ds)
+
+        # Create the output tif in memory (nodata value consistent with the bf.write_raster)
+        y_size, x_size = ds_temp.RasterYSize, ds_temp.RasterXSize
+        driver = gdal.GetDriverByName('GTiff')
+        out_ds_dic = {}
+        for _ in construct_list:
+            data_type = self._index_output_type(_)[0]
+            out_ds = driver.Create(f'/vsimem/{str(filedate)}_{str(tile_num)}_{str(_)}.TIF.TIF', xsize=x_size, ysize=y_size, bands=1, eType=data_type, options=['COMPRESS=LZW', 'PREDICTOR=2'])
+            out_ds.SetGeoTransform(ds_temp.GetGeoTransform())
+            out_ds.SetProjection(ds_temp.GetProjection())
+            out_ds.GetRasterBand(1).SetNoDataValue({gdal.GDT_UInt16: 65535, gdal.GDT_Int16: -32768}.get(data_type, 0))
+            out_ds_dic[_] = out_ds
+
+        # Compile the fused kernel once for all the blocks
+        fused_dep_list, fused_func = self._fused_index_func(construct_list, fileid)
+
+        # Align the block rows with the natural block of the band
+        natural_rows = ds_dic[unique_dep_list[0]].GetRasterBand(1).GetBlockSize()[1]
+        block_rows = max(natural_rows, self._block_size // natural_rows * natural_rows)
+        for yoff in range(0, y_size, block_rows):
+            ysize = min(block_rows, y_size - yoff)
+            arr_dic = {band_temp: self._read_band_window(ds_dic[band_temp], band_temp, sensor_type, yoff, ysize) for band_temp in unique_dep_list}
+
+            if self._cloud_removal_para:
+                halo_beg, halo_end = max(yoff - halo, 0), min(yoff + ysize + halo, y_size)
+                QI_arr = self._read_band_window(qa_ds, 'QA_PIXEL', sensor_type, halo_beg, halo_end - halo_beg)
+                gap_arr = None if gap_mask is None else gap_mask[halo_beg: halo_end, :]
+                QI_arr = self._process_QA_band(QI_arr, i, gap_mask_array=gap_arr)[yoff - halo_beg: yoff - halo_beg + ysize, :]
+
+            output_list = fused_func(*[arr_dic[__] for __ in fused_dep_list])
+            arr_dic = None
+            for _, output_array in zip(construct_list, output_list):
+                if self._cloud_removal_para:
+                    output_array = QI_arr * output_array
+                output_array = self._postprocess_index_arr(_, output_array)
+                out_ds_dic[_].GetRasterBand(1).WriteArray(output_array, 0, yoff)
+
+        for _ in construct_list:
+            out_ds_dic[_].GetRasterBand(1).FlushCache()
+            out_ds_dic[_] = None
+        return bound_temp, ds_temp
+
+    def _retrieve_gap_mask(self, tiffile_serial_num, qa_ds=None):
+
+        # The SLC-off gap mask of the Landsat 7 scene (0 for the gap and 1 otherwise) derived from the fill of the QA_PIXEL
+        # The footprint is cached per path/row by the slc_gap, thus no gap_mask band is written
+        if qa_ds is None:
+            qa_dic, t, tt = self._safe_retrieve_band_arr(['QA_PIXEL'], tiffile_serial_num, ds_only=True)
+            if qa_dic is None:
+                raise Exception(f'Error during the retrieval of QA_PIXEL file for {self.Landsat_metadata.FileID[tiffile_serial_num]}')
+            qa_ds = qa_dic['QA_PIXEL']
+        qa_arr = qa_ds.GetRasterBand(1).ReadAsArray()
+        gap_arr = footprint_cache.gap_mask(str(self.Landsat_metadata['Tile_Num'][tiffile_serial_num]), qa_arr, nodata_value=1)
+        return (~gap_arr).astype(np.uint8)
+
+    def _process_QA_band(self, QI_temp_array, tiffile_serial_num, gap_mask_array=None):
 
         # s1_time = time.time()
         if not isinstance(QI_temp_array, np.ndarray):
@@ -827,11 +956,9 @@ class Landsat_l2_ds(object):
                                                         np.mod(QI_temp_array, 128) != 66))] = np.nan
 
             if self._scan_line_correction:
-                gap_mask_array, t, tt = self._safe_retrieve_band_arr(['gap_mask'], tiffile_serial_num)
+                # The gap mask could be input as a window for the block construction
                 if gap_mask_array is None:
-                    raise Exception(f'Error during the retrival of Band Array of {fileid}')
-                else:
-                    gap_mask_array = gap_mask_array['gap_mask']
+                    gap_mask_array = self._retrieve_gap_mask(tiffile_serial_num)
                 QI_temp_array[gap_mask_array == 0] = 1
 
         elif sensor_type in ['LT05', 'LT04']:
@@ -908,7 +1035,7 @@ class Landsat_l2_ds(object):
     def _process_2dc_para(self, **kwargs):
         # Detect whether all the indicators are valid
         for kwarg_indicator in kwargs.keys():
-            if kwarg_indicator not in ('skip_invalid_file', 'inherit_from_logfile', 'ROI', 'ROI_name', 'dc_overwritten_para', 'remove_nan_layer', 'manually_remove_datelist', 'size_control_factor', 'cloud_removal_para'):
+            if kwarg_indicator not in ('skip_invalid_file', 'inherit_from_logfile', 'ROI', 'ROI_name', 'dc_overwritten_para', 'remove_nan_layer', 'manually_remove_datelist', 'size_control_factor', 'cloud_removal_para', 'scan_line_correction'):
                 raise NameError(f'{kwarg_indicator} is not supported kwargs! Please double check!')
 
         # process clipped_overwritten_para
@@ -998,6 +1125,15 @@ class Landsat_l2_ds(object):
         else:
             self._cloud_removal_para = False
 
+        # Retrieve scan line correction factor (the value of the index construction is kept if not specified)
+        if 'scan_line_correction' in kwargs.keys():
+            if type(kwargs['scan_line_correction']) is bool:
+                self._scan_line_correction = kwargs['scan_line_correction']
+            else:
+                raise TypeError('Please mention the scan_line_correction should be bool type!')
+        elif self._inherit_from_logfile:
+            self._retrieve_para(['scan_line_correction'], protected_var=True)
+
     @save_log_file
     def mp_ds2landsatdc(self, index_list: list, *args, **kwargs):
 
@@ -1043,7 +1179,7 @@ class Landsat_l2_ds(object):
         bf.create_folder(self._dc_infr[_])
 
         # Construct the dc
-        if self._dc_overwritten_para or not os.path.exists(self._dc_infr[_] + _ + '_datacube.npy') or not os.path.exists(self._dc_infr[_] + 'date.npy') or not os.path.exists(self._dc_infr[_] + 'metadata.json'):
+        if self._dc_overwritten_para or not os.path.exists(self._dc_infr[_] + 'doy.npy') or not os.path.exists(self._dc_infr[_] + 'metadata.json'):
 
             sa_map = np.load(bf.file_filter(self._work_env + 'ROI_map\\', [self.ROI_name, '.npy'], and_or_factor='and')[0], allow_pickle=True)
             if self.ROI_name is None or self.ROI is None:
@@ -1385,9 +1521,39 @@ class Landsat_l2_ds(object):
 
             print(f'Finished writing the \033[1;31m{str(_)}\033[0m sdc in \033[1;34m{str(time.time() - start_time)} s\033[0m.')
 
+            # Fill the SLC-off gap left as the nodata by the index construction
+            if self._scan_line_correction:
+                self._fill_dc_slc_gap(_, doy_list)
+
+        else:
+            # Ingest the new dates into the existing dc instead of rebuilding it
+            doy_exist = set([int(doy_temp) for doy_temp in np.load(self._dc_infr[_] + 'doy.npy', allow_pickle=True)])
+            metadata_date = set(self.Landsat_metadata['Date'])
+            removed_date = set(self._manually_remove_datelist) if self._manually_remove_para else set()
+            new_doy_list = set()
+            for file_temp in os.listdir(self._dc_infr[_ + 'input_path']):
+                if file_temp.endswith(f'_{_}.TIF') and file_temp[0:8].isdigit():
+                    date_temp = int(file_temp[0:8])
+                    if date_temp in metadata_date and date_temp not in doy_exist and date_temp not in removed_date:
+                        new_doy_list.add(date_temp)
+
+            if len(new_doy_list) > 0:
+                Landsat_dc(self._dc_infr[_], metadata_only=True).ingest(date_list=sorted(new_doy_list), remove_nan_layer=self._remove_nan_layer)
+                if self._scan_line_correction:
+                    self._fill_dc_slc_gap(_, sorted(new_doy_list))
+
+    def _fill_dc_slc_gap(self, index, date_list: list):
+
+        # Fill the SLC-off gap of the Landsat 7 layers (acquired after the SLC failure on 2003-05-31) in the date list over the whole dc
+        # All the nodata of these layers is regarded as the gap, since the gap is not tracked once the scenes are clipped into the ROI
+        le07_date_list = set(self.Landsat_metadata['Date'][self.Landsat_metadata['Sensor_Type'] == 'LE07'])
+        le07_date_list = sorted([int(_) for _ in date_list if _ in le07_date_list and int(_) >= 20030531])
+        if len(le07_date_list) > 0:
+            Landsat_dc(self._dc_infr[index]).fill_slc_gap(le07_date_list=le07_date_list).save(self._dc_infr[index])
+
 
 class Landsat_dc(object):
-    def __init__(self, dc_filepath, work_env=None):
+    def __init__(self, dc_filepath, work_env=None, metadata_only: bool = False):
 
         # Check the dcfile path
         self.dc_filepath = bf.Path(dc_filepath).path_name
@@ -1397,7 +1563,10 @@ class Landsat_dc(object):
         self.index, self.Datatype, self.coordinate_system = None, None, None
         self.dc_group_list, self.tiles = None, None
         self.sdc_factor, self.sparse_matrix, self.size_control_factor, self.huge_matrix = False, False, False, False
+        self.pixel_major = False
+        self.codec = None
         self.Nodata_value, self.Zoffset = None, None
+        self._metadata_only, self._pending_upgrade = metadata_only, False
 
         # Def Inundation parameter
         self._DSWE_threshold = None
@@ -1434,6 +1603,12 @@ class Landsat_dc(object):
                             raise Exception(f'The {dic_name} is not in the dc metadata, double check!')
                         else:
                             self.__dict__[dic_name] = dc_metadata[dic_name]
+                    # The pixel-major factor is optional for the dc generated by the previous version
+                    if 'pixel_major' in dc_metadata.keys():
+                        self.pixel_major = dc_metadata['pixel_major']
+                    # The layer codec is optional, the dc without codec is stored as the npz/npy
+                    if 'codec' in dc_metadata.keys():
+                        self.codec = dc_metadata['codec']
             except:
                 raise Exception('Something went wrong when reading the metadata!')
 
@@ -1462,10 +1637,53 @@ class Landsat_dc(object):
             raise Exception('Something went wrong when reading the doy list!')
 
         # Read datacube
+        # With the metadata_only, the sparse dc is opened lazily and the dense dc is only peeked for its shape and dtype
+        if metadata_only and not self.sparse_matrix:
+            self._peek_dc()
+        else:
+            self._load_dc()
+
+        # Backdoor metadata check
+        self._backdoor_metadata_check()
+
+        # The format migration is kept in memory until the upgrade() is called
+        if self._pending_upgrade:
+            print(f'The Landsat dc of \033[1;31m{self.index}\033[0m is migrated in memory, run the upgrade() to persist it')
+
+        print(f'Finish loading the Landsat dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+
+    def __sizeof__(self):
+        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+
+    def __getattr__(self, name):
+        # The dc of the metadata-only Landsat dc is materialised on first access
+        if name == 'dc' and self.__dict__.get('_metadata_only', False):
+            self._load_dc()
+            return self.__dict__['dc']
+        raise AttributeError(name)
+
+    def _peek_dc(self):
+
+        # Read the shape and dtype from the npy header (or the codec header) without reading the cube
+        if self.codec is not None:
+            _, dc_shape, self.dc_dtype = layer_codec.peek_codec_cube(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+            self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_shape[0], dc_shape[1], dc_shape[2]
+            return
+        dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and', exclude_word_list=['_tmp.npy'])
+        if len(dc_filename) != 1:
+            raise ValueError('There has no valid dc or more than one dc in the dc dir!')
+        dc_temp = np.load(dc_filename[0], mmap_mode='r')
+        self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_temp.shape[0], dc_temp.shape[1], dc_temp.shape[2]
+        self.dc_dtype = dc_temp.dtype
+
+    def _load_dc(self):
+
         try:
-            if self.sparse_matrix:
+            if not self.sparse_matrix and self.codec is not None:
+                self.dc = layer_codec.load_codec_cube(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+            elif self.sparse_matrix:
                 if os.path.exists(self.dc_filepath + f'{self.index}_sequenced_datacube\\'):
-                    self.dc = NDSparseMatrix().load(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+                    self.dc = NDSparseMatrix().load(self.dc_filepath + f'{self.index}_sequenced_datacube\\', lazy=self._metadata_only)
                 else:
                     raise Exception('Please double check the code if the sparse huge matrix is generated properly')
             elif not self.sparse_matrix and self.huge_matrix:
@@ -1475,26 +1693,41 @@ class Landsat_dc(object):
                 elif len(self.dc_filename) > 1:
                     raise ValueError('There has more than one date file in the dc dir')
                 else:
-                    self.dc = np.load(self.dc_filename[0], allow_pickle=True)
+                    # The huge dense dc is memory-mapped (copy-on-write) instead of being read into memory,
+                    # process it blockwise through the iter_dc_blocks to keep the memory bounded
+                    self.dc = np.load(self.dc_filename[0], mmap_mode='c')
             elif not self.huge_matrix and not self.sparse_matrix:
-                self.dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and')
+                self.dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and', exclude_word_list=['_tmp.npy'])
         except:
             raise Exception('Something went wrong when reading the datacube!')
 
-        # autotrans sparse matrix
+        # Autotrans sparse matrix
+        # The conversion decodes every layer, thus it is deferred to the upgrade() for the metadata-only dc
         if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
-            self._autotrans_sparse_matrix()
+            if self._metadata_only:
+                self._pending_upgrade = True
+            else:
+                self._autotrans_sparse_matrix()
 
-        # Backdoor metadata check
-        self._backdoor_metadata_check()
+        # The SMsequence is committed before the doy list during the ingestion, thus the interrupted ingestion is recovered from it
+        if self.sparse_matrix and len(self.sdc_doylist) != self.dc.shape[2]:
+            self.sdc_doylist = [int(_) for _ in self.dc.SM_namelist]
+            self._pending_upgrade = True
 
         # Size calculation and shape definition
         self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+        self.dc_dtype = self.dc.dtype
 
-        print(f'Finish loading the Landsat dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+    def upgrade(self, storage: str = None, chunk_shape: tuple = None):
 
-    def __sizeof__(self):
-        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+        # Persist the migration deferred by the loading (COO to CSR, relocated ROI paths and recovered doy list)
+        if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
+            self._autotrans_sparse_matrix()
+        # The storage or the chunk shape converts the sparse dc (e.g. into the chunked container)
+        if self._pending_upgrade or storage is not None or chunk_shape is not None:
+            self.save(self.dc_filepath, storage=storage, chunk_shape=chunk_shape)
+            self._pending_upgrade = False
+        return self
 
     def _backdoor_metadata_check(self):
 
@@ -1522,8 +1755,7 @@ class Landsat_dc(object):
 
         # Problem 2
         if backdoor_issue:
-            self.save(self.dc_filepath)
-            self.__init__(self.dc_filepath)
+            self._pending_upgrade = True
 
     def _autotrans_sparse_matrix(self):
 
@@ -1536,7 +1768,7 @@ class Landsat_dc(object):
 
         self.dc._update_size_para()
         self.dc._matrix_type = sm.csr_matrix
-        self.save(self.dc_filepath)
+        self._pending_upgrade = True
 
     def append(self, append_landsat_dc):
         if not isinstance(append_landsat_dc, Landsat_dc):
@@ -1555,57 +1787,234 @@ class Landsat_dc(object):
         if not (roi_arr_ori == roi_arr_app).any():
             raise ValueError('The Landsat dcs didnot share consistency roi')
 
-        # Move all the tif from append folder into the original landsat dc folder
+        # Only the dates not in the original landsat dc are appended
+        new_date_list = [_ for _ in append_landsat_dc.sdc_doylist if _ not in self.sdc_doylist]
+        if len(new_date_list) == 0:
+            return
+
+        # Copy the tif of the new dates from append folder into the original landsat dc folder
         append_tiffile = bf.file_filter(append_landsat_dc.oritif_folder, ['.TIF', '.tif'], and_or_factor='or')
         for _ in append_tiffile:
             filename = _.split('\\')[-1]
+            if filename[0:8].isdigit() and int(filename[0:8]) in new_date_list and not os.path.exists(f"{self.oritif_folder}{filename}"):
+                try:
+                    shutil.copy(_, f"{self.oritif_folder}{filename}")
+                except:
+                    pass
+
+        # Ingest the layers of the new dates
+        if self.sparse_matrix:
+            layer_list = [append_landsat_dc.dc.SM_group[__] for __ in new_date_list]
+        else:
+            layer_list = [append_landsat_dc.dc[:, :, append_landsat_dc.sdc_doylist.index(__)] for __ in new_date_list]
+        self._ingest_layers(layer_list, new_date_list)
+
+    def _save_dense_dc(self, filename: str):
+
+        # The dense dc is replaced atomically. The memory-mapped dc saved onto its own file is released before the replacement,
+        # since a file still mapped cannot be replaced on Windows, and then mapped again from the new file
+        if isinstance(self.dc, np.memmap) and self.dc.filename is not None and os.path.abspath(self.dc.filename) == os.path.abspath(filename):
             try:
-                shutil.copy(_, f"{self.oritif_folder}{filename}")
-            except:
-                pass
+                bf.save_npy_atomic(filename, self.dc, before_replace=self._release_dc)
+            finally:
+                if self.dc is None:
+                    self.dc = np.load(filename, mmap_mode='c')
+        else:
+            bf.save_npy_atomic(filename, self.dc)
+
+    def _release_dc(self):
+        self.dc = None
+        gc.collect()
+
+    def _save_header(self, output_path: str):
+
+        # The doy list and metadata are replaced atomically, thus an interrupted ingestion never leaves a partial header
+        bf.save_npy_atomic(f'{output_path}doy.npy', np.array(self.sdc_doylist))
+        metadata_dic = {'ROI_name': self.ROI_name, 'index': self.index, 'Datatype': self.Datatype, 'ROI': self.ROI,
+                        'ROI_array': self.ROI_array, 'Zoffset': self.Zoffset, 'Nodata_value': self.Nodata_value,
+                        'ROI_tif': self.ROI_tif, 'sdc_factor': self.sdc_factor,
+                        'coordinate_system': self.coordinate_system,
+                        'sparse_matrix': self.sparse_matrix, 'huge_matrix': self.huge_matrix,
+                        'size_control_factor': self.size_control_factor,
+                        'oritif_folder': self.oritif_folder, 'dc_group_list': self.dc_group_list, 'tiles': self.tiles,
+                        'pixel_major': self.pixel_major, 'codec': self.codec}
+        bf.dump_json_atomic(f'{output_path}metadata.json', metadata_dic)
+
+    def _read_oritif_layer(self, file_list: list):
+
+        # Mosaic the index tif of one date and convert it into the dc layer as the ds2landsatdc
+        ds_list = [gdal.Open(file_temp) for file_temp in file_list]
+        array_list = [ds_temp.GetRasterBand(1).ReadAsArray() for ds_temp in ds_list]
+        nodata_list = list(set([ds_temp.GetRasterBand(1).GetNoDataValue() for ds_temp in ds_list]))
+        if len(nodata_list) != 1 and not np.isnan(nodata_list).all():
+            raise ValueError(f'The nodata value is not consistent for {str(file_list)}')
+        nodata_value = nodata_list[0]
+
+        if len(array_list) == 1:
+            output_arr = array_list[0]
+        else:
+            output_arr = np.stack(array_list, axis=2).astype(float)
+            if not np.isnan(nodata_value):
+                output_arr[output_arr == nodata_value] = np.nan
+            output_arr = np.nanmean(output_arr, axis=2)
 
-        # re-arrange the doy and dc file
         if self.sparse_matrix:
-            for __ in append_landsat_dc.sdc_doylist:
-                if __ not in self.sdc_doylist:
-                    self.sdc_doylist.append(__)
-                    self.dc.append(append_landsat_dc.dc.SM_group[__], name=__)
+            layer_dtype = self.dc.dtype
+            if nodata_value is None or np.isnan(nodata_value):
+                output_arr[np.isnan(output_arr)] = 0
+            else:
+                output_arr = output_arr.astype(float)
+                output_arr[np.isnan(output_arr)] = nodata_value
+                output_arr = output_arr - nodata_value
+            return sm.csr_matrix(output_arr.astype(layer_dtype))
         else:
-            pass
+            if np.issubdtype(output_arr.dtype, np.floating) and nodata_value is not None and not np.isnan(nodata_value):
+                output_arr[np.isnan(output_arr)] = nodata_value
+            return output_arr.astype(self.dc.dtype)
+
+    def ingest(self, date_list: list = None, remove_nan_layer: bool = False):
+
+        # Add the dates in the oritif folder which are not in the dc, the untouched layers are not rewritten
+        # (1) For the sparse dc, only the npz of the new dates, the SMsequence, doy.npy and metadata.json are written
+        # (2) For the dense dc, the npy cube has to be re-saved as a whole
+        tif_dic = {}
+        for file_temp in os.listdir(self.oritif_folder):
+            if file_temp.endswith(f'_{self.index}.TIF') and 'aux' not in file_temp and 'xml' not in file_temp:
+                try:
+                    date_temp = int(file_temp[0:8])
+                except ValueError:
+                    continue
+                tif_dic.setdefault(date_temp, []).append(self.oritif_folder + file_temp)
+
+        new_date_list = [_ for _ in tif_dic.keys() if _ not in self.sdc_doylist]
+        if date_list is not None:
+            new_date_list = [_ for _ in new_date_list if _ in date_list]
+        new_date_list.sort()
+        if len(new_date_list) == 0:
+            return self
+
+        start_time = time.time()
+        layer_list, name_list = [], []
+        for date_temp in new_date_list:
+            layer_temp = self._read_oritif_layer(tif_dic[date_temp])
+            if remove_nan_layer and ((self.sparse_matrix and layer_temp.nnz == 0) or (not self.sparse_matrix and np.all(layer_temp == self.Nodata_value))):
+                continue
+            layer_list.append(layer_temp)
+            name_list.append(date_temp)
+
+        self._ingest_layers(layer_list, name_list)
+        print(f'Finish ingesting \033[1;31m{str(len(name_list))}\033[0m dates into the Landsat dc of \033[1;31m{self.index}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+        return self
 
-        self.sdc_doylist.sort()
-        self.save(self.dc_filepath)
-        self.__init__(self.dc_filepath)
+    def _ingest_layers(self, layer_list: list, name_list: list):
 
-    def save(self, output_path: str):
+        if len(name_list) == 0:
+            return
+
+        if self.sparse_matrix:
+            self.dc.ingest(layer_list, name_list)
+            self.sdc_doylist = [int(_) for _ in self.dc.SM_namelist]
+        else:
+            doy_list = self.sdc_doylist + name_list
+            order = np.argsort(doy_list, kind='stable')
+            self.dc = np.concatenate([self.dc] + [_[:, :, None] for _ in layer_list], axis=2)[:, :, order]
+            self.sdc_doylist = [int(doy_list[_]) for _ in order]
+            if self.codec is not None:
+                layer_codec.save_codec_cube(f'{self.dc_filepath}{str(self.index)}_sequenced_datacube\\', self.dc, self.sdc_doylist, self.codec,
+                                            layer_index=[self.sdc_doylist.index(_) for _ in name_list])
+            else:
+                self._save_dense_dc(f'{self.dc_filepath}{str(self.index)}_sequenced_datacube.npy')
+
+        self._save_header(self.dc_filepath)
+        self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+
+    def fill_slc_gap(self, le07_date_list: list = None, gap_dc=None, method: str = 'temporal', max_gap_day: int = 48,
+                     max_search_dist: int = 14, block_bytes: int = 64 * 1024 ** 2):
+
+        # Fill the SLC-off gap of the Landsat 7 layers over the whole dc in one pass (see the slc_gap)
+        # (1) The gap is the gap_dc (Landsat dc, NDsm or 3D array of the same shape, True or 1 for the gap),
+        #     otherwise all the nodata of the layers in the le07_date_list (including the cloud) is regarded as the gap
+        # (2) The dense dc is filled in place block by block, the filled pixels of the sparse dc are gathered and each layer is replaced once
+        # The filled dc is not persisted until the save() is called
+        if gap_dc is None and le07_date_list is None:
+            raise ValueError('Please input the le07 date list or the gap dc!')
+        elif isinstance(gap_dc, Landsat_dc):
+            if gap_dc.sdc_doylist != self.sdc_doylist:
+                raise ValueError('The gap dc is not consistent with the Landsat dc in the doy list!')
+            gap_dc = gap_dc.dc
+        if gap_dc is not None and list(gap_dc.shape) != list(self.dc.shape):
+            raise ValueError('The gap dc is not consistent with the Landsat dc in shape!')
+
+        gap_layer = None
+        if le07_date_list is not None:
+            gap_layer = bf.Date_index(self.sdc_doylist).get_pos(le07_date_list)
+            gap_layer = [int(_) for _ in gap_layer if _ != -1]
+            if gap_dc is None and len(gap_layer) == 0:
+                return self
+
+        start_time = time.time()
+        if self.sparse_matrix:
+            # The nodata of the sparse dc is 0 and the gap is filled under the offset value
+            fill_dic = {}
+            for window, block, gap_block in iter_slc_filled_blocks(self.dc, self.sdc_doylist, gap_dc=gap_dc, gap_layer=gap_layer, method=method, nodata_value=0,
+                                                                   max_gap_day=max_gap_day, max_search_dist=max_search_dist, block_bytes=block_bytes):
+                y_arr, x_arr, z_arr = np.nonzero(np.logical_and(gap_block, block != 0))
+                for z in np.unique(z_arr):
+                    fill_dic.setdefault(int(z), []).append((y_arr[z_arr == z] + window['y_range'][0], x_arr[z_arr == z] + window['x_range'][0], block[y_arr[z_arr == z], x_arr[z_arr == z], z]))
+
+            for z, fill_list in fill_dic.items():
+                y_arr, x_arr, value_arr = [np.concatenate(_) for _ in zip(*fill_list)]
+                layer_name = self.dc.SM_namelist[z]
+                layer_temp = self.dc.SM_group[layer_name]
+                gap_sm = sm.csr_matrix((np.ones(y_arr.shape[0], dtype=layer_temp.dtype), (y_arr, x_arr)), shape=layer_temp.shape)
+                fill_sm = sm.csr_matrix((value_arr.astype(layer_temp.dtype), (y_arr, x_arr)), shape=layer_temp.shape)
+                layer_temp = (layer_temp - layer_temp.multiply(gap_sm) + fill_sm).tocsr().astype(layer_temp.dtype)
+                layer_temp.eliminate_zeros()
+                self.dc.replace_layer(layer_name, layer_temp)
+        else:
+            nodata_value = np.nan if self.Nodata_value is None else self.Nodata_value
+            fill_slc_gap_stack(self.dc, self.sdc_doylist, gap_dc=gap_dc, gap_layer=gap_layer, method=method, nodata_value=nodata_value,
+                               max_gap_day=max_gap_day, max_search_dist=max_search_dist, block_bytes=block_bytes, out=self.dc)
+
+        print(f'Finish filling the SLC-off gap of the Landsat dc of \033[1;31m{self.index}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+        return self
+
+    def save(self, output_path: str, pixel_major: bool = None, codec: str = None, storage: str = None, chunk_shape: tuple = None):
         start_time = time.time()
         print(f'Start saving the Landsat dc of \033[1;31m{self.index}\033[0m in the \033[1;34m{self.ROI_name}\033[0m')
 
+        # The pixel-major (time-series-contiguous) cube is persisted for the sparse dc if required
+        if pixel_major is not None:
+            self.pixel_major = pixel_major
+
+        # The storage ('npz', 'chunk' or 'codec') and the chunk shape of the sparse dc are passed through to the NDSparseMatrix.save
+        # The dc saved in the single chunked container is opened lazily and only the touched chunks are read
+        if (storage is not None or chunk_shape is not None) and not self.sparse_matrix:
+            raise ValueError('The storage and the chunk shape are only supported for the sparse dc!')
+        elif storage in ['npz', 'chunk'] or chunk_shape is not None:
+            self.codec = None
+
+        # The layer codec of the dc (see the layer_codec) is recorded in the metadata, None for the npz/npy storage
+        if codec is not None:
+            layer_codec.parse_codec(codec)
+            self.codec = codec
+
         if not os.path.exists(output_path):
             bf.create_folder(output_path)
         output_path = bf.Path(output_path).path_name
 
         # Save the datacube
         if self.sparse_matrix:
-            self.dc.save(f'{output_path}{str(self.index)}_sequenced_datacube\\')
+            self.dc.save(f'{output_path}{str(self.index)}_sequenced_datacube\\', storage=storage, chunk_shape=chunk_shape, codec=self.codec)
+            if self.pixel_major:
+                self.dc.save_pixel_major(f'{output_path}{str(self.index)}_sequenced_datacube\\')
+        elif self.codec is not None:
+            layer_codec.save_codec_cube(f'{output_path}{str(self.index)}_sequenced_datacube\\', self.dc, self.sdc_doylist, self.codec)
         else:
-            np.save(f'{output_path}{str(self.index)}_sequenced_datacube.npy', self.dc)
-
-        # Save the doy list
-        doy = self.sdc_doylist
-        np.save(f'{output_path}doy.npy', doy)
-
-        # Save the metadata
-        metadata_dic = {'ROI_name': self.ROI_name, 'index': self.index, 'Datatype': self.Datatype, 'ROI': self.ROI,
-                        'ROI_array': self.ROI_array, 'Zoffset': self.Zoffset, 'Nodata_value': self.Nodata_value,
-                        'ROI_tif': self.ROI_tif, 'sdc_factor': self.sdc_factor,
-                        'coordinate_system': self.coordinate_system,
-                        'sparse_matrix': self.sparse_matrix, 'huge_matrix': self.huge_matrix,
-                        'size_control_factor': self.size_control_factor,
-                        'oritif_folder': self.oritif_folder, 'dc_group_list': self.dc_group_list, 'tiles': self.tiles}
+            self._save_dense_dc(f'{output_path}{str(self.index)}_sequenced_datacube.npy')
 
-        with open(f'{output_path}metadata.json', 'w') as js_temp:
-            json.dump(metadata_dic, js_temp)
+        # Save the doy list and the metadata
+        self._save_header(output_path)
 
         print(f'Finish saving the Landsat dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
 
@@ -1620,31 +2029,12 @@ class Landsat_dc(object):
             output_folder = bf.Path(self.dc_filepath).path_name + 'stacked_Zvalue\\'
         bf.create_folder(output_folder)
 
-        # Get the ROI
-        roi_temp = np.load(self.ROI_array)
-        roi_xy = np.argwhere(roi_temp != -32768)
-        roi_xy = pd.DataFrame(roi_xy, columns=['y', 'x'])
-        roi_xy = roi_xy.sort_values(['x', 'y'], ascending=True).reset_index(drop=True)
-
-        roi_xy_list, offset_list, dc_list = [], [], []
-        cpu_amount = os.cpu_count()
-        roi_xy_itr = int(np.floor(roi_xy.shape[0]/cpu_amount))
-
-        for _ in range(cpu_amount):
-            if _ != cpu_amount - 1:
-                roi_xy_list.append(np.array(roi_xy[_ * roi_xy_itr: (_ + 1) * roi_xy_itr]))
-            else:
-                roi_xy_list.append(np.array(roi_xy[_ * roi_xy_itr:]))
-            offset_list.append([np.nanmin(roi_xy_list[-1][:, 0]), np.nanmin(roi_xy_list[-1][:, 1])])
-            if self.sparse_matrix:
-                dc_list.append(self.dc.extract_matrix(([np.nanmin(roi_xy_list[-1][:, 0]), np.nanmax(roi_xy_list[-1][:, 0]) + 1], [np.nanmin(roi_xy_list[-1][:, 1]), np.nanmax(roi_xy_list[-1][:, 1]) + 1], ['all'])))
-            else:
-                dc_list.append(self.dc[np.nanmin(roi_xy_list[-1][:, 0]): np.nanmax(roi_xy_list[-1][:, 0]) + 1, np.nanmin(roi_xy_list[-1][:, 1]): np.nanmax(roi_xy_list[-1][:, 1]) + 1, :])
-
+        # Partition the ROI into tiles balanced by the valid pixels, the workers reopen the dc by path or attach the shared dc
         doy_list = bf.date2doy(self.sdc_doylist)
         doy_list = [np.mod(__, 1000) for __ in doy_list]
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            executor.map(print_single_stacked_Zvalue, repeat(output_folder), roi_xy_list, dc_list, offset_list, repeat(self.Nodata_value), repeat(doy_list))
+        scheduler = Tile_scheduler(self.ROI_array, nodata_value=-32768)
+        for _ in scheduler.map(print_stacked_Zvalue4tile, self.dc, output_folder, self.Nodata_value, doy_list, desc='Printing stacked Zvalue'):
+            pass
 
 
 class Landsat_dcs(object):
@@ -1889,7 +2279,7 @@ class Landsat_dcs(object):
                                     inundation_map_inundated_month_temp[(mndwi_dc_temp[:, :, np.argwhere(doy_temp == doy)]).reshape(mndwi_dc_temp.shape[0], -1) > self._MNDWI_threshold] = 2
                         inundation_map_inundated_month_temp[inundation_map_regular_month_temp == 1] = 1
                         inundation_map_inundated_month_temp[inundation_map_inundated_month_temp == 0] = 255
-                        remove_sole_pixel(inundation_map_inundated_month_temp, Nan_value=255, half_size_window=2)
+                        inundation_map_inundated_month_temp = remove_sole_pixel(inundation_map_inundated_month_temp, Nan_value=255, half_size_window=2)
                         MNDWI_temp_ds = gdal.Open((bf.file_filter(self.work_env + 'Landsat_clipped_MNDWI\\', ['MNDWI']))[0])
                         bf.write_raster(MNDWI_temp_ds, inundation_map_inundated_month_temp, self.inun_det_method_dic['rs_dem_inundation_folder'], str(year) + '_inundation_map.TIF')
                         self.inun_det_method_dic[str(year) + '_inundation_map'] = inundation_map_inundated_month_temp
@@ -1906,7 +2296,7 @@ class Landsat_dcs(object):
                             raise Exception('Please double check whether the yearly inundation map was properly generated!')
 
                         temp_array = ds_temp.GetRasterBand(1).ReadAsArray.astype(np.uint8)
-                        sole_water = identify_all_inundated_area(temp_array, nan_water_pixel_indicator=None)
+                        sole_water = identify_all_inundated_area_batch(temp_array)
                         bf.write_raster(ds_temp, sole_water, rs_dem_inundated_dic['rs_dem_inundation_folder'], str(year) + '_sole_water.TIF')
 
                 DEM_ds = gdal.Open(self._DEM_path + 'dem_' + self.ROI_name + '.tif')
@@ -1927,7 +2317,7 @@ class Landsat_dcs(object):
                         inundated_temp_band = inundated_ds_temp.GetRasterBand(1)
                         sole_temp_array = gdal_array.BandReadAsArray(sole_temp_band).astype(np.uint32)
                         inundated_temp_array = gdal_array.BandReadAsArray(inundated_temp_band).astype(np.uint8)
-                        inundated_array_ttt = complement_all_inundated_area(DEM_array, sole_temp_array, inundated_temp_array)
+                        inundated_array_ttt = complement_all_inundated_area_batch(DEM_array, sole_temp_array, inundated_temp_array)
                         bf.write_raster(DEM_ds, inundated_array_ttt, rs_dem_inundated_dic['inundation_folder'], str(year) + '_sole_water_fixed.TIF')
 
         elif not rs_dem_factor:
@@ -2819,9 +3209,9 @@ class Landsat_dcs(object):
                     if example_date in file:
                         example_ds = gdal.Open(file)
                         example_raster = example_ds.GetRasterBand(1).ReadAsArray()
-                        example_sole = identify_all_inundated_area(example_raster,
-                                                                   inundated_pixel_indicator=inundated_value,
-                                                                   nanvalue_pixel_indicator=nan_value)
+                        example_sole = identify_all_inundated_area_batch(example_raster,
+                                                                         inundated_pixel_indicator=inundated_value,
+                                                                         nanvalue_pixel_indicator=nan_value)
                         unique_sole = np.unique(example_sole.flatten())
                         unique_sole = np.delete(unique_sole, np.argwhere(unique_sole == 0))
                         amount_sole = [np.sum(example_sole == value) for value in unique_sole]
@@ -2859,31 +3249,28 @@ class Landsat_dcs(object):
                         inundation_dc[:, :, 0] = raster_temp3
                     else:
                         inundation_dc[:, :, num_temp] = raster_temp3
+                    num_temp += 1
+                date_dc = np.array(date_dc).transpose()
 
-                    if not os.path.exists(sole_file_path + str(date_temp) + '_individual_area.tif'):
-                        sole_floodplain_temp = identify_all_inundated_area(raster_temp3,
-                                                                           inundated_pixel_indicator=inundated_value,
-                                                                           nanvalue_pixel_indicator=nan_value)
-                        sole_result = np.zeros_like(sole_floodplain_temp)
-                        unique_value = np.unique(sole_floodplain_temp.flatten())
-                        unique_value = np.delete(unique_value, np.argwhere(unique_value == 0))
-                        for u_value in unique_value:
-                            if np.logical_and(sole_floodplain_temp == u_value, river_sample == 1).any():
-                                sole_result[sole_floodplain_temp == u_value] = 1
+                # The sole inundated area of all the dates without the individual area file is identified on the 3D stack at once
+                sole_area_dc = np.zeros_like(inundation_dc)
+                sole_date_list = [_ for _ in range(len(date_dc)) if not os.path.exists(sole_file_path + str(date_dc[_]) + '_individual_area.tif')]
+                if len(sole_date_list) > 0:
+                    sole_area_dc[:, :, sole_date_list] = identify_all_inundated_area_batch(inundation_dc[:, :, sole_date_list],
+                                                                                           inundated_pixel_indicator=inundated_value,
+                                                                                           nanvalue_pixel_indicator=nan_value)
+                for num_temp in range(len(date_dc)):
+                    if num_temp in sole_date_list:
+                        # The area connected to the river sample is kept, excluding the river itself
+                        sole_floodplain_temp = sole_area_dc[:, :, num_temp]
+                        river_value = np.unique(sole_floodplain_temp[river_sample == 1])
+                        sole_result = np.isin(sole_floodplain_temp, river_value[river_value != 0]).astype(np.int32)
                         sole_result[river_sample == 1] = 0
-                        bf.write_raster(ds_temp3, sole_result, sole_file_path, str(date_temp) + '_individual_area.tif',
+                        bf.write_raster(gdal.Open(inundation_file[num_temp]), sole_result, sole_file_path, str(date_dc[num_temp]) + '_individual_area.tif',
                                      raster_datatype=gdal.GDT_Int32)
                     else:
-                        sole_floodplain_ds_temp = gdal.Open(sole_file_path + str(date_temp) + '_individual_area.tif')
-                        sole_floodplain_temp = sole_floodplain_ds_temp.GetRasterBand(1).ReadAsArray()
-
-                    if sole_area_dc == []:
-                        sole_area_dc = np.zeros([raster_temp3.shape[0], raster_temp3.shape[1], len(inundation_file)])
-                        sole_area_dc[:, :, 0] = sole_floodplain_temp
-                    else:
-                        sole_area_dc[:, :, num_temp] = sole_floodplain_temp
-                    num_temp += 1
-                date_dc = np.array(date_dc).transpose()
+                        sole_floodplain_ds_temp = gdal.Open(sole_file_path + str(date_dc[num_temp]) + '_individual_area.tif')
+                        sole_area_dc[:, :, num_temp] = sole_floodplain_ds_temp.GetRasterBand(1).ReadAsArray()
 
                 if date_dc.shape[0] == sole_area_dc.shape[2] == inundation_dc.shape[2]:
                     np.save(output_folder + 'date_dc.npy', date_dc)
@@ -3513,12 +3900,11 @@ class Landsat_dcs(object):
                     bf.create_folder(annual_v_output_path)
                     bf.create_folder(annual_obs_path)
 
-                    flood_dc = copy.copy(self.Landsat_dcs[self.index_list.index(flood_indi)].dc)
-                    index_dc = copy.copy(self.Landsat_dcs[self.index_list.index(index)].dc)
+                    flood_dc = self.Landsat_dcs[self.index_list.index(flood_indi)].dc
+                    index_dc = self.Landsat_dcs[self.index_list.index(index)].dc
                     doy_dc = copy.copy(self.doy_list)
                     year_range = np.sort(np.unique(np.floor(doy_dc/1000)).astype(int))
 
-                    index_dc[flood_dc == 1] = np.nan
                     # initiate the cube
                     output_metrics = np.zeros([self.sa_map.shape[0], self.sa_map.shape[1], year_range.shape[0]]).astype(np.float16)
                     output_obs = np.zeros([self.sa_map.shape[0], self.sa_map.shape[1], year_range.shape[0]]).astype(np.int16)
@@ -3528,29 +3914,35 @@ class Landsat_dcs(object):
                                 output_metrics[y, x, :] = np.nan
                                 output_obs[y, x, :] = -32768
 
-                    for year in year_range:
-                        for y_t in range(index_dc.shape[0]):
-                            for x_t in range(index_dc.shape[1]):
-                                obs = doy_dc[np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
-                                index_temp = index_dc[y_t, x_t, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
-                                if False in np.isnan(index_temp):
-                                    if 90 < np.mod(obs[np.argwhere(index_temp == np.nanmax(index_temp))],1000)[0] < 210:
-                                        output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nanmax(index_temp)
-                                        output_obs[y_t, x_t, np.argwhere(year_range == year)] = obs[np.argwhere(index_temp == np.nanmax(index_temp))[0]]
-                                    else:
-                                        index_90_210 = np.delete(index_temp, np.argwhere(np.logical_and(90 < np.mod(obs, 1000), np.mod(obs, 1000) < 210)))
-                                        obs_90_210 = np.delete(obs, np.argwhere(np.logical_and(90 < np.mod(obs, 1000), np.mod(obs, 1000) < 210)))
-                                        if np.nanmax(index_90_210) >= 0.5:
-                                            output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nanmax(
-                                                index_90_210)
-                                            output_obs[y_t, x_t, np.argwhere(year_range == year)] = obs_90_210[
-                                                np.argwhere(index_90_210 == np.nanmax(index_90_210))[0]]
+                    # The VI and flood dcs are processed block by block, thus the dc larger than the memory is supported
+                    for window, (index_blk, flood_blk) in iter_dc_blocks(index_dc, flood_dc):
+                        index_blk[flood_blk == 1] = np.nan
+                        for year in year_range:
+                            for y_b in range(index_blk.shape[0]):
+                                for x_b in range(index_blk.shape[1]):
+                                    y_t, x_t = y_b + window['y_range'][0], x_b + window['x_range'][0]
+                                    obs = doy_dc[np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
+                                    index_temp = index_blk[y_b, x_b, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
+                                    if False in np.isnan(index_temp):
+                                        if 90 < np.mod(obs[np.argwhere(index_temp == np.nanmax(index_temp))],1000)[0] < 210:
+                                            output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nanmax(index_temp)
+                                            output_obs[y_t, x_t, np.argwhere(year_range == year)] = obs[np.argwhere(index_temp == np.nanmax(index_temp))[0]]
                                         else:
-                                            output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
-                                            output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
-                                else:
-                                    output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
-                                    output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
+                                            index_90_210 = np.delete(index_temp, np.argwhere(np.logical_and(90 < np.mod(obs, 1000), np.mod(obs, 1000) < 210)))
+                                            obs_90_210 = np.delete(obs, np.argwhere(np.logical_and(90 < np.mod(obs, 1000), np.mod(obs, 1000) < 210)))
+                                            if np.nanmax(index_90_210) >= 0.5:
+                                                output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nanmax(
+                                                    index_90_210)
+                                                output_obs[y_t, x_t, np.argwhere(year_range == year)] = obs_90_210[
+                                                    np.argwhere(index_90_210 == np.nanmax(index_90_210))[0]]
+                                            else:
+                                                output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
+                                                output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
+                                    else:
+                                        output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
+                                        output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
+
+                    for year in year_range:
                         bf.write_raster(gdal.Open(self.ds_file), output_obs[:, :, np.argwhere(year_range == year)].reshape([output_obs.shape[0], output_obs.shape[1]]), annual_obs_path, str(year) + '_obs_date.TIF', raster_datatype=gdal.GDT_Int16)
                         bf.write_raster(gdal.Open(self.ds_file), output_metrics[:, :, np.argwhere(year_range == year)].reshape([output_metrics.shape[0], output_metrics.shape[1]]), annual_output_path, str(year) + '_annual_maximum_VI.TIF', raster_datatype=gdal.GDT_Float32)
                         if year + 1 in year_range:
@@ -3572,8 +3964,8 @@ class Landsat_dcs(object):
                     bf.create_folder(annual_v_output_path)
                     bf.create_folder(annual_obs_path)
 
-                    index_dc = copy.copy(self.Landsat_dcs[self.index_list.index(index)].dc)
-                    inundated_dc = copy.copy(self.Landsat_dcs[self.index_list.index(flood_indi)].dc)
+                    index_dc = self.Landsat_dcs[self.index_list.index(index)].dc
+                    inundated_dc = self.Landsat_dcs[self.index_list.index(flood_indi)].dc
                     doy_dc = copy.copy(self.doy_list)
                     year_range = np.sort(np.unique(np.floor(doy_dc/1000)).astype(int))
 
@@ -3588,257 +3980,261 @@ class Landsat_dcs(object):
 
                     SPDL_para_dic = {}
 
-                    for year in year_range[0:-1]:
-                        for y_t in range(index_dc.shape[0]):
-                            for x_t in range(index_dc.shape[1]):
-                                current_year_obs = doy_dc[np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
-                                current_year_index_temp = index_dc[y_t, x_t, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
-                                current_year_inundated_temp = inundated_dc[y_t, x_t, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
-
-                                next_year_obs = doy_dc[np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
-                                next_year_index_temp = index_dc[
-                                    y_t, x_t, np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
-                                next_year_inundated_temp = inundated_dc[
-                                    y_t, x_t, np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
-
-                                if False in np.isnan(current_year_index_temp) and False in np.isnan(next_year_index_temp):
-                                    current_year_max_obs = current_year_obs[np.nanargmax(current_year_index_temp)]
-                                    current_year_inundated_status = 1 in current_year_inundated_temp[np.argwhere(current_year_obs >= current_year_max_obs)]
-
-                                    next_year_max_obs = next_year_obs[np.nanargmax(next_year_index_temp)]
-                                    next_year_inundated_status = 1 in next_year_inundated_temp[np.argwhere(next_year_obs >=next_year_max_obs)]
-
-                                    if 90 < np.mod(current_year_max_obs, 1000) < 200 and 90 < np.mod(next_year_max_obs, 1000) < 200:
-                                        if current_year_inundated_status or next_year_inundated_status:
-
-                                            if current_year_inundated_status:
-                                                for obs_temp in range(np.argwhere(current_year_obs == current_year_max_obs)[0][0], current_year_obs.shape[0]):
-                                                    if current_year_inundated_temp[obs_temp] == 1:
-                                                        current_year_date = current_year_obs[obs_temp] - current_year_max_obs
-                                            else:
-                                                current_year_date = 365
+                    # The VI and inundated dcs are processed block by block, thus the dc larger than the memory is supported
+                    for window, (index_blk, inundated_blk) in iter_dc_blocks(index_dc, inundated_dc):
+                        for year in year_range[0:-1]:
+                            for y_b in range(index_blk.shape[0]):
+                                for x_b in range(index_blk.shape[1]):
+                                    y_t, x_t = y_b + window['y_range'][0], x_b + window['x_range'][0]
+                                    current_year_obs = doy_dc[np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
+                                    current_year_index_temp = index_blk[y_b, x_b, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
+                                    current_year_inundated_temp = inundated_blk[y_b, x_b, np.argwhere(np.floor(doy_dc/1000) == year)].reshape([-1])
+
+                                    next_year_obs = doy_dc[np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
+                                    next_year_index_temp = index_blk[
+                                        y_b, x_b, np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
+                                    next_year_inundated_temp = inundated_blk[
+                                        y_b, x_b, np.argwhere(np.floor(doy_dc / 1000) == year + 1)].reshape([-1])
+
+                                    if False in np.isnan(current_year_index_temp) and False in np.isnan(next_year_index_temp):
+                                        current_year_max_obs = current_year_obs[np.nanargmax(current_year_index_temp)]
+                                        current_year_inundated_status = 1 in current_year_inundated_temp[np.argwhere(current_year_obs >= current_year_max_obs)]
+
+                                        next_year_max_obs = next_year_obs[np.nanargmax(next_year_index_temp)]
+                                        next_year_inundated_status = 1 in next_year_inundated_temp[np.argwhere(next_year_obs >=next_year_max_obs)]
+
+                                        if 90 < np.mod(current_year_max_obs, 1000) < 200 and 90 < np.mod(next_year_max_obs, 1000) < 200:
+                                            if current_year_inundated_status or next_year_inundated_status:
+
+                                                if current_year_inundated_status:
+                                                    for obs_temp in range(np.argwhere(current_year_obs == current_year_max_obs)[0][0], current_year_obs.shape[0]):
+                                                        if current_year_inundated_temp[obs_temp] == 1:
+                                                            current_year_date = current_year_obs[obs_temp] - current_year_max_obs
+                                                else:
+                                                    current_year_date = 365
 
-                                            if next_year_inundated_status:
-                                                for obs_temp in range(np.argwhere(next_year_obs == next_year_max_obs)[0][0], next_year_obs.shape[0]):
-                                                    if next_year_inundated_temp[obs_temp] == 1:
-                                                        next_year_date = next_year_obs[obs_temp] - next_year_max_obs
-                                            else:
-                                                next_year_date = 365
+                                                if next_year_inundated_status:
+                                                    for obs_temp in range(np.argwhere(next_year_obs == next_year_max_obs)[0][0], next_year_obs.shape[0]):
+                                                        if next_year_inundated_temp[obs_temp] == 1:
+                                                            next_year_date = next_year_obs[obs_temp] - next_year_max_obs
+                                                else:
+                                                    next_year_date = 365
 
-                                            if current_year_date >= next_year_date:
-                                                current_year_avim = np.nanmean(current_year_index_temp[np.argwhere(np.logical_and(current_year_obs >= current_year_max_obs, current_year_obs <= current_year_obs + next_year_date))])
-                                                next_year_avim = np.nanmean(next_year_index_temp[np.argwhere(np.logical_and(next_year_obs >= next_year_max_obs, next_year_obs <= next_year_obs + next_year_date))])
-                                            elif current_year_date < next_year_date:
-                                                current_year_avim = np.nanmean(current_year_index_temp[np.argwhere(np.logical_and(current_year_obs >= current_year_max_obs, current_year_obs <= current_year_obs + current_year_date))])
-                                                next_year_avim = np.nanmean(next_year_index_temp[np.argwhere(np.logical_and(next_year_obs >= next_year_max_obs, next_year_obs <= next_year_obs + current_year_date))])
+                                                if current_year_date >= next_year_date:
+                                                    current_year_avim = np.nanmean(current_year_index_temp[np.argwhere(np.logical_and(current_year_obs >= current_year_max_obs, current_year_obs <= current_year_obs + next_year_date))])
+                                                    next_year_avim = np.nanmean(next_year_index_temp[np.argwhere(np.logical_and(next_year_obs >= next_year_max_obs, next_year_obs <= next_year_obs + next_year_date))])
+                                                elif current_year_date < next_year_date:
+                                                    current_year_avim = np.nanmean(current_year_index_temp[np.argwhere(np.logical_and(current_year_obs >= current_year_max_obs, current_year_obs <= current_year_obs + current_year_date))])
+                                                    next_year_avim = np.nanmean(next_year_index_temp[np.argwhere(np.logical_and(next_year_obs >= next_year_max_obs, next_year_obs <= next_year_obs + current_year_date))])
 
-                                            output_metrics[y_t, x_t, np.argwhere(year_range == year)] = next_year_avim - current_year_avim
-                                            output_obs[y_t, x_t, np.argwhere(year_range == year)] = min(current_year_date, next_year_date)
-                                        else:
-                                            if f'{str(x_t)}_{str(y_t)}_para_ori' not in SPDL_para_dic.keys():
-                                                vi_all = index_dc[y_t, x_t, :].reshape([-1])
-                                                inundated_all = inundated_dc[y_t, x_t, :].reshape([-1])
-                                                vi_all[inundated_all == 1] = np.nan
-                                                doy_all = copy.copy(doy_dc)
-                                                doy_all = np.mod(doy_all, 1000)
-                                                doy_all = np.delete(doy_all, np.argwhere(np.isnan(vi_all)))
-                                                vi_all = np.delete(vi_all, np.argwhere(np.isnan(vi_all)))
-                                                paras, extras = curve_fit(seven_para_logistic_function, doy_all, vi_all,
-                                                                          maxfev=500000,
-                                                                          p0=[0.10, 0.8802, 108.2, 7.596, 311.4, 7.473, 0.00225],
-                                                                          bounds=([0.08, 0.7, 90, 6.2, 285, 4.5, 0.0015], [0.20, 1.0, 130, 11.5, 330, 8.8, 0.0028]))
-                                                SPDL_para_dic[str(x_t) + '_' + str(y_t) + '_para_ori'] = paras
-                                                vi_dormancy = []
-                                                doy_dormancy = []
-                                                vi_max = []
-                                                doy_max = []
-                                                doy_index_max = np.argmax(seven_para_logistic_function(np.linspace(0, 366, 365), paras[0],
-                                                                                  paras[1], paras[2], paras[3], paras[4],
-                                                                                  paras[5], paras[6]))
-                                                # Generate the parameter boundary
-                                                senescence_t = paras[4] - 4 * paras[5]
-                                                for doy_index in range(doy_all.shape[0]):
-                                                    if 0 < doy_all[doy_index] < paras[2] or paras[4] < doy_all[
-                                                        doy_index] < 366:
-                                                        vi_dormancy.append(vi_all[doy_index])
-                                                        doy_dormancy.append(doy_all[doy_index])
-                                                    if doy_index_max - 5 < doy_all[doy_index] < doy_index_max + 5:
-                                                        vi_max.append(vi_all[doy_index])
-                                                        doy_max.append(doy_all[doy_index])
-
-                                                if vi_max == []:
-                                                    vi_max = [np.max(vi_all)]
-                                                    doy_max = [doy_all[np.argmax(vi_all)]]
-
-                                                itr = 5
-                                                while itr < 10:
-                                                    doy_senescence = []
-                                                    vi_senescence = []
+                                                output_metrics[y_t, x_t, np.argwhere(year_range == year)] = next_year_avim - current_year_avim
+                                                output_obs[y_t, x_t, np.argwhere(year_range == year)] = min(current_year_date, next_year_date)
+                                            else:
+                                                if f'{str(x_t)}_{str(y_t)}_para_ori' not in SPDL_para_dic.keys():
+                                                    vi_all = index_blk[y_b, x_b, :].reshape([-1])
+                                                    inundated_all = inundated_blk[y_b, x_b, :].reshape([-1])
+                                                    vi_all[inundated_all == 1] = np.nan
+                                                    doy_all = copy.copy(doy_dc)
+                                                    doy_all = np.mod(doy_all, 1000)
+                                                    doy_all = np.delete(doy_all, np.argwhere(np.isnan(vi_all)))
+                                                    vi_all = np.delete(vi_all, np.argwhere(np.isnan(vi_all)))
+                                                    paras, extras = curve_fit(seven_para_logistic_function, doy_all, vi_all,
+                                                                              maxfev=500000,
+                                                                              p0=[0.10, 0.8802, 108.2, 7.596, 311.4, 7.473, 0.00225],
+                                                                              bounds=([0.08, 0.7, 90, 6.2, 285, 4.5, 0.0015], [0.20, 1.0, 130, 11.5, 330, 8.8, 0.0028]))
+                                                    SPDL_para_dic[str(x_t) + '_' + str(y_t) + '_para_ori'] = paras
+                                                    vi_dormancy = []
+                                                    doy_dormancy = []
+                                                    vi_max = []
+                                                    doy_max = []
+                                                    doy_index_max = np.argmax(seven_para_logistic_function(np.linspace(0, 366, 365), paras[0],
+                                                                                      paras[1], paras[2], paras[3], paras[4],
+                                                                                      paras[5], paras[6]))
+                                                    # Generate the parameter boundary
+                                                    senescence_t = paras[4] - 4 * paras[5]
                                                     for doy_index in range(doy_all.shape[0]):
-                                                        if senescence_t - itr < doy_all[doy_index] < senescence_t + itr:
-                                                            vi_senescence.append(vi_all[doy_index])
-                                                            doy_senescence.append(doy_all[doy_index])
-                                                    if doy_senescence != [] and vi_senescence != []:
-                                                        break
+                                                        if 0 < doy_all[doy_index] < paras[2] or paras[4] < doy_all[
+                                                            doy_index] < 366:
+                                                            vi_dormancy.append(vi_all[doy_index])
+                                                            doy_dormancy.append(doy_all[doy_index])
+                                                        if doy_index_max - 5 < doy_all[doy_index] < doy_index_max + 5:
+                                                            vi_max.append(vi_all[doy_index])
+                                                            doy_max.append(doy_all[doy_index])
+
+                                                    if vi_max == []:
+                                                        vi_max = [np.max(vi_all)]
+                                                        doy_max = [doy_all[np.argmax(vi_all)]]
+
+                                                    itr = 5
+                                                    while itr < 10:
+                                                        doy_senescence = []
+                                                        vi_senescence = []
+                                                        for doy_index in range(doy_all.shape[0]):
+                                                            if senescence_t - itr < doy_all[doy_index] < senescence_t + itr:
+                                                                vi_senescence.append(vi_all[doy_index])
+                                                                doy_senescence.append(doy_all[doy_index])
+                                                        if doy_senescence != [] and vi_senescence != []:
+                                                            break
+                                                        else:
+                                                            itr += 1
+
+                                                    # [0, 0.3, 0, 0, 180, 0, 0], [0.5, 1, 180, 20, 330, 10, 0.01]
+                                                    # define the para1
+                                                    if vi_dormancy != []:
+                                                        vi_dormancy_sort = np.sort(vi_dormancy)
+                                                        vi_max_sort = np.sort(vi_max)
+                                                        paras1_max = vi_dormancy_sort[
+                                                            int(np.fix(vi_dormancy_sort.shape[0] * 0.95))]
+                                                        paras1_min = vi_dormancy_sort[
+                                                            int(np.fix(vi_dormancy_sort.shape[0] * 0.05))]
+                                                        paras1_max = min(paras1_max, 0.5)
+                                                        paras1_min = max(paras1_min, 0)
                                                     else:
-                                                        itr += 1
-
-                                                # [0, 0.3, 0, 0, 180, 0, 0], [0.5, 1, 180, 20, 330, 10, 0.01]
-                                                # define the para1
-                                                if vi_dormancy != []:
-                                                    vi_dormancy_sort = np.sort(vi_dormancy)
-                                                    vi_max_sort = np.sort(vi_max)
-                                                    paras1_max = vi_dormancy_sort[
-                                                        int(np.fix(vi_dormancy_sort.shape[0] * 0.95))]
-                                                    paras1_min = vi_dormancy_sort[
-                                                        int(np.fix(vi_dormancy_sort.shape[0] * 0.05))]
-                                                    paras1_max = min(paras1_max, 0.5)
-                                                    paras1_min = max(paras1_min, 0)
-                                                else:
-                                                    paras1_max = 0.5
-                                                    paras1_min = 0
-
-                                                # define the para2
-                                                paras2_max = vi_max[-1] - paras1_min
-                                                paras2_min = vi_max[0] - paras1_max
-                                                if paras2_min < 0.2:
-                                                    paras2_min = 0.2
-                                                if paras2_max > 0.7 or paras2_max < 0.2:
-                                                    paras2_max = 0.7
-
-                                                # define the para3
-                                                paras3_max = 0
-                                                for doy_index in range(len(doy_all)):
-                                                    if paras1_min < vi_all[doy_index] < paras1_max and doy_all[
-                                                        doy_index] < 180:
-                                                        paras3_max = max(float(paras3_max), doy_all[doy_index])
-
-                                                paras3_min = 180
-                                                for doy_index in range(len(doy_all)):
-                                                    if vi_all[doy_index] > paras1_max:
-                                                        paras3_min = min(paras3_min, doy_all[doy_index])
-
-                                                if paras3_min > paras[2] or paras3_min < paras[2] - 15:
-                                                    paras3_min = paras[2] - 15
-
-                                                if paras3_max < paras[2] or paras3_max > paras[2] + 15:
-                                                    paras3_max = paras[2] + 15
-
-                                                # define the para5
-                                                paras5_max = 0
-                                                for doy_index in range(len(doy_all)):
-                                                    if vi_all[doy_index] > paras1_max:
-                                                        paras5_max = max(paras5_max, doy_all[doy_index])
-                                                paras5_min = 365
-                                                for doy_index in range(len(doy_all)):
-                                                    if paras1_min < vi_all[doy_index] < paras1_max and doy_all[
-                                                        doy_index] > 180:
-                                                        paras5_min = min(paras5_min, doy_all[doy_index])
-                                                if paras5_min > paras[4] or paras5_min < paras[4] - 15:
-                                                    paras5_min = paras[4] - 15
-
-                                                if paras5_max < paras[4] or paras5_max > paras[4] + 15:
-                                                    paras5_max = paras[4] + 15
-
-                                                # define the para 4
-                                                if len(doy_max) != 1:
-                                                    paras4_max = (np.nanmax(doy_max) - paras3_min) / 4
-                                                    paras4_min = (np.nanmin(doy_max) - paras3_max) / 4
-                                                else:
-                                                    paras4_max = (np.nanmax(doy_max) + 5 - paras3_min) / 4
-                                                    paras4_min = (np.nanmin(doy_max) - 5 - paras3_max) / 4
-                                                paras4_min = max(3, paras4_min)
-                                                paras4_max = min(17, paras4_max)
-                                                if paras4_min > 17:
-                                                    paras4_min = 3
-                                                if paras4_max < 3:
-                                                    paras4_max = 17
-                                                paras6_max = paras4_max
-                                                paras6_min = paras4_min
-                                                if doy_senescence == [] or vi_senescence == []:
-                                                    paras7_max = 0.01
-                                                    paras7_min = 0.00001
+                                                        paras1_max = 0.5
+                                                        paras1_min = 0
+
+                                                    # define the para2
+                                                    paras2_max = vi_max[-1] - paras1_min
+                                                    paras2_min = vi_max[0] - paras1_max
+                                                    if paras2_min < 0.2:
+                                                        paras2_min = 0.2
+                                                    if paras2_max > 0.7 or paras2_max < 0.2:
+                                                        paras2_max = 0.7
+
+                                                    # define the para3
+                                                    paras3_max = 0
+                                                    for doy_index in range(len(doy_all)):
+                                                        if paras1_min < vi_all[doy_index] < paras1_max and doy_all[
+                                                            doy_index] < 180:
+                                                            paras3_max = max(float(paras3_max), doy_all[doy_index])
+
+                                                    paras3_min = 180
+                                                    for doy_index in range(len(doy_all)):
+                                                        if vi_all[doy_index] > paras1_max:
+                                                            paras3_min = min(paras3_min, doy_all[doy_index])
+
+                                                    if paras3_min > paras[2] or paras3_min < paras[2] - 15:
+                                                        paras3_min = paras[2] - 15
+
+                                                    if paras3_max < paras[2] or paras3_max > paras[2] + 15:
+                                                        paras3_max = paras[2] + 15
+
+                                                    # define the para5
+                                                    paras5_max = 0
+                                                    for doy_index in range(len(doy_all)):
+                                                        if vi_all[doy_index] > paras1_max:
+                                                            paras5_max = max(paras5_max, doy_all[doy_index])
+                                                    paras5_min = 365
+                                                    for doy_index in range(len(doy_all)):
+                                                        if paras1_min < vi_all[doy_index] < paras1_max and doy_all[
+                                                            doy_index] > 180:
+                                                            paras5_min = min(paras5_min, doy_all[doy_index])
+                                                    if paras5_min > paras[4] or paras5_min < paras[4] - 15:
+                                                        paras5_min = paras[4] - 15
+
+                                                    if paras5_max < paras[4] or paras5_max > paras[4] + 15:
+                                                        paras5_max = paras[4] + 15
+
+                                                    # define the para 4
+                                                    if len(doy_max) != 1:
+                                                        paras4_max = (np.nanmax(doy_max) - paras3_min) / 4
+                                                        paras4_min = (np.nanmin(doy_max) - paras3_max) / 4
+                                                    else:
+                                                        paras4_max = (np.nanmax(doy_max) + 5 - paras3_min) / 4
+                                                        paras4_min = (np.nanmin(doy_max) - 5 - paras3_max) / 4
+                                                    paras4_min = max(3, paras4_min)
+                                                    paras4_max = min(17, paras4_max)
+                                                    if paras4_min > 17:
+                                                        paras4_min = 3
+                                                    if paras4_max < 3:
+                                                        paras4_max = 17
+                                                    paras6_max = paras4_max
+                                                    paras6_min = paras4_min
+                                                    if doy_senescence == [] or vi_senescence == []:
+                                                        paras7_max = 0.01
+                                                        paras7_min = 0.00001
+                                                    else:
+                                                        paras7_max = (np.nanmax(vi_max) - np.nanmin(vi_senescence)) / (
+                                                                    doy_senescence[np.argmin(vi_senescence)] - doy_max[
+                                                                np.argmax(vi_max)])
+                                                        paras7_min = (np.nanmin(vi_max) - np.nanmax(vi_senescence)) / (
+                                                                    doy_senescence[np.argmax(vi_senescence)] - doy_max[
+                                                                np.argmin(vi_max)])
+                                                    if np.isnan(paras7_min):
+                                                        paras7_min = 0.00001
+                                                    if np.isnan(paras7_max):
+                                                        paras7_max = 0.01
+                                                    paras7_max = min(paras7_max, 0.01)
+                                                    paras7_min = max(paras7_min, 0.00001)
+                                                    if paras7_max < 0.00001:
+                                                        paras7_max = 0.01
+                                                    if paras7_min > 0.01:
+                                                        paras7_min = 0.00001
+                                                    if paras1_min > paras[0]:
+                                                        paras1_min = paras[0] - 0.01
+                                                    if paras1_max < paras[0]:
+                                                        paras1_max = paras[0] + 0.01
+                                                    if paras2_min > paras[1]:
+                                                        paras2_min = paras[1] - 0.01
+                                                    if paras2_max < paras[1]:
+                                                        paras2_max = paras[1] + 0.01
+                                                    if paras3_min > paras[2]:
+                                                        paras3_min = paras[2] - 1
+                                                    if paras3_max < paras[2]:
+                                                        paras3_max = paras[2] + 1
+                                                    if paras4_min > paras[3]:
+                                                        paras4_min = paras[3] - 0.1
+                                                    if paras4_max < paras[3]:
+                                                        paras4_max = paras[3] + 0.1
+                                                    if paras5_min > paras[4]:
+                                                        paras5_min = paras[4] - 1
+                                                    if paras5_max < paras[4]:
+                                                        paras5_max = paras[4] + 1
+                                                    if paras6_min > paras[5]:
+                                                        paras6_min = paras[5] - 0.5
+                                                    if paras6_max < paras[5]:
+                                                        paras6_max = paras[5] + 0.5
+                                                    if paras7_min > paras[6]:
+                                                        paras7_min = paras[6] - 0.00001
+                                                    if paras7_max < paras[6]:
+                                                        paras7_max = paras[6] + 0.00001
+                                                    SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'] = (
+                                                    [paras1_min, paras2_min, paras3_min, paras4_min, paras5_min, paras6_min,
+                                                     paras7_min],
+                                                    [paras1_max, paras2_max, paras3_max, paras4_max, paras5_max, paras6_max,
+                                                     paras7_max])
+                                                current_year_index_temp[current_year_inundated_temp == 1] = np.nan
+                                                next_year_index_temp[next_year_inundated_temp == 1] = np.nan
+                                                if np.sum(~np.isnan(current_year_index_temp)) >= 7 and np.sum(~np.isnan(next_year_index_temp)) >= 7:
+                                                    current_year_obs_date = np.mod(current_year_obs, 1000)
+                                                    next_year_obs_date = np.mod(next_year_obs, 1000)
+                                                    current_year_obs_date = np.delete(current_year_obs_date, np.argwhere(np.isnan(current_year_index_temp)))
+                                                    next_year_obs_date = np.delete(next_year_obs_date, np.argwhere(np.isnan(next_year_index_temp)))
+                                                    current_year_index_temp = np.delete(current_year_index_temp, np.argwhere(np.isnan(current_year_index_temp)))
+                                                    next_year_index_temp = np.delete(next_year_index_temp, np.argwhere(np.isnan(next_year_index_temp)))
+                                                    paras1, extras1 = curve_fit(seven_para_logistic_function, current_year_obs_date, current_year_index_temp,
+                                                                              maxfev=500000,
+                                                                              p0=SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_ori'],
+                                                                              bounds= SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'])
+                                                    paras2, extras2 = curve_fit(seven_para_logistic_function, next_year_obs_date, next_year_index_temp,
+                                                                              maxfev=500000,
+                                                                              p0=SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_ori'],
+                                                                              bounds= SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'])
+                                                    current_year_avim = (paras1[0] + paras1[1] + seven_para_logistic_function(paras1[4] - 3 * paras1[5], paras1[0],paras1[1],paras1[2],paras1[3], paras1[4],paras1[5],paras1[6])) /2
+                                                    next_year_avim = (paras2[0] + paras2[1] + seven_para_logistic_function(paras2[4] - 3 * paras2[5], paras2[0], paras2[1], paras2[2], paras2[3], paras2[4], paras2[5], paras2[6])) / 2
+                                                    output_metrics[y_t, x_t, np.argwhere(year_range == year)] = next_year_avim - current_year_avim
+                                                    output_obs[y_t, x_t, np.argwhere(year_range == year)] = 365
                                                 else:
-                                                    paras7_max = (np.nanmax(vi_max) - np.nanmin(vi_senescence)) / (
-                                                                doy_senescence[np.argmin(vi_senescence)] - doy_max[
-                                                            np.argmax(vi_max)])
-                                                    paras7_min = (np.nanmin(vi_max) - np.nanmax(vi_senescence)) / (
-                                                                doy_senescence[np.argmax(vi_senescence)] - doy_max[
-                                                            np.argmin(vi_max)])
-                                                if np.isnan(paras7_min):
-                                                    paras7_min = 0.00001
-                                                if np.isnan(paras7_max):
-                                                    paras7_max = 0.01
-                                                paras7_max = min(paras7_max, 0.01)
-                                                paras7_min = max(paras7_min, 0.00001)
-                                                if paras7_max < 0.00001:
-                                                    paras7_max = 0.01
-                                                if paras7_min > 0.01:
-                                                    paras7_min = 0.00001
-                                                if paras1_min > paras[0]:
-                                                    paras1_min = paras[0] - 0.01
-                                                if paras1_max < paras[0]:
-                                                    paras1_max = paras[0] + 0.01
-                                                if paras2_min > paras[1]:
-                                                    paras2_min = paras[1] - 0.01
-                                                if paras2_max < paras[1]:
-                                                    paras2_max = paras[1] + 0.01
-                                                if paras3_min > paras[2]:
-                                                    paras3_min = paras[2] - 1
-                                                if paras3_max < paras[2]:
-                                                    paras3_max = paras[2] + 1
-                                                if paras4_min > paras[3]:
-                                                    paras4_min = paras[3] - 0.1
-                                                if paras4_max < paras[3]:
-                                                    paras4_max = paras[3] + 0.1
-                                                if paras5_min > paras[4]:
-                                                    paras5_min = paras[4] - 1
-                                                if paras5_max < paras[4]:
-                                                    paras5_max = paras[4] + 1
-                                                if paras6_min > paras[5]:
-                                                    paras6_min = paras[5] - 0.5
-                                                if paras6_max < paras[5]:
-                                                    paras6_max = paras[5] + 0.5
-                                                if paras7_min > paras[6]:
-                                                    paras7_min = paras[6] - 0.00001
-                                                if paras7_max < paras[6]:
-                                                    paras7_max = paras[6] + 0.00001
-                                                SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'] = (
-                                                [paras1_min, paras2_min, paras3_min, paras4_min, paras5_min, paras6_min,
-                                                 paras7_min],
-                                                [paras1_max, paras2_max, paras3_max, paras4_max, paras5_max, paras6_max,
-                                                 paras7_max])
-                                            current_year_index_temp[current_year_inundated_temp == 1] = np.nan
-                                            next_year_index_temp[next_year_inundated_temp == 1] = np.nan
-                                            if np.sum(~np.isnan(current_year_index_temp)) >= 7 and np.sum(~np.isnan(next_year_index_temp)) >= 7:
-                                                current_year_obs_date = np.mod(current_year_obs, 1000)
-                                                next_year_obs_date = np.mod(next_year_obs, 1000)
-                                                current_year_obs_date = np.delete(current_year_obs_date, np.argwhere(np.isnan(current_year_index_temp)))
-                                                next_year_obs_date = np.delete(next_year_obs_date, np.argwhere(np.isnan(next_year_index_temp)))
-                                                current_year_index_temp = np.delete(current_year_index_temp, np.argwhere(np.isnan(current_year_index_temp)))
-                                                next_year_index_temp = np.delete(next_year_index_temp, np.argwhere(np.isnan(next_year_index_temp)))
-                                                paras1, extras1 = curve_fit(seven_para_logistic_function, current_year_obs_date, current_year_index_temp,
-                                                                          maxfev=500000,
-                                                                          p0=SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_ori'],
-                                                                          bounds= SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'])
-                                                paras2, extras2 = curve_fit(seven_para_logistic_function, next_year_obs_date, next_year_index_temp,
-                                                                          maxfev=500000,
-                                                                          p0=SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_ori'],
-                                                                          bounds= SPDL_para_dic[f'{str(x_t)}_{str(y_t)}_para_boundary'])
-                                                current_year_avim = (paras1[0] + paras1[1] + seven_para_logistic_function(paras1[4] - 3 * paras1[5], paras1[0],paras1[1],paras1[2],paras1[3], paras1[4],paras1[5],paras1[6])) /2
-                                                next_year_avim = (paras2[0] + paras2[1] + seven_para_logistic_function(paras2[4] - 3 * paras2[5], paras2[0], paras2[1], paras2[2], paras2[3], paras2[4], paras2[5], paras2[6])) / 2
-                                                output_metrics[y_t, x_t, np.argwhere(year_range == year)] = next_year_avim - current_year_avim
-                                                output_obs[y_t, x_t, np.argwhere(year_range == year)] = 365
-                                            else:
-                                                output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
-                                                output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
+                                                    output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
+                                                    output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
+                                        else:
+                                            output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
+                                            output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
                                     else:
                                         output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
                                         output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
-                                else:
-                                    output_metrics[y_t, x_t, np.argwhere(year_range == year)] = np.nan
-                                    output_obs[y_t, x_t, np.argwhere(year_range == year)] = -32768
 
+                    for year in year_range[0:-1]:
                         bf.write_raster(gdal.Open(self.ds_file), output_obs[:, :, np.argwhere(year_range == year)].reshape([output_obs.shape[0], output_obs.shape[1]]), annual_obs_path, str(year) + '_' + str(year+1) + '_obs_duration.TIF', raster_datatype=gdal.GDT_Int16)
                         bf.write_raster(gdal.Open(self.ds_file), output_metrics[:, :, np.argwhere(year_range == year)].reshape([output_metrics.shape[0], output_metrics.shape[1]]), annual_v_output_path, str(year) + '_' + str(year+1) + '_AVIM_variation.TIF', raster_datatype=gdal.GDT_Float32)
 
@@ -3909,167 +4305,26 @@ class Landsat_dcs(object):
         # Generate the initial parameter
         if not os.path.exists(output_path + 'para_boundary.npy'):
             doy_all_s = np.mod(doy_dc, 1000)
+            para_num = self._curve_fitting_dic['para_num']
             for y_t in range(index_dc.shape[0]):
-                for x_t in range(index_dc.shape[1]):
-                    if self.sa_map[y_t, x_t] != -32768:
-                        vi_all = index_dc[y_t, x_t, :].flatten()
-                        doy_all = copy.copy(doy_all_s)
-                        vi_index = 0
-                        while vi_index < vi_all.shape[0]:
-                            if np.isnan(vi_all[vi_index]):
-                                vi_all = np.delete(vi_all, vi_index)
-                                doy_all = np.delete(doy_all, vi_index)
-                                vi_index -= 1
-                            vi_index += 1
-                        if doy_all.shape[0] >= 7:
-                            paras, extras = curve_fit(self._curve_fitting_algorithm, doy_all, vi_all, maxfev=500000, p0=self._curve_fitting_dic['initial_para_ori'], bounds=self._curve_fitting_dic['initial_para_boundary'])
-                            self._curve_fitting_dic[str(x_t) + '_' + str(y_t) + '_para_ori'] = paras
-                            vi_dormancy = []
-                            doy_dormancy = []
-                            vi_max = []
-                            doy_max = []
-                            doy_index_max = np.argmax(self._curve_fitting_algorithm(np.linspace(0,366,365), paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6]))
-                            # Generate the parameter boundary
-                            senescence_t = paras[4] - 4 * paras[5]
-                            for doy_index in range(doy_all.shape[0]):
-                                if 0 < doy_all[doy_index] < paras[2] or paras[4] < doy_all[doy_index] < 366:
-                                    vi_dormancy.append(vi_all[doy_index])
-                                    doy_dormancy.append(doy_all[doy_index])
-                                if doy_index_max - 5 < doy_all[doy_index] < doy_index_max + 5:
-                                    vi_max.append(vi_all[doy_index])
-                                    doy_max.append(doy_all[doy_index])
-
-                            if vi_max == []:
-                                vi_max = [np.max(vi_all)]
-                                doy_max = [doy_all[np.argmax(vi_all)]]
-
-                            itr = 5
-                            while itr < 10:
-                                doy_senescence = []
-                                vi_senescence = []
-                                for doy_index in range(doy_all.shape[0]):
-                                    if senescence_t - itr < doy_all[doy_index] < senescence_t + itr:
-                                        vi_senescence.append(vi_all[doy_index])
-                                        doy_senescence.append(doy_all[doy_index])
-                                if doy_senescence != [] and vi_senescence != []:
-                                    break
-                                else:
-                                    itr += 1
-
-                            # [0, 0.3, 0, 0, 180, 0, 0], [0.5, 1, 180, 20, 330, 10, 0.01]
-                            # define the para1
-                            if vi_dormancy != []:
-                                vi_dormancy_sort = np.sort(vi_dormancy)
-                                vi_max_sort = np.sort(vi_max)
-                                paras1_max = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.95))]
-                                paras1_min = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.05))]
-                                paras1_max = min(paras1_max, 0.5)
-                                paras1_min = max(paras1_min, 0)
-                            else:
-                                paras1_max = 0.5
-                                paras1_min = 0
-
-                            # define the para2
-                            paras2_max = vi_max[-1] - paras1_min
-                            paras2_min = vi_max[0] - paras1_max
-                            if paras2_min < 0.2:
-                                paras2_min = 0.2
-                            if paras2_max > 0.7 or paras2_max < 0.2:
-                                paras2_max = 0.7
-
-                            # define the para3
-                            paras3_max = 0
-                            for doy_index in range(len(doy_all)):
-                                if paras1_min < vi_all[doy_index] < paras1_max and doy_all[doy_index] < 180:
-                                    paras3_max = max(float(paras3_max), doy_all[doy_index])
-
-                            paras3_min = 180
-                            for doy_index in range(len(doy_all)):
-                                if vi_all[doy_index] > paras1_max:
-                                    paras3_min = min(paras3_min, doy_all[doy_index])
-
-                            if paras3_min > paras[2] or paras3_min < paras[2] - 15:
-                                paras3_min = paras[2] - 15
-
-                            if paras3_max < paras[2] or paras3_max > paras[2] + 15:
-                                paras3_max = paras[2] + 15
-
-                            # define the para5
-                            paras5_max = 0
-                            for doy_index in range(len(doy_all)):
-                                if vi_all[doy_index] > paras1_max:
-                                    paras5_max = max(paras5_max, doy_all[doy_index])
-                            paras5_min = 365
-                            for doy_index in range(len(doy_all)):
-                                if paras1_min < vi_all[doy_index] < paras1_max and doy_all[doy_index] > 180:
-                                    paras5_min = min(paras5_min, doy_all[doy_index])
-                            if paras5_min > paras[4] or paras5_min < paras[4] - 15:
-                                paras5_min = paras[4] - 15
-
-                            if paras5_max < paras[4] or paras5_max > paras[4] + 15:
-                                paras5_max = paras[4] + 15
-
-                            # define the para 4
-                            if len(doy_max) != 1:
-                                paras4_max = (np.nanmax(doy_max) - paras3_min) / 4
-                                paras4_min = (np.nanmin(doy_max) - paras3_max) / 4
-                            else:
-                                paras4_max = (np.nanmax(doy_max) + 5 - paras3_min) / 4
-                                paras4_min = (np.nanmin(doy_max) - 5 - paras3_max) / 4
-                            paras4_min = max(3, paras4_min)
-                            paras4_max = min(17, paras4_max)
-                            if paras4_min > 17:
-                                paras4_min = 3
-                            if paras4_max < 3:
-                                paras4_max = 17
-                            paras6_max = paras4_max
-                            paras6_min = paras4_min
-                            if doy_senescence == [] or vi_senescence == []:
-                                paras7_max = 0.01
-                                paras7_min = 0.00001
-                            else:
-                                paras7_max = (np.nanmax(vi_max) - np.nanmin(vi_senescence)) / (doy_senescence[np.argmin(vi_senescence)] - doy_max[np.argmax(vi_max)])
-                                paras7_min = (np.nanmin(vi_max) - np.nanmax(vi_senescence)) / (doy_senescence[np.argmax(vi_senescence)] - doy_max[np.argmin(vi_max)])
-                            if np.isnan(paras7_min):
-                                paras7_min = 0.00001
-                            if np.isnan(paras7_max):
-                                paras7_max = 0.01
-                            paras7_max = min(paras7_max, 0.01)
-                            paras7_min = max(paras7_min, 0.00001)
-                            if paras7_max < 0.00001:
-                                paras7_max = 0.01
-                            if paras7_min > 0.01:
-                                paras7_min = 0.00001
-                            if paras1_min > paras[0]:
-                                paras1_min = paras[0] - 0.01
-                            if paras1_max < paras[0]:
-                                paras1_max = paras[0] + 0.01
-                            if paras2_min > paras[1]:
-                                paras2_min = paras[1] - 0.01
-                            if paras2_max < paras[1]:
-                                paras2_max = paras[1] + 0.01
-                            if paras3_min > paras[2]:
-                                paras3_min = paras[2] - 1
-                            if paras3_max < paras[2]:
-                                paras3_max = paras[2] + 1
-                            if paras4_min > paras[3]:
-                                paras4_min = paras[3] - 0.1
-                            if paras4_max < paras[3]:
-                                paras4_max = paras[3] + 0.1
-                            if paras5_min > paras[4]:
-                                paras5_min = paras[4] - 1
-                            if paras5_max < paras[4]:
-                                paras5_max = paras[4] + 1
-                            if paras6_min > paras[5]:
-                                paras6_min = paras[5] - 0.5
-                            if paras6_max < paras[5]:
-                                paras6_max = paras[5] + 0.5
-                            if paras7_min > paras[6]:
-                                paras7_min = paras[6] - 0.00001
-                            if paras7_max < paras[6]:
-                                paras7_max = paras[6] + 0.00001
-                            self._curve_fitting_dic['para_boundary_' + str(y_t) + '_' + str(x_t)] = ([paras1_min, paras2_min, paras3_min, paras4_min, paras5_min, paras6_min, paras7_min], [paras1_max, paras2_max,  paras3_max,  paras4_max,  paras5_max,  paras6_max,  paras7_max])
-                            self._curve_fitting_dic['para_ori_' + str(y_t) + '_' + str(x_t)] = [paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6]]
+
+                # Fit all the observations of the pixels in the row with at least seven valid observations in one batch
+                vi_row = np.array(index_dc[y_t, :, :], dtype=np.float64)
+                fit_x = np.argwhere((self.sa_map[y_t, :] != -32768) & (np.sum(~np.isnan(vi_row), axis=1) >= 7)).flatten()
+                if fit_x.shape[0] == 0:
+                    continue
+                paras_all, converged_all, r_square_all = batch_curve_fit(doy_all_s, vi_row[fit_x], self._curve_fitting_dic['CFM'], self._curve_fitting_dic['initial_para_ori'], self._curve_fitting_dic['initial_para_boundary'])
+
+                # Generate the per-pixel parameter boundary (the infeasible pixel is not recorded as curve_fit raised for it)
+                for _, x_t in enumerate(fit_x):
+                    if np.isnan(r_square_all[_]):
+                        continue
+                    paras = paras_all[_]
+                    valid_pos = ~np.isnan(vi_row[x_t])
+                    paras_min, paras_max = curfit_bound_by_paras(doy_all_s[valid_pos], vi_row[x_t][valid_pos], paras, self._curve_fitting_algorithm, para_num)
+                    self._curve_fitting_dic[str(x_t) + '_' + str(y_t) + '_para_ori'] = paras
+                    self._curve_fitting_dic['para_boundary_' + str(y_t) + '_' + str(x_t)] = (list(paras_min), list(paras_max))
+                    self._curve_fitting_dic['para_ori_' + str(y_t) + '_' + str(x_t)] = list(paras)
             np.save(output_path + 'para_boundary.npy', self._curve_fitting_dic)
         else:
             self._curve_fitting_dic = np.load(output_path + 'para_boundary.npy', allow_pickle=True).item()
@@ -4085,25 +4340,27 @@ class Landsat_dcs(object):
                 annual_doy = doy_dc[np.min(np.argwhere(doy_dc // 1000 == year)): np.max(np.argwhere(doy_dc // 1000 == year)) + 1]
                 annual_doy = np.mod(annual_doy, 1000)
 
+                para_num = self._curve_fitting_dic['para_num']
+                annual_para_dc[self.sa_map == -32768] = np.nan
                 for y_temp in range(annual_vi.shape[0]):
-                    for x_temp in range(annual_vi.shape[1]):
-                        if self.sa_map[y_temp, x_temp] != -32768:
-                            vi_temp = annual_vi[y_temp, x_temp, :]
-                            nan_index = np.argwhere(np.isnan(vi_temp))
-                            vi_temp = np.delete(vi_temp, nan_index)
-                            doy_temp = np.delete(annual_doy, nan_index)
-                            if np.sum(~np.isnan(vi_temp)) >= self._curve_fitting_dic['para_num']:
-                                try:
-                                    paras, extras = curve_fit(self._curve_fitting_algorithm, doy_temp, vi_temp, maxfev=50000, p0=self._curve_fitting_dic['para_ori_' + str(y_temp) + '_' + str(x_temp)], bounds=self._curve_fitting_dic['para_boundary_' + str(y_temp) + '_' + str(x_temp)])
-                                    predicted_y_data = self._curve_fitting_algorithm(doy_temp, paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6])
-                                    R_square = (1 - np.sum((predicted_y_data - vi_temp) ** 2) / np.sum((vi_temp - np.mean(vi_temp)) ** 2))
-                                    annual_para_dc[y_temp, x_temp, :] = np.append(paras, R_square)
-                                except:
-                                    pass
-                            else:
-                                annual_para_dc[y_temp, x_temp, :] = np.nan
-                        else:
-                            annual_para_dc[y_temp, x_temp, :] = np.nan
+                    vi_row = np.array(annual_vi[y_temp, :, :], dtype=np.float64)
+                    valid_x = np.argwhere(self.sa_map[y_temp, :] != -32768).flatten()
+                    annual_para_dc[y_temp, valid_x[np.sum(~np.isnan(vi_row[valid_x]), axis=1) < para_num], :] = np.nan
+
+                    # Fit the annual observations of the row with the per-pixel boundary in one batch
+                    fit_x = [x_temp for x_temp in valid_x if np.sum(~np.isnan(vi_row[x_temp])) >= para_num
+                             and 'para_ori_' + str(y_temp) + '_' + str(x_temp) in self._curve_fitting_dic.keys()]
+                    if len(fit_x) == 0:
+                        continue
+                    fit_x = np.array(fit_x)
+                    p0 = np.array([self._curve_fitting_dic['para_ori_' + str(y_temp) + '_' + str(x_temp)] for x_temp in fit_x])
+                    lower = np.array([self._curve_fitting_dic['para_boundary_' + str(y_temp) + '_' + str(x_temp)][0] for x_temp in fit_x])
+                    upper = np.array([self._curve_fitting_dic['para_boundary_' + str(y_temp) + '_' + str(x_temp)][1] for x_temp in fit_x])
+                    paras, converged, r_square = batch_curve_fit(annual_doy, vi_row[fit_x], self._curve_fitting_dic['CFM'], p0, (lower, upper))
+
+                    # The pixel failed in fitting is left as zero as before
+                    fitted = ~np.isnan(r_square)
+                    annual_para_dc[y_temp, fit_x[fitted], :] = np.concatenate([paras[fitted], r_square[fitted, None]], axis=1)
                 annual_cf_para_dic[str(year) + '_cf_para'] = annual_para_dc
             np.save(output_path + 'annual_cf_para.npy', annual_cf_para_dic)
             np.save(output_path + 'year.npy', year_list)
@@ -4391,10 +4648,10 @@ class Landsat_dcs(object):
 
             # Define vi dc
             vi_doy = copy.copy(self.doy_list)
-            vi_sdc = copy.copy(self.Landsat_dcs[self.index_list.index(vi_temp)].dc)
+            vi_sdc = self.Landsat_dcs[self.index_list.index(vi_temp)].dc
 
             # Define inundated dic
-            inundated_sdc = copy.copy(self.Landsat_dcs[self.index_list.index(flood_mapping_method)].dc)
+            inundated_sdc = self.Landsat_dcs[self.index_list.index(flood_mapping_method)].dc
             inundated_doy = copy.copy(self.doy_list)
 
             # Process the phenology
@@ -4403,16 +4660,12 @@ class Landsat_dcs(object):
             bf.create_folder(NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'])
             bf.create_folder(NIPY_para_path)
 
-            # Preprocess the VI sdc
+            # The position of the inundated doy in the VI sdc, the VI is masked by the inundation block by block in the main process
+            vi_pos_list = []
             for inundated_doy_index in range(inundated_doy.shape[0]):
                 vi_doy_index = np.argwhere(vi_doy == inundated_doy[inundated_doy_index])
                 if vi_doy_index.size == 1:
-                    vi_array_temp = vi_sdc[:, :, vi_doy_index[0]].reshape([vi_sdc.shape[0], vi_sdc.shape[1]])
-                    inundated_array_temp = inundated_sdc[:, :, inundated_doy_index].reshape(
-                        [inundated_sdc.shape[0], inundated_sdc.shape[1]])
-                    vi_array_temp[inundated_array_temp > 0] = np.nan
-                    vi_array_temp[vi_array_temp <= 0] = np.nan
-                    vi_sdc[:, :, vi_doy_index[0]] = vi_array_temp.reshape([vi_sdc.shape[0], vi_sdc.shape[1], 1])
+                    vi_pos_list.append(int(vi_doy_index[0][0]))
                 else:
                     print('Inundated dc has doy can not be found in vi dc')
                     sys.exit(-1)
@@ -4428,119 +4681,139 @@ class Landsat_dcs(object):
 
                 year_list = [int(i[i.find('.TIF') - 4: i.find('.TIF')]) for i in bf.file_filter(annual_inundated_path, ['.TIF'])]
                 NIPY_header = {'ROI_name': self.ROI_name, 'VI': f'{vi_temp}_NIPY', 'Datatype': self.Datatype, 'ROI': self.ROI, 'Study_area': self.sa_map, 'ds_file': self.ds_file, 'sdc_factor': self.sdc_factor}
-                NIPY_vi_dc = []
-                NIPY_doy = []
+                annual_inundated_list = [gdal.Open(bf.file_filter(annual_inundated_path, ['.TIF', str(year_temp)], and_or_factor='and')[0]).GetRasterBand(1).ReadAsArray() for year_temp in year_list]
+
+                # The annual NIPY dc of each year is written into a memory-mapped temporary cube, the day valid in any pixel is recorded
+                NIPY_temp_list, annual_NIPY_list, annual_valid_list = [], [], []
                 for i in range(1, len(year_list)):
-                    current_year_inundated_temp_ds = gdal.Open(bf.file_filter(annual_inundated_path, ['.TIF', str(year_list[i])], and_or_factor='and')[0])
-                    current_year_inundated_temp_array = current_year_inundated_temp_ds.GetRasterBand(1).ReadAsArray()
-                    last_year_inundated_temp_ds = gdal.Open(bf.file_filter(annual_inundated_path, ['.TIF', str(year_list[i - 1])], and_or_factor='and')[0])
-                    last_year_inundated_temp_array = last_year_inundated_temp_ds.GetRasterBand(1).ReadAsArray()
-                    NIPY_temp = np.zeros([current_year_inundated_temp_array.shape[0], current_year_inundated_temp_array.shape[1], 2])
-                    annual_NIPY_dc = np.zeros([vi_sdc.shape[0], vi_sdc.shape[1], 366]) * np.nan
-                    annual_NIPY_doy = np.linspace(1, 366, 366) + year_list[i] * 1000
-                    doy_init = np.min(np.argwhere(inundated_doy//1000 == year_list[i]))
-                    doy_init_f = np.min(np.argwhere(inundated_doy//1000 == year_list[i - 1]))
-                    for y_temp in range(vi_sdc.shape[0]):
-                        for x_temp in range(vi_sdc.shape[1]):
-
-                            # Obtain the doy beg and end for current year
-                            doy_end_current = np.nan
-                            doy_beg_current = np.nan
-                            if self.sa_map[y_temp, x_temp] == -32768:
-                                NIPY_temp[y_temp, x_temp, 0] = doy_beg_current
-                                NIPY_temp[y_temp, x_temp, 1] = doy_end_current
-                            else:
-                                if current_year_inundated_temp_array[y_temp, x_temp] > 0:
-                                    # Determine the doy_end_current
+                    NIPY_temp_list.append(np.zeros([vi_sdc.shape[0], vi_sdc.shape[1], 2]))
+                    annual_NIPY_list.append(np.lib.format.open_memmap(NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'] + f'{str(year_list[i])}_NIPY_annual_tmp.npy', mode='w+', dtype=np.float64, shape=(vi_sdc.shape[0], vi_sdc.shape[1], 366)))
+                    annual_valid_list.append(np.zeros(366, dtype=bool))
+
+                # The VI and inundated dcs are processed block by block, thus the dc larger than the memory is supported
+                for window, (vi_blk, inundated_blk) in iter_dc_blocks(vi_sdc, inundated_sdc):
+
+                    # Preprocess the VI block
+                    for inundated_doy_index, vi_doy_index in enumerate(vi_pos_list):
+                        vi_array_temp = vi_blk[:, :, vi_doy_index]
+                        vi_array_temp[inundated_blk[:, :, inundated_doy_index] > 0] = np.nan
+                        vi_array_temp[vi_array_temp <= 0] = np.nan
+
+                    for i in range(1, len(year_list)):
+                        current_year_inundated_temp_array, last_year_inundated_temp_array = annual_inundated_list[i], annual_inundated_list[i - 1]
+                        NIPY_temp = NIPY_temp_list[i - 1]
+                        annual_blk = np.zeros([vi_blk.shape[0], vi_blk.shape[1], 366]) * np.nan
+                        doy_init = np.min(np.argwhere(inundated_doy//1000 == year_list[i]))
+                        doy_init_f = np.min(np.argwhere(inundated_doy//1000 == year_list[i - 1]))
+                        for y_b in range(vi_blk.shape[0]):
+                            for x_b in range(vi_blk.shape[1]):
+                                y_temp, x_temp = y_b + window['y_range'][0], x_b + window['x_range'][0]
+
+
+                                # Obtain the doy beg and end for current year
+                                doy_end_current = np.nan
+                                doy_beg_current = np.nan
+                                if self.sa_map[y_temp, x_temp] == -32768:
+                                    NIPY_temp[y_temp, x_temp, 0] = doy_beg_current
+                                    NIPY_temp[y_temp, x_temp, 1] = doy_end_current
+                                else:
+                                    if current_year_inundated_temp_array[y_temp, x_temp] > 0:
+                                        # Determine the doy_end_current
+                                        # time_s = time.time()
+                                        doy_end_factor = False
+                                        doy_index = doy_init
+                                        while doy_index < inundated_doy.shape[0]:
+                                            if int(inundated_doy[doy_index] // 1000) == year_list[i] and inundated_blk[y_b, x_b, doy_index] == 1 and 285 >= np.mod(inundated_doy[doy_index], 1000) >= 152:
+                                                doy_end_current = inundated_doy[doy_index]
+                                                doy_end_factor = True
+                                                break
+                                            elif int(inundated_doy[doy_index] // 1000) > year_list[i]:
+                                                doy_end_current = year_list[i] * 1000 + 366
+                                                doy_beg_current = year_list[i] * 1000
+                                                break
+                                            doy_index += 1
+
+                                        # check the doy index
+                                        if doy_index == 0:
+                                            print('Unknown error during phenology processing doy_end_current generation!')
+                                            sys.exit(-1)
+                                        # p1_time = p1_time + time.time() - time_s
+
+                                        # Determine the doy_beg_current
+                                        # time_s = time.time()
+                                        if doy_end_factor:
+                                            if last_year_inundated_temp_array[y_temp, x_temp] > 0:
+                                                while doy_index <= inundated_doy.shape[0]:
+                                                    if int(inundated_doy[doy_index - 1] // 1000) == year_list[i - 1] and inundated_blk[y_b, x_b, doy_index - 1] == 1:
+                                                        break
+                                                    doy_index -= 1
+                                                if doy_index == inundated_doy.shape[0]:
+                                                    print('Unknown error during phenology processing doy_beg_current generation!')
+                                                    sys.exit(-1)
+                                                else:
+                                                    doy_beg_current = inundated_doy[doy_index]
+                                                # Make sure doy beg temp < doy end temp - 1000
+                                                if doy_beg_current < doy_end_current - 1000 or np.isnan(doy_beg_current):
+                                                    doy_beg_current = doy_end_current - 1000
+                                            elif last_year_inundated_temp_array[y_temp, x_temp] == 0:
+                                                doy_beg_current = doy_end_current - 1000
+                                        # p2_time = p2_time + time.time() - time_s
+                                    elif current_year_inundated_temp_array[y_temp, x_temp] == 0:
+                                        doy_end_current = year_list[i] * 1000 + 366
+                                        doy_beg_current = year_list[i] * 1000
                                     # time_s = time.time()
-                                    doy_end_factor = False
-                                    doy_index = doy_init
-                                    while doy_index < inundated_doy.shape[0]:
-                                        if int(inundated_doy[doy_index] // 1000) == year_list[i] and inundated_sdc[y_temp, x_temp, doy_index] == 1 and 285 >= np.mod(inundated_doy[doy_index], 1000) >= 152:
-                                            doy_end_current = inundated_doy[doy_index]
-                                            doy_end_factor = True
-                                            break
-                                        elif int(inundated_doy[doy_index] // 1000) > year_list[i]:
-                                            doy_end_current = year_list[i] * 1000 + 366
-                                            doy_beg_current = year_list[i] * 1000
+
+                                    # Construct NIPY_vi_dc
+                                    doy_f = doy_init_f
+                                    while doy_f <= inundated_doy.shape[0] - 1:
+                                        if doy_end_current > inundated_doy[doy_f] > doy_beg_current:
+                                            doy_index_f = np.argwhere(vi_doy == inundated_doy[doy_f])
+                                            doy_temp = int(np.mod(inundated_doy[doy_f], 1000))
+                                            if not np.isnan(vi_blk[y_b, x_b, doy_index_f[0][0]]):
+                                                annual_blk[y_b, x_b, doy_temp - 1] = vi_blk[y_b, x_b, doy_index_f[0][0]]
+                                        elif inundated_doy[doy_f] > doy_end_current:
                                             break
-                                        doy_index += 1
+                                        doy_f = doy_f + 1
 
-                                    # check the doy index
-                                    if doy_index == 0:
-                                        print('Unknown error during phenology processing doy_end_current generation!')
-                                        sys.exit(-1)
-                                    # p1_time = p1_time + time.time() - time_s
+                                    NIPY_temp[y_temp, x_temp, 0] = doy_beg_current
+                                    NIPY_temp[y_temp, x_temp, 1] = doy_end_current
 
-                                    # Determine the doy_beg_current
-                                    # time_s = time.time()
-                                    if doy_end_factor:
-                                        if last_year_inundated_temp_array[y_temp, x_temp] > 0:
-                                            while doy_index <= inundated_doy.shape[0]:
-                                                if int(inundated_doy[doy_index - 1] // 1000) == year_list[i - 1] and inundated_sdc[y_temp, x_temp, doy_index - 1] == 1:
-                                                    break
-                                                doy_index -= 1
-                                            if doy_index == inundated_doy.shape[0]:
-                                                print('Unknown error during phenology processing doy_beg_current generation!')
-                                                sys.exit(-1)
-                                            else:
-                                                doy_beg_current = inundated_doy[doy_index]
-                                            # Make sure doy beg temp < doy end temp - 1000
-                                            if doy_beg_current < doy_end_current - 1000 or np.isnan(doy_beg_current):
-                                                doy_beg_current = doy_end_current - 1000
-                                        elif last_year_inundated_temp_array[y_temp, x_temp] == 0:
-                                            doy_beg_current = doy_end_current - 1000
-                                    # p2_time = p2_time + time.time() - time_s
-                                elif current_year_inundated_temp_array[y_temp, x_temp] == 0:
-                                    doy_end_current = year_list[i] * 1000 + 366
-                                    doy_beg_current = year_list[i] * 1000
-                                # time_s = time.time()
-
-                                # Construct NIPY_vi_dc
-                                doy_f = doy_init_f
-                                while doy_f <= inundated_doy.shape[0] - 1:
-                                    if doy_end_current > inundated_doy[doy_f] > doy_beg_current:
-                                        doy_index_f = np.argwhere(vi_doy == inundated_doy[doy_f])
-                                        doy_temp = int(np.mod(inundated_doy[doy_f], 1000))
-                                        if not np.isnan(vi_sdc[y_temp, x_temp, doy_index_f[0][0]]):
-                                            annual_NIPY_dc[y_temp, x_temp, doy_temp - 1] = vi_sdc[y_temp, x_temp, doy_index_f[0][0]]
-                                    elif inundated_doy[doy_f] > doy_end_current:
-                                        break
-                                    doy_f = doy_f + 1
-
-                                NIPY_temp[y_temp, x_temp, 0] = doy_beg_current
-                                NIPY_temp[y_temp, x_temp, 1] = doy_end_current
-
-                    doy_index_t = 0
-                    while doy_index_t < annual_NIPY_doy.shape[0]:
-                        if np.isnan(annual_NIPY_dc[:, :, doy_index_t]).all():
-                            annual_NIPY_dc = np.delete(annual_NIPY_dc, doy_index_t, axis=2)
-                            annual_NIPY_doy = np.delete(annual_NIPY_doy, doy_index_t, axis=0)
-                            doy_index_t -= 1
-                        doy_index_t += 1
-
-                    if NIPY_vi_dc == []:
-                        NIPY_vi_dc = copy.copy(annual_NIPY_dc)
-                    else:
-                        NIPY_vi_dc = np.append(NIPY_vi_dc, annual_NIPY_dc, axis=2)
+                        annual_NIPY_list[i - 1][window['y_range'][0]: window['y_range'][1], window['x_range'][0]: window['x_range'][1], :] = annual_blk
+                        annual_valid_list[i - 1] |= ~np.isnan(annual_blk).all(axis=(0, 1))
 
-                    if NIPY_doy == []:
-                        NIPY_doy = copy.copy(annual_NIPY_doy)
-                    else:
-                        NIPY_doy = np.append(NIPY_doy, annual_NIPY_doy, axis=0)
+                # Save dic and phenology dc
+                if len(year_list) > 1:
+
+                    # Only the days valid in any pixel are kept as the NIPY dc, which is assembled blockwise from the annual cubes
+                    NIPY_doy = np.concatenate([(np.linspace(1, 366, 366) + year_list[i] * 1000)[annual_valid_list[i - 1]] for i in range(1, len(year_list))], axis=0)
+                    NIPY_vi_filename = NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'] + str(vi_temp) + '_NIPY_sequenced_datacube.npy'
+                    NIPY_vi_dc = np.lib.format.open_memmap(NIPY_vi_filename[:-4] + '_tmp.npy', mode='w+', dtype=np.float64, shape=(vi_sdc.shape[0], vi_sdc.shape[1], NIPY_doy.shape[0]))
+                    z_start = 0
+                    for i in range(1, len(year_list)):
+                        valid_day = np.flatnonzero(annual_valid_list[i - 1])
+                        for window, (annual_blk, ) in iter_dc_blocks(annual_NIPY_list[i - 1]):
+                            NIPY_vi_dc[window['y_range'][0]: window['y_range'][1], window['x_range'][0]: window['x_range'][1], z_start: z_start + valid_day.shape[0]] = annual_blk[:, :, valid_day]
+                        z_start += valid_day.shape[0]
+
+                        bf.write_raster(gdal.Open(self.ds_file), NIPY_temp_list[i - 1][:,:,0], NIPY_para_path, f'{str(year_list[i])}_NIPY_beg.TIF', raster_datatype=gdal.GDT_Float32)
+                        bf.write_raster(gdal.Open(self.ds_file), NIPY_temp_list[i - 1][:,:,1], NIPY_para_path, f'{str(year_list[i])}_NIPY_end.TIF', raster_datatype=gdal.GDT_Float32)
 
                     # Consistency check
                     if NIPY_vi_dc.shape[2] != NIPY_doy.shape[0]:
                         raise Exception('Consistency error for the NIPY doy and NIPY VI DC')
 
-                    bf.write_raster(gdal.Open(self.ds_file), NIPY_temp[:,:,0], NIPY_para_path, f'{str(year_list[i])}_NIPY_beg.TIF', raster_datatype=gdal.GDT_Float32)
-                    bf.write_raster(gdal.Open(self.ds_file), NIPY_temp[:,:,1], NIPY_para_path, f'{str(year_list[i])}_NIPY_end.TIF', raster_datatype=gdal.GDT_Float32)
-                # Save dic and phenology dc
-                if NIPY_vi_dc != [] and NIPY_doy != []:
-                    np.save(NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'] + str(vi_temp) + '_NIPY_sequenced_datacube.npy', NIPY_vi_dc)
+                    NIPY_vi_dc.flush()
+                    del NIPY_vi_dc
+                    os.replace(NIPY_vi_filename[:-4] + '_tmp.npy', NIPY_vi_filename)
                     np.save(NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'] + 'doy.npy', NIPY_doy)
                     np.save(NIPY_para[f'NIPY_{vi_temp}_{self.ROI_name}_dcpath'] + 'header.npy', NIPY_header)
 
+                # Remove the temporary annual cubes
+                for i in range(1, len(year_list)):
+                    annual_filename = annual_NIPY_list[i - 1].filename
+                    annual_NIPY_list[i - 1] = None
+                    os.remove(annual_filename)
+
         # Add the NIPY
         if self._add_NIPY_dc:
             for vi_temp in VI:
@@ -1,5 +1,6 @@
 # coding=utf-8
 import sympy
+import numpy as np
 
 
 def convert_index_func(expr: str):
@@ -12,6 +13,29 @@ def convert_index_func(expr: str):
         raise ValueError(f'The {expr} is not valid!')
 
 
+def convert_fused_index_func(expr_list: list):
+
+    # Compile the expressions into one fused kernel sharing the common subexpressions
+    # (1) The expressions are kept as written (evaluate=False) thus the shared sums are not expanded by the sympify
+    # (2) The common subexpressions across all the expressions are eliminated by the sympy.cse in the generated kernel
+    # (3) The kernel returns the outputs in the order of the expr_list, the output equal to an input band is copied
+    # (4) Each output is cast to the dtype of the convert_index_func of its expression, which is evaluated on the first pixel
+    try:
+        f_list = [sympy.sympify(expr, evaluate=False) for expr in expr_list]
+        dep_list = sorted(set().union(*[f.free_symbols for f in f_list]), key=str)
+        num_f = sympy.lambdify(dep_list, f_list, 'numpy', cse=sympy.cse)
+    except:
+        raise ValueError(f'The {expr_list} is not valid!')
+    single_list = [convert_index_func(expr) for expr in expr_list]
+
+    def fused_func(*arr_list):
+        pixel_list = [np.asarray(arr).ravel()[:1] for arr in arr_list]
+        dtype_list = [np.asarray(func(*[pixel_list[dep_list.index(dep)] for dep in dep_temp])).dtype for dep_temp, func in single_list]
+        return [np.asarray(res).astype(dtype, copy=any(res is arr for arr in arr_list)) for res, dtype in zip(num_f(*arr_list), dtype_list)]
+
+    return dep_list, fused_func
+
+
 class built_in_index(object):
 
     def __init__(self, *args):
@@ -52,6 +76,6 @@ class built_in_index(object):
         for i in self.__dict__:
             if i != 'index_dic':
                 var, func = convert_index_func(self.__dict__[i].split('=')[-1])
-                self.index_dic[i] = [var, func]
+                self.index_dic[i] = [var, func, self.__dict__[i].split('=')[-1]]
 
 
@@ -0,0 +1,99 @@
+import numpy as np
+from scipy import ndimage
+
+
+### The neighbourhood filters of the classified map (e.g. the inundation map)
+# (1) The window sum is the separable box filter (ndimage.correlate1d along y and x) with zero outside the extent,
+#     thus the cost is independent of the window size and no pixel is visited in python
+# (2) The 2D map or the 3D (y, x, date) stack is accepted, the stack is filtered date by date within one call
+# (3) The nodata (Nan_value, nan if the Nan_value is nan) is excluded explicitly from the counts
+
+
+def _nodata_mask(array: np.ndarray, nodata_value):
+    if nodata_value is not None and isinstance(nodata_value, float) and np.isnan(nodata_value):
+        return np.isnan(array)
+    return array == nodata_value
+
+
+def window_sum(array: np.ndarray, half_size_window: int, exclude_centre: bool = False):
+
+    # The sum of the (2 * half_size_window + 1) square window of each pixel, the window is clipped by the extent
+    if array.ndim not in (2, 3):
+        raise TypeError('Please input a 2D array or a 3D stack!')
+    elif half_size_window < 0:
+        raise ValueError('The half size of the window should not be negative!')
+
+    array = np.asarray(array)
+    sum_arr = array.astype(np.int64) if array.dtype.kind in 'biu' else array.astype(np.float64)
+    weights = np.ones(2 * half_size_window + 1)
+    for axis in (0, 1):
+        sum_arr = ndimage.correlate1d(sum_arr, weights, axis=axis, mode='constant', cval=0)
+    return sum_arr - array if exclude_centre else sum_arr
+
+
+def window_area(shape, half_size_window: int):
+
+    # The number of the pixels within the clipped window of each pixel, broadcastable to the 3D stack
+    y_arr, x_arr = np.arange(shape[0]), np.arange(shape[1])
+    y_num = np.minimum(y_arr + half_size_window, shape[0] - 1) - np.maximum(y_arr - half_size_window, 0) + 1
+    x_num = np.minimum(x_arr + half_size_window, shape[1] - 1) - np.maximum(x_arr - half_size_window, 0) + 1
+    area_arr = y_num[:, None] * x_num[None, :]
+    return area_arr if len(shape) == 2 else area_arr[:, :, None]
+
+
+def reassign_sole_pixel_batch(array: np.ndarray, Nan_value=0, half_size_window: int = 2):
+
+    # Reassign the pixel surrounded only by the other value within the clipped window, for the map of two values besides the nodata
+    nodata_arr = _nodata_mask(array, Nan_value)
+    unique_value_list = np.unique(array[~nodata_arr]).tolist()
+    if len(unique_value_list) <= 1:
+        return array
+    elif len(unique_value_list) > 2:
+        raise TypeError('This function can not reassign the sole value for this raster')
+
+    value_a, value_b = unique_value_list
+    area_arr = window_area(array.shape, half_size_window) - 1
+    sole_a = np.logical_and(array == value_a, window_sum(array == value_b, half_size_window) == area_arr)
+    sole_b = np.logical_and(array == value_b, window_sum(array == value_a, half_size_window) == area_arr)
+
+    array_temp = array.copy()
+    array_temp[sole_a] = value_b
+    array_temp[sole_b] = value_a
+    return array_temp
+
+
+def remove_sole_pixel_batch(array: np.ndarray, Nan_value=0, half_size_window: int = 2):
+
+    # Assign the nodata to the pixel surrounded only by the nodata within the full window
+    # The pixel whose window exceeds the extent is kept (as the remove_sole_pixel)
+    nodata_arr = _nodata_mask(array, Nan_value)
+    sole_arr = np.logical_and(~nodata_arr, window_sum(nodata_arr, half_size_window) == (2 * half_size_window + 1) ** 2 - 1)
+    sole_arr[: half_size_window], sole_arr[array.shape[0] - half_size_window:] = False, False
+    sole_arr[:, : half_size_window], sole_arr[:, array.shape[1] - half_size_window:] = False, False
+
+    array_temp = array.copy()
+    array_temp[sole_arr] = Nan_value
+    return array_temp
+
+
+def shift_array(array: np.ndarray, dy: int, dx: int, fill_value=0):
+
+    # The array[y + dy, x + dx] of each pixel, filled outside the extent
+    shift_arr = np.full_like(array, fill_value)
+    y_src, y_dst = slice(max(dy, 0), array.shape[0] + min(dy, 0)), slice(max(-dy, 0), array.shape[0] + min(-dy, 0))
+    x_src, x_dst = slice(max(dx, 0), array.shape[1] + min(dx, 0)), slice(max(-dx, 0), array.shape[1] + min(-dx, 0))
+    shift_arr[y_dst, x_dst] = array[y_src, x_src]
+    return shift_arr
+
+
+def surrounding_max_half_window_map(array: np.ndarray, water_pixel_v=1):
+
+    # The largest half window of all the pixels of the 2D map within which all the pixels are water, via the chessboard distance
+    # to the nearest non-water pixel. Unlike the surrounding_max_half_window, the window is clipped at all the edges
+    # rather than failing at the bottom and right edges
+    water_arr = array == water_pixel_v
+    max_half_window = min(array.shape[0], array.shape[1]) - 2
+    if water_arr.all():
+        return np.full(array.shape, max_half_window, dtype=np.int64)
+    dis_arr = ndimage.distance_transform_cdt(water_arr, metric='chessboard').astype(np.int64)
+    return np.minimum(np.maximum(dis_arr, 1) - 1, max_half_window)
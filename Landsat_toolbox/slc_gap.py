@@ -0,0 +1,234 @@
+import numpy as np
+import basic_function as bf
+from NDsm import NDSparseMatrix
+from RSDatacube.tiling import iter_dc_blocks
+from Landsat_toolbox.neighbor_filter import window_sum, _nodata_mask
+
+
+### The gap filling of the Landsat 7 ETM+ SLC-off stripes
+# (1) The footprint of the scene is the quadrilateral of its four corners (as the fill_landsat7_gap), the SLC-off gap is the nodata within it
+# (2) The footprint is derived by the broadcast comparison against the four edge lines and cached per path/row,
+#     thus the scenes of the same path/row sharing the corners reuse the footprint without any mask file
+# (3) The gap is filled either by the normalised convolution of the valid pixels within the layer (spatial)
+#     or by the linear interpolation of the nearest valid observations of the adjacent dates (temporal)
+# (4) The whole stack is filled block by block through the iter_dc_blocks, thus the memory is bounded by the block_bytes
+
+
+def _footprint_corner(array: np.ndarray, nodata_value=0):
+
+    # The first/last rows and columns of the scene and the mean position of the valid pixels on them
+    nodata_arr = _nodata_mask(array, nodata_value)
+    empty_row, empty_col = nodata_arr.all(axis=1), nodata_arr.all(axis=0)
+    if empty_row.all():
+        raise ValueError('The scene has no valid pixel!')
+
+    row_beg = np.argwhere(np.logical_and(empty_row[:-1], ~empty_row[1:])).ravel() + 1
+    row_end = np.argwhere(np.logical_and(~empty_row[:-1], empty_row[1:])).ravel()
+    col_beg = np.argwhere(np.logical_and(empty_col[:-1], ~empty_col[1:])).ravel() + 1
+    col_end = np.argwhere(np.logical_and(~empty_col[:-1], empty_col[1:])).ravel()
+    row_min = int(row_beg.max()) if row_beg.shape[0] > 0 else 0
+    row_max = int(row_end.min()) if row_end.shape[0] > 0 else array.shape[0] - 1
+    col_min = int(col_beg.max()) if col_beg.shape[0] > 0 else 0
+    col_max = int(col_end.min()) if col_end.shape[0] > 0 else array.shape[1] - 1
+
+    row_min_column_pos = int(np.mean(np.argwhere(~nodata_arr[row_min, :])))
+    row_max_column_pos = int(np.mean(np.argwhere(~nodata_arr[row_max, :])))
+    col_min_row_pos = int(np.mean(np.argwhere(~nodata_arr[:, col_min])))
+    col_max_row_pos = int(np.mean(np.argwhere(~nodata_arr[:, col_max])))
+    return row_min, row_max, col_min, col_max, row_min_column_pos, row_max_column_pos, col_min_row_pos, col_max_row_pos
+
+
+def _footprint_from_corner(shape, corner: tuple):
+
+    # The pixels within the four edge lines (upper left, upper right, lower left and lower right)
+    row_min, row_max, col_min, col_max, row_min_column_pos, row_max_column_pos, col_min_row_pos, col_max_row_pos = corner
+    ul_slope = (row_min - col_min_row_pos) / (row_min_column_pos - col_min)
+    ul_offset = row_min - row_min_column_pos * ul_slope
+    ur_slope = (col_max_row_pos - row_min) / (col_max - row_min_column_pos)
+    ur_offset = row_min - row_min_column_pos * ur_slope
+    ll_slope = (row_max - col_min_row_pos) / (row_max_column_pos - col_min)
+    ll_offset = row_max - row_max_column_pos * ll_slope
+    lr_slope = (col_max_row_pos - row_max) / (col_max - row_max_column_pos)
+    lr_offset = row_max - row_max_column_pos * lr_slope
+
+    row_arr, col_arr = np.arange(shape[0])[:, None], np.arange(shape[1])[None, :]
+    footprint = row_arr - ul_slope * col_arr > ul_offset
+    footprint &= row_arr - ur_slope * col_arr > ur_offset
+    footprint &= row_arr - ll_slope * col_arr < ll_offset
+    footprint &= row_arr - lr_slope * col_arr < lr_offset
+    return footprint
+
+
+class SLC_footprint_cache(object):
+
+    ### The footprint of the Landsat 7 scene cached per path/row
+    # (1) The footprint is keyed by the path/row and reused while the shape and the corners of the scene are unchanged
+    # (2) Only the latest footprint of each path/row is kept, thus the cache is bounded by the number of the path/row
+
+    def __init__(self):
+        self._footprint = {}
+
+    def clear(self):
+        self._footprint = {}
+
+    def footprint(self, path_row: str, array: np.ndarray, nodata_value=0):
+        corner = _footprint_corner(array, nodata_value=nodata_value)
+        cache_temp = self._footprint.get(str(path_row))
+        if cache_temp is None or cache_temp[0] != array.shape or cache_temp[1] != corner:
+            cache_temp = (array.shape, corner, _footprint_from_corner(array.shape, corner))
+            self._footprint[str(path_row)] = cache_temp
+        return cache_temp[2]
+
+    def gap_mask(self, path_row: str, array: np.ndarray, nodata_value=0):
+
+        # The SLC-off gap (True) is the nodata within the footprint
+        return np.logical_and(self.footprint(path_row, array, nodata_value=nodata_value), _nodata_mask(array, nodata_value))
+
+
+footprint_cache = SLC_footprint_cache()
+
+
+def landsat7_path_row(filename: str):
+
+    # The path/row of the Landsat product id, e.g. LE07_L2SP_123039_20100101_20200911_02_T1_SR_B3.TIF
+    name_temp = filename.replace('\\', '/').split('/')[-1].split('_')
+    if len(name_temp) < 3 or not name_temp[2].isdigit():
+        raise ValueError(f'The path/row cannot be retrieved from {filename}!')
+    return name_temp[2]
+
+
+def _fill_value(array: np.ndarray, value_arr: np.ndarray):
+    return np.rint(value_arr).astype(array.dtype) if array.dtype.kind in 'biu' else value_arr.astype(array.dtype)
+
+
+def fill_gap_spatial(array: np.ndarray, gap_array: np.ndarray, max_search_dist: int = 14, nodata_value=np.nan):
+
+    # Fill the gap of the 2D layer or each layer of the 3D (y, x, date) stack by the normalised convolution
+    # (1) The gap pixel is the mean of the valid pixels within the smallest square window (half size 1, 2, 4 ... max_search_dist) having any
+    # (2) The gap without any valid pixel within the max_search_dist is kept as it is
+    if array.shape != gap_array.shape:
+        raise ValueError('The gap array is not consistent with the array!')
+    elif max_search_dist < 1:
+        raise ValueError('The max search dist should be a positive int!')
+
+    valid_arr = np.logical_and(~gap_array.astype(bool), ~_nodata_mask(array, nodata_value))
+    remain_arr = gap_array.astype(bool, copy=True)
+    value_arr = np.where(valid_arr, array, 0).astype(np.float64)
+    output_arr = array.copy()
+
+    half_size_window = 1
+    while remain_arr.any():
+        half_size_window = min(half_size_window, max_search_dist)
+        num_arr = window_sum(valid_arr, half_size_window)
+        fill_arr = np.logical_and(remain_arr, num_arr > 0)
+        if fill_arr.any():
+            output_arr[fill_arr] = _fill_value(array, window_sum(value_arr, half_size_window)[fill_arr] / num_arr[fill_arr])
+            remain_arr[fill_arr] = False
+        if half_size_window == max_search_dist:
+            break
+        half_size_window *= 2
+    return output_arr
+
+
+def fill_gap_temporal(array: np.ndarray, gap_array: np.ndarray, date_list: list, max_gap_day: int = 48, nodata_value=np.nan):
+
+    # Fill the gap of the 3D (y, x, date) stack by the nearest valid observations of the adjacent dates
+    # (1) The gap between two valid observations is linearly interpolated by the date, otherwise the only one within the max_gap_day is used
+    # (2) The nearest valid layer before/after each pixel is found by the running max/min of the valid layer index along the date
+    if array.ndim != 3 or array.shape != gap_array.shape:
+        raise ValueError('Please input the 3D stack and the gap stack of the same shape!')
+    elif array.shape[2] != len(date_list):
+        raise ValueError('The date list is not consistent with the stack!')
+
+    ordinal = bf.Date_index(date_list).ordinal
+    order = np.argsort(ordinal, kind='stable')
+    if not np.array_equal(order, np.arange(order.shape[0])):
+        output_arr = np.empty_like(array)
+        output_arr[:, :, order] = fill_gap_temporal(array[:, :, order], gap_array[:, :, order], np.array(date_list)[order].tolist(), max_gap_day=max_gap_day, nodata_value=nodata_value)
+        return output_arr
+
+    gap_array = gap_array.astype(bool)
+    valid_arr = np.logical_and(~gap_array, ~_nodata_mask(array, nodata_value))
+    z_arr = np.arange(array.shape[2], dtype=np.int32)
+    before_arr = np.maximum.accumulate(np.where(valid_arr, z_arr, -1), axis=2)
+    after_arr = np.minimum.accumulate(np.where(valid_arr, z_arr, array.shape[2])[:, :, ::-1], axis=2)[:, :, ::-1]
+
+    # The gap (in days) to the valid observations before/after, beyond the max_gap_day is regarded as absent
+    before_gap = ordinal[None, None, :] - ordinal[np.clip(before_arr, 0, None)]
+    after_gap = ordinal[np.clip(after_arr, None, array.shape[2] - 1)] - ordinal[None, None, :]
+    before_factor = np.logical_and(before_arr >= 0, before_gap <= max_gap_day)
+    after_factor = np.logical_and(after_arr < array.shape[2], after_gap <= max_gap_day)
+
+    before_value = np.take_along_axis(array, np.clip(before_arr, 0, None), axis=2).astype(np.float64)
+    after_value = np.take_along_axis(array, np.clip(after_arr, None, array.shape[2] - 1), axis=2).astype(np.float64)
+    both_factor = np.logical_and(before_factor, after_factor)
+    weight = np.where(both_factor, before_gap / np.maximum(before_gap + after_gap, 1), 0)
+    value_arr = np.where(both_factor, before_value + (after_value - before_value) * weight, np.where(before_factor, before_value, after_value))
+
+    fill_arr = np.logical_and(gap_array, np.logical_or(before_factor, after_factor))
+    output_arr = array.copy()
+    output_arr[fill_arr] = _fill_value(array, value_arr[fill_arr])
+    return output_arr
+
+
+def iter_slc_filled_blocks(dc, date_list: list, gap_dc=None, gap_layer: list = None, method: str = 'temporal', nodata_value=np.nan,
+                           max_gap_day: int = 48, max_search_dist: int = 14, block_bytes: int = 64 * 1024 ** 2):
+
+    # Fill the SLC-off gap of the whole stack (NDsm, dense or memory-mapped array) block by block
+    # (1) The gap is the gap_dc (True or 1 for the gap), or all the nodata of the gap_layer (the positions of the LE07 layers) without the gap_dc
+    # (2) The 'temporal' fills the gap from the adjacent dates, the 'spatial' within the layer and the 'temporal+spatial' fills the rest spatially
+    # (3) The block_bytes is small since the filling holds several float64 copies of the block
+    # Yield the window dict, the filled core block and the gap core block
+    if method not in ['temporal', 'spatial', 'temporal+spatial']:
+        raise ValueError('The method should be temporal, spatial or temporal+spatial!')
+    elif gap_dc is None and gap_layer is None:
+        raise ValueError('Please input the gap dc or the gap layer!')
+    elif dc.shape[2] != len(date_list):
+        raise ValueError('The date list is not consistent with the dc!')
+
+    halo = max_search_dist if 'spatial' in method else 0
+    dc_list = [dc] if gap_dc is None else [dc, gap_dc]
+    for window, block_list in iter_dc_blocks(*dc_list, halo=halo, block_bytes=block_bytes):
+        block = block_list[0]
+        if gap_dc is None:
+            gap_block = np.zeros(block.shape, dtype=bool)
+            gap_block[:, :, gap_layer] = _nodata_mask(block[:, :, gap_layer], nodata_value)
+        else:
+            gap_block = block_list[1].astype(bool)
+
+        if gap_block.any():
+            if 'temporal' in method:
+                block = fill_gap_temporal(block, gap_block, date_list, max_gap_day=max_gap_day, nodata_value=nodata_value)
+            if 'spatial' in method:
+                remain_block = np.logical_and(gap_block, _nodata_mask(block, nodata_value)) if 'temporal' in method else gap_block
+                block = fill_gap_spatial(block, remain_block, max_search_dist=max_search_dist, nodata_value=nodata_value)
+
+        core_y, core_x = window['core']
+        yield window, block[core_y, core_x, :], gap_block[core_y, core_x, :]
+
+
+def fill_slc_gap_stack(dc: np.ndarray, date_list: list, gap_dc=None, gap_layer: list = None, method: str = 'temporal', nodata_value=np.nan,
+                       max_gap_day: int = 48, max_search_dist: int = 14, block_bytes: int = 64 * 1024 ** 2, out: np.ndarray = None):
+
+    # Fill the SLC-off gap of the dense (or memory-mapped) stack into the out (a copy of the dc if None, could be the dc itself)
+    # For the in-place spatial filling, the filled pixels are written after all the blocks, thus the halo never reads the filled pixels
+    if isinstance(dc, NDSparseMatrix):
+        raise TypeError('Please use the iter_slc_filled_blocks for the NDsm!')
+    out = np.array(dc) if out is None else out
+    if out is not dc:
+        out[...] = dc
+    defer_factor = out is dc and 'spatial' in method
+
+    fill_list = []
+    for window, block, gap_block in iter_slc_filled_blocks(dc, date_list, gap_dc=gap_dc, gap_layer=gap_layer, method=method, nodata_value=nodata_value,
+                                                           max_gap_day=max_gap_day, max_search_dist=max_search_dist, block_bytes=block_bytes):
+        y_range, x_range = window['y_range'], window['x_range']
+        if defer_factor:
+            y_arr, x_arr, z_arr = np.nonzero(np.logical_and(gap_block, ~_nodata_mask(block, nodata_value)))
+            fill_list.append((y_arr + y_range[0], x_arr + x_range[0], z_arr, block[y_arr, x_arr, z_arr]))
+        else:
+            out[y_range[0]: y_range[1], x_range[0]: x_range[1], :] = block
+
+    for y_arr, x_arr, z_arr, value_arr in fill_list:
+        out[y_arr, x_arr, z_arr] = value_arr
+    return out
@@ -10,10 +10,14 @@ import shutil
 import datetime
 import copy
 from scipy.signal import convolve2d
+from scipy import ndimage
+from Landsat_toolbox import slc_gap
+from Landsat_toolbox.neighbor_filter import window_sum, shift_array, reassign_sole_pixel_batch, remove_sole_pixel_batch, surrounding_max_half_window_map
 import time
 from itertools import chain
 from collections import Counter
 import basic_function as bf
+from NDsm import NDSparseMatrix
 import matplotlib.pyplot as plt
 
 
@@ -87,64 +91,20 @@ def confusion_matrix_2_raster(raster_predict, raster_real, nan_value=np.nan):
     return confusion_matrix
 
 
-def fill_landsat7_gap(ori_tif, mask_tif='Landsat7_default'):
+def fill_landsat7_gap(ori_tif, mask_tif='Landsat7_default', max_search_dist: int = 14):
     # Get the boundary
+    # The footprint is cached per path/row (see the slc_gap) and the gap mask is kept in memory instead of the _gap_mask.TIF
     driver = gdal.GetDriverByName('GTiff')
     if mask_tif == 'Landsat7_default':
-        gap_mask_file = ori_tif.split('_02_T')[0] + '_gap_mask.TIF'
-        if not os.path.exists(gap_mask_file):
-            ori_ds = gdal.Open(ori_tif)
-            ori_array = bf.file2raster(ori_tif)
-
-            row_min = 0
-            row_max = ori_array.shape[0]
-            for row in range(ori_array.shape[0] - 1):
-                row_state = ori_array[row, :] == 0
-                next_row_state = ori_array[row + 1, :] == 0
-                if row_state.all() == 1 and next_row_state.all() == 0:
-                    row_min = max(row_min, row + 1)
-                elif row_state.all() == 0 and next_row_state.all() == 1:
-                    row_max = min(row_max, row)
-            row_min_column_pos = int(np.mean(np.argwhere(ori_array[row_min,:] != 0)))
-            row_max_column_pos = int(np.mean(np.argwhere(ori_array[row_max,:] != 0)))
-
-            col_min = 0
-            col_max = ori_array.shape[1]
-            for col in range(ori_array.shape[1] - 1):
-                col_state = ori_array[:, col] == 0
-                next_col_state = ori_array[:, col + 1] == 0
-                if col_state.all() == 1 and next_col_state.all() == 0:
-                    col_min = max(col_min, col + 1)
-                elif col_state.all() == 0 and next_col_state.all() == 1:
-                    col_max = min(col_max, col)
-            col_min_row_pos = int(np.mean(np.argwhere(ori_array[:, col_min] != 0)))
-            col_max_row_pos = int(np.mean(np.argwhere(ori_array[:, col_max] != 0)))
-            ul_slope = (row_min - col_min_row_pos) / (row_min_column_pos - col_min)
-            ul_offset = row_min - row_min_column_pos * ul_slope
-            ur_slope = (col_max_row_pos - row_min) / (col_max - row_min_column_pos)
-            ur_offset = row_min - row_min_column_pos * ur_slope
-            ll_slope = (row_max - col_min_row_pos) / (row_max_column_pos - col_min)
-            ll_offset = row_max - row_max_column_pos * ll_slope
-            lr_slope = (col_max_row_pos - row_max) / (col_max - row_max_column_pos)
-            lr_offset = row_max - row_max_column_pos * lr_slope
-
-            array_mask = np.ones_like(ori_array)
-            for col in range(array_mask.shape[1]):
-                for row in range(array_mask.shape[0]):
-                    if row - ul_slope * col > ul_offset:
-                        if row - ur_slope * col > ur_offset:
-                            if row - ll_slope * col < ll_offset:
-                                if row - lr_slope * col < lr_offset:
-                                    array_mask[row, col] = 0
-            array_mask[ori_array != 0] = 1
-            bf.write_raster(ori_ds, array_mask, gap_mask_file, '', raster_datatype=gdal.GDT_Int16, nodatavalue=0)
-            ori_ds = None
+        ori_array = bf.file2raster(ori_tif)
+        gap_arr = slc_gap.footprint_cache.gap_mask(slc_gap.landsat7_path_row(ori_tif), ori_array, nodata_value=0)
+        mask_ds = gdal.GetDriverByName('MEM').Create('', ori_array.shape[1], ori_array.shape[0], 1, gdal.GDT_Byte)
+        mask_ds.GetRasterBand(1).WriteArray((~gap_arr).astype(np.uint8))
         ori_ds = gdal.Open(ori_tif)
         dst_ds = driver.CreateCopy(ori_tif.split('.TIF')[0] + "_SLC.TIF", ori_ds, strict=0)
-        mask_ds = gdal.Open(gap_mask_file)
         mask_band = mask_ds.GetRasterBand(1)
         dst_band = dst_ds.GetRasterBand(1)
-        gdal.FillNodata(targetBand=dst_band, maskBand=mask_band, maxSearchDist=14, smoothingIterations=0)
+        gdal.FillNodata(targetBand=dst_band, maskBand=mask_band, maxSearchDist=max_search_dist, smoothingIterations=0)
         ori_ds = None
         mask_ds = None
         dst_ds = None
@@ -1043,6 +1003,239 @@ def identify_all_inundated_area(inundated_array, inundated_pixel_indicator=None,
     return inundated_sole_water_map
 
 
+### The connected-component engine of the inundated area
+# (1) The inundated area is the connected component (EightP: 8-connectivity, FourP: 4-connectivity) labelled by the ndimage.label
+#     instead of growing the pixel list, and the 3D (y, x, date) stack is labelled date by date within one call
+# (2) The surrounding pixels of the areas are derived from the region adjacency of the labelled map
+# (3) The DEM fix grows the sole inundated area by the region and by the lowest surrounding pixels at once
+# The pixel-list functions above (water_pixel_cor, surrounding_pixel_cor, detect_sole_inundated_area, DEM_fix_sole and
+# identify_all_inundated_area) are kept as the reference of the regression test
+
+
+def _cc_structure(detection_method: str, stack: bool = False):
+
+    if detection_method not in ['EightP', 'FourP']:
+        raise ValueError('Please mention current inundated area detection method only consist EightP and FourP!')
+    structure = ndimage.generate_binary_structure(2, 2 if detection_method == 'EightP' else 1)
+    if stack:
+        structure = np.stack([np.zeros_like(structure), structure, np.zeros_like(structure)], axis=0)
+    return structure
+
+
+def _cc_neighbour_index(flat_index: np.ndarray, shape, detection_method: str = 'EightP'):
+
+    # The unique flat index of the neighbours (within the extent) of the pixels
+    y_arr, x_arr = np.divmod(np.asarray(flat_index, dtype=np.int64), shape[1])
+    index_list = []
+    for dy, dx in np.argwhere(_cc_structure(detection_method)) - 1:
+        if dy != 0 or dx != 0:
+            valid = (y_arr + dy >= 0) & (y_arr + dy < shape[0]) & (x_arr + dx >= 0) & (x_arr + dx < shape[1])
+            index_list.append((y_arr[valid] + dy) * shape[1] + x_arr[valid] + dx)
+    return np.unique(np.concatenate(index_list)) if len(index_list) > 0 else np.zeros([0], dtype=np.int64)
+
+
+def label_inundated_area(inundated_array: np.ndarray, inundated_pixel_indicator=1, detection_method: str = 'EightP'):
+
+    # Label the inundated area of the 2D array or of each date of the 3D (y, x, date) stack
+    # The label of each date starts from 1 in the raster order (as the identify_all_inundated_area)
+    if inundated_array.ndim == 2:
+        label_arr, label_num = ndimage.label(inundated_array == inundated_pixel_indicator, structure=_cc_structure(detection_method))
+        return label_arr.astype(np.int32), label_num
+    elif inundated_array.ndim == 3:
+        label_arr, _ = ndimage.label(np.moveaxis(inundated_array == inundated_pixel_indicator, 2, 0), structure=_cc_structure(detection_method, stack=True))
+        layer_max = label_arr.reshape(label_arr.shape[0], -1).max(axis=1)
+        offset = np.concatenate([[0], np.maximum.accumulate(layer_max)[:-1]])
+        label_arr = np.where(label_arr > 0, label_arr - offset[:, None, None], 0)
+        return np.moveaxis(label_arr, 0, 2).astype(np.int32), np.maximum(layer_max - offset, 0)
+    else:
+        raise TypeError('The inundated array should be a 2D array or a 3D stack!')
+
+
+def inundated_area_adjacency(label_arr: np.ndarray, candidate_arr: np.ndarray, detection_method: str = 'EightP'):
+
+    # The (flat index of the candidate pixel, label of the adjacent inundated area) pairs sorted by the pixel then the label
+    # The adjacency of the 3D stack is only considered within each date
+    pad_width = [(1, 1), (1, 1)] + [(0, 0)] * (label_arr.ndim - 2)
+    label_pad = np.pad(label_arr, pad_width, mode='constant', constant_values=0)
+    index_list, label_list = [], []
+    for dy, dx in np.argwhere(_cc_structure(detection_method)) - 1:
+        if dy != 0 or dx != 0:
+            label_nbr = label_pad[1 + dy: 1 + dy + label_arr.shape[0], 1 + dx: 1 + dx + label_arr.shape[1]]
+            pair_arr = np.logical_and(candidate_arr, label_nbr > 0)
+            index_list.append(np.flatnonzero(pair_arr))
+            label_list.append(label_nbr[pair_arr].astype(np.int64))
+    index_arr, label_arr_ = np.concatenate(index_list), np.concatenate(label_list)
+    key_arr = np.unique(index_arr * (int(label_arr.max()) + 1) + label_arr_)
+    return np.divmod(key_arr, int(label_arr.max()) + 1)
+
+
+def inundated_area_statistics(label_arr: np.ndarray, value_arr: np.ndarray = None):
+
+    # The area, the bounding box (y_min, y_max, x_min, x_max, inclusive) and the min/max/mean value of each inundated area of the 2D label
+    label_list = np.arange(1, int(label_arr.max()) + 1)
+    area_arr = np.bincount(label_arr.ravel()[label_arr.ravel() > 0], minlength=label_list.shape[0] + 1)[1:]
+    bbox_list = ndimage.find_objects(np.maximum(label_arr, 0))
+    stat_dic = {'label': label_list, 'area': area_arr,
+                'y_min': [_[0].start if _ is not None else -1 for _ in bbox_list], 'y_max': [_[0].stop - 1 if _ is not None else -1 for _ in bbox_list],
+                'x_min': [_[1].start if _ is not None else -1 for _ in bbox_list], 'x_max': [_[1].stop - 1 if _ is not None else -1 for _ in bbox_list]}
+    if value_arr is not None and label_list.shape[0] > 0:
+        stat_dic['min'] = ndimage.minimum(value_arr, labels=label_arr, index=label_list)
+        stat_dic['max'] = ndimage.maximum(value_arr, labels=label_arr, index=label_list)
+        stat_dic['mean'] = ndimage.mean(value_arr, labels=label_arr, index=label_list)
+    return pd.DataFrame(stat_dic)
+
+
+def identify_all_inundated_area_batch(inundated_array, inundated_pixel_indicator=None, nanvalue_pixel_indicator=None, surrounding_pixel_identification_factor=False, input_detection_method=None):
+
+    # The same sole water map as the identify_all_inundated_area, the 3D (y, x, date) stack is processed date by date in a batch
+    input_detection_method = 'EightP' if input_detection_method is None else input_detection_method
+    inundated_pixel_indicator = 1 if inundated_pixel_indicator is None else inundated_pixel_indicator
+    nanvalue_pixel_indicator = 255 if nanvalue_pixel_indicator is None else nanvalue_pixel_indicator
+    inundated_sole_water_map, _ = label_inundated_area(inundated_array, inundated_pixel_indicator, input_detection_method)
+
+    # The surrounding pixel is assigned -label of the first adjacent area and -10000 * label of the other adjacent areas
+    if surrounding_pixel_identification_factor:
+        candidate_arr = np.logical_and(inundated_array != inundated_pixel_indicator, inundated_array != nanvalue_pixel_indicator)
+        index_arr, label_arr = inundated_area_adjacency(inundated_sole_water_map, candidate_arr, input_detection_method)
+        if index_arr.shape[0] > 0:
+            pixel_arr, first_arr = np.unique(index_arr, return_index=True)
+            label_min, label_sum = label_arr[first_arr], np.add.reduceat(label_arr, first_arr)
+            inundated_sole_water_map.flat[pixel_arr] = (- label_min - 10000 * (label_sum - label_min)).astype(np.int32)
+
+    inundated_sole_water_map[inundated_array == nanvalue_pixel_indicator] = 0
+    return inundated_sole_water_map
+
+
+def detect_sole_inundated_area_batch(array, water_pixel_list, water_pixel_value=1, detection_method='EightP', nodata_value=None):
+
+    # The same sole area as the detect_sole_inundated_area, 1 for the area connected to the water pixels and 2 for its surrounding pixels
+    if nodata_value is None:
+        raise ValueError('Please input the nodata value!')
+    elif water_pixel_list is None:
+        raise ValueError('Please input the original water pixel')
+
+    water_pixel_list = np.asarray(water_pixel_list, dtype=np.int64).reshape(-1, 2)
+    water_arr = array == water_pixel_value
+    water_arr[water_pixel_list[:, 0], water_pixel_list[:, 1]] = True
+    label_arr, _ = ndimage.label(water_arr, structure=_cc_structure(detection_method))
+    sole_arr = np.isin(label_arr, np.unique(label_arr[water_pixel_list[:, 0], water_pixel_list[:, 1]]))
+    around_arr = np.logical_and(ndimage.binary_dilation(sole_arr, structure=_cc_structure(detection_method)), ~sole_arr)
+
+    array_sole_area = np.full_like(array, nodata_value)
+    array_sole_area[sole_arr] = 1
+    array_sole_area[np.logical_and(around_arr, array != nodata_value)] = 2
+    return array_sole_area
+
+
+def inundated_area_detection_batch(dem_raster_array_f, water_pixel, water_level_indicator=None):
+
+    # The same inundated pixels as the inundated_area_detection, i.e. the water pixels followed by the pixels lower than the water level
+    # and 4-connected to them (in the raster order), the DEM array is not modified
+    if water_level_indicator is None or water_pixel is None:
+        raise ValueError('Please input the the water level data or the coordinate of water original pixel!')
+    water_pixel = np.asarray(water_pixel, dtype=np.int64)
+    if water_pixel.ndim != 2 or water_pixel.shape[1] != 2:
+        raise ValueError('Please make sure the water pixel coordinate is stored in a 2darray')
+
+    inundated_arr = dem_raster_array_f < water_level_indicator
+    inundated_arr[water_pixel[:, 0], water_pixel[:, 1]] = True
+    label_arr, _ = ndimage.label(inundated_arr, structure=_cc_structure('FourP'))
+    inundated_arr = np.isin(label_arr, np.unique(label_arr[water_pixel[:, 0], water_pixel[:, 1]]))
+    inundated_arr[water_pixel[:, 0], water_pixel[:, 1]] = False
+    return np.concatenate([water_pixel, np.argwhere(inundated_arr)], axis=0)
+
+
+def _most_common_label(sole_temp_array_f, inundated_temp_array_f, nan_value=0):
+
+    # The same as the mostCommon, the most frequent label (ties by the first occurrence) not led by the sole inundated pixel (2)
+    value_arr, first_arr, count_arr = np.unique(sole_temp_array_f.ravel(), return_index=True, return_counts=True)
+    for pos in np.lexsort((first_arr, -count_arr)):
+        if value_arr[pos] != nan_value and inundated_temp_array_f.flat[first_arr[pos]] != 2:
+            return value_arr[pos]
+    return None
+
+
+def DEM_fix_sole_batch(DEM_array_f, sole_temp_array_f, inundated_temp_array_f, indicator_list=None, nan_water_value=None, sole_max=None):
+
+    # The same DEM fix as the DEM_fix_sole, the sole inundated area (2) of the indicator is grown until it is adjacent to the main water (1)
+    # (1) The adjacent sole inundated areas are merged
+    # (2) Otherwise, the surrounding non-inundated pixels with the lowest DEM are added
+    # The growth stops if neither is possible, rather than recursing endlessly
+    if indicator_list is None:
+        raise ValueError('Please double check the indicator within the DEM_fix_sole Function!')
+    indicator_list = [int(indicator_list)] if isinstance(indicator_list, (int, np.integer)) else [int(_) for _ in indicator_list]
+    nan_water_value = 255 if nan_water_value is None else nan_water_value
+    sole_max = _most_common_label(sole_temp_array_f, inundated_temp_array_f) if sole_max is None else sole_max
+
+    # The pixels of each label are retrieved through the sorted label
+    shape = sole_temp_array_f.shape
+    sole_flat, inundated_flat, dem_flat = sole_temp_array_f.ravel(), inundated_temp_array_f.ravel(), DEM_array_f.ravel()
+    label_order = np.argsort(sole_flat, kind='stable')
+    label_sorted = sole_flat[label_order]
+    def _label_index(label):
+        return label_order[np.searchsorted(label_sorted, label, side='left'): np.searchsorted(label_sorted, label, side='right')]
+
+    water_arr = np.zeros(sole_flat.shape[0], dtype=bool)
+    for indicator in indicator_list:
+        water_arr[_label_index(indicator)] = True
+    around_arr = _cc_neighbour_index(np.flatnonzero(water_arr), shape)
+    around_arr = around_arr[~water_arr[around_arr]]
+
+    initial_factor = True
+    while True:
+        inundated_around = inundated_flat[around_arr]
+        near_water_arr = inundated_around == 1 if initial_factor else np.logical_and(inundated_around == 1, sole_flat[around_arr] == sole_max)
+        dry_arr = np.logical_and(~near_water_arr, inundated_around == nan_water_value)
+        another_indicator_exist = (inundated_around == 2).any()
+        dem_around_min = min(1000, dem_flat[around_arr][dry_arr].min()) if dry_arr.any() else 1000
+        initial_factor = False
+
+        if near_water_arr.any() and not another_indicator_exist:
+            break
+        elif another_indicator_exist:
+            # Merge the adjacent sole inundated areas in the raster order of their surrounding pixels
+            label_temp = sole_flat[around_arr][inundated_around == 2].astype(np.int64)
+            label_temp = label_temp[np.sort(np.unique(label_temp, return_index=True)[1])]
+            label_temp = [int(_) for _ in label_temp if int(_) not in indicator_list]
+            if len(label_temp) == 0:
+                break
+            indicator_list.extend(label_temp)
+            add_arr = np.concatenate([_label_index(_) for _ in label_temp])
+        else:
+            add_arr = around_arr[dem_flat[around_arr] == dem_around_min]
+            if add_arr.shape[0] == 0:
+                break
+
+        water_arr[add_arr] = True
+        around_arr = np.union1d(around_arr, _cc_neighbour_index(add_arr, shape))
+        around_arr = around_arr[~water_arr[around_arr]]
+
+    water_pixel_list = np.argwhere(water_arr.reshape(shape))
+    around_pixel_list = np.stack(np.unravel_index(around_arr, shape), axis=1)
+    return indicator_list, water_pixel_list, around_pixel_list
+
+
+def complement_all_inundated_area_batch(DEM_array_f, sole_temp_array_f, inundated_temp_array_f):
+
+    # The same as the complement_all_inundated_area, the non-inundated pixels (255) filled by the DEM fix are assigned 3
+    # The largest label is skipped as the complement_all_inundated_area does (its candidate list range(max) omits the max label)
+    inundated_temp_array_ff = copy.copy(inundated_temp_array_f)
+    sole_max = _most_common_label(sole_temp_array_f, inundated_temp_array_f)
+    fixed_indicator = []
+    value_arr, first_arr = np.unique(sole_temp_array_f.ravel(), return_index=True)
+    for indi_temp, first_temp in zip(value_arr, first_arr):
+        if 0 < indi_temp < value_arr[-1] and int(indi_temp) not in fixed_indicator:
+            inundated_indi_f = inundated_temp_array_f.flat[first_temp]
+            if inundated_indi_f == 2:
+                indicator_list, water_pixel_list, _ = DEM_fix_sole_batch(DEM_array_f, sole_temp_array_f, inundated_temp_array_f, indicator_list=int(indi_temp), sole_max=sole_max)
+                fixed_indicator.extend(indicator_list)
+                fix_arr = inundated_temp_array_ff[water_pixel_list[:, 0], water_pixel_list[:, 1]] == 255
+                inundated_temp_array_ff[water_pixel_list[fix_arr, 0], water_pixel_list[fix_arr, 1]] = 3
+            elif inundated_indi_f == 255:
+                raise Exception('Some inconsistency error occurred!')
+    return inundated_temp_array_ff
+
+
 def remove_all_file_and_folder(filter_list):
     for file in filter_list:
         if os.path.isdir(str(file)):
@@ -1182,72 +1375,34 @@ def file_consistency_check(filepath_list_f, filename_filter_list, files_in_same_
         print('All input files are consistent')
 
 
-def neighbor_average_convolve2d(array, size=4):
-    kernel = np.ones((2 * size + 1, 2 * size + 1))
-    kernel[4, 4] = 0
-    neighbor_sum = convolve2d(
-        array, kernel, mode='same',
-        boundary='fill', fillvalue=0)
-    return neighbor_sum
+def index_arr2int16(index_arr: np.ndarray, scale_factor=10000, nodata_value=-32768):
 
+    # Scale the float index arr in place and convert it into int16 (nan to the nodata value)
+    if not np.issubdtype(index_arr.dtype, np.floating):
+        index_arr = index_arr.astype(np.float32)
+    nan_mask = np.isnan(index_arr)
+    np.multiply(index_arr, scale_factor, out=index_arr)
+    np.rint(index_arr, out=index_arr)
+    np.clip(index_arr, -32768, 32767, out=index_arr)
+    index_arr[nan_mask] = nodata_value
+    return index_arr.astype(np.int16)
 
-def reassign_sole_pixel(twod_array, Nan_value=0, half_size_window=2):
-
-    if len(twod_array.shape) != 2:
-        print('Please correctly inputting a 2d array!')
-        sys.exit(-1)
-    unique_value_list = [i for i in np.unique(twod_array) if i != Nan_value]
-
-    if len(unique_value_list) == 0 or len(unique_value_list) == 1:
-        return twod_array
-    elif len(unique_value_list) == 2:
-        twod_array_temp = copy.copy(twod_array)
 
-        for y in range(twod_array.shape[0]):
-            for x in range(twod_array.shape[1]):
-
-                if twod_array[y, x] != Nan_value:
-
-                    if y + half_size_window + 1 > twod_array_temp.shape[0]:
-                        y_max = twod_array_temp.shape[0]
-                    else:
-                        y_max = y + half_size_window + 1
-                    if y - half_size_window < 0:
-                        y_min = 0
-                    else:
-                        y_min = y - half_size_window
-
-                    if x + half_size_window + 1 > twod_array_temp.shape[1]:
-                        x_max = twod_array_temp.shape[1]
-                    else:
-                        x_max = x + half_size_window + 1
-                    if x - half_size_window < 0:
-                        x_min = 0
-                    else:
-                        x_min = x - half_size_window
-
-                    array_temp = twod_array[y_min: y_max, x_min: x_max]
-
-                    if np.sum(np.logical_and(array_temp != twod_array[y, x], array_temp != Nan_value)) == (array_temp.shape[0] * array_temp.shape[1] - 1):
-                        twod_array_temp[y, x] = [_ for _ in unique_value_list if _ != twod_array_temp[y, x]][0]
+def neighbor_average_convolve2d(array, size=4):
+    # The sum of the (2 * size + 1) window with zero outside the extent, excluding the element of the kernel[4, 4] (the centre for size 4)
+    if size < 2:
+        raise IndexError('The size of the neighbor average should be no less than 2!')
+    return (window_sum(array, size) - shift_array(array, size - 4, size - 4)).astype(np.float64)
 
-        return twod_array_temp
 
-    else:
-        raise TypeError('This function can not reassign the sole value for this raster')
+def reassign_sole_pixel(twod_array, Nan_value=0, half_size_window=2):
+    # The map (or the 3D stack of maps) is processed as a whole by the reassign_sole_pixel_batch
+    return reassign_sole_pixel_batch(twod_array, Nan_value=Nan_value, half_size_window=half_size_window)
 
 
 def remove_sole_pixel(twod_array, Nan_value=0, half_size_window=2):
-    if len(twod_array.shape) != 2:
-        print('Please correctly inputting a 2d array!')
-        sys.exit(-1)
-    else:
-        twod_array_temp = copy.copy(twod_array)
-        for y in range(twod_array.shape[0]):
-            for x in range(twod_array.shape[1]):
-                if twod_array[y, x] != Nan_value and np.count_nonzero(twod_array[y - half_size_window: y + half_size_window + 1, x - half_size_window: x + half_size_window + 1] == Nan_value) == (2 * half_size_window + 1) ** 2 - 1:
-                    twod_array_temp[y, x] = Nan_value
-    return twod_array_temp
+    # The map (or the 3D stack of maps) is processed as a whole by the remove_sole_pixel_batch
+    return remove_sole_pixel_batch(twod_array, Nan_value=Nan_value, half_size_window=half_size_window)
 
 
 def cor_to_pixel(two_corner_coordinate, study_area_example_file_path):
@@ -1289,13 +1444,20 @@ def cor_to_pixel(two_corner_coordinate, study_area_example_file_path):
 
 def print_single_stacked_Zvalue(output_folder, xy_list, datacube, offset_list, nodata_value, doy_list):
 
+    # Extract the zValue series of the unprinted pixels at once (the datacube could be a shared NDsm or Shared_array)
+    xy_list = np.array([xy_temp for xy_temp in xy_list if not os.path.exists(output_folder + f'stacked_{str(xy_temp[1])}_{str(xy_temp[0])}.png')], dtype=np.int64).reshape(-1, 2)
+    y_rel, x_rel = xy_list[:, 0] - offset_list[0], xy_list[:, 1] - offset_list[1]
+    if isinstance(datacube, NDSparseMatrix):
+        series = datacube.extract_pixel_series(y_rel, x_rel, pixel_major=False)
+    else:
+        series = datacube[y_rel, x_rel, :]
+
     # Generate the zValue series
     for _ in range(xy_list.shape[0]):
         x, y = xy_list[_, 1], xy_list[_, 0]
-        x_rel, y_rel = x - offset_list[1], y - offset_list[0]
 
         if not os.path.exists(output_folder + f'stacked_{str(x)}_{str(y)}.png'):
-            dc_temp = datacube[y_rel, x_rel, :].flatten()
+            dc_temp = np.array(series[_, :]).flatten()
             doy_list_ = np.array(copy.copy(doy_list))
             doy_list_ = np.delete(doy_list_, np.argwhere(dc_temp == nodata_value))
             dc_temp = np.delete(dc_temp, np.argwhere(dc_temp == nodata_value))
@@ -1304,4 +1466,10 @@ def print_single_stacked_Zvalue(output_folder, xy_list, datacube, offset_list, n
                 ax1.scatter(doy_list_, dc_temp, s=8**2, color=(196/256, 80/256, 80/256), edgecolor=(0/256, 0/256, 0/256), linewidth=2, zorder=4)
                 plt.savefig(output_folder + f'stacked_{str(x)}_{str(y)}.png')
                 fig1 = None
-                ax1 = None
\ No newline at end of file
+                ax1 = None
+
+def print_stacked_Zvalue4tile(tile_dc, tile, output_folder, nodata_value, doy_list):
+
+    # Adapter of the print_single_stacked_Zvalue for the Tile_scheduler, the pixels of the tile are offset by the origin of its bounding box
+    print_single_stacked_Zvalue(output_folder, tile['pos'], tile_dc, [tile['y_range'][0], tile['x_range'][0]], nodata_value, doy_list)
+    return tile['pos'].shape[0]
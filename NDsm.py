@@ -1,11 +1,279 @@
 import scipy.sparse as sm
 import pickle
+import json
 import basic_function as bf
+import layer_codec
 import numpy as np
 import os
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from multiprocessing import shared_memory
 from tqdm.auto import tqdm
 
 
+class _LazySMGroup(MutableMapping):
+
+    ### The lazy SM group is a drop-in replacement of the SM_group dict of the NDSparseMatrix
+    # (1) The layers are decoded from disk on first access instead of being materialised in the load()
+    # (2) The decoded layers are kept in a LRU cache bounded by cache_bytes (no caching if None or 0)
+    # (3) The layers replaced or added after loading are kept in memory and shadow the on-disk layers
+    # (4) The subclass should implement the _read_layer for decoding one layer from disk
+
+    def __init__(self, namelist: list, layer_shape: tuple, dtype, matrix_type=sm.csr_matrix, cache_bytes: int = None):
+        self._ondisk_namelist = list(namelist)
+        self._ondisk_names = set(self._ondisk_namelist)
+        self._modified = {}
+        self._removed = set()
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self.cache_bytes = cache_bytes
+        self.layer_shape = tuple(layer_shape)
+        self.dtype = np.dtype(dtype)
+        self.matrix_type = matrix_type
+
+    def __getstate__(self):
+        # The decoded layers are not shipped to the worker
+        state = self.__dict__.copy()
+        state['_cache'], state['_cached_bytes'] = OrderedDict(), 0
+        return state
+
+    def _read_layer(self, name):
+        raise NotImplementedError
+
+    def set_cache_bytes(self, cache_bytes: int):
+        self.cache_bytes = cache_bytes
+        self._evict_cache()
+
+    def _evict_cache(self):
+        budget = 0 if self.cache_bytes is None else self.cache_bytes
+        while self._cache and self._cached_bytes > budget:
+            name, layer = self._cache.popitem(last=False)
+            self._cached_bytes -= _layer_nbytes(layer)
+
+    def _uncache(self, name):
+        if name in self._cache:
+            self._cached_bytes -= _layer_nbytes(self._cache.pop(name))
+
+    def __getitem__(self, name):
+        if name in self._modified:
+            return self._modified[name]
+        elif name in self._ondisk_names and name not in self._removed:
+            if name in self._cache:
+                self._cache.move_to_end(name)
+                return self._cache[name]
+            layer = self._read_layer(name)
+            if self.cache_bytes and _layer_nbytes(layer) <= self.cache_bytes:
+                self._cache[name] = layer
+                self._cached_bytes += _layer_nbytes(layer)
+                self._evict_cache()
+            return layer
+        else:
+            raise KeyError(name)
+
+    def __setitem__(self, name, layer):
+        self._uncache(name)
+        self._modified[name] = layer
+        self._removed.discard(name)
+
+    def __delitem__(self, name):
+        self._uncache(name)
+        if name in self._modified:
+            self._modified.pop(name)
+            if name in self._ondisk_names:
+                self._removed.add(name)
+        elif name in self._ondisk_names and name not in self._removed:
+            self._removed.add(name)
+        else:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._modified or (name in self._ondisk_names and name not in self._removed)
+
+    def __iter__(self):
+        for name in self._ondisk_namelist:
+            if name not in self._removed or name in self._modified:
+                yield name
+        for name in self._modified:
+            if name not in self._ondisk_names:
+                yield name
+
+    def __len__(self):
+        return len([_ for _ in self])
+
+
+class _ChunkedSMGroup(_LazySMGroup):
+
+    ### The chunked SM group reads the layers from the single chunked container (SMchunk.bin)
+    # (1) The container is split into (y-block, x-block, z-block) chunks, each chunk is stored as a csr triplet
+    #     (indptr of the bz * by local rows, local x indices and data) padded to 8 bytes
+    # (2) The SMchunk_index.npy records the byte offset and nnz of every chunk (offset -1 for the empty chunk)
+    # (3) The bin file is memory-mapped, thus only the chunks touched by a query are read from disk
+
+    def __init__(self, input_path: str, header: dict, cache_bytes: int = None):
+        super(_ChunkedSMGroup, self).__init__(header['SM_namelist'], header['shape'][0: 2], header['dtype'], matrix_type=sm.csr_matrix, cache_bytes=cache_bytes)
+        self._input_path = input_path
+        self.chunk_shape = tuple(header['chunk_shape'])
+        self._z_pos = {name: pos for pos, name in enumerate(self._ondisk_namelist)}
+        self._mm = None
+        self._chunk_index = None
+
+    def __getstate__(self):
+        # Drop the memmap to avoid pickling the whole container into the worker
+        state = super(_ChunkedSMGroup, self).__getstate__()
+        state['_mm'], state['_chunk_index'] = None, None
+        return state
+
+    def _open(self):
+        if self._mm is None:
+            self._mm = np.memmap(self._input_path + 'SMchunk.bin', dtype=np.uint8, mode='r')
+            self._chunk_index = np.load(self._input_path + 'SMchunk_index.npy', mmap_mode='r')
+
+    def close(self):
+        self._mm, self._chunk_index = None, None
+
+    def _read_chunk(self, yb, xb, zb):
+        offset, nnz = self._chunk_index[yb, xb, zb]
+        if offset < 0:
+            return None
+        by, bx, bz = self.chunk_shape
+        indptr_size = bz * by + 1
+        indptr = np.frombuffer(self._mm, dtype=np.int64, count=indptr_size, offset=int(offset))
+        offset = int(offset) + _pad8(indptr_size * 8)
+        indices = np.frombuffer(self._mm, dtype=np.int32, count=int(nnz), offset=offset)
+        offset += _pad8(int(nnz) * 4)
+        data = np.frombuffer(self._mm, dtype=self.dtype, count=int(nnz), offset=offset)
+        return indptr, indices, data
+
+    def read_window(self, name, y_range: list, x_range: list):
+
+        if name in self._modified:
+            return self.matrix_type(self._modified[name])[y_range[0]: y_range[1], x_range[0]: x_range[1]]
+        elif name not in self:
+            raise KeyError(name)
+
+        self._open()
+        by, bx, bz = self.chunk_shape
+        z = self._z_pos[name]
+        zb, z_local = z // bz, z % bz
+        rows, cols, data = [], [], []
+        for yb in range(y_range[0] // by, (y_range[1] - 1) // by + 1):
+            for xb in range(x_range[0] // bx, (x_range[1] - 1) // bx + 1):
+                chunk = self._read_chunk(yb, xb, zb)
+                if chunk is None:
+                    continue
+                indptr, indices, data_temp = chunk
+                row_beg, row_end = z_local * by, (z_local + 1) * by
+                row_nnz = np.diff(indptr[row_beg: row_end + 1])
+                if row_nnz.sum() == 0:
+                    continue
+                rows_temp = np.repeat(np.arange(by) + yb * by, row_nnz)
+                cols_temp = indices[indptr[row_beg]: indptr[row_end]].astype(np.int64) + xb * bx
+                data_temp = data_temp[indptr[row_beg]: indptr[row_end]]
+                in_window = (rows_temp >= y_range[0]) & (rows_temp < y_range[1]) & (cols_temp >= x_range[0]) & (cols_temp < x_range[1])
+                rows.append(rows_temp[in_window] - y_range[0])
+                cols.append(cols_temp[in_window] - x_range[0])
+                data.append(data_temp[in_window])
+
+        window_shape = (y_range[1] - y_range[0], x_range[1] - x_range[0])
+        if len(data) == 0:
+            return self.matrix_type(window_shape, dtype=self.dtype)
+        else:
+            return self.matrix_type((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=window_shape, dtype=self.dtype)
+
+    def _read_layer(self, name):
+        return self.read_window(name, [0, self.layer_shape[0]], [0, self.layer_shape[1]])
+
+
+class _NpzSMGroup(_LazySMGroup):
+
+    ### The npz SM group reads the layers from the one-npz-per-layer folder on first access
+    # The layers saved with a codec (one .lyr per layer) are decoded and converted into the matrix type
+
+    def __init__(self, input_path: str, namelist: list, layer_shape: tuple, dtype, matrix_type, cache_bytes: int = None, codec: str = None):
+        super(_NpzSMGroup, self).__init__(namelist, layer_shape, dtype, matrix_type=matrix_type, cache_bytes=cache_bytes)
+        self._input_path = input_path
+        self.codec = codec
+
+    def _read_layer(self, name):
+        try:
+            if self.codec is not None:
+                return self.matrix_type(layer_codec.read_layer(f'{self._input_path}{str(name)}.lyr', mmap=False))
+            return sm.load_npz(f'{self._input_path}{str(name)}.npz')
+        except:
+            raise Exception(f'file {str(name)} cannot be loaded')
+
+
+class _SharedSMGroup(_LazySMGroup):
+
+    ### The shared SM group keeps the csr/csc triplets of all the layers in one shared memory block
+    # (1) Each layer is stored as indptr, indices and data padded to 8 bytes, the layout records their offsets
+    # (2) Pickling only ships the block name and the layout, the worker attaches the block and builds zero-copy read-only views
+    # (3) Only the owner (the process created the block) unlinks it in the release()
+
+    def __init__(self, shm_name: str, layout: dict, namelist: list, layer_shape: tuple, dtype, idx_dtype, matrix_type=sm.csr_matrix):
+        super(_SharedSMGroup, self).__init__(namelist, layer_shape, dtype, matrix_type=matrix_type, cache_bytes=None)
+        self.shm_name = shm_name
+        self._layout = layout
+        self._idx_dtype = np.dtype(idx_dtype)
+        self._shm = None
+        self._owner = False
+
+    def __getstate__(self):
+        state = super(_SharedSMGroup, self).__getstate__()
+        state['_shm'], state['_owner'] = None, False
+        return state
+
+    def _open(self):
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.shm_name)
+
+    def release(self):
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm, self._owner = None, False
+
+    def _read_layer(self, name):
+        self._open()
+        indptr_off, indptr_len, indices_off, nnz, data_off = self._layout[name]
+        indptr = np.ndarray((indptr_len,), dtype=self._idx_dtype, buffer=self._shm.buf, offset=indptr_off)
+        indices = np.ndarray((nnz,), dtype=self._idx_dtype, buffer=self._shm.buf, offset=indices_off)
+        data = np.ndarray((nnz,), dtype=self.dtype, buffer=self._shm.buf, offset=data_off)
+        for arr in (indptr, indices, data):
+            arr.flags.writeable = False
+        return self.matrix_type((data, indices, indptr), shape=self.layer_shape, copy=False)
+
+
+def _pad8(size: int):
+    return (size + 7) // 8 * 8
+
+
+def _layer_nbytes(layer):
+    if isinstance(layer, (sm.csr_matrix, sm.csc_matrix, sm.bsr_matrix)):
+        return layer.data.nbytes + layer.indices.nbytes + layer.indptr.nbytes
+    elif isinstance(layer, sm.coo_matrix):
+        return layer.data.nbytes + layer.row.nbytes + layer.col.nbytes
+    elif isinstance(layer, np.ndarray):
+        return layer.nbytes
+    else:
+        return len(pickle.dumps(layer))
+
+
+def _layer_flat_index(layer, cols: int):
+
+    # Return the flattened pixel index and the stored value of a sparse layer directly from its index arrays
+    if isinstance(layer, sm.csr_matrix):
+        rows = np.repeat(np.arange(layer.shape[0], dtype=np.int64), np.diff(layer.indptr))
+        return rows * cols + layer.indices, layer.data
+    elif isinstance(layer, sm.csc_matrix):
+        cols_temp = np.repeat(np.arange(layer.shape[1], dtype=np.int64), np.diff(layer.indptr))
+        return layer.indices.astype(np.int64) * cols + cols_temp, layer.data
+    else:
+        return _layer_flat_index(sm.csr_matrix(layer), cols)
+
+
 class NDSparseMatrix:
 
     ### The NDSparseMatrix is a data class specified for the huge and sparse N-dimensional matrix
@@ -23,6 +291,11 @@ class NDSparseMatrix:
         self.shape = [self._rows, self._cols, self._height]
         self.SM_namelist = None
         self.file_size = 0
+        self._pixel_major = None
+        self._input_path = None
+        self._codec = None
+        self.dtype = None
+        self._ondisk_state = None
 
         for kw_temp in kwargs.keys():
             if kw_temp not in ['SM_namelist']:
@@ -61,6 +334,30 @@ class NDSparseMatrix:
 
         self._update_size_para()
 
+    def __getstate__(self):
+        # The weak references of the on-disk state are not picklable, the unpickled NDsm is regarded as modified
+        state = self.__dict__.copy()
+        state['_ondisk_state'] = None
+        return state
+
+    def _mark_ondisk(self):
+        # Record the layers matching the input folder, the layer replaced, added or removed afterwards is detected by the is_ondisk()
+        layer_ref = {name: weakref.ref(layer) for name, layer in self.SM_group.items()} if isinstance(self.SM_group, dict) else None
+        self._ondisk_state = (list(self.SM_namelist), layer_ref)
+
+    def is_ondisk(self):
+        # Whether the NDsm is known to be unmodified since it was loaded from (or ingested into) its input folder
+        # Only such NDsm can be reopened from the input path instead of being shipped from memory
+        state = getattr(self, '_ondisk_state', None)
+        if self._input_path is None or state is None or list(self.SM_namelist) != state[0]:
+            return False
+        elif isinstance(self.SM_group, dict):
+            return state[1] is not None and len(self.SM_group) == len(state[1]) and all([name in state[1] and state[1][name]() is layer for name, layer in self.SM_group.items()])
+        elif isinstance(self.SM_group, (_ChunkedSMGroup, _NpzSMGroup)):
+            return len(self.SM_group._modified) == 0 and len(self.SM_group._removed) == 0
+        else:
+            return False
+
     def __sizeof__(self):
         try:
             return len(pickle.dumps(self))
@@ -93,11 +390,28 @@ class NDSparseMatrix:
             return np.stack(arr_list, axis=2)
 
     def _update_size_para(self):
+
+        # Any change of the layers invalidates the pixel-major cache
+        self._pixel_major = None
+        if isinstance(self.SM_group, _LazySMGroup):
+            # Avoid decoding every on-disk layer just for the size check
+            self._rows, self._cols = self.SM_group.layer_shape
+            for name in self.SM_group._modified:
+                if self.SM_group._modified[name].shape != self.SM_group.layer_shape:
+                    raise Exception(f'Consistency Error for the {str(name)}')
+            self._height = len(self.SM_namelist)
+            self.shape = [self._rows, self._cols, self._height]
+            self.dtype = self.SM_group.dtype
+            return
+
+        self.dtype = None
         for ele in self.SM_group.values():
             if self._cols == -1 or self._rows == -1:
                 self._cols, self._rows = ele.shape[1], ele.shape[0]
             elif ele.shape[1] != self._cols or ele.shape[0] != self._rows:
                 raise Exception(f'Consistency Error for the {str(ele)}')
+            if self.dtype is None:
+                self.dtype = ele.dtype
         self._height = len(self.SM_namelist)
         self.shape = [self._rows, self._cols, self._height]
 
@@ -144,15 +458,60 @@ class NDSparseMatrix:
                 self.append(sm_matrix, name=name[i])
             i += 1
 
-    def save(self, output_path, overwritten_para=True):
+    def save(self, output_path, overwritten_para=True, storage: str = None, chunk_shape: tuple = None, codec: str = None):
+
+        # The storage is 'npz' (one npz per layer), 'chunk' (single chunked container) or 'codec' (one .lyr per layer encoded by the layer_codec)
+        # By default, the NDsm loaded from a chunked container or a codec folder is saved in the same storage
+        if codec is not None:
+            storage = 'codec' if storage is None else storage
+            layer_codec.parse_codec(codec)
+        if storage is None:
+            storage = 'chunk' if isinstance(self.SM_group, _ChunkedSMGroup) or chunk_shape is not None else ('codec' if self._codec is not None else 'npz')
+        elif storage not in ['npz', 'chunk', 'codec']:
+            raise ValueError(f'The storage {str(storage)} is not supported!')
+        if storage == 'codec':
+            codec = self._codec if codec is None else codec
+            if codec is None:
+                raise ValueError('Please input the codec for the codec storage!')
+        elif codec is not None:
+            raise ValueError(f'The codec is not supported for the {storage} storage!')
 
         bf.create_folder(output_path)
         output_path = bf.Path(output_path).path_name
+
+        if storage == 'chunk':
+            self._save_chunked(output_path, chunk_shape=chunk_shape)
+            return
+
+        # Remove the chunked header to prevent loading the out-of-date container
+        # and the codec header if the storage of the folder is changed
+        for header_file in ['SMchunk_header.json', 'SMchunk_index.npy'] + (['SMcodec.json'] if storage == 'npz' else []):
+            if os.path.exists(output_path + header_file):
+                os.remove(output_path + header_file)
+
+        # The untouched layers of a lazy NDsm are already on disk (under the same codec)
+        if isinstance(self.SM_group, _NpzSMGroup) and self.SM_group._input_path == output_path and self.SM_group.codec == codec:
+            unchanged_layers = set([_ for _ in self.SM_namelist if _ not in self.SM_group._modified])
+        else:
+            unchanged_layers = set()
+
+        if storage == 'codec':
+            with tqdm(total=len(self.SM_namelist), desc=f'Saving the N-D sparse matrix ({codec})', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
+                for sm_name in self.SM_namelist:
+                    if sm_name not in unchanged_layers and (not os.path.exists(output_path + str(sm_name) + '.lyr') or overwritten_para):
+                        layer_codec.write_layer(output_path + str(sm_name) + '.lyr', self.SM_group[sm_name], codec)
+                    pbar.update()
+            bf.dump_json_atomic(output_path + 'SMcodec.json', {'codec': codec, 'shape': [self._rows, self._cols], 'dtype': np.dtype(self.dtype).str, 'matrix_type': self._matrix_type.__name__ if self._matrix_type is not None else 'csr_matrix'})
+            bf.save_npy_atomic(output_path + 'SMsequence.npz.npy', np.array(self.SM_namelist))
+            return
+
         i = 0
 
         with tqdm(total=len(self.SM_namelist), desc=f'Saving the N-D sparse matrix', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
             for sm_name in self.SM_namelist:
-                if not os.path.exists(output_path + str(sm_name) + '.npz') or overwritten_para:
+                if sm_name in unchanged_layers:
+                    pass
+                elif not os.path.exists(output_path + str(sm_name) + '.npz') or overwritten_para:
                     if isinstance(self.SM_group[sm_name], sm.lil_matrix):
                         sm_temp = sm.csc_matrix(self.SM_group[sm_name])
                         sm.save_npz(output_path + str(sm_name) + '.npz', sm_temp)
@@ -161,12 +520,113 @@ class NDSparseMatrix:
                 i += 1
                 pbar.update()
 
-        np.save(output_path + 'SMsequence.npz', np.array(self.SM_namelist))
+        bf.save_npy_atomic(output_path + 'SMsequence.npz.npy', np.array(self.SM_namelist))
 
-    def load(self, input_path):
+    def _save_chunked(self, output_path, chunk_shape: tuple = None):
 
+        # Determine the chunk shape and the dtype
+        if chunk_shape is None:
+            if isinstance(self.SM_group, _ChunkedSMGroup):
+                chunk_shape = self.SM_group.chunk_shape
+            else:
+                chunk_shape = (1024, 1024, 64)
+        if len(chunk_shape) != 3 or False in [isinstance(_, (int, np.integer)) and _ > 0 for _ in chunk_shape]:
+            raise ValueError('Please input the chunk shape as a tuple of three positive int!')
+        by, bx, bz = [int(_) for _ in chunk_shape]
+
+        if isinstance(self.SM_group, _LazySMGroup):
+            dtype = np.result_type(self.SM_group.dtype, *[_.dtype for _ in self.SM_group._modified.values()])
+        else:
+            dtype = np.result_type(*[self.SM_group[_].dtype for _ in self.SM_namelist])
+
+        rows, cols, height = self._rows, self._cols, len(self.SM_namelist)
+        nyb, nxb, nzb = (rows - 1) // by + 1, (cols - 1) // bx + 1, max((height - 1) // bz + 1, 1)
+        chunk_index = np.full((nyb, nxb, nzb, 2), -1, dtype=np.int64)
+        chunk_index[..., 1] = 0
+
+        # Write the chunks into a temporary container since the original one might be memory-mapped
+        offset = 0
+        with open(output_path + 'SMchunk.bin.tmp', 'wb') as bin_temp, tqdm(total=nzb, desc=f'Saving the chunked N-D sparse matrix', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
+            for zb in range(nzb):
+                layer_list = [sm.csr_matrix(self.SM_group[_], dtype=dtype) for _ in self.SM_namelist[zb * bz: (zb + 1) * bz]]
+                for yb in range(nyb):
+                    for xb in range(nxb):
+                        indptr, indices, data = [0], [], []
+                        for z_local in range(bz):
+                            if z_local < len(layer_list):
+                                block_temp = layer_list[z_local][yb * by: (yb + 1) * by, xb * bx: (xb + 1) * bx]
+                                block_temp.sort_indices()
+                                block_indptr = block_temp.indptr[1:] + indptr[-1]
+                                block_indptr = np.concatenate([block_indptr, np.full(by - block_indptr.shape[0], block_indptr[-1])])
+                                indices.append(block_temp.indices.astype(np.int32))
+                                data.append(block_temp.data)
+                            else:
+                                block_indptr = np.full(by, indptr[-1])
+                            indptr.extend(block_indptr.tolist())
+
+                        nnz = int(indptr[-1])
+                        if nnz == 0:
+                            continue
+                        chunk_bytes = [np.array(indptr, dtype=np.int64).tobytes(), np.concatenate(indices).astype(np.int32).tobytes(), np.concatenate(data).astype(dtype).tobytes()]
+                        chunk_index[yb, xb, zb] = [offset, nnz]
+                        for bytes_temp in chunk_bytes:
+                            bin_temp.write(bytes_temp + bytes(_pad8(len(bytes_temp)) - len(bytes_temp)))
+                            offset += _pad8(len(bytes_temp))
+                pbar.update()
+
+        # Release the memmap before replacing the container
+        if isinstance(self.SM_group, _ChunkedSMGroup):
+            self.SM_group.close()
+        os.replace(output_path + 'SMchunk.bin.tmp', output_path + 'SMchunk.bin')
+        np.save(output_path + 'SMchunk_index.npy', chunk_index)
+
+        header = {'SM_namelist': [_.item() if isinstance(_, np.generic) else _ for _ in self.SM_namelist],
+                  'shape': [rows, cols, height], 'chunk_shape': [by, bx, bz], 'dtype': np.dtype(dtype).str}
+        with open(output_path + 'SMchunk_header.json', 'w') as js_temp:
+            json.dump(header, js_temp)
+
+        # Remove the npz header to prevent loading the out-of-date layers
+        if os.path.exists(output_path + 'SMsequence.npz.npy'):
+            os.remove(output_path + 'SMsequence.npz.npy')
+
+        # Re-point the chunked NDsm to the new container
+        if isinstance(self.SM_group, _ChunkedSMGroup):
+            self._load_chunked(output_path, cache_bytes=self.SM_group.cache_bytes)
+
+    def _load_chunked(self, input_path, cache_bytes: int = None):
+
+        with open(input_path + 'SMchunk_header.json') as js_temp:
+            header = json.load(js_temp)
+
+        self.SM_group = _ChunkedSMGroup(input_path, header, cache_bytes=cache_bytes)
+        self._input_path = input_path
+        self.SM_namelist = np.sort(np.array(header['SM_namelist'])).tolist()
+        self._matrix_type = sm.csr_matrix
+        self._update_size_para()
+        self._mark_ondisk()
+        return self
+
+    def load(self, input_path, lazy: bool = False, cache_bytes: int = None):
+
+        # The lazy mode decodes the layer on first access and keeps at most cache_bytes of decoded layers
         input_path = bf.Path(input_path).path_name
-        file_list = bf.file_filter(input_path, ['SMsequence.npz'])
+
+        # Open the chunked container lazily
+        if os.path.exists(input_path + 'SMchunk_header.json'):
+            return self._load_chunked(input_path, cache_bytes=cache_bytes)
+
+        # The layers of the codec folder are decoded by the layer_codec
+        if os.path.exists(input_path + 'SMcodec.json'):
+            with open(input_path + 'SMcodec.json') as js_temp:
+                codec_header = json.load(js_temp)
+            self._codec = codec_header['codec']
+            layer_codec.parse_codec(self._codec)
+        else:
+            codec_header, self._codec = None, None
+        layer_suffix = '.npz' if self._codec is None else '.lyr'
+
+        # The temporary header left by an interrupted save is excluded
+        file_list = bf.file_filter(input_path, ['SMsequence.npz'], exclude_word_list=['.partial', '_tmp.npy'])
 
         if len(file_list) == 0:
             raise ValueError('The header file is missing！')
@@ -179,11 +639,14 @@ class NDSparseMatrix:
                 header_file = np.load(file_list[0], allow_pickle=True)
 
         self.SM_namelist = np.sort(header_file).tolist()
+        if lazy:
+            return self._load_lazy(input_path, cache_bytes=cache_bytes, codec_header=codec_header)
+
         self.SM_group = {}
         missing_sm = []
 
         for SM_name in self.SM_namelist:
-            SM_arr_path = bf.file_filter(input_path, [f'{str(SM_name)}.npz'], and_or_factor='and')
+            SM_arr_path = bf.file_filter(input_path, [f'{str(SM_name)}{layer_suffix}'], and_or_factor='and')
             if len(SM_arr_path) == 0:
                 missing_sm.append(SM_name)
                 # raise ValueError(f'The file {str(SM_name)} is missing！')
@@ -191,7 +654,10 @@ class NDSparseMatrix:
                 raise ValueError(f'There are more than one file sharing name {str(SM_name)}')
             else:
                 try:
-                    SM_arr_temp = sm.load_npz(SM_arr_path[0])
+                    if self._codec is not None:
+                        SM_arr_temp = getattr(sm, codec_header.get('matrix_type', 'csr_matrix'))(layer_codec.read_layer(SM_arr_path[0], mmap=False))
+                    else:
+                        SM_arr_temp = sm.load_npz(SM_arr_path[0])
                 except:
                     raise Exception(f'file {str(SM_name)} cannot be loaded')
                 self.SM_group[SM_name] = SM_arr_temp
@@ -212,8 +678,137 @@ class NDSparseMatrix:
 
         self._update_size_para()
         self._matrix_type = type(SM_arr_temp)
+        self._input_path = input_path
+        self._mark_ondisk()
         return self
 
+    def _load_lazy(self, input_path, cache_bytes: int = None, codec_header: dict = None):
+
+        # Check the missing layer with one listing of the folder
+        npz_list = set(bf.list_dir(input_path))
+        layer_suffix = '.npz' if codec_header is None else '.lyr'
+        missing_sm = [_ for _ in self.SM_namelist if f'{str(_)}{layer_suffix}' not in npz_list]
+        if missing_sm:
+            for _ in missing_sm:
+                self.SM_namelist.remove(_)
+            bf.save_npy_atomic(input_path + 'SMsequence.npz.npy', np.array(self.SM_namelist))
+
+        if len(self.SM_namelist) == 0:
+            raise ValueError('There is no valid layer in the N-D sparse matrix!')
+
+        # Read the first layer for the shape, dtype and matrix type, the codec folder records them in the SMcodec.json
+        if codec_header is not None:
+            layer_shape, dtype, matrix_type = tuple(codec_header['shape']), np.dtype(codec_header['dtype']), getattr(sm, codec_header.get('matrix_type', 'csr_matrix'))
+        else:
+            first_layer = sm.load_npz(f'{input_path}{str(self.SM_namelist[0])}.npz')
+            layer_shape, dtype, matrix_type = first_layer.shape, first_layer.dtype, type(first_layer)
+        self.SM_group = _NpzSMGroup(input_path, self.SM_namelist, layer_shape, dtype, matrix_type, cache_bytes=cache_bytes, codec=self._codec)
+        self._input_path = input_path
+        self._matrix_type = matrix_type
+        self._update_size_para()
+        self._mark_ondisk()
+        return self
+
+    def ingest(self, sm_matrix_list: list, name_list: list):
+
+        # Add the new layers into the NDsm and its on-disk folder without rewriting the untouched layers
+        # (1) Each new layer is written into its own npz (or .lyr under the codec), then the SMsequence is replaced as the commit of the ingestion
+        # (2) The chunked container cannot be extended in place, thus it is re-saved as a whole
+        # (3) The layers are kept sorted by name as the load() does
+        if self._input_path is None:
+            raise Exception('The ingestion is only supported for the NDsm loaded from disk!')
+        elif len(sm_matrix_list) != len(name_list):
+            raise ValueError('The sm matrix list and the name list are not consistent!')
+
+        for name in name_list:
+            if name in self.SM_namelist:
+                raise ValueError(f'The layer {str(name)} is already in the N-D sparse matrix!')
+        for sm_matrix in sm_matrix_list:
+            if sm_matrix.shape != (self._rows, self._cols):
+                raise ValueError(f'The shape of the new layer {str(sm_matrix.shape)} is not consistent with the N-D sparse matrix!')
+
+        ondisk = self.is_ondisk()
+        if isinstance(self.SM_group, _ChunkedSMGroup):
+            for sm_matrix, name in zip(sm_matrix_list, name_list):
+                self.SM_group[name] = sm.csr_matrix(sm_matrix)
+            self.SM_namelist = np.sort(np.array(self.SM_namelist + list(name_list))).tolist()
+            self._update_size_para()
+            self.save(self._input_path, storage='chunk')
+            return self
+
+        # Write the new layers
+        for sm_matrix, name in zip(sm_matrix_list, name_list):
+            if self._matrix_type is not None and type(sm_matrix) != self._matrix_type:
+                sm_matrix = self._matrix_type(sm_matrix)
+            if self._codec is not None:
+                layer_codec.write_layer(f'{self._input_path}{str(name)}.lyr', sm_matrix, self._codec)
+            else:
+                sm.save_npz(f'{self._input_path}{str(name)}_tmp.npz', sm_matrix)
+                os.replace(f'{self._input_path}{str(name)}_tmp.npz', f'{self._input_path}{str(name)}.npz')
+
+            # The lazy group reads the new layer from disk on demand
+            if isinstance(self.SM_group, _NpzSMGroup) and self.SM_group._input_path == self._input_path:
+                self.SM_group._ondisk_namelist.append(name)
+                self.SM_group._ondisk_names.add(name)
+                self.SM_group._removed.discard(name)
+            else:
+                self.SM_group[name] = sm_matrix
+
+        # Commit the new sequence
+        self.SM_namelist = np.sort(np.array(self.SM_namelist + list(name_list))).tolist()
+        bf.save_npy_atomic(self._input_path + 'SMsequence.npz.npy', np.array(self.SM_namelist))
+        self._update_size_para()
+        if ondisk:
+            self._mark_ondisk()
+        return self
+
+    def share_memory(self):
+
+        # Export the layers into one shared memory block and return the shared NDsm
+        # The shared NDsm is pickled with the block name only, thus the worker attaches it without copying the layers
+        # Call the release_shared_memory() of the returned NDsm after the workers finished
+        matrix_type = self._matrix_type if self._matrix_type in (sm.csr_matrix, sm.csc_matrix) else sm.csr_matrix
+        layer_list = [matrix_type(self.SM_group[_]) for _ in self.SM_namelist]
+        if len(layer_list) == 0:
+            raise ValueError('There is no layer in the N-D sparse matrix!')
+
+        dtype = np.result_type(*[_.dtype for _ in layer_list])
+        idx_max = max([max(self._rows, self._cols)] + [_.nnz for _ in layer_list])
+        idx_dtype = np.dtype(np.int32) if idx_max < np.iinfo(np.int32).max else np.dtype(np.int64)
+
+        # Generate the layout
+        layout, offset = {}, 0
+        for name, layer in zip(self.SM_namelist, layer_list):
+            indptr_off = offset
+            indices_off = indptr_off + _pad8(layer.indptr.shape[0] * idx_dtype.itemsize)
+            data_off = indices_off + _pad8(layer.nnz * idx_dtype.itemsize)
+            offset = data_off + _pad8(layer.nnz * dtype.itemsize)
+            layout[name] = (indptr_off, layer.indptr.shape[0], indices_off, layer.nnz, data_off)
+
+        # Copy the layers into the block
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+        for name, layer in zip(self.SM_namelist, layer_list):
+            indptr_off, indptr_len, indices_off, nnz, data_off = layout[name]
+            np.ndarray((indptr_len,), dtype=idx_dtype, buffer=shm.buf, offset=indptr_off)[:] = layer.indptr
+            np.ndarray((nnz,), dtype=idx_dtype, buffer=shm.buf, offset=indices_off)[:] = layer.indices
+            np.ndarray((nnz,), dtype=dtype, buffer=shm.buf, offset=data_off)[:] = layer.data
+
+        shared_group = _SharedSMGroup(shm.name, layout, self.SM_namelist, (self._rows, self._cols), dtype, idx_dtype, matrix_type=matrix_type)
+        shared_group._shm, shared_group._owner = shm, True
+
+        shared_ndsm = NDSparseMatrix()
+        shared_ndsm.SM_group = shared_group
+        shared_ndsm.SM_namelist = list(self.SM_namelist)
+        shared_ndsm._matrix_type = matrix_type
+        shared_ndsm._update_size_para()
+        return shared_ndsm
+
+    def release_shared_memory(self):
+
+        # Close the attached block, the block is unlinked if it was created by this process
+        if isinstance(self.SM_group, _SharedSMGroup):
+            self.SM_group.release()
+
     def replace_layer(self, ori_layer_name, new_layer, new_layer_name=None):
 
         if type(new_layer) not in (sm.spmatrix, sm.csr_matrix, sm.csc_matrix, sm.coo_matrix, sm.bsr_matrix, sm.dia_matrix, sm.dok_matrix):
@@ -261,8 +856,14 @@ class NDSparseMatrix:
             raise ValueError(f'The {layer_name} cannot be found')
         else:
             self.SM_group.pop(layer_name)
+            layer_pos = self.SM_namelist.index(layer_name)
             self.SM_namelist.remove(layer_name)
+
+        # Drop the layer from the pixel-major cube rather than rebuilding it
+        pixel_major = self._pixel_major
         self._update_size_para()
+        if pixel_major is not None:
+            self._pixel_major = pixel_major[[_ for _ in range(pixel_major.shape[0]) if _ != layer_pos], :]
 
     def _understand_range(self, list_temp: list, range_temp: range):
 
@@ -293,6 +894,13 @@ class NDSparseMatrix:
             cols_range = self._understand_range(tuple_temp[1], range(self._cols + 1))
             heights_range = self._understand_range(tuple_temp[2], range(self._height + 1))
 
+        # Only read the touched chunks for the chunked container
+        if isinstance(self.SM_group, _ChunkedSMGroup):
+            namelist_temp = self.SM_namelist[heights_range[0]: heights_range[1]]
+            output_array = NDSparseMatrix(*[self.SM_group.read_window(_, rows_range, cols_range) for _ in namelist_temp], SM_namelist=namelist_temp)
+            self._extract_pixel_major(output_array, rows_range, cols_range, heights_range)
+            return output_array
+
         output_array = None
         height_temp = 0
         while height_temp < self._height:
@@ -314,8 +922,16 @@ class NDSparseMatrix:
 
         if output_array._cols != cols_range[1] - cols_range[0] or output_array._rows != rows_range[1] - rows_range[0] or output_array._height != heights_range[1] - heights_range[0]:
             raise Exception('Code error for the NDsparsematrix extraction')
+        self._extract_pixel_major(output_array, rows_range, cols_range, heights_range)
         return output_array
 
+    def _extract_pixel_major(self, output_array, rows_range: list, cols_range: list, heights_range: list):
+
+        # Carry the pixel-major cube of the window into the extracted NDsm
+        if self._pixel_major is not None:
+            window_y, window_x = np.mgrid[rows_range[0]: rows_range[1], cols_range[0]: cols_range[1]]
+            output_array._pixel_major = self._pixel_major[:, (window_y * self._cols + window_x).flatten()][heights_range[0]: heights_range[1], :].tocsc()
+
     def _extract_matrix_y1x1zh(self, tuple_temp: tuple, nodata_export=False):
 
         # tt0, tt1, tt2 = 0, 0, 0
@@ -334,7 +950,10 @@ class NDSparseMatrix:
         for height_temp in range(self._height):
             if height_temp in range(heights_range[0], heights_range[1]):
                 date_tt = self.SM_namelist[height_temp]
-                temp = self.SM_group[date_tt][rows_extract, cols_extract]
+                if isinstance(self.SM_group, _ChunkedSMGroup):
+                    temp = self.SM_group.read_window(date_tt, [rows_extract, rows_extract + 1], [cols_extract, cols_extract + 1])[0, 0]
+                else:
+                    temp = self.SM_group[date_tt][rows_extract, cols_extract]
                 if nodata_export:
                     date_temp.append(date_tt)
                     index_temp.append(temp)
@@ -368,7 +987,10 @@ class NDSparseMatrix:
         for height_temp in range(self._height):
             if height_temp in range(heights_range[0], heights_range[1]):
                 date_tt = self.SM_namelist[height_temp]
-                temp = self.SM_group[date_tt][rows_extract, cols_extract]
+                if isinstance(self.SM_group, _ChunkedSMGroup):
+                    temp = self.SM_group.read_window(date_tt, [rows_extract, rows_extract + 1], [cols_extract, cols_extract + 1])[0, 0]
+                else:
+                    temp = self.SM_group[date_tt][rows_extract, cols_extract]
                 if nodata_export:
                     index_temp.append(temp)
                 elif not nodata_export and temp != 0:
@@ -379,6 +1001,154 @@ class NDSparseMatrix:
 
         return index_temp
 
+    def _transpose_layers(self, namelist: list):
+
+        # Transpose the layers into a (layer, pixel) csc matrix, thus the time series of each pixel is a contiguous column
+        z_list, pixel_list, data_list = [], [], []
+        for z_temp, name in enumerate(namelist):
+            layer = sm.coo_matrix(self.SM_group[name])
+            z_list.append(np.full(layer.nnz, z_temp, dtype=np.int64))
+            pixel_list.append(layer.row.astype(np.int64) * self._cols + layer.col)
+            data_list.append(layer.data)
+
+        if len(data_list) == 0:
+            return sm.csc_matrix((len(namelist), self._rows * self._cols))
+        else:
+            return sm.csc_matrix((np.concatenate(data_list), (np.concatenate(z_list), np.concatenate(pixel_list))), shape=(len(namelist), self._rows * self._cols))
+
+    def _persisted_pixel_major(self):
+
+        # Memory-map the (data, indices, indptr) of the persisted pixel-major cube if it is consistent with the current layers
+        input_path = getattr(self, '_input_path', None)
+        if input_path is None or not os.path.exists(input_path + 'SMpixel_major_namelist.npy'):
+            return None
+        elif False in [os.path.exists(f'{input_path}SMpixel_major_{_}.npy') for _ in ['data', 'indices', 'indptr']]:
+            return None
+        elif np.load(input_path + 'SMpixel_major_namelist.npy', allow_pickle=True).tolist() != list(self.SM_namelist) or (isinstance(self.SM_group, _LazySMGroup) and len(self.SM_group._modified) != 0):
+            return None
+
+        data, indices, indptr = [np.load(f'{input_path}SMpixel_major_{_}.npy', mmap_mode='r') for _ in ['data', 'indices', 'indptr']]
+        if indptr.shape[0] != self._rows * self._cols + 1:
+            return None
+        return data, indices, indptr
+
+    def load_pixel_major(self):
+
+        # Use the persisted pixel-major cube if it is consistent with the current layers
+        # Return whether the pixel-major cube is available without transposing the layers
+        if self._pixel_major is not None:
+            return True
+        persisted = self._persisted_pixel_major()
+        if persisted is None:
+            return False
+        data, indices, indptr = persisted
+        self._pixel_major = sm.csc_matrix((np.array(data), np.array(indices), np.array(indptr)), shape=(self._height, self._rows * self._cols))
+        return True
+
+    def read_pixel_major_window(self, rows_range: list, cols_range: list, heights_range: list = ['all']):
+
+        # Read the columns of the y-x window from the persisted pixel-major cube without loading the whole cube
+        # The columns of each row of the window are contiguous, thus only the touched segments of the memory-mapped arrays are read
+        # Return None if the persisted pixel-major cube is not available
+        rows_range = self._understand_range(rows_range, range(self._rows + 1))
+        cols_range = self._understand_range(cols_range, range(self._cols + 1))
+        heights_range = self._understand_range(heights_range, range(self._height + 1))
+        persisted = self._persisted_pixel_major()
+        if persisted is None:
+            return None
+
+        data, indices, indptr = persisted
+        data_list, indices_list, count_list = [], [], [np.zeros(1, dtype=np.int64)]
+        for row_temp in range(rows_range[0], rows_range[1]):
+            ptr_temp = np.asarray(indptr[row_temp * self._cols + cols_range[0]: row_temp * self._cols + cols_range[1] + 1], dtype=np.int64)
+            data_list.append(np.asarray(data[ptr_temp[0]: ptr_temp[-1]]))
+            indices_list.append(np.asarray(indices[ptr_temp[0]: ptr_temp[-1]]))
+            count_list.append(np.diff(ptr_temp))
+
+        window = sm.csc_matrix((np.concatenate(data_list) if data_list else np.zeros(0, dtype=data.dtype),
+                                np.concatenate(indices_list) if indices_list else np.zeros(0, dtype=indices.dtype),
+                                np.cumsum(np.concatenate(count_list))),
+                               shape=(self._height, (rows_range[1] - rows_range[0]) * (cols_range[1] - cols_range[0])))
+        return window[heights_range[0]: heights_range[1], :].tocsc()
+
+    def _build_pixel_major(self):
+
+        # Transpose the layers unless the persisted pixel-major cube is available
+        if not self.load_pixel_major():
+            self._pixel_major = self._transpose_layers(self.SM_namelist)
+        return self._pixel_major
+
+    def save_pixel_major(self, output_path):
+
+        # Persist the pixel-major cube next to the layers
+        # Only the layers absent from (or modified after) the existing pixel-major cube are transposed
+        output_path = bf.Path(output_path).path_name
+        namelist_file = output_path + 'SMpixel_major_namelist.npy'
+        pm_files = [f'{output_path}SMpixel_major_{_}.npy' for _ in ['data', 'indices', 'indptr']]
+
+        if self._pixel_major is not None:
+            pixel_major = self._pixel_major
+        elif os.path.exists(namelist_file) and False not in [os.path.exists(_) for _ in pm_files]:
+            ori_namelist = np.load(namelist_file, allow_pickle=True).tolist()
+            data, indices, indptr = [np.load(_) for _ in pm_files]
+            ori_pixel_major = sm.csc_matrix((data, indices, indptr), shape=(len(ori_namelist), indptr.shape[0] - 1)).tocsr()
+            modified_layers = set(self.SM_group._modified) if isinstance(self.SM_group, _LazySMGroup) else set()
+
+            if ori_pixel_major.shape[1] != self._rows * self._cols:
+                pixel_major = self._transpose_layers(self.SM_namelist)
+            else:
+                current_layers = set(self.SM_namelist)
+                kept_pos = [_ for _, name in enumerate(ori_namelist) if name in current_layers and name not in modified_layers]
+                kept_namelist = [ori_namelist[_] for _ in kept_pos]
+                kept_layers = set(kept_namelist)
+                new_namelist = [_ for _ in self.SM_namelist if _ not in kept_layers]
+
+                stacked_namelist = kept_namelist + new_namelist
+                stacked_pos = {name: pos for pos, name in enumerate(stacked_namelist)}
+                stacked = sm.vstack([ori_pixel_major[kept_pos], self._transpose_layers(new_namelist).tocsr()], format='csr')
+                pixel_major = stacked[[stacked_pos[_] for _ in self.SM_namelist]].tocsc()
+        else:
+            pixel_major = self._transpose_layers(self.SM_namelist)
+
+        # The cube is stored as the uncompressed csc arrays, thus the worker memory-maps them and reads the columns of its tile only
+        # The namelist is written last, thus an interrupted save is never regarded as consistent
+        pixel_major = pixel_major.tocsc()
+        pixel_major.sort_indices()
+        if os.path.exists(namelist_file):
+            os.remove(namelist_file)
+        for pm_file, arr in zip(pm_files, [pixel_major.data, pixel_major.indices, pixel_major.indptr]):
+            bf.save_npy_atomic(pm_file, arr)
+        bf.save_npy_atomic(namelist_file, np.array(self.SM_namelist))
+        self._pixel_major = pixel_major
+        self._input_path = output_path
+
+    def extract_pixel_series(self, y_arr, x_arr, z_range: list = None, pixel_major: bool = True):
+
+        # Extract the time series of a batch of pixels into a dense (n_pixels, n_layers) array
+        # (1) With pixel_major, the transposed cube is built once and cached until the layers are changed
+        # (2) Without pixel_major, each layer is indexed once for all the pixels
+        y_arr, x_arr = np.asarray(y_arr, dtype=np.int64).flatten(), np.asarray(x_arr, dtype=np.int64).flatten()
+        if y_arr.shape[0] != x_arr.shape[0]:
+            raise ValueError('The y and x of the pixels are not consistent!')
+        elif y_arr.shape[0] > 0 and (y_arr.min() < 0 or y_arr.max() >= self._rows or x_arr.min() < 0 or x_arr.max() >= self._cols):
+            raise ValueError('The pixel is out of the range of the N-D sparse matrix!')
+
+        heights_range = [0, self._height] if z_range is None else self._understand_range(z_range, range(self._height + 1))
+
+        if pixel_major:
+            if self._pixel_major is None:
+                self._build_pixel_major()
+            series = self._pixel_major[:, y_arr * self._cols + x_arr].toarray().T
+            return series[:, heights_range[0]: heights_range[1]]
+        else:
+            series = np.zeros([y_arr.shape[0], heights_range[1] - heights_range[0]], dtype=self.SM_group[self.SM_namelist[heights_range[0]]].dtype)
+            for z_temp in range(heights_range[0], heights_range[1]):
+                layer = self.SM_group[self.SM_namelist[z_temp]]
+                if not isinstance(layer, (sm.csr_matrix, sm.csc_matrix)):
+                    layer = sm.csr_matrix(layer)
+                series[:, z_temp - heights_range[0]] = np.asarray(layer[y_arr, x_arr]).flatten()
+            return series
+
     def drop_nanlayer(self):
 
         i = 0
@@ -392,6 +1162,205 @@ class NDSparseMatrix:
 
         return self
 
+    def _reduce_mask(self, mask, z_temp: int, flat_temp, data_temp):
+
+        # Evaluate the mask at the stored pixels of the z_temp-th layer
+        if callable(mask):
+            return np.asarray(mask(data_temp), dtype=bool)
+        elif isinstance(mask, NDSparseMatrix):
+            mask_flat, mask_data = _layer_flat_index(mask.SM_group[mask.SM_namelist[z_temp]], self._cols)
+            mask_flat = mask_flat[mask_data != 0]
+            mask_flat = np.sort(mask_flat)
+            pos = np.searchsorted(mask_flat, flat_temp)
+            pos[pos >= mask_flat.shape[0]] = 0
+            return mask_flat[pos] == flat_temp if mask_flat.shape[0] > 0 else np.zeros(flat_temp.shape[0], dtype=bool)
+        elif mask.ndim == 2:
+            return mask.ravel()[flat_temp].astype(bool)
+        else:
+            return mask[:, :, z_temp].ravel()[flat_temp].astype(bool)
+
+    def reduce(self, method: str, z_range: list = None, namelist: list = None, mask=None, q=None, batch_size: int = 32, block_bytes: int = 512 * 1024 ** 2):
+
+        # Reduce the layers along the z axis into a dense (rows, cols) array
+        # (1) Only the stored and non-nan values are observations, the implicit zeros are treated as no data
+        #     Except that the sum propagates the stored nan as the np.sum, while the nansum ignores it
+        # (2) The layers are reduced in batches of batch_size layers directly on their index arrays, thus at most batch_size layers are decoded at once
+        # (3) The mask could be a NDsm or a (rows, cols, z) array aligned with the layers, a (rows, cols) array shared by all layers, or a callable on the stored values
+        # (4) The sum, nansum and count are 0 for the pixel without observation, the other methods return nan (-1 for the argmax)
+        # (5) The percentile sorts the observations of the row blocks one by one, each row block holds about block_bytes of observations
+        #     (each layer is decoded once per row block)
+        if method not in ['sum', 'nansum', 'mean', 'min', 'max', 'count', 'argmax', 'percentile']:
+            raise ValueError(f'The reduction method {str(method)} is not supported!')
+        elif method == 'percentile' and q is None:
+            raise ValueError('Please input the q for the percentile reduction!')
+        elif not isinstance(batch_size, int) or batch_size <= 0:
+            raise TypeError('The batch_size should be a positive int!')
+        elif not isinstance(block_bytes, int) or block_bytes <= 0:
+            raise TypeError('The block_bytes should be a positive int!')
+
+        if namelist is not None:
+            if z_range is not None:
+                raise ValueError('The z_range and namelist cannot be input simultaneously!')
+            for _ in namelist:
+                if _ not in self.SM_namelist:
+                    raise ValueError(f'The layer {str(_)} is not in the N-D sparse matrix!')
+            z_list = [self.SM_namelist.index(_) for _ in namelist]
+        else:
+            heights_range = [0, self._height] if z_range is None else self._understand_range(z_range, range(self._height + 1))
+            z_list = list(range(heights_range[0], heights_range[1]))
+
+        if mask is not None and not callable(mask):
+            if isinstance(mask, NDSparseMatrix):
+                if mask.shape[0] != self._rows or mask.shape[1] != self._cols or mask.shape[2] != self._height:
+                    raise ValueError('The mask is not consistent with the N-D sparse matrix!')
+            elif isinstance(mask, np.ndarray):
+                if mask.shape[:2] != (self._rows, self._cols) or (mask.ndim == 3 and mask.shape[2] != self._height) or mask.ndim not in (2, 3):
+                    raise ValueError('The mask is not consistent with the N-D sparse matrix!')
+            else:
+                raise TypeError('The mask should be a NDsm, a ndarray or a callable!')
+
+        # Generate the accumulator
+        pixel_num = self._rows * self._cols
+        count_arr = np.zeros(pixel_num, dtype=np.int64)
+        nan_arr = np.zeros(pixel_num, dtype=bool)
+        if method in ['sum', 'nansum', 'mean']:
+            acc_arr = np.zeros(pixel_num, dtype=np.float64)
+        elif method in ['min', 'max', 'argmax']:
+            acc_arr = np.full(pixel_num, np.nan, dtype=np.float64)
+            arg_arr = np.full(pixel_num, -1, dtype=np.int64)
+
+        for batch_beg in range(0, len(z_list), batch_size):
+
+            # Gather the observations of the batch
+            batch_flat, batch_data, batch_z = [], [], []
+            for z_temp in z_list[batch_beg: batch_beg + batch_size]:
+                flat_temp, data_temp, nan_flat = self._reduce_observation(z_temp, mask)
+                if method == 'sum':
+                    nan_arr[nan_flat] = True
+                batch_flat.append(flat_temp)
+                batch_data.append(data_temp)
+                if method == 'argmax':
+                    batch_z.append(np.full(batch_flat[-1].shape[0], z_temp, dtype=np.int64))
+
+            if len(batch_flat) == 0:
+                continue
+            batch_flat, batch_data = np.concatenate(batch_flat), np.concatenate(batch_data)
+            count_arr += np.bincount(batch_flat, minlength=pixel_num)
+
+            if method in ['sum', 'nansum', 'mean']:
+                acc_arr += np.bincount(batch_flat, weights=batch_data, minlength=pixel_num)
+            elif method == 'min':
+                np.fmin.at(acc_arr, batch_flat, batch_data)
+            elif method == 'max':
+                np.fmax.at(acc_arr, batch_flat, batch_data)
+            elif method == 'argmax':
+                # The first layer reaching the maximum is kept as np.nanargmax
+                batch_z = np.concatenate(batch_z)
+                batch_max = np.full(pixel_num, np.nan, dtype=np.float64)
+                np.fmax.at(batch_max, batch_flat, batch_data)
+                cand_temp = batch_data == batch_max[batch_flat]
+                batch_arg = np.full(pixel_num, np.iinfo(np.int64).max, dtype=np.int64)
+                np.minimum.at(batch_arg, batch_flat[cand_temp], batch_z[cand_temp])
+                update_temp = ~np.isnan(batch_max) & (np.isnan(acc_arr) | (batch_max > acc_arr))
+                acc_arr[update_temp], arg_arr[update_temp] = batch_max[update_temp], batch_arg[update_temp]
+
+        if method == 'count':
+            output_arr = count_arr
+        elif method == 'sum':
+            output_arr = acc_arr
+            output_arr[nan_arr] = np.nan
+        elif method == 'nansum':
+            output_arr = acc_arr
+        elif method == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                output_arr = acc_arr / count_arr
+        elif method in ['min', 'max']:
+            output_arr = acc_arr
+        elif method == 'argmax':
+            output_arr = arg_arr
+        else:
+            output_arr = self._reduce_percentile(z_list, mask, count_arr, q, block_bytes)
+
+        if method == 'percentile' and not np.isscalar(q):
+            return output_arr.reshape(self._rows, self._cols, -1)
+        else:
+            return output_arr.reshape(self._rows, self._cols)
+
+    def _reduce_observation(self, z_temp: int, mask):
+
+        # Return the flattened pixel index and the value of the valid (non-nan and masked) observations of the z_temp-th layer
+        # and the flattened pixel index of its stored nan (masked)
+        flat_temp, data_temp = _layer_flat_index(self.SM_group[self.SM_namelist[z_temp]], self._cols)
+        nan_temp = np.isnan(data_temp) if np.issubdtype(data_temp.dtype, np.floating) else np.zeros(data_temp.shape[0], dtype=bool)
+        valid_temp = ~nan_temp
+        if mask is not None:
+            mask_temp = self._reduce_mask(mask, z_temp, flat_temp, data_temp)
+            valid_temp &= mask_temp
+            nan_temp &= mask_temp
+        return flat_temp[valid_temp], data_temp[valid_temp].astype(np.float64), flat_temp[nan_temp]
+
+    def _reduce_percentile(self, z_list: list, mask, count_arr, q, block_bytes: int):
+
+        # Sort the observations by pixel and value, then interpolate linearly as np.nanpercentile
+        # The rows are grouped into blocks by the observation count, thus only the observations of one row block are held at once
+        q_arr = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if np.any(q_arr < 0) or np.any(q_arr > 100):
+            raise ValueError('The q should be in the range of 0 to 100!')
+
+        output_arr = np.full([count_arr.shape[0], q_arr.shape[0]], np.nan, dtype=np.float64)
+        if len(z_list) == 0 or count_arr.sum() == 0:
+            return output_arr
+
+        # Each observation takes the flattened index, the value and the sorting order (8 bytes each)
+        row_cumsum = np.concatenate([[0], np.cumsum(count_arr.reshape(self._rows, self._cols).sum(axis=1))])
+        block_obs, row_beg = max(block_bytes // 24, 1), 0
+        while row_beg < self._rows:
+            row_end = max(int(np.searchsorted(row_cumsum, row_cumsum[row_beg] + block_obs, side='right')) - 1, row_beg + 1)
+            pixel_beg, pixel_end = row_beg * self._cols, row_end * self._cols
+
+            # Gather the observations of the row block
+            flat_list, data_list = [], []
+            for z_temp in z_list:
+                flat_temp, data_temp, _ = self._reduce_observation(z_temp, mask)
+                block_temp = (flat_temp >= pixel_beg) & (flat_temp < pixel_end)
+                flat_list.append(flat_temp[block_temp])
+                data_list.append(data_temp[block_temp])
+
+            flat_all, data_all = np.concatenate(flat_list), np.concatenate(data_list)
+            del flat_list, data_list
+            order = np.lexsort((data_all, flat_all))
+            data_all = data_all[order]
+            del flat_all, order
+
+            block_count = count_arr[pixel_beg: pixel_end]
+            valid_pixel = np.nonzero(block_count)[0]
+            start_arr = (np.cumsum(block_count) - block_count)[valid_pixel]
+            n_arr = block_count[valid_pixel]
+            for q_num, q_temp in enumerate(q_arr):
+                pos_arr = q_temp / 100 * (n_arr - 1)
+                lo_arr = np.floor(pos_arr).astype(np.int64)
+                hi_arr = np.minimum(lo_arr + 1, n_arr - 1)
+                lo_v, hi_v = data_all[start_arr + lo_arr], data_all[start_arr + hi_arr]
+                output_arr[pixel_beg + valid_pixel, q_num] = lo_v + (hi_v - lo_v) * (pos_arr - lo_arr)
+            row_beg = row_end
+        return output_arr
+
+        flat_all, data_all = np.concatenate(flat_list), np.concatenate(data_list)
+        order = np.lexsort((data_all, flat_all))
+        data_all = data_all[order]
+        del flat_all, order
+
+        valid_pixel = np.nonzero(count_arr)[0]
+        start_arr = (np.cumsum(count_arr) - count_arr)[valid_pixel]
+        n_arr = count_arr[valid_pixel]
+        for q_num, q_temp in enumerate(q_arr):
+            pos_arr = q_temp / 100 * (n_arr - 1)
+            lo_arr = np.floor(pos_arr).astype(np.int64)
+            hi_arr = np.minimum(lo_arr + 1, n_arr - 1)
+            lo_v, hi_v = data_all[start_arr + lo_arr], data_all[start_arr + hi_arr]
+            output_arr[valid_pixel, q_num] = lo_v + (hi_v - lo_v) * (pos_arr - lo_arr)
+        return output_arr
+
     def sum(self, axis: int, new_layer_name=None):
 
         if axis == 0 or axis == 1:
@@ -402,9 +1371,9 @@ class NDSparseMatrix:
             temp = None
             for _ in self.SM_namelist:
                 if temp is None:
-                    temp = self.SM_group[_].astype(np.float)
+                    temp = self.SM_group[_].astype(np.float64)
                 else:
-                    temp = temp + self.SM_group[_].astype(np.float)
+                    temp = temp + self.SM_group[_].astype(np.float64)
             if new_layer_name is None:
                 new_layer_name = 'sum'
             elif isinstance(new_layer_name, str):
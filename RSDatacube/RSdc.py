@@ -4,6 +4,7 @@ import traceback
 import numpy as np
 import pandas as pd
 from scipy.interpolate import interp1d
+from scipy import ndimage
 from basic_function import Path
 import concurrent.futures
 from itertools import repeat
@@ -15,6 +16,8 @@ from Sentinel2_toolbox.Sentinel_main_V2 import Sentinel2_dc, Sentinel2_ds
 from River_GIS.River_GIS import Inunfac_dc
 from tqdm import tqdm as tq
 from .utils import *
+from .tiling import Tile_scheduler
+from .dc_view import Dc_view
 from shapely import wkt
 
 
@@ -43,7 +46,7 @@ class Denv_dc(object):
     # Currently, it was integrated into the NCEI and MODIS FPAR toolbox as an output datatype.
     ####################################################################################################
 
-    def __init__(self, Denv_dc_filepath, work_env=None, autofill=True):
+    def __init__(self, Denv_dc_filepath, work_env=None, autofill=True, metadata_only: bool = False):
 
         # Check the phemetric path
         self.Denv_dc_filepath = bf.Path(Denv_dc_filepath).path_name
@@ -55,6 +58,7 @@ class Denv_dc(object):
         self.sdc_factor, self.sparse_matrix, self.size_control_factor, self.huge_matrix = False, False, False, False
         self.Denv_factor, self.timescale, self.timerange = False, None, None
         self.compete_doy_list = []
+        self._metadata_only, self._pending_upgrade, self._autofill = metadata_only, False, autofill
 
         # Check work env
         if work_env is not None:
@@ -154,11 +158,48 @@ class Denv_dc(object):
             self.compete_doy_list = bf.date2doy(compete_doy_list)
 
         # Read the Denv datacube
+        # With the metadata_only, the sparse dc is opened lazily and the dense dc is only peeked for its shape and dtype
+        if metadata_only and not (self.sparse_matrix and self.huge_matrix):
+            self._peek_dc()
+        else:
+            self._load_dc()
+
+        # Backdoor metadata check
+        self._backdoor_metadata_check()
+
+        # The format migration is kept in memory until the upgrade() is called
+        if self._pending_upgrade:
+            print(f'The Denv dc of \033[1;31m{self.index}\033[0m is migrated in memory, run the upgrade() to persist it')
+
+        print(f'Finish loading the \033[1;31m{str(self.timerange)}\033[0m Denv dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+
+    def __sizeof__(self):
+        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+
+    def __getattr__(self, name):
+        # The dc of the metadata-only Denv dc is materialised on first access
+        if name == 'dc' and self.__dict__.get('_metadata_only', False):
+            self._load_dc()
+            return self.__dict__['dc']
+        raise AttributeError(name)
+
+    def _peek_dc(self):
+
+        # Read the shape and dtype from the npy header without reading the cube
+        dc_filename = bf.file_filter(self.Denv_dc_filepath, ['Denv_datacube.npy'])
+        if len(dc_filename) != 1:
+            raise ValueError('There has no valid dc or more than one dc in the dc dir!')
+        dc_temp = np.load(dc_filename[0], mmap_mode='r')
+        self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_temp.shape[0], dc_temp.shape[1], dc_temp.shape[2]
+        self.dc_dtype = dc_temp.dtype
+
+    def _load_dc(self):
+
         try:
             if self.sparse_matrix and self.huge_matrix:
                 self.dc_filename = self.Denv_dc_filepath + f'{self.index}_Denv_datacube\\'
                 if os.path.exists(self.dc_filename):
-                    self.dc = NDSparseMatrix().load(self.dc_filename)
+                    self.dc = NDSparseMatrix().load(self.dc_filename, lazy=self._metadata_only)
                 else:
                     raise Exception('Please double check the code if the sparse huge matrix is generated properly')
             elif not self.huge_matrix:
@@ -174,27 +215,40 @@ class Denv_dc(object):
         except:
             raise Exception('Something went wrong when reading the datacube!')
 
-        if autofill is True and len(self.compete_doy_list) > len(self.sdc_doylist):
+        autofill_factor = self._autofill is True and len(self.compete_doy_list) > len(self.sdc_doylist)
+        if autofill_factor:
             self._autofill_Denv_DC()
         elif len(self.compete_doy_list) < len(self.sdc_doylist):
             raise Exception('Code has issues in the Denv autofill procedure!')
 
-        # autotrans sparse matrix
+        # Autotrans sparse matrix
+        # The conversion decodes every layer, thus it is deferred to the upgrade() for the metadata-only dc
         if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
-            self._autotrans_sparse_matrix()
-
-        # Backdoor metadata check
-        self._backdoor_metadata_check()
+            if self._metadata_only:
+                self._pending_upgrade = True
+            else:
+                self._autotrans_sparse_matrix()
 
         # Size calculation and shape definition
         self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+        self.dc_dtype = self.dc.dtype
         if self.dc_ZSize != len(self.sdc_doylist):
             raise TypeError('The Denv datacube is not consistent with the doy list')
 
-        print(f'Finish loading the \033[1;31m{str(self.timerange)}\033[0m Denv dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+        # The autofill is persisted at once, otherwise it is repeated in every open of the dc
+        if autofill_factor:
+            self.upgrade()
 
-    def __sizeof__(self):
-        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+    def upgrade(self, storage: str = None, chunk_shape: tuple = None):
+
+        # Persist the migration deferred by the loading (COO to CSR and relocated ROI paths)
+        if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
+            self._autotrans_sparse_matrix()
+        # The storage or the chunk shape converts the sparse dc (e.g. into the chunked container)
+        if self._pending_upgrade or storage is not None or chunk_shape is not None:
+            self.save(self.Denv_dc_filepath, storage=storage, chunk_shape=chunk_shape)
+            self._pending_upgrade = False
+        return self
 
     def _backdoor_metadata_check(self):
 
@@ -218,14 +272,22 @@ class Denv_dc(object):
 
         # Problem 2
         if backdoor_issue:
-            self.save(self.Phemetric_dc_filepath)
-            self.__init__(self.Phemetric_dc_filepath)
+            self._pending_upgrade = True
 
     def _autofill_Denv_DC(self):
         # Interpolate the denv dc
         autofill_factor = False
-        for date_temp in self.compete_doy_list:
-            if date_temp not in self.sdc_doylist:
+
+        # Locate the neighbouring dates of all the days once through the date index
+        date_index = bf.Date_index(self.sdc_doylist)
+        compete_ordinal = bf.doy2ordinal(self.compete_doy_list)
+        pos_before, gap_before = date_index.nearest(self.compete_doy_list, direction='before', max_gap=59, exclude_self=True)
+        pos_after, gap_after = date_index.nearest(self.compete_doy_list, direction='after', max_gap=59, exclude_self=True)
+        present_factor = date_index.get_pos(self.compete_doy_list) != -1
+        last_filled = None
+
+        for gap_pos, date_temp in enumerate(self.compete_doy_list):
+            if not present_factor[gap_pos]:
                 autofill_factor = True
                 if date_temp == self.compete_doy_list[0]:
                     date_merge = [_ for _ in self.compete_doy_list if _ in self.sdc_doylist][0]
@@ -234,39 +296,32 @@ class Denv_dc(object):
                     else:
                         self.dc = np.insert(self.dc, 0, values=self.dc[:, :, 0], axis=2)
                     self.sdc_doylist.insert(0, date_temp)
+                    last_filled = [date_temp, compete_ordinal[gap_pos]]
                 elif date_temp == self.compete_doy_list[-1]:
                     date_merge = [_ for _ in self.compete_doy_list if _ in self.sdc_doylist][-1]
                     if self.sparse_matrix:
                         self.dc.add_layer(self.dc.SM_group[date_merge], date_temp, -1)
                     else:
-                        self.dc = np.insert(self.dc, 0, values=self.dc[:, :, -1], axis=2)
+                        self.dc = np.insert(self.dc, self.dc.shape[2], values=self.dc[:, :, -1], axis=2)
                     self.sdc_doylist.append(date_temp)
                 else:
+                    # The nearest original date after the gap and the nearest original or filled date before the gap within 59 days
                     date_beg, date_end, _beg, _end = None, None, None, None
-                    for _ in range(1, 60):
-                        ordinal_date = datetime.date(year=int(np.floor(bf.doy2date(date_temp) / 10000)),
-                                                     month=int(np.floor(np.mod(bf.doy2date(date_temp), 10000) / 100)),
-                                                     day=int(np.mod(bf.doy2date(date_temp), 100))).toordinal()
-                        if date_beg is None:
-                            date_out = bf.date2doy(int(datetime.date.fromordinal(ordinal_date - _).strftime('%Y%m%d')))
-                            date_beg = date_out if date_out in self.sdc_doylist else None
-                            _beg = _ if date_out in self.sdc_doylist else None
-
-                        if date_end is None:
-                            date_out = bf.date2doy(int(datetime.date.fromordinal(ordinal_date + _).strftime('%Y%m%d')))
-                            date_end = date_out if date_out in self.sdc_doylist else None
-                            _end = _ if date_out in self.sdc_doylist else None
-
-                        if date_end is not None and date_beg is not None:
-                            break
+                    if pos_after[gap_pos] != -1:
+                        date_end, _end = date_index.date_list[pos_after[gap_pos]], int(gap_after[gap_pos])
+                    if pos_before[gap_pos] != -1:
+                        date_beg, _beg = date_index.date_list[pos_before[gap_pos]], int(gap_before[gap_pos])
+                    if last_filled is not None and compete_ordinal[gap_pos] - last_filled[1] < 60 and (_beg is None or compete_ordinal[gap_pos] - last_filled[1] < _beg):
+                        date_beg, _beg = last_filled[0], int(compete_ordinal[gap_pos] - last_filled[1])
+                    last_filled = [date_temp, compete_ordinal[gap_pos]]
 
                     if isinstance(self.dc, NDSparseMatrix):
                         if date_end is None:
                             array_beg = self.dc.SM_group[date_beg]
-                            self.dc.add_layer(array_beg, date_temp, self.compete_doy_list.index(date_temp))
+                            self.dc.add_layer(array_beg, date_temp, gap_pos)
                         elif date_beg is None:
                             array_end = self.dc.SM_group[date_end]
-                            self.dc.add_layer(array_end, date_temp, self.compete_doy_list.index(date_temp))
+                            self.dc.add_layer(array_end, date_temp, gap_pos)
                         else:
                             type_temp = type(self.dc.SM_group[date_beg])
                             array_beg = self.dc.SM_group[date_beg].toarray()
@@ -277,30 +332,36 @@ class Denv_dc(object):
                             array_out = array_beg + (array_end - array_beg) * _beg / (_beg + _end)
                             array_out = array_out.astype(dtype_temp)
                             array_out = type_temp(array_out)
-                            self.dc.add_layer(array_out, date_temp, self.compete_doy_list.index(date_temp))
+                            self.dc.add_layer(array_out, date_temp, gap_pos)
                     else:
-                        array_beg = self.dc[:, :, date_beg]
-                        array_end = self.dc[:, :, date_end]
-                        array_beg = array_beg.astype(np.float32)
-                        array_end = array_end.astype(np.float32)
-                        array_out = array_beg + (array_end - array_beg) * _beg / (_beg + _end)
-                        self.dc = np.insert(self.dc, self.compete_doy_list.index(date_temp),
+                        if date_end is None:
+                            array_out = self.dc[:, :, self.sdc_doylist.index(date_beg)]
+                        elif date_beg is None:
+                            array_out = self.dc[:, :, self.sdc_doylist.index(date_end)]
+                        else:
+                            array_beg = self.dc[:, :, self.sdc_doylist.index(date_beg)].astype(np.float32)
+                            array_end = self.dc[:, :, self.sdc_doylist.index(date_end)].astype(np.float32)
+                            array_out = array_beg + (array_end - array_beg) * _beg / (_beg + _end)
+                        self.dc = np.insert(self.dc, gap_pos,
                                             values=array_out.reshape([array_out.shape[0], array_out.shape[1], 1]),
                                             axis=2)
-                    self.sdc_doylist.insert(self.compete_doy_list.index(date_temp), date_temp)
+                    self.sdc_doylist.insert(gap_pos, date_temp)
 
         if self.sdc_doylist != self.compete_doy_list:
             raise Exception('Error occurred during the autofill for the Denv DC!')
 
         if autofill_factor:
-            self.save(self.Denv_dc_filepath)
-            self.__init__(self.Denv_dc_filepath)
+            self._pending_upgrade = True
 
-    def save(self, output_path: str):
+    def save(self, output_path: str, storage: str = None, chunk_shape: tuple = None):
 
         start_time = time.time()
         print(f'Start saving the sdc of \033[1;31m{self.index}\033[0m in the \033[1;34m{self.ROI_name}\033[0m')
 
+        # The storage ('npz' or 'chunk') and the chunk shape of the sparse dc are passed through to the NDSparseMatrix.save
+        if (storage is not None or chunk_shape is not None) and not self.sparse_matrix:
+            raise ValueError('The storage and the chunk shape are only supported for the sparse dc!')
+
         output_path = bf.Path(output_path).path_name
         bf.create_folder(output_path) if not os.path.exists(output_path) else None
 
@@ -318,7 +379,7 @@ class Denv_dc(object):
             json.dump(metadata_dic, js_temp)
 
         if self.sparse_matrix:
-            self.dc.save(f'{output_path}{str(self.index)}_Denv_datacube\\')
+            self.dc.save(f'{output_path}{str(self.index)}_Denv_datacube\\', storage=storage, chunk_shape=chunk_shape)
         else:
             np.save(f'{output_path}{str(self.index)}_Denv_datacube.npy', self.dc)
 
@@ -334,7 +395,8 @@ class Denv_dc(object):
             if isinstance(self.dc.SM_group[_], sm.coo_matrix):
                 self.dc.SM_group[_] = sm.csr_matrix(self.dc.SM_group[_])
                 self.dc._update_size_para()
-        self.save(self.Denv_dc_filepath)
+        self.dc._matrix_type = sm.csr_matrix
+        self._pending_upgrade = True
 
     def denv_comparison(self):
         pass
@@ -349,7 +411,7 @@ class Phemetric_dc(object):
     # Currently, it was taken as the Sentinel_dcs/Landsat_dcs's output datatype after the phenological analysis.
     ####################################################################################################
 
-    def __init__(self, phemetric_filepath, work_env=None):
+    def __init__(self, phemetric_filepath, work_env=None, metadata_only: bool = False):
 
         # Check the phemetric path
         self.Phemetric_dc_filepath = bf.Path(phemetric_filepath).path_name
@@ -361,6 +423,7 @@ class Phemetric_dc(object):
         self.sdc_factor, self.sparse_matrix, self.size_control_factor, self.huge_matrix = False, False, False, False
         self.Phemetric_factor, self.pheyear = False, None
         self.curfit_dic = {}
+        self._metadata_only, self._pending_upgrade = metadata_only, False
 
         # Init protected var
         self._support_pheme_list = ['SOS', 'EOS', 'trough_vi', 'peak_vi', 'peak_doy', 'GR', 'DR', 'DR2', 'MAVI', 'TSVI']
@@ -431,11 +494,48 @@ class Phemetric_dc(object):
             raise Exception('Something went wrong when reading the paraname list!')
 
         # Read func dic
+        # With the metadata_only, the sparse dc is opened lazily and the dense dc is only peeked for its shape and dtype
+        if metadata_only and not (self.sparse_matrix and self.huge_matrix):
+            self._peek_dc()
+        else:
+            self._load_dc()
+
+        # Backdoor metadata check
+        self._backdoor_metadata_check()
+
+        # The format migration is kept in memory until the upgrade() is called
+        if self._pending_upgrade:
+            print(f'The Phemetric datacube of {str(self.pheyear)} \033[1;31m{self.index}\033[0m is migrated in memory, run the upgrade() to persist it')
+
+        print(f'Finish loading the Phemetric datacube of {str(self.pheyear)} \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+
+    def _update_parasize_(self):
+        self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+
+    def __getattr__(self, name):
+        # The dc of the metadata-only Phemetric dc is materialised on first access
+        if name == 'dc' and self.__dict__.get('_metadata_only', False):
+            self._load_dc()
+            return self.__dict__['dc']
+        raise AttributeError(name)
+
+    def _peek_dc(self):
+
+        # Read the shape and dtype from the npy header without reading the cube
+        dc_filename = bf.file_filter(self.Phemetric_dc_filepath, ['Phemetric_datacube.npy'])
+        if len(dc_filename) != 1:
+            raise ValueError('There has no valid Phemetric datacube or more than one dc in the dc dir!')
+        dc_temp = np.load(dc_filename[0], mmap_mode='r')
+        self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_temp.shape[0], dc_temp.shape[1], dc_temp.shape[2]
+        self.dc_dtype = dc_temp.dtype
+
+    def _load_dc(self):
+
         try:
             if self.sparse_matrix and self.huge_matrix:
                 self.dc_filename = self.Phemetric_dc_filepath + f'{self.index}_Phemetric_datacube\\'
                 if os.path.exists(self.dc_filename):
-                    self.dc = NDSparseMatrix().load(self.dc_filename)
+                    self.dc = NDSparseMatrix().load(self.dc_filename, lazy=self._metadata_only)
                 else:
                     raise Exception('Please double check the code if the sparse huge matrix is generated properly')
             elif not self.huge_matrix:
@@ -447,30 +547,38 @@ class Phemetric_dc(object):
                 else:
                     self.dc = np.load(self.dc_filename[0], allow_pickle=True)
             elif self.huge_matrix and not self.sparse_matrix:
-                self.dc_filename = bf.file_filter(self.Phemetric_dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and')
+                self.dc_filename = bf.file_filter(self.Phemetric_dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and', exclude_word_list=['_tmp.npy'])
         except:
             print(traceback.format_exc())
             raise Exception('Something went wrong when reading the Phemetric datacube!')
 
-        # autotrans sparse matrix
+        # Autotrans sparse matrix
+        # The conversion decodes every layer, thus it is deferred to the upgrade() for the metadata-only dc
         if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
-            self._autotrans_sparse_matrix()
+            if self._metadata_only:
+                self._pending_upgrade = True
+            else:
+                self._autotrans_sparse_matrix()
 
         # Drop duplicate layers
         self._drop_duplicate_layers()
 
-        # Backdoor metadata check
-        self._backdoor_metadata_check()
-
         # Size calculation and shape definition
         self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+        self.dc_dtype = self.dc.dtype
         if self.dc_ZSize != len(self.paraname_list):
             raise TypeError('The Phemetric datacube is not consistent with the paraname file')
 
-        print(f'Finish loading the Phemetric datacube of {str(self.pheyear)} \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+    def upgrade(self, storage: str = None, chunk_shape: tuple = None):
 
-    def _update_parasize_(self):
-        self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+        # Persist the migration deferred by the loading (COO to CSR, relocated ROI paths and missing coordinate system)
+        if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
+            self._autotrans_sparse_matrix()
+        # The storage or the chunk shape converts the sparse dc (e.g. into the chunked container)
+        if self._pending_upgrade or storage is not None or chunk_shape is not None:
+            self.save(self.Phemetric_dc_filepath, storage=storage, chunk_shape=chunk_shape)
+            self._pending_upgrade = False
+        return self
 
     def _backdoor_metadata_check(self):
 
@@ -499,8 +607,7 @@ class Phemetric_dc(object):
             backdoor_issue = True
 
         if backdoor_issue:
-            self.save(self.Phemetric_dc_filepath)
-            self.__init__(self.Phemetric_dc_filepath)
+            self._pending_upgrade = True
 
     def _autotrans_sparse_matrix(self):
 
@@ -511,7 +618,8 @@ class Phemetric_dc(object):
             if isinstance(self.dc.SM_group[_], sm.coo_matrix):
                 self.dc.SM_group[_] = sm.csr_matrix(self.dc.SM_group[_])
                 self.dc._update_size_para()
-        self.save(self.Phemetric_dc_filepath)
+        self.dc._matrix_type = sm.csr_matrix
+        self._pending_upgrade = True
 
     def _drop_duplicate_layers(self):
         for _ in self.paraname_list:
@@ -793,10 +901,14 @@ class Phemetric_dc(object):
         self.save(self.Phemetric_dc_filepath)
         self.__init__(self.Phemetric_dc_filepath)
 
-    def save(self, output_path: str):
+    def save(self, output_path: str, storage: str = None, chunk_shape: tuple = None):
         start_time = time.time()
         print(f'Start saving the Phemetric datacube of \033[1;31m{self.index}\033[0m in the \033[1;34m{self.ROI_name}\033[0m')
 
+        # The storage ('npz' or 'chunk') and the chunk shape of the sparse dc are passed through to the NDSparseMatrix.save
+        if (storage is not None or chunk_shape is not None) and not self.sparse_matrix:
+            raise ValueError('The storage and the chunk shape are only supported for the sparse dc!')
+
         if not os.path.exists(output_path):
             bf.create_folder(output_path)
         output_path = bf.Path(output_path).path_name
@@ -817,7 +929,7 @@ class Phemetric_dc(object):
             json.dump(metadata_dic, js_temp)
 
         if self.sparse_matrix:
-            self.dc.save(f'{output_path}{str(self.index)}_Phemetric_datacube\\')
+            self.dc.save(f'{output_path}{str(self.index)}_Phemetric_datacube\\', storage=storage, chunk_shape=chunk_shape)
         else:
             np.save(f'{output_path}{str(self.index)}_Phemetric_datacube.npy', self.dc)
 
@@ -1594,28 +1706,26 @@ class RS_dcs(object):
 
                 if not os.path.exists(static_output + 'metadata.json'):
 
-                    inundation_dc = copy.deepcopy(self.dcs[dc_num])
                     if self._sparse_matrix_list[dc_num]:
                         inundation_array = NDSparseMatrix()
 
-                        # Separate into several stacks
-                        inundation_dc_list = []
-                        worker = int(os.cpu_count() / 4)
-                        range_ = int(np.floor(inundation_dc.shape[2] / worker))
+                        # Separate into several stacks, the workers attach the shared dc instead of receiving the pickled stacks
+                        inundation_dc = self.dcs[dc_num].share_memory()
+                        namelist_list = []
+                        worker = max(int(os.cpu_count() / 4), 1)
+                        range_ = int(np.ceil(inundation_dc.shape[2] / worker))
                         for _ in range(worker):
-                            if (_ + 1) * range_ >= inundation_dc.shape[2]:
-                                inundation_dc_list.append(inundation_dc.extract_matrix(
-                                    (['all'], ['all'], [_ * range_, inundation_dc.shape[2]])))
-                            else:
-                                inundation_dc_list.append(
-                                    inundation_dc.extract_matrix((['all'], ['all'], [_ * range_, (_ + 1) * range_])))
+                            if _ * range_ < inundation_dc.shape[2]:
+                                namelist_list.append(inundation_dc.SM_namelist[_ * range_: min((_ + 1) * range_, inundation_dc.shape[2])])
 
-                        inundation_dc = None
                         sz, zoff, nd, thr = self._size_control_factor_list[dc_num], self._Zoffset_list[dc_num], self._Nodata_value_list[dc_num], self._static_wi_threshold
-                        with concurrent.futures.ProcessPoolExecutor(max_workers=worker) as executor:
-                            res = executor.map(mp_static_wi_detection, inundation_dc_list, repeat(sz), repeat(zoff),  repeat(nd), repeat(thr))
+                        try:
+                            with concurrent.futures.ProcessPoolExecutor(max_workers=worker) as executor:
+                                res = list(executor.map(mp_static_wi_detection, repeat(inundation_dc), repeat(sz), repeat(zoff), repeat(nd), repeat(thr), namelist_list))
+                        finally:
+                            inundation_dc.release_shared_memory()
+                            inundation_dc = None
 
-                        res = list(res)
                         for _ in res:
                             for __ in range(len(_[0])):
                                 inundation_array.append(_[0][__], name=_[1][__])
@@ -1637,7 +1747,7 @@ class RS_dcs(object):
 
                         inundation_array = np.stack(inundation_arr_list, axis=2)
 
-                    inundation_dc = copy.deepcopy(self._dcs_backup_[dc_num])
+                    inundation_dc = copy.copy(self._dcs_backup_[dc_num])
                     inundation_dc.dc = inundation_array
                     inundation_dc.index = 'inundation_' + inundation_mapping_method
                     inundation_dc.Datatype = str(np.byte)
@@ -1645,6 +1755,7 @@ class RS_dcs(object):
                     inundation_dc.Zoffset = None
                     inundation_dc.size_control_factor = False
                     inundation_dc.Nodata_value = 0
+                    inundation_dc.codec = 'bitpack'
                     inundation_dc.save(static_output)
 
                     if self._append_inundated_dc:
@@ -1674,14 +1785,13 @@ class RS_dcs(object):
                 if not os.path.exists(DT_threshold_path + 'threshold_map.TIF') or not os.path.exists(DT_threshold_path + 'bh_threshold_map.TIF') or self._inundation_overwritten_para:
 
                     # Define input
-                    WI_sdc = copy.deepcopy(self.dcs[dc_num])
+                    WI_sdc = Dc_view(self.dcs[dc_num])
                     doy_array = copy.copy(self._doys_backup_[dc_num])
                     doy_array = bf.date2doy(doy_array)
                     doy_array = np.array(doy_array)
                     nodata_value = self._Nodata_value_list[dc_num]
 
                     roi_arr = np.load(self.ROI_array)
-                    roi_coord = np.argwhere(roi_arr == 1).tolist()
 
                     sz_ctrl_fac = self._size_control_factor_list[dc_num]
                     zoffset = self._Zoffset_list[dc_num]
@@ -1689,25 +1799,9 @@ class RS_dcs(object):
                     variance = self._variance_num
                     bio_factor = self._DT_bimodal_histogram_factor
 
-                    # Define output
-                    DT_threshold_arr = np.ones([WI_sdc.shape[0], WI_sdc.shape[1]]) * np.nan
-                    bh_threshold_arr = np.ones([WI_sdc.shape[0], WI_sdc.shape[1]]) * np.nan
-
                     # DT method with empirical and bimodal threshold
-                    dc_list, pos_list, yxoffset_list = slice_datacube(WI_sdc, roi_coord)
-                    with concurrent.futures.ProcessPoolExecutor() as executor:
-                        res = executor.map(create_bimodal_histogram_threshold, dc_list, pos_list, yxoffset_list,
-                                           repeat(doy_array), repeat(sz_ctrl_fac), repeat(zoffset), repeat(nd_v),
-                                           repeat(variance), repeat(bio_factor))
-
-                    res = list(res)
-                    res_concat = []
-                    for res_temp in res:
-                        res_concat.extend(res_temp)
-
-                    for r_ in range(len(res_concat)):
-                        DT_threshold_arr[res_concat[r_][0], res_concat[r_][1]] = res_concat[r_][2]
-                        bh_threshold_arr[res_concat[r_][0], res_concat[r_][1]] = res_concat[r_][3]
+                    # The thresholds of all the ROI pixels in one block are estimated at once by the batched engine
+                    DT_threshold_arr, bh_threshold_arr = create_DT_threshold_map(WI_sdc, roi_arr, doy_array, sz_ctrl_fac, zoffset, nd_v, variance, bio_factor)
 
                     bf.write_raster(gdal.Open(self.ROI_tif), DT_threshold_arr, DT_threshold_path, 'threshold_map.TIF',
                                     raster_datatype=gdal.GDT_Float32, nodatavalue=np.nan)
@@ -1781,20 +1875,15 @@ class RS_dcs(object):
                 # Construct inundation dc
                 if not os.path.exists(DT_output_path + 'doy.npy') or not os.path.exists(DT_output_path + 'metadata.json') or self._inundation_overwritten_para:
 
-                    inundation_dc = copy.deepcopy(self._dcs_backup_[dc_num])
-                    inundated_arr = copy.deepcopy(self.dcs[dc_num])
+                    # The wi dc is read through the view and the inundation maps are written copy-on-write
+                    inundation_dc = copy.copy(self._dcs_backup_[dc_num])
+                    inundated_arr = Dc_view(self.dcs[dc_num])
                     doy_array = copy.copy(self._doys_backup_[dc_num])
                     doy_array = bf.date2doy(doy_array)
                     doy_array = np.array(doy_array)
                     DT_threshold = DT_threshold_arr.astype(float)
                     num_list = [q for q in range(doy_array.shape[0])]
-                    if self._sparse_matrix_list[dc_num]:
-                        inundated_arr_list = [inundated_arr.SM_group[inundated_arr.SM_namelist[_]] for _ in
-                                              range(inundated_arr.shape[2])]
-                    else:
-                        inundated_arr_list = [
-                            inundated_arr[:, :, _].reshape([inundated_arr.shape[0], inundated_arr.shape[1]]) for _ in
-                            range(inundated_arr.shape[2])]
+                    inundated_arr_list = [inundated_arr.read_layer(_) for _ in range(inundated_arr.shape[2])]
 
                     with concurrent.futures.ProcessPoolExecutor() as executor:
                         res = list(tq(executor.map(create_indi_DT_inundation_map,
@@ -1807,10 +1896,7 @@ class RS_dcs(object):
                                       total=len(num_list)))
 
                     for _ in res:
-                        if self._sparse_matrix_list[dc_num]:
-                            inundated_arr.SM_group[inundated_arr.SM_namelist[_[0]]] = _[1]
-                        else:
-                            inundated_arr[:, :, [_[0]]] = _[1]
+                        inundated_arr.write_layer(_[0], _[1])
 
                     # for date_num in range(doy_array.shape[0]):
                     #     if not os.path.exists(f'{DT_inditif_path}\\DT_{str(doy_array[date_num])}.TIF') or thalweg_temp._inundation_overwritten_factor:
@@ -1835,13 +1921,14 @@ class RS_dcs(object):
                     #         inundated_ds = gdal.Open(f'{DT_inditif_path}DT_{str(doy_array[date_num])}.TIF')
                     #         inundation_map = inundated_ds.GetRasterBand(1).ReadAsArray()
 
-                    inundation_dc.dc = inundated_arr
+                    inundation_dc.dc = inundated_arr.materialize()
                     inundation_dc.index = 'Inundation_' + inundation_mapping_method
                     inundation_dc.Datatype = str(np.byte)
                     inundation_dc.sdc_doylist = doy_list
                     inundation_dc.Zoffset = None
                     inundation_dc.size_control_factor = False
                     inundation_dc.Nodata_value = 0
+                    inundation_dc.codec = 'bitpack'
                     inundation_dc.save(DT_output_path)
                 else:
                     inundation_dc = dc_type(DT_output_path)
@@ -1863,18 +1950,18 @@ class RS_dcs(object):
             for year in year_array:
                 if not os.path.exists(f'{annualtif_path}{inundation_mapping_method}_{str(year)}.TIF') or not os.path.exists(f'{annualshp_path}{inundation_mapping_method}_{str(year)}.shp') or self._inundation_overwritten_factor:
                     annual_vi_list = []
-                    for doy_index in range(doy_array.shape[0]):
-                        if doy_array[doy_index] // 1000 == year and 90 <= np.mod(doy_array[doy_index], 1000) <= 300:
-                            if isinstance(inundation_dc.dc, NDSparseMatrix):
-                                arr_temp = inundation_dc.dc.SM_group[inundation_dc.dc.SM_namelist[doy_index]]
-                                annual_vi_list.append(arr_temp.toarray())
-                            else:
-                                annual_vi_list.append(inundation_dc.dc[:, :, doy_index])
-
-                    if annual_vi_list == []:
-                        annual_inundated_map = np.zeros([inundation_dc.dc.shape[0], inundation_dc.dc.shape[1]], dtype=np.byte)
+                    annual_index = [doy_index for doy_index in range(doy_array.shape[0]) if doy_array[doy_index] // 1000 == year and 90 <= np.mod(doy_array[doy_index], 1000) <= 300]
+                    if isinstance(inundation_dc.dc, NDSparseMatrix) and annual_index != []:
+                        annual_inundated_map = inundation_dc.dc.reduce('max', namelist=[inundation_dc.dc.SM_namelist[_] for _ in annual_index])
+                        annual_inundated_map = np.nan_to_num(annual_inundated_map, nan=0).astype(np.byte)
                     else:
-                        annual_inundated_map = np.nanmax(np.stack(annual_vi_list, axis=2), axis=2)
+                        for doy_index in annual_index:
+                            annual_vi_list.append(inundation_dc.dc[:, :, doy_index])
+
+                        if annual_vi_list == []:
+                            annual_inundated_map = np.zeros([inundation_dc.dc.shape[0], inundation_dc.dc.shape[1]], dtype=np.byte)
+                        else:
+                            annual_inundated_map = np.nanmax(np.stack(annual_vi_list, axis=2), axis=2)
                     bf.write_raster(temp_ds, annual_inundated_map, annualtif_path, f'{inundation_mapping_method}_' + str(year) + '.TIF', raster_datatype=gdal.GDT_Byte, nodatavalue=0)
                     annual_ds = gdal.Open(annualtif_path + f'{inundation_mapping_method}_' + str(year) + '.TIF')
 
@@ -1934,14 +2021,14 @@ class RS_dcs(object):
                 inun_arr[roi_temp == -32768] = np.nan
                 all_arr[roi_temp == -32768] = np.nan
 
-                for doy_index in range(doy_array.shape[0]):
-                    if isinstance(inundation_dc.dc, NDSparseMatrix):
-                        arr_temp = inundation_dc.dc.SM_group[inundation_dc.dc.SM_namelist[doy_index]]
-                    else:
+                if isinstance(inundation_dc.dc, NDSparseMatrix):
+                    inun_arr = inun_arr + inundation_dc.dc.reduce('count', mask=lambda data_temp: data_temp == 2)
+                    all_arr = all_arr + inundation_dc.dc.reduce('count', mask=lambda data_temp: data_temp >= 1)
+                else:
+                    for doy_index in range(doy_array.shape[0]):
                         arr_temp = inundation_dc.dc[:, :, doy_index].reshape([inundation_dc.dc.shape[0], inundation_dc.dc.shape[1]])
-
-                    inun_arr = inun_arr + (arr_temp == 2).astype(np.int16)
-                    all_arr = all_arr + (arr_temp >= 1).astype(np.int16)
+                        inun_arr = inun_arr + (arr_temp == 2).astype(np.int16)
+                        all_arr = all_arr + (arr_temp >= 1).astype(np.int16)
 
                 inundation_freq = inun_arr.astype(np.float32) / all_arr.astype(np.float32)
                 bf.write_raster(temp_ds, inundation_freq, inunfactor_path,
@@ -2039,7 +2126,7 @@ class RS_dcs(object):
         if inundation_dc_num == 0:
             raise ValueError('The inundated dc for inundation removal is not properly imported')
         else:
-            inundation_dc = copy.deepcopy(self.dcs[inundation_dc_num[0]])
+            inundation_dc = Dc_view(self.dcs[inundation_dc_num[0]])
 
         # Retrieve processed dc
         processed_dc_num = [_ for _ in range(len(self._index_list)) if
@@ -2047,8 +2134,8 @@ class RS_dcs(object):
         if len(processed_dc_num) == 0:
             raise ValueError('The processed dc for inundation removal is not properly imported')
         else:
-            processed_dc = copy.deepcopy(self.dcs[processed_dc_num[0]])
-            processed_dc4save = copy.deepcopy(self._dcs_backup_[processed_dc_num[0]])
+            processed_dc = Dc_view(self.dcs[processed_dc_num[0]])
+            processed_dc4save = copy.copy(self._dcs_backup_[processed_dc_num[0]])
 
         if self._doys_backup_[inundation_dc_num[0]] != self._doys_backup_[processed_dc_num[0]]:
             raise TypeError('The inundation removal method must processed on two datacube with same doy list!')
@@ -2061,9 +2148,9 @@ class RS_dcs(object):
 
             if self._sparse_matrix_list[processed_dc_num[0]]:
                 for height in range(z_size):
-                    inundation_arr = copy.deepcopy(inundation_dc.SM_group[inundation_dc.SM_namelist[height]])
+                    inundation_arr = inundation_dc.read_layer(height).copy()
                     inundation_arr[inundation_arr == 2] = 0
-                    processed_dc.SM_group[processed_dc.SM_namelist[height]] = processed_dc.SM_group[processed_dc.SM_namelist[height]].multiply(inundation_arr)
+                    processed_dc.write_layer(height, processed_dc.read_layer(height).multiply(inundation_arr))
 
                 # if thalweg_temp._remove_nan_layer or thalweg_temp._manually_remove_para:
                 #     i_temp = 0
@@ -2078,7 +2165,7 @@ class RS_dcs(object):
 
                 processed_index = processed_index + '_noninun'
                 processed_dc4save.index = processed_index
-                processed_dc4save.dc = processed_dc
+                processed_dc4save.dc = processed_dc.materialize()
                 processed_dc4save.save(output_path + processed_index + '_datacube\\')
 
             else:
@@ -2129,6 +2216,14 @@ class RS_dcs(object):
         else:
             self._flood_removal_method = None
 
+        # Memory budget of each worker (bytes)
+        if 'worker_memory' in kwargs.keys():
+            if not isinstance(kwargs['worker_memory'], int) or kwargs['worker_memory'] <= 0:
+                raise TypeError('The worker memory should be a positive int in bytes!')
+            self._worker_memory = kwargs['worker_memory']
+        else:
+            self._worker_memory = 2 * 1024 ** 3
+
         # Overwritten_para
         if 'overwritten' in kwargs.keys():
             self._curve_fitting_algorithm = kwargs['curve_fitting_algorithm']
@@ -2161,10 +2256,8 @@ class RS_dcs(object):
         else:
             dc_num = dc_num[0]
 
-        index_dc = copy.deepcopy(self.dcs[dc_num])
         doy_dc = copy.deepcopy(doy_list)
-        doy_dc = bf.date2doy(doy_dc)
-        doy_all = np.mod(doy_dc, 1000)
+        doy_all = bf.date2doy(doy_dc)
         size_control_fac = self._size_control_factor_list[dc_num]
 
         # Retrieve the ROI
@@ -2188,62 +2281,29 @@ class RS_dcs(object):
         cache_folder = f'{para_output_path}cache\\'
         bf.create_folder(cache_folder)
 
-        # Read pos_df
-        if not os.path.exists(f'{cache_folder}pos_df.csv'):
-            pos_df = pd.DataFrame(np.argwhere(sa_map != -32768), columns=['y', 'x'])
-            pos_df = pos_df.sort_values(['x', 'y'], ascending=[True, True])
-            pos_df = pos_df.reset_index()
-        else:
-            pos_df = pd.read_csv(f'{cache_folder}pos_df.csv')
-
         # Generate all the curve fitting para into a table
         if not os.path.exists(csv_para_output_path + 'curfit_all.csv'):
 
-            # Slice into several tasks/blocks to use all cores
-            work_num = os.cpu_count()
-            doy_all_list, pos_list, xy_offset_list, index_size_list, index_dc_list, indi_size = [], [], [], [], [], int(
-                np.ceil(pos_df.shape[0] / work_num))
-            for i_size in range(work_num):
-                if i_size != work_num - 1:
-                    pos_list.append(pos_df[indi_size * i_size: indi_size * (i_size + 1)])
-                else:
-                    pos_list.append(pos_df[indi_size * i_size: -1])
-
-                index_size_list.append(
-                    [int(max(0, pos_list[-1]['y'].min())), int(min(sa_map.shape[0], pos_list[-1]['y'].max())),
-                     int(max(0, pos_list[-1]['x'].min())), int(min(sa_map.shape[1], pos_list[-1]['x'].max()))])
-                xy_offset_list.append([int(max(0, pos_list[-1]['y'].min())), int(max(0, pos_list[-1]['x'].min()))])
-
-                if self._sparse_matrix_list[dc_num]:
-                    dc_temp = index_dc.extract_matrix(([index_size_list[-1][0], index_size_list[-1][1] + 1],
-                                                       [index_size_list[-1][2], index_size_list[-1][3] + 1], ['all']))
-                    index_dc_list.append(dc_temp.drop_nanlayer())
-                    doy_all_list.append(bf.date2doy(index_dc_list[-1].SM_namelist))
-                else:
-                    index_dc_list.append(index_dc[index_size_list[-1][0]: index_size_list[-1][2],
-                                         index_size_list[-1][1]: index_size_list[-1][3], :])
-                    doy_all_list.append(doy_all)
-
-            with concurrent.futures.ProcessPoolExecutor(max_workers=work_num) as executor:
-                result = executor.map(curfit4bound_annual, pos_list, index_dc_list, doy_all_list,
-                                      repeat(self._curve_fitting_dic), repeat(self._sparse_matrix_list[dc_num]),
-                                      repeat(size_control_fac), xy_offset_list, repeat(cache_folder),
-                                      repeat(self._Nodata_value_list[dc_num]), repeat(self._Zoffset_list[dc_num]))
-            result_list = list(result)
-
-            # Integrate all the result into the para dict
-            self._curfit_result = None
-            for result_temp in result_list:
-                if self._curfit_result is None:
-                    self._curfit_result = copy.copy(result_temp)
-                else:
-                    self._curfit_result = pd.concat([self._curfit_result, result_temp])
-
-            key_list = []
-            for key_temp in self._curfit_result.keys():
-                if key_temp not in pos_df.keys() and 'para' in key_temp:
-                    key_list.append(key_temp)
-
+            # Partition the ROI into tiles balanced by the valid pixels, the workers reopen the dc by path or attach the shared dc
+            # The sparse tile carries the columns of the persisted pixel-major cube (if saved with the pixel_major), thus the pixel series are not transposed per tile
+            scheduler = Tile_scheduler(sa_map, nodata_value=-32768, worker_memory=self._worker_memory, resume_folder=f'{cache_folder}tile\\')
+            result_dic = {}
+            for tile, result in scheduler.map(curfit4tile, self.dcs[dc_num], doy_all, self._curve_fitting_dic,
+                                              self._sparse_matrix_list[dc_num], size_control_fac, cache_folder,
+                                              self._Nodata_value_list[dc_num], self._Zoffset_list[dc_num], desc='Curve fitting tiles',
+                                              pixel_major=self._sparse_matrix_list[dc_num]):
+                result_dic[tile['id']] = result
+            result_list = [result_dic[_] for _ in sorted(result_dic.keys())]
+
+            # Export the array-backed result stores of all the blocks into the csv
+            # The store is only accepted if its checkpoint covers all the pixel positions of the tile, otherwise the cached tile is dropped for the rerun
+            failed_tile = [_ for _ in sorted(result_dic.keys()) if not curfit_store_finished(result_dic[_])]
+            if len(failed_tile) > 0:
+                for _ in failed_tile:
+                    if os.path.exists(f'{scheduler.resume_folder}tile_{str(_)}.pkl'):
+                        os.remove(f'{scheduler.resume_folder}tile_{str(_)}.pkl')
+                raise Exception('Some error occurred during the curve fitting, please rerun to resume from the cache!')
+            self._curfit_result = pd.concat([pd.DataFrame(np.load(result_temp)) for result_temp in result_list], ignore_index=True)
             self._curfit_result.to_csv(csv_para_output_path + 'curfit_all.csv')
         else:
             self._curfit_result = pd.read_csv(csv_para_output_path + 'curfit_all.csv')
@@ -4059,9 +4119,11 @@ class RS_dcs(object):
                          generate_max_water_level_factor: bool = False, generate_min_inun_wl: bool = True,
                          generate_inun_duration: bool = True,
                          manual_remove_date: list = [], roi_name=None, veg_height_dic: dict = {},
-                         veg_inun_itr: int = 20, generate_optimised_gt_thr: bool = True):
+                         veg_inun_itr: int = 20, generate_optimised_gt_thr: bool = True, wl_refine: str = 'legacy'):
 
         # Check the var
+        if wl_refine not in ['legacy', 'nearest']:
+            raise ValueError(f'The wl_refine {str(wl_refine)} is not supported!')
         output_path = Path(output_path).path_name
         if not os.path.exists(f'{output_path}'):
             bf.create_folder(f'{output_path}')
@@ -4084,37 +4146,23 @@ class RS_dcs(object):
         if inundated_index not in self._index_list:
             raise ValueError(f'Inundated dc {str(inundated_index)} is not input!')
         else:
-            inundated_dc = copy.copy(self.dcs[self._index_list.index(inundated_index)])
             roi_ds = gdal.Open(self.ROI_tif)
             transform = roi_ds.GetGeoTransform()
             proj = roi_ds.GetProjection()
             roi_arr = roi_ds.GetRasterBand(1).ReadAsArray()
-            if not self._sparse_matrix_list[self._index_list.index(inundated_index)]:
-                if process_extent is not None and isinstance(process_extent, (list, tuple)) and len(
-                        process_extent) == 4:
-                    y_min, y_max, x_min, x_max = process_extent
-                    inundated_dc = inundated_dc[y_min: y_max, x_min: x_max, :]
-                    roi_arr = roi_arr[y_min: y_max, x_min: x_max]
-                    new_trans = (transform[0] + x_min * transform[1], transform[1], transform[2],
-                                 transform[3] + y_min * transform[5], transform[4], transform[5])
-                elif process_extent is None:
-                    inundated_dc = inundated_dc[:, :, :]
-                    new_trans = transform
-                else:
-                    raise TypeError('Process extent is not properly input!')
+
+            # The inundated dc is cropped through the view, the untouched layers or array are shared rather than copied
+            if process_extent is not None and isinstance(process_extent, (list, tuple)) and len(process_extent) == 4:
+                y_min, y_max, x_min, x_max = process_extent
+                inundated_dc = Dc_view(self.dcs[self._index_list.index(inundated_index)], y_range=[y_min, y_max], x_range=[x_min, x_max]).materialize()
+                roi_arr = roi_arr[y_min: y_max, x_min: x_max]
+                new_trans = (transform[0] + x_min * transform[1], transform[1], transform[2],
+                             transform[3] + y_min * transform[5], transform[4], transform[5])
+            elif process_extent is None:
+                inundated_dc = Dc_view(self.dcs[self._index_list.index(inundated_index)]).materialize()
+                new_trans = transform
             else:
-                if process_extent is not None and isinstance(process_extent, (list, tuple)) and len(
-                        process_extent) == 4:
-                    y_min, y_max, x_min, x_max = process_extent
-                    inundated_dc = inundated_dc.extract_matrix(([y_min, y_max], [x_min, x_max], ['all']))
-                    roi_arr = roi_arr[y_min: y_max, x_min: x_max]
-                    new_trans = (transform[0] + x_min * transform[1], transform[1], transform[2],
-                                 transform[3] + y_min * transform[5], transform[4], transform[5])
-                elif process_extent is None:
-                    inundated_dc = inundated_dc.extract_matrix((['all'], ['all'], ['all']))
-                    new_trans = transform
-                else:
-                    raise TypeError('Process extent is not properly input!')
+                raise TypeError('Process extent is not properly input!')
             doy_list = self._doys_backup_[self._index_list.index(inundated_index)]
 
         water_level_data[:, 0] = water_level_data[:, 0].astype(np.int32)
@@ -4234,12 +4282,13 @@ class RS_dcs(object):
                         inundated_frequency[roi_arr == -32768] = -2
                         inundated_frequency = inundated_frequency.astype(np.int16)
                     elif isinstance(inundated_dc, NDSparseMatrix):
-                        inundated_all = np.zeros([inundated_dc.shape[0], inundated_dc.shape[1]])
-                        valid_all = np.zeros([inundated_dc.shape[0], inundated_dc.shape[1]])
-                        for _ in inundated_dc.SM_namelist:
-                            arr_temp = inundated_dc.SM_group[_].toarray()
-                            valid_all = valid_all + (arr_temp != nan_value).astype(np.int32)
-                            inundated_all = inundated_all + (arr_temp == inundated_value).astype(np.int32)
+                        inundated_all = inundated_dc.reduce('count', mask=lambda data_temp: data_temp == inundated_value)
+                        valid_all = inundated_dc.reduce('count', mask=lambda data_temp: data_temp != nan_value)
+                        if nan_value != 0:
+                            # The implicit zeros are valid observations when the nodata value is not 0
+                            valid_all = valid_all + (len(inundated_dc.SM_namelist) - inundated_dc.reduce('count'))
+                            if inundated_value == 0:
+                                inundated_all = inundated_all + (len(inundated_dc.SM_namelist) - inundated_dc.reduce('count'))
                         inundated_frequency = inundated_all / valid_all
                         inundated_frequency[inundated_frequency > 0.5] = 1
                         inundated_frequency[inundated_frequency <= 0.5] = 0
@@ -4909,267 +4958,33 @@ class RS_dcs(object):
 
                         inun_id_arr = target_ds.GetRasterBand(3).ReadAsArray()
                         inun_id_list = np.unique(inun_id_arr.flatten())
+                        inun_id_slice = ndimage.find_objects(np.where(inun_id_arr > 0, inun_id_arr, 0))
 
                         with tqdm(total=len(inun_id_list), desc=f'Refine the inundation water level',
                                   bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar3:
                             for inun_id_ in inun_id_list:
-                                if inun_id_ != 0:
-
-                                    # Create the dic and extract inun ras by using inun id
-                                    time1, time2, time3, time4 = 0, 0, 0, 0
-
-                                    s_t = time.time()
-                                    inun_inform = []
-                                    min_wl_arr_t = copy.deepcopy(min_inun_wl_arr)
-                                    min_wl_arr_t[inun_id_arr != inun_id_] = np.nan
-                                    min_wl_arr_t[permanent_water_arr == 1] = -1
-
-                                    max_wl_arr_t = copy.deepcopy(max_noninun_wl_arr)
-                                    max_wl_arr_t[inun_id_arr != inun_id_] = np.nan
-                                    max_wl_arr_t[permanent_water_arr == 1] = -1
-
-                                    # Get all the wl within this inun id
-                                    offset_all, bound_all = np.min(np.argwhere(inun_id_arr == inun_id_),
-                                                                   axis=0), np.max(np.argwhere(inun_id_arr == inun_id_),
-                                                                                   axis=0)
-                                    min_wl_arr_t = min_wl_arr_t[offset_all[0] - 1: bound_all[0] + 2,
-                                                   offset_all[1] - 1: bound_all[1] + 2]
-                                    max_wl_arr_t = max_wl_arr_t[offset_all[0] - 1: bound_all[0] + 2,
-                                                   offset_all[1] - 1: bound_all[1] + 2]
-                                    min_wl_arr_list = np.unique(min_wl_arr_t.flatten())
-                                    min_wl_arr_list = np.sort(np.delete(min_wl_arr_list, np.argwhere(
-                                        np.logical_or(np.isnan(min_wl_arr_list), min_wl_arr_list == -1))))
-                                    time1 = time.time() - s_t
-                                    s_t = time.time()
-
-                                    # mp got inun status
-                                    # with concurrent.futures.ProcessPoolExecutor() as exe:
-                                    #     res = exe.map(assign_wl_status, repeat(min_wl_arr_t), min_wl_arr_list)
-                                    #
-                                    # res = list(res)
-                                    # for res_ in res:
-                                    #     inun_inform.extend(res_)
-
-                                    # Got inun status
-                                    for wl in min_wl_arr_list:
-                                        inun_inform_list = []
-                                        pos_all = np.argwhere(min_wl_arr_t == wl)
-                                        for pos_temp in pos_all:
-                                            arr_temp = min_wl_arr_t[pos_temp[0] - 1: pos_temp[0] + 2,
-                                                       pos_temp[1] - 1: pos_temp[1] + 2]
-                                            inun_inform__ = [wl]
-                                            inun_inform__.extend([pos_temp[0], pos_temp[1]])
-                                            if (arr_temp == wl).all():
-                                                inun_inform__.append(0)
-                                            elif (arr_temp > wl).any():
-                                                inun_inform__.append(1)
-                                            elif np.isnan(arr_temp).any() == 1:
-                                                inun_inform__.append(1)
-                                            elif (arr_temp == -1).any():
-                                                inun_inform__.append(-1)
-                                            elif (arr_temp < wl).any():
-                                                inun_inform__.append(0)
-                                            else:
-                                                raise Exception(str(arr_temp))
-                                            inun_inform_list.append(inun_inform__)
-                                        inun_inform.extend(inun_inform_list)
-                                    time2 = time.time() - s_t
-                                    s_t = time.time()
-
-                                    # Pre-assign the wl for bound pixel
-                                    # with concurrent.futures.ProcessPoolExecutor() as exe:
-                                    #     res = exe.map(pre_assign_wl, inun_inform, repeat(min_wl_arr_t), repeat(max_wl_arr_t), repeat(water_level_data), repeat(doy_list))
-                                    #
-                                    # inun_inform = []
-                                    # min_wl_arr_refined_t = np.zeros_like(min_wl_arr_t) * np.nan
-                                    # res = list(res)
-                                    # for res_ in res:
-                                    #     inun_inform.append(res_)
-                                    #
-                                    # i_len = 0
-                                    # while i_len < len(inun_inform):
-                                    #     min_wl_, pos_y, pos_x, status, wl_refined = inun_inform[i_len]
-                                    #     if ~np.isnan(wl_refined):
-                                    #         min_wl_arr_refined_t[pos_y, pos_x] = wl_refined
-                                    #         inun_inform.remove(inun_inform[i_len])
-                                    #     else:
-                                    #         i_len += 1
-
-                                    # Pre-assign the wl for bound pixel
-                                    min_wl_arr_refined_t = np.zeros_like(min_wl_arr_t) * np.nan
-                                    i_len = 0
-                                    while i_len < len(inun_inform):
-
-                                        min_wl_, pos_y, pos_x, status = inun_inform[i_len]
-                                        if status == 1:
-                                            min_wl_arr_refined_t[pos_y, pos_x] = min_wl_arr_t[pos_y, pos_x]
-                                            inun_inform.remove(inun_inform[i_len])
-                                        elif status == -1:
-                                            if max_wl_arr_t[pos_y, pos_x] > min_wl_arr_t[pos_y, pos_x]:
-                                                wl_temp = min_wl_arr_t[pos_y, pos_x]
-                                                wl_pos = np.argwhere(water_level_data == float(str(wl_temp)))
-                                                date, date_pos = [], []
-                                                for wl_pos_temp in wl_pos:
-                                                    if water_level_data[wl_pos_temp[0], 0] in doy_list:
-                                                        date.append(water_level_data[wl_pos_temp[0]])
-                                                        date_pos.append(wl_pos_temp[0])
-
-                                                if len(date) == 1:
-                                                    wl_temp_2 = water_level_data[int(date_pos[0]) - 5, 1]
-                                                else:
-                                                    date_pos = min(date_pos)
-                                                    wl_temp_2 = water_level_data[int(date_pos) - 5, 1]
-
-                                                if wl_temp_2 <= wl_temp and wl_temp - wl_temp_2 < 3:
-                                                    min_wl_arr_refined_t[pos_y, pos_x] = (wl_temp_2 + wl_temp) / 2
-                                                    inun_inform.remove(inun_inform[i_len])
-                                                else:
-                                                    min_wl_arr_refined_t[pos_y, pos_x] = wl_temp - 1
-                                                    inun_inform.remove(inun_inform[i_len])
-
-                                            else:
-                                                min_wl_arr_refined_t[pos_y, pos_x] = (min_wl_arr_t[pos_y, pos_x] +
-                                                                                      max_wl_arr_t[pos_y, pos_x]) / 2
-                                                inun_inform.remove(inun_inform[i_len])
-
-                                        elif status == 0:
-                                            inun_inform[i_len].append(np.nan)
-                                            i_len += 1
-
-                                    for min_wl_ in min_wl_arr_list:
-                                        if not (min_wl_arr_refined_t == min_wl_).any():
-                                            pos_x_em_list, pos_y_em_list = [], []
-                                            for inun_ in inun_inform:
-                                                if inun_[0] == min_wl_:
-                                                    pos_x_em_list.append(inun_[2])
-                                                    pos_y_em_list.append(inun_[1])
-
-                                            if len(pos_x_em_list) != 0:
-                                                pos_x_em_list, pos_y_em_list = np.array(pos_x_em_list), np.array(
-                                                    pos_y_em_list)
-                                                pos_x_mid = int(np.nanmedian(pos_x_em_list))
-                                                if pos_x_mid in pos_x_em_list:
-                                                    pos_y_mid = int(
-                                                        np.nanmedian(pos_y_em_list[pos_x_em_list == pos_x_mid]))
-                                                    min_wl_arr_refined_t[pos_y_mid, pos_x_mid] = min_wl_
-                                                else:
-                                                    min_wl_arr_refined_t[
-                                                        pos_y_em_list[int(pos_y_em_list.shape[0] / 2)], pos_x_em_list[
-                                                            int(pos_x_em_list.shape[0] / 2)]] = min_wl_
-
-                                    time3 = time.time() - s_t
-                                    s_t = time.time()
-
-                                    # Get wl
-                                    if len(inun_inform) > 5000000000:
-                                        # MP get wl
-                                        with concurrent.futures.ProcessPoolExecutor() as exe:
-                                            res = exe.map(assign_wl, inun_inform, repeat(min_wl_arr_refined_t))
-
-                                        inun_inform = []
-                                        res = list(res)
-                                        for res_ in res:
-                                            inun_inform.append(res_)
-
-                                        for inun_ in inun_inform:
-                                            min_wl_, pos_y, pos_x, status, wl_refined = inun_
-                                            if ~np.isnan(wl_refined):
-                                                min_wl_arr_refined_t[pos_y, pos_x] = wl_refined
-                                            else:
-                                                print(
-                                                    f'inun_id:{str(inun_id_)}, pos{str(pos_y)}_{str(pos_x)}, wl{str(wl_refined)}')
-                                                raise Exception('Error during mp get wl')
-
-                                    else:
-                                        # Seq get wl
-                                        for inun__ in inun_inform:
-                                            min_wl_, pos_y, pos_x, status, wl_refined = inun__
-                                            if status == 0 and np.isnan(wl_refined):
-                                                wl_centre = min_wl_
-                                                upper_wl_dis, lower_wl_dis, lower_wl = [], [], []
-
-                                                # Find 10 nearest points
-                                                for r in range(1, 100):
-                                                    pos_y_lower = 0 if pos_y - r < 0 else pos_y - r
-                                                    pos_x_lower = 0 if pos_x - r < 0 else pos_x - r
-                                                    pos_y_upper = min_wl_arr_refined_t.shape[0] if pos_y + r + 1 > \
-                                                                                                   min_wl_arr_refined_t.shape[
-                                                                                                       0] else pos_y + r + 1
-                                                    pos_x_upper = min_wl_arr_refined_t.shape[1] if pos_x + r + 1 > \
-                                                                                                   min_wl_arr_refined_t.shape[
-                                                                                                       1] else pos_x + r + 1
-
-                                                    arr_tt = min_wl_arr_refined_t[pos_y_lower: pos_y_upper,
-                                                             pos_x_lower: pos_x_upper]
-                                                    arr_tt[pos_y_lower - 1: pos_y_upper - 1,
-                                                    pos_x_lower - 1: pos_x_upper - 1] = np.nan
-                                                    if len(upper_wl_dis) < 10:
-                                                        upper_wl_dis_list = []
-                                                        if (arr_tt == wl_centre).any():
-                                                            for pos_ttt in np.argwhere(arr_tt == wl_centre):
-                                                                upper_wl_dis_list.append(np.sqrt(
-                                                                    (pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2))
-                                                            upper_wl_dis_list.sort()
-                                                            if len(upper_wl_dis_list) > 10 - len(upper_wl_dis):
-                                                                upper_wl_dis.extend(
-                                                                    upper_wl_dis_list[:10 - len(upper_wl_dis)])
-                                                            else:
-                                                                upper_wl_dis.extend(upper_wl_dis_list)
-
-                                                    if len(lower_wl_dis) < 10:
-                                                        lower_wl_dat_list = []
-                                                        arr_tt[arr_tt < 0] = 100000
-                                                        if (arr_tt < wl_centre).any():
-                                                            for pos_ttt in np.argwhere(arr_tt <= wl_centre):
-                                                                lower_wl_dat_list.append(
-                                                                    [arr_tt[pos_ttt[0], pos_ttt[1]], np.sqrt(
-                                                                        (pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2)])
-                                                            lower_wl_dat_list.sort()
-                                                            if len(lower_wl_dat_list) > 10 - len(lower_wl_dis):
-                                                                lower_wl_dis.extend([lower_wl_dat_list[_][1] for _ in
-                                                                                     range(10 - len(lower_wl_dis))])
-                                                                lower_wl.extend([lower_wl_dat_list[_][0] for _ in
-                                                                                 range(10 - len(lower_wl))])
-                                                            else:
-                                                                lower_wl_dis.extend([lower_wl_dat_list[_][1] for _ in
-                                                                                     range(len(lower_wl_dat_list))])
-                                                                lower_wl.extend([lower_wl_dat_list[_][0] for _ in
-                                                                                 range(len(lower_wl_dat_list))])
-
-                                                    if len(upper_wl_dis) == 10 and len(lower_wl_dis) == 10 and len(
-                                                            lower_wl) == 10:
-                                                        break
-                                                if len(upper_wl_dis) == 0:
-                                                    upper_wl_dis = [0.00001]
-                                                elif len(lower_wl_dis) == 0:
-                                                    lower_wl_dis = [0.00001]
-                                                    lower_wl = [wl_centre]
-                                                elif len(upper_wl_dis) != len(lower_wl_dis):
-                                                    size_ = min(len(upper_wl_dis), len(lower_wl_dis))
-                                                    upper_wl_dis = upper_wl_dis[: size_]
-                                                    lower_wl_dis = lower_wl_dis[: size_]
-                                                    lower_wl = lower_wl[: size_]
-
-                                                upper_wl_dis = [(1 / _) ** 2 for _ in upper_wl_dis]
-                                                lower_wl_dis = [(1 / _) ** 2 for _ in lower_wl_dis]
-                                                upper_wl = [wl_centre * upper_wl_dis[_] for _ in
-                                                            range(len(upper_wl_dis))]
-                                                lower_wl = [lower_wl[_] * lower_wl_dis[_] for _ in
-                                                            range(len(lower_wl_dis))]
-
-                                                min_wl_arr_refined_t[pos_y, pos_x] = sum(
-                                                    [sum(upper_wl), sum(lower_wl)]) / sum(
-                                                    [sum(upper_wl_dis), sum(lower_wl_dis)])
-
+                                if inun_id_ > 0 and inun_id_slice[inun_id_ - 1] is not None:
+
+                                    # Extract the inun ras within the bounding box (plus one pixel) of the inun id
+                                    y_slice, x_slice = inun_id_slice[inun_id_ - 1]
+                                    y_slice = slice(max(y_slice.start - 1, 0), y_slice.stop + 1)
+                                    x_slice = slice(max(x_slice.start - 1, 0), x_slice.stop + 1)
+                                    inun_id_t = inun_id_arr[y_slice, x_slice] != inun_id_
+                                    pw_t = permanent_water_arr[y_slice, x_slice] == 1
+
+                                    min_wl_arr_t = min_inun_wl_arr[y_slice, x_slice].astype(np.float32)
+                                    min_wl_arr_t[inun_id_t] = np.nan
+                                    min_wl_arr_t[pw_t] = -1
+
+                                    max_wl_arr_t = max_noninun_wl_arr[y_slice, x_slice].astype(np.float32)
+                                    max_wl_arr_t[inun_id_t] = np.nan
+                                    max_wl_arr_t[pw_t] = -1
+
+                                    # Assign the status, pre-assign the bound pixel and interpolate the wl of the pixels within the region
+                                    # The legacy window search is the default, the nearest lower pixel engine is used with the wl_refine='nearest'
+                                    min_wl_arr_refined_t = refine_inundation_wl(min_wl_arr_t, max_wl_arr_t, water_level_data, doy_list, wl_refine=wl_refine)
                                     min_wl_arr_refined_t[np.isnan(min_wl_arr_refined_t)] = 0
-                                    min_wl_arr_refined[offset_all[0] - 1: bound_all[0] + 2,
-                                    offset_all[1] - 1: bound_all[1] + 2] = min_wl_arr_refined[
-                                                                           offset_all[0] - 1: bound_all[0] + 2,
-                                                                           offset_all[1] - 1: bound_all[
-                                                                                                  1] + 2] + min_wl_arr_refined_t
-                                    time4 = time.time() - s_t
-
-                                    # print(f'P1: {str(time1)[0:6]}s, P2: {str(time2)[0:6]}s, P3: {str(time3)[0:6]}s, P4: {str(time4)[0:6]}s')
+                                    min_wl_arr_refined[y_slice, x_slice] = min_wl_arr_refined[y_slice, x_slice] + min_wl_arr_refined_t
                                 pbar3.update()
 
                             min_wl_arr_refined[permanent_water_arr == 1] = -1
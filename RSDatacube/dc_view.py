@@ -0,0 +1,236 @@
+import numpy as np
+import scipy.sparse as sm
+from collections.abc import Mapping
+from NDsm import NDSparseMatrix, _ChunkedSMGroup
+
+
+class _ViewSMGroup(Mapping):
+
+    ### The read-only SM group of the Dc_view, keyed by the layer name as the SM_group of the NDsm
+    # The layer is cropped and converted on access, writing should go through the Dc_view.write_layer
+
+    def __init__(self, view):
+        self._view = view
+
+    def __getitem__(self, name):
+        if name not in self._view._name_pos:
+            raise KeyError(name)
+        return self._view.read_layer(self._view._name_pos[name])
+
+    def __contains__(self, name):
+        return name in self._view._name_pos
+
+    def __iter__(self):
+        return iter(self._view.SM_namelist)
+
+    def __len__(self):
+        return len(self._view.SM_namelist)
+
+
+def _understand_index(key, size: int):
+
+    # Convert the int or slice index of one axis into [start, end] and whether the axis is squeezed
+    if isinstance(key, (int, np.integer)):
+        key = int(key) + size if key < 0 else int(key)
+        if key not in range(size):
+            raise IndexError(f'The index {str(key)} is out of the range {str(size)}!')
+        return [key, key + 1], True
+    elif isinstance(key, slice):
+        if key.step not in (None, 1):
+            raise IndexError('The step of the slice is not supported for the Dc_view!')
+        start, end, _ = key.indices(size)
+        return [start, max(start, end)], False
+    else:
+        raise IndexError(f'The index {str(key)} is not supported for the Dc_view!')
+
+
+class Dc_view(object):
+
+    ### The Dc_view is a read-only view over the NDSparseMatrix, the dense (memory-mapped) datacube or another Dc_view
+    # (1) The spatial crop (y_range/x_range), the date subset (z_index/namelist) and the dtype conversion are recorded instead of being applied
+    # (2) Each layer is cropped and converted only when it is read, thus the base datacube is never duplicated
+    # (3) The mutation is an explicit copy-on-write through the write_layer, the new layer is kept in the overlay of the view and the base is untouched
+    # (4) The materialize() returns a standalone NDsm or array, the untouched layers are shared with the base instead of being copied
+    # Caution: The shared layers and the array returned by the materialize() should be treated as read-only
+
+    def __init__(self, dc, y_range: list = None, x_range: list = None, z_index: list = None, namelist: list = None, dtype=None):
+
+        # Check the base datacube
+        if isinstance(dc, Dc_view):
+            self._sparse = dc._sparse
+        elif isinstance(dc, NDSparseMatrix):
+            self._sparse = True
+        elif isinstance(dc, np.ndarray):
+            if dc.ndim != 3:
+                raise TypeError('The dense datacube should be a 3D array!')
+            self._sparse = False
+        else:
+            raise TypeError('The Dc_view only supports the NDsm, the 3D array or another Dc_view!')
+        self._base = dc
+        base_shape = list(dc.shape)
+
+        # Process the spatial crop
+        self._y_range = self._process_range(y_range, base_shape[0], 'y_range')
+        self._x_range = self._process_range(x_range, base_shape[1], 'x_range')
+
+        # Process the date subset, the namelist is only available for the sparse datacube
+        base_namelist = list(dc.SM_namelist) if self._sparse else None
+        if z_index is not None and namelist is not None:
+            raise ValueError('Please input either the z_index or the namelist for the date subset!')
+        elif namelist is not None:
+            if not self._sparse:
+                raise TypeError('The namelist is only supported for the NDsm!')
+            base_pos = {name: pos for pos, name in enumerate(base_namelist)}
+            if False in [name in base_pos for name in namelist]:
+                raise ValueError('Some layers in the namelist are not in the datacube!')
+            self._z_index = [base_pos[name] for name in namelist]
+        elif z_index is not None:
+            self._z_index = [int(_) for _ in z_index]
+            if False in [_ in range(base_shape[2]) for _ in self._z_index]:
+                raise ValueError('The z_index is out of the range of the datacube!')
+        else:
+            self._z_index = list(range(base_shape[2]))
+
+        self.SM_namelist = [base_namelist[_] for _ in self._z_index] if self._sparse else None
+        self._name_pos = {name: pos for pos, name in enumerate(self.SM_namelist)} if self._sparse else None
+        self.SM_group = _ViewSMGroup(self) if self._sparse else None
+
+        # The dtype conversion is applied to the layer read from the base
+        self._dtype = None if dtype is None else np.dtype(dtype)
+        self.dtype = self._dtype if self._dtype is not None else (np.dtype(dc.dtype) if dc.dtype is not None else None)
+        self.shape = [self._y_range[1] - self._y_range[0], self._x_range[1] - self._x_range[0], len(self._z_index)]
+
+        # The copy-on-write overlay keyed by the z position of the view
+        self._overlay = {}
+
+    def _process_range(self, range_temp, size: int, name: str):
+        if range_temp is None:
+            return [0, size]
+        elif isinstance(range_temp, (list, tuple)) and len(range_temp) == 2 and 0 <= range_temp[0] <= range_temp[1] <= size:
+            return [int(range_temp[0]), int(range_temp[1])]
+        else:
+            raise ValueError(f'The {name} {str(range_temp)} is not within the range [0, {str(size)}]!')
+
+    def _full_window(self, y_range: list, x_range: list):
+        return y_range == [0, self.shape[0]] and x_range == [0, self.shape[1]]
+
+    def _read_base(self, base_pos: int, y_range: list, x_range: list):
+
+        # Read the window of one base layer under the coordinate of the base
+        base = self._base
+        if isinstance(base, Dc_view):
+            return base._read_window(base_pos, y_range, x_range)
+        elif isinstance(base, NDSparseMatrix):
+            name = base.SM_namelist[base_pos]
+            if isinstance(base.SM_group, _ChunkedSMGroup):
+                return base.SM_group.read_window(name, y_range, x_range)
+            layer = base.SM_group[name]
+            if y_range == [0, base.shape[0]] and x_range == [0, base.shape[1]]:
+                return layer
+            elif not isinstance(layer, (sm.csr_matrix, sm.csc_matrix)):
+                layer = sm.csr_matrix(layer)
+            return layer[y_range[0]: y_range[1], x_range[0]: x_range[1]]
+        else:
+            return base[y_range[0]: y_range[1], x_range[0]: x_range[1], base_pos]
+
+    def _read_window(self, pos: int, y_range: list, x_range: list):
+
+        # Read the window of one layer under the coordinate of the view
+        if pos in self._overlay:
+            layer = self._overlay[pos]
+            return layer if self._full_window(y_range, x_range) else layer[y_range[0]: y_range[1], x_range[0]: x_range[1]]
+
+        layer = self._read_base(self._z_index[pos], [y_range[0] + self._y_range[0], y_range[1] + self._y_range[0]],
+                                [x_range[0] + self._x_range[0], x_range[1] + self._x_range[0]])
+        if self._dtype is not None and layer.dtype != self._dtype:
+            layer = layer.astype(self._dtype)
+        return layer
+
+    def read_layer(self, pos: int):
+
+        # The whole layer of the view, the sparse layer is the base layer itself if it is neither cropped nor converted
+        if pos not in range(self.shape[2]):
+            raise IndexError(f'The layer {str(pos)} is out of the range of the view!')
+        return self._read_window(pos, [0, self.shape[0]], [0, self.shape[1]])
+
+    def write_layer(self, pos: int, layer):
+
+        # Copy-on-write, the layer is kept in the overlay and the base datacube is never modified
+        if pos not in range(self.shape[2]):
+            raise IndexError(f'The layer {str(pos)} is out of the range of the view!')
+        elif list(layer.shape[:2]) != self.shape[:2] or (layer.ndim == 3 and layer.shape[2] != 1):
+            raise ValueError(f'The shape of the layer {str(layer.shape)} is not consistent with the view {str(self.shape)}!')
+        self._overlay[pos] = layer.reshape(self.shape[:2]) if isinstance(layer, np.ndarray) else layer
+
+    def crop(self, y_range: list = None, x_range: list = None):
+        return Dc_view(self, y_range=y_range, x_range=x_range)
+
+    def __getitem__(self, keys):
+
+        if not isinstance(keys, tuple) or len(keys) != 3:
+            raise TypeError('Please index the Dc_view with a (y, x, z) tuple!')
+        y_range, y_squeeze = _understand_index(keys[0], self.shape[0])
+        x_range, x_squeeze = _understand_index(keys[1], self.shape[1])
+        if isinstance(keys[2], (list, np.ndarray)):
+            z_list, z_squeeze = [int(_) for _ in keys[2]], False
+        else:
+            z_temp, z_squeeze = _understand_index(keys[2], self.shape[2])
+            z_list = list(range(z_temp[0], z_temp[1]))
+
+        # (1) The numpy view of the dense base is returned directly if no layer is overwritten or converted
+        if isinstance(self._base, np.ndarray) and len(self._overlay) == 0 and (self._dtype is None or self._dtype == self._base.dtype):
+            base_z = [self._z_index[_] for _ in z_list]
+            if len(base_z) > 0 and base_z == list(range(base_z[0], base_z[-1] + 1)):
+                base_z = slice(base_z[0], base_z[-1] + 1)
+            arr = self._base[y_range[0] + self._y_range[0]: y_range[1] + self._y_range[0],
+                             x_range[0] + self._x_range[0]: x_range[1] + self._x_range[0], base_z]
+
+        # (2) Otherwise the windows of the layers are read and stacked
+        else:
+            arr_list = []
+            for pos in z_list:
+                layer = self._read_window(pos, y_range, x_range)
+                arr_list.append(layer.toarray() if sm.issparse(layer) else np.asarray(layer))
+            if len(arr_list) == 0:
+                arr = np.zeros([y_range[1] - y_range[0], x_range[1] - x_range[0], 0], dtype=self.dtype)
+            else:
+                arr = np.stack(arr_list, axis=2)
+
+        return arr[0 if y_squeeze else slice(None), 0 if x_squeeze else slice(None), 0 if z_squeeze else slice(None)]
+
+    def __setitem__(self, keys, value):
+        raise TypeError('The Dc_view is read-only, please modify the layer through the write_layer (copy-on-write)!')
+
+    def extract_pixel_series(self, y_arr, x_arr):
+
+        # Extract the time series of a batch of pixels into a dense (n_pixels, n_layers) array, each layer is indexed once
+        y_arr, x_arr = np.asarray(y_arr, dtype=np.int64).flatten(), np.asarray(x_arr, dtype=np.int64).flatten()
+        if y_arr.shape[0] != x_arr.shape[0]:
+            raise ValueError('The y and x of the pixels are not consistent!')
+        elif y_arr.shape[0] > 0 and (y_arr.min() < 0 or y_arr.max() >= self.shape[0] or x_arr.min() < 0 or x_arr.max() >= self.shape[1]):
+            raise ValueError('The pixel is out of the range of the view!')
+
+        series = np.zeros([y_arr.shape[0], self.shape[2]], dtype=self.dtype)
+        for pos in range(self.shape[2]):
+            layer = self.read_layer(pos)
+            if sm.issparse(layer) and not isinstance(layer, (sm.csr_matrix, sm.csc_matrix)):
+                layer = sm.csr_matrix(layer)
+            series[:, pos] = np.asarray(layer[y_arr, x_arr]).flatten()
+        return series
+
+    def materialize(self):
+
+        # Convert the view into a standalone datacube
+        # (1) For the NDsm, the untouched layers that are neither cropped nor converted are shared with the base
+        # (2) For the dense datacube, the read-only numpy view is returned if no layer is overwritten or converted
+        if self._sparse:
+            layer_list = [self.read_layer(pos) for pos in range(self.shape[2])]
+            matrix_type = type([_ for _ in layer_list if sm.issparse(_)][0]) if True in [sm.issparse(_) for _ in layer_list] else sm.csr_matrix
+            layer_list = [_ if type(_) == matrix_type else matrix_type(_) for _ in layer_list]
+            return NDSparseMatrix(*layer_list, SM_namelist=list(self.SM_namelist))
+        else:
+            arr = self[:, :, :]
+            if isinstance(self._base, np.ndarray) and len(self._overlay) == 0 and (self._dtype is None or self._dtype == self._base.dtype):
+                arr = arr.view()
+                arr.setflags(write=False)
+            return arr
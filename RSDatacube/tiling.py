@@ -0,0 +1,264 @@
+import os
+import pickle
+import traceback
+import concurrent.futures
+import numpy as np
+import psutil
+from tqdm.auto import tqdm
+from NDsm import NDSparseMatrix, _SharedSMGroup
+from .dc_view import Dc_view
+import basic_function as bf
+
+
+def open_dc_source(dc_source, cache_bytes: int = None):
+
+    # Open the datacube in the worker
+    # (1) The NDsm folder (end with \\) is opened lazily with a bounded layer cache
+    # (2) The dense npy datacube is memory-mapped
+    # (3) The shared array is attached
+    # (4) Otherwise the datacube object itself is used
+    if isinstance(dc_source, str):
+        if dc_source.endswith('.npy'):
+            return np.load(dc_source, mmap_mode='r')
+        elif dc_source.endswith('\\') or os.path.isdir(dc_source):
+            return NDSparseMatrix().load(dc_source, lazy=True, cache_bytes=cache_bytes)
+        else:
+            raise TypeError('The type of dc_source is not supported!')
+    elif isinstance(dc_source, bf.Shared_array):
+        return dc_source.array
+    elif isinstance(dc_source, (NDSparseMatrix, np.ndarray)):
+        return dc_source
+    else:
+        raise TypeError('The type of dc_source is not supported!')
+
+
+def dc2source(dc):
+
+    # Return the source of the datacube which is cheap to ship to the worker
+    # (1) The NDsm known to be unmodified since it was loaded is reopened from its folder, the modified NDsm is exported into the shared memory
+    # (2) The memory-mapped npy is reopened from its file, the in-memory dense array is exported into the shared memory
+    # Release the source by release_dc_source() after the workers finished
+    if isinstance(dc, NDSparseMatrix):
+        if isinstance(dc.SM_group, _SharedSMGroup):
+            return dc
+        elif dc.is_ondisk():
+            return dc._input_path
+        else:
+            return dc.share_memory()
+    elif isinstance(dc, np.memmap) and dc.filename is not None and dc.filename.endswith('.npy'):
+        return dc.filename
+    elif isinstance(dc, np.ndarray):
+        return bf.Shared_array(dc)
+    else:
+        return dc
+
+
+def release_dc_source(dc_source, dc):
+
+    # Release the shared memory exported by the dc2source
+    if dc_source is dc:
+        return
+    elif isinstance(dc_source, bf.Shared_array):
+        dc_source.release()
+    elif isinstance(dc_source, NDSparseMatrix):
+        dc_source.release_shared_memory()
+
+
+def block_windows(shape: list, block_size: tuple, halo: int = 0):
+
+    # Generate the (y-block, x-block) windows covering the y-x extent, each window is a dict of
+    # the core y/x range, the halo y/x range (core padded by the halo and clipped by the extent) and the core slice within the halo block
+    if len(block_size) != 2 or False in [isinstance(_, (int, np.integer)) and _ > 0 for _ in block_size]:
+        raise ValueError('Please input the block size as a tuple of two positive int!')
+    elif not isinstance(halo, (int, np.integer)) or halo < 0:
+        raise ValueError('Please input the halo as a non-negative int!')
+
+    window_list = []
+    for y0 in range(0, shape[0], block_size[0]):
+        for x0 in range(0, shape[1], block_size[1]):
+            y_range, x_range = [y0, min(y0 + block_size[0], shape[0])], [x0, min(x0 + block_size[1], shape[1])]
+            halo_y_range, halo_x_range = [max(y_range[0] - halo, 0), min(y_range[1] + halo, shape[0])], [max(x_range[0] - halo, 0), min(x_range[1] + halo, shape[1])]
+            window_list.append({'y_range': y_range, 'x_range': x_range, 'halo_y_range': halo_y_range, 'halo_x_range': halo_x_range,
+                                'core': (slice(y_range[0] - halo_y_range[0], y_range[1] - halo_y_range[0]), slice(x_range[0] - halo_x_range[0], x_range[1] - halo_x_range[0]))})
+    return window_list
+
+
+def iter_dc_blocks(*dcs, block_size: tuple = None, halo: int = 0, block_bytes: int = 512 * 1024 ** 2):
+
+    # Iterate the datacubes (NDsm, dense or memory-mapped array and Dc_view sharing the y-x extent) in (y-block, x-block, all-z) windows
+    # (1) Each block is read into an in-memory dense array, thus only one block of each datacube is resident at a time
+    # (2) The block is padded by the halo (clipped at the edge of the extent), use the window['core'] to get the core of the block
+    # (3) Without the block size, the square block is sized so that the blocks of all the datacubes fit the block_bytes
+    # Yield the window dict and the tuple of the blocks in the order of the input datacubes
+    if len(dcs) == 0:
+        raise ValueError('Please input at least one datacube!')
+    for dc in dcs:
+        if not isinstance(dc, (NDSparseMatrix, np.ndarray, Dc_view)) or len(dc.shape) != 3:
+            raise TypeError('The block iterator only supports the NDsm, the 3D array or the Dc_view!')
+        elif list(dc.shape[:2]) != list(dcs[0].shape[:2]):
+            raise ValueError('The datacubes are not consistent in the y-x extent!')
+
+    if block_size is None:
+        bytes_per_pixel = sum([max(dc.shape[2], 1) * (np.dtype(dc.dtype).itemsize if dc.dtype is not None else 8) for dc in dcs])
+        block_side = max(int(np.sqrt(block_bytes / bytes_per_pixel)) - 2 * halo, 1)
+        block_size = (block_side, block_side)
+
+    for window in block_windows(list(dcs[0].shape[:2]), block_size, halo=halo):
+        y_range, x_range = window['halo_y_range'], window['halo_x_range']
+        block_list = []
+        for dc in dcs:
+            if isinstance(dc, np.ndarray):
+                block_list.append(np.array(dc[y_range[0]: y_range[1], x_range[0]: x_range[1], :]))
+            else:
+                block = Dc_view(dc, y_range=y_range, x_range=x_range)[:, :, :]
+                block_list.append(block if block.flags.owndata else np.array(block))
+        yield window, tuple(block_list)
+
+
+def _process_tile(func, dc_source, tile: dict, z_range: list, cache_bytes: int, args: tuple, pixel_major: bool = False):
+
+    try:
+        dc = open_dc_source(dc_source, cache_bytes=cache_bytes)
+        y_range, x_range = tile['y_range'], tile['x_range']
+        if isinstance(dc, NDSparseMatrix):
+            tile_dc = dc.extract_matrix(([y_range[0], y_range[1]], [x_range[0], x_range[1]], z_range))
+            if pixel_major and tile_dc._pixel_major is None:
+                tile_dc._pixel_major = dc.read_pixel_major_window([y_range[0], y_range[1]], [x_range[0], x_range[1]], z_range)
+        else:
+            z_slice = slice(None) if z_range == ['all'] else slice(z_range[0], z_range[-1])
+            tile_dc = np.asarray(dc[y_range[0]: y_range[1], x_range[0]: x_range[1], z_slice])
+        return func(tile_dc, tile, *args)
+    except:
+        print(traceback.format_exc())
+        raise Exception(f'Some error occurred during processing the tile {str(tile["id"])}!')
+
+
+class Tile_scheduler(object):
+
+    ### The tile scheduler partitions the ROI into tiles balanced by valid-pixel count and dispatches them to a process pool
+    # (1) The ROI is recursively bisected along the longer side at the median valid pixel until each tile fits the worker memory budget
+    # (2) Each worker opens the datacube by path (unmodified lazy NDsm or memory-mapped npy) or attaches the shared memory (modified NDsm or in-memory array)
+    #     instead of receiving a pickled slice
+    # (3) The results are yielded once each tile is finished
+    # (4) With the resume folder, the finished tiles are cached and skipped in the rerun (None result is regarded as failed and not cached)
+    # (5) With the pixel_major, the NDsm tile carries the columns of the persisted pixel-major cube for the pixel-wise func (only the columns of the tile are read)
+    # Caution: For the NDsm saved in one npz per layer, every worker still decodes the whole layers, the chunked container only reads the touched chunks
+
+    def __init__(self, roi_array, nodata_value=-32768, worker_memory: int = 2 * 1024 ** 3, max_workers: int = None, resume_folder: str = None):
+
+        # Read the ROI
+        if isinstance(roi_array, str):
+            roi_array = np.load(roi_array)
+        elif not isinstance(roi_array, np.ndarray):
+            raise TypeError('Please input the ROI as an array or the path of the ROI array!')
+        self.roi_shape = roi_array.shape
+        if np.isnan(nodata_value):
+            self._roi_pos = np.argwhere(~np.isnan(roi_array))
+        else:
+            self._roi_pos = np.argwhere(roi_array != nodata_value)
+
+        # Worker number restricted by the available memory
+        if not isinstance(worker_memory, int) or worker_memory <= 0:
+            raise TypeError('Please input the worker memory as a positive int in bytes!')
+        self.worker_memory = worker_memory
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        self.max_workers = int(max(1, min(max_workers, psutil.virtual_memory().available // worker_memory)))
+
+        # Resume folder
+        if resume_folder is not None:
+            bf.create_folder(resume_folder)
+            resume_folder = bf.Path(resume_folder).path_name
+        self.resume_folder = resume_folder
+        self.tiles = None
+
+    def partition(self, bytes_per_pixel: int = 8):
+
+        # Half of the worker memory is left for the layer cache, the other half bounds the valid pixels in a tile
+        # At least four tiles per worker are generated for the load balance
+        max_pixels = max(1, int(self.worker_memory // 2 // max(bytes_per_pixel, 1)))
+        max_pixels = max(1, min(max_pixels, int(np.ceil(self._roi_pos.shape[0] / (self.max_workers * 4)))))
+
+        # No tile for the ROI without valid pixel
+        if self._roi_pos.shape[0] == 0:
+            self.tiles = []
+            return self.tiles
+
+        # Reuse the partition in the resume folder
+        if self.resume_folder is not None and os.path.exists(f'{self.resume_folder}tile_partition.npy'):
+            tile_id_arr = np.load(f'{self.resume_folder}tile_partition.npy')
+            if tile_id_arr.shape[0] == self._roi_pos.shape[0]:
+                self.tiles = [self._create_tile(_, self._roi_pos[tile_id_arr == _]) for _ in range(int(tile_id_arr.max()) + 1)]
+                self.tiles = [_ for _ in self.tiles if _ is not None]
+                return self.tiles
+
+        pos_stack, pos_list = [self._roi_pos], []
+        while pos_stack:
+            pos_temp = pos_stack.pop()
+            if pos_temp.shape[0] <= max_pixels:
+                pos_list.append(pos_temp)
+            else:
+                axis = 0 if np.ptp(pos_temp[:, 0]) >= np.ptp(pos_temp[:, 1]) else 1
+                pos_temp = pos_temp[np.argsort(pos_temp[:, axis], kind='stable')]
+                pos_stack.extend([pos_temp[pos_temp.shape[0] // 2:], pos_temp[: pos_temp.shape[0] // 2]])
+
+        self.tiles = [self._create_tile(_, pos_list[_]) for _ in range(len(pos_list))]
+        self.tiles = [_ for _ in self.tiles if _ is not None]
+
+        if self.resume_folder is not None:
+            tile_id_arr = np.zeros(self._roi_pos.shape[0], dtype=np.int32)
+            roi_index = {tuple(_): __ for __, _ in enumerate(self._roi_pos.tolist())}
+            for tile in self.tiles:
+                tile_id_arr[[roi_index[tuple(_)] for _ in tile['pos'].tolist()]] = tile['id']
+            np.save(f'{self.resume_folder}tile_partition.npy', tile_id_arr)
+        return self.tiles
+
+    def _create_tile(self, tile_id: int, pos: np.ndarray):
+        # Sort the pixels in x-y order within the tile, None for the tile without pixel
+        if pos.shape[0] == 0:
+            return None
+        pos = pos[np.lexsort((pos[:, 0], pos[:, 1]))]
+        return {'id': tile_id, 'pos': pos, 'y_range': [int(pos[:, 0].min()), int(pos[:, 0].max()) + 1],
+                'x_range': [int(pos[:, 1].min()), int(pos[:, 1].max()) + 1]}
+
+    def map(self, func, dc, *args, z_range: list = None, desc: str = 'Processing tiles', pixel_major: bool = False):
+
+        # Dispatch the func(tile_dc, tile, *args) over all the tiles and yield the (tile, result)
+        # The tile is a dict of the id, the pos (global y-x of the valid pixels) and the y/x range of the bounding box
+        z_range = ['all'] if z_range is None else z_range
+        if self.tiles is None:
+            if isinstance(dc, NDSparseMatrix):
+                self.partition(bytes_per_pixel=dc.shape[2] * 8)
+            elif isinstance(dc, np.ndarray):
+                self.partition(bytes_per_pixel=dc.shape[2] * 8 if dc.ndim == 3 else 8)
+            else:
+                self.partition()
+
+        # Yield the cached result of the finished tiles
+        unfinished_tiles = []
+        for tile in self.tiles:
+            if self.resume_folder is not None and os.path.exists(f'{self.resume_folder}tile_{str(tile["id"])}.pkl'):
+                with open(f'{self.resume_folder}tile_{str(tile["id"])}.pkl', 'rb') as pkl_temp:
+                    yield tile, pickle.load(pkl_temp)
+            else:
+                unfinished_tiles.append(tile)
+
+        if len(unfinished_tiles) == 0:
+            return
+
+        # The datacube is shipped once (by path or shared memory) rather than pickled into every tile
+        dc_source = dc2source(dc)
+        try:
+            with tqdm(total=sum([_['pos'].shape[0] for _ in unfinished_tiles]), desc=desc, bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                    futures = {executor.submit(_process_tile, func, dc_source, tile, z_range, self.worker_memory // 2, args, pixel_major): tile for tile in unfinished_tiles}
+                    for future in concurrent.futures.as_completed(futures):
+                        tile, result = futures[future], future.result()
+                        if self.resume_folder is not None and result is not None:
+                            with open(f'{self.resume_folder}tile_{str(tile["id"])}.pkl.tmp', 'wb') as pkl_temp:
+                                pickle.dump(result, pkl_temp)
+                            os.replace(f'{self.resume_folder}tile_{str(tile["id"])}.pkl.tmp', f'{self.resume_folder}tile_{str(tile["id"])}.pkl')
+                        pbar.update(tile['pos'].shape[0])
+                        yield tile, result
+        finally:
+            release_dc_source(dc_source, dc)
@@ -1,5 +1,7 @@
 import os
 from NDsm import NDSparseMatrix
+from .dc_view import Dc_view
+from .tiling import iter_dc_blocks
 import numpy as np
 import pandas as pd
 import scipy.sparse as sm
@@ -9,6 +11,9 @@ from osgeo import gdal
 import basic_function as bf
 from Landsat_toolbox.utils import *
 from scipy.optimize import curve_fit
+from scipy.special import expit
+from scipy import ndimage
+from scipy.spatial import cKDTree
 import psutil
 import numpy as np
 import json
@@ -260,12 +265,205 @@ def assign_wl_status(wl_arr: np.ndarray,  wl: float):
     return inun_inform_list
 
 
-def mp_static_wi_detection(dc: NDSparseMatrix, sz_f, zoffset, nodata, thr):
+### The raster-wide engine assigning the water level to the pixels of one inundation region
+# (1) The status of all the pixels is derived from their 3x3 neighbourhood at once (as the assign_wl_status)
+#     1: bounded by a higher wl or the non-inundated (nan) pixel, -1: bounded by the permanent water, 0: within the region
+# (2) The wl of the status 1/-1 pixels is pre-assigned (as the pre_assign_wl)
+# (3) For each distinct wl, the k nearest pixels with the same wl ("equal") and with a lower wl ("lower") are queried for all
+#     the status 0 pixels through the KD-tree, and the wl is interpolated by the inverse distance weighting
+#     k_nearest=1 and idw_power=1 is the linear interpolation of the assign_wl, k_nearest=10 and idw_power=2 is the one of the est_inunduration
+# (4) The wl_refine selects the interpolation of the step (3)
+#     'legacy': the window search of the est_inunduration, the status 0 pixels are refined one by one (sorted by the wl and
+#               then row by row) and each sees the wl refined before it. The lower pixels are the lowest wl within the window
+#     'nearest': the truly nearest lower pixels, the result is independent of the pixel order
 
+
+def assign_wl_status_map(wl_arr: np.ndarray):
+
+    # The status of all the pixels with wl, nan for the non-inundated and the permanent water (-1) pixels
+    nan_arr = np.isnan(wl_arr)
+    max_arr = ndimage.maximum_filter(np.where(nan_arr, -np.inf, wl_arr), size=3, mode='constant', cval=-np.inf)
+    nan_nbr = ndimage.maximum_filter(nan_arr.astype(np.uint8), size=3, mode='constant', cval=0).astype(bool)
+    pw_nbr = ndimage.maximum_filter((wl_arr == -1).astype(np.uint8), size=3, mode='constant', cval=0).astype(bool)
+
+    status_arr = np.where(np.logical_or(max_arr > wl_arr, nan_nbr), 1, np.where(pw_nbr, -1, 0)).astype(np.float32)
+    status_arr[np.logical_or(nan_arr, wl_arr == -1)] = np.nan
+    return status_arr
+
+
+def _previous_wl(wl_temp, water_level_data: np.ndarray, doy_list):
+
+    # The wl five days before the first date in the doy_list reaching the wl_temp
+    wl_pos = np.argwhere(water_level_data == float(str(wl_temp)))[:, 0]
+    wl_pos = wl_pos[np.isin(water_level_data[wl_pos, 0], doy_list)]
+    if wl_pos.shape[0] == 0:
+        raise Exception(f'The water level {str(wl_temp)} is not found within the doy list!')
+    return water_level_data[int(np.min(wl_pos)) - 5, 1]
+
+
+def pre_assign_wl_map(min_wl_arr: np.ndarray, max_wl_arr: np.ndarray, status_arr: np.ndarray, water_level_data: np.ndarray, doy_list):
+
+    # Pre-assign the wl of the status 1/-1 pixels, the status 0 pixels are left as nan
+    refined_arr = np.full(min_wl_arr.shape, np.nan, dtype=np.result_type(min_wl_arr.dtype, np.float32))
+    bound_pix = status_arr == 1
+    refined_arr[bound_pix] = min_wl_arr[bound_pix]
+
+    # The pw-bounded pixel is assigned the mean of the min inundated and the max non-inundated wl
+    # Or, if the max non-inundated wl is higher, the wl before the inundation is used
+    pw_pix = status_arr == -1
+    higher_pix = np.logical_and(pw_pix, max_wl_arr > min_wl_arr)
+    mean_pix = np.logical_and(pw_pix, ~higher_pix)
+    refined_arr[mean_pix] = (min_wl_arr[mean_pix] + max_wl_arr[mean_pix]) / 2
+    for wl_temp in np.unique(min_wl_arr[higher_pix]):
+        wl_temp_2 = _previous_wl(wl_temp, water_level_data, doy_list)
+        if wl_temp_2 <= wl_temp and wl_temp - wl_temp_2 < 3:
+            refined_arr[np.logical_and(higher_pix, min_wl_arr == wl_temp)] = (wl_temp_2 + wl_temp) / 2
+        else:
+            refined_arr[np.logical_and(higher_pix, min_wl_arr == wl_temp)] = wl_temp - 1
+    return refined_arr
+
+
+def _nearest_known(known_yx: np.ndarray, target_yx: np.ndarray, k_nearest: int, max_radius: int):
+
+    # The distance (inf if missing) and the position in the known_yx of the k nearest known pixels
+    # Only the known pixels within the square window of max_radius are considered (as the window search of the assign_wl)
+    dis_arr = np.full([target_yx.shape[0], k_nearest], np.inf)
+    pos_arr = np.zeros([target_yx.shape[0], k_nearest], dtype=np.int64)
+    if known_yx.shape[0] == 0 or target_yx.shape[0] == 0:
+        return dis_arr, pos_arr
+
+    k_temp = min(k_nearest, known_yx.shape[0])
+    dis_temp, pos_temp = cKDTree(known_yx).query(target_yx, k=k_temp, distance_upper_bound=max_radius * np.sqrt(2) + 1e-6)
+    dis_temp, pos_temp = dis_temp.reshape(target_yx.shape[0], k_temp), pos_temp.reshape(target_yx.shape[0], k_temp)
+    pos_temp = np.minimum(pos_temp, known_yx.shape[0] - 1)
+    dis_temp[np.abs(known_yx[pos_temp] - target_yx[:, None, :]).max(axis=2) > max_radius] = np.inf
+
+    order = np.argsort(dis_temp, axis=1, kind='stable')
+    dis_arr[:, :k_temp] = np.take_along_axis(dis_temp, order, axis=1)
+    pos_arr[:, :k_temp] = np.take_along_axis(pos_temp, order, axis=1)
+    return dis_arr, pos_arr
+
+
+def refine_wl_nearest(refined_arr: np.ndarray, min_wl_arr: np.ndarray, target_arr: np.ndarray, k_nearest: int = 10, idw_power: float = 2, max_radius: int = 99):
+
+    # Interpolate the wl of the target pixels with the k nearest "equal" and "lower" pixels of the pre-assigned refined_arr
+    # The same number of the equal and lower pixels is used, and the wl of the target pixel is kept if either is missing
+    refined_arr = refined_arr.copy()
+    known_pix = np.logical_and(~np.isnan(refined_arr), refined_arr >= 0)
+    known_yx, known_wl = np.argwhere(known_pix), refined_arr[known_pix]
+
+    for wl_temp in np.unique(min_wl_arr[target_arr]):
+        target_yx = np.argwhere(np.logical_and(target_arr, min_wl_arr == wl_temp))
+        upper_dis, _ = _nearest_known(known_yx[known_wl == wl_temp], target_yx, k_nearest, max_radius)
+        lower_dis, lower_pos = _nearest_known(known_yx[known_wl < wl_temp], target_yx, k_nearest, max_radius)
+        lower_wl = known_wl[known_wl < wl_temp][lower_pos] if (known_wl < wl_temp).any() else np.zeros_like(lower_dis)
+
+        num_arr = np.minimum(np.isfinite(upper_dis).sum(axis=1), np.isfinite(lower_dis).sum(axis=1))
+        used_arr = np.arange(k_nearest)[None, :] < num_arr[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            upper_w = np.where(used_arr, 1 / upper_dis ** idw_power, 0).sum(axis=1)
+            lower_w = np.where(used_arr, 1 / lower_dis ** idw_power, 0)
+            wl_arr = (wl_temp * upper_w + (lower_wl * lower_w).sum(axis=1)) / (upper_w + lower_w.sum(axis=1))
+        refined_arr[target_yx[:, 0], target_yx[:, 1]] = np.where(num_arr > 0, wl_arr, wl_temp)
+    return refined_arr
+
+
+def refine_wl_window(refined_arr: np.ndarray, min_wl_arr: np.ndarray, target_yx: np.ndarray, k_nearest: int = 10, idw_power: float = 2, max_radius: int = 99):
+
+    # Interpolate the wl of the target pixels in the order of the target_yx through the growing square window (as the est_inunduration)
+    # The window slicing and the nan written into the window of the refined_arr are kept as they were, so as to reproduce the legacy surface
+    refined_arr = refined_arr.copy()
+    for pos_y, pos_x in target_yx:
+        wl_centre = min_wl_arr[pos_y, pos_x]
+        upper_wl_dis, lower_wl_dis, lower_wl = [], [], []
+
+        # Find the k nearest points
+        for r in range(1, max_radius + 1):
+            pos_y_lower = 0 if pos_y - r < 0 else pos_y - r
+            pos_x_lower = 0 if pos_x - r < 0 else pos_x - r
+            pos_y_upper = refined_arr.shape[0] if pos_y + r + 1 > refined_arr.shape[0] else pos_y + r + 1
+            pos_x_upper = refined_arr.shape[1] if pos_x + r + 1 > refined_arr.shape[1] else pos_x + r + 1
+
+            arr_tt = refined_arr[pos_y_lower: pos_y_upper, pos_x_lower: pos_x_upper]
+            arr_tt[pos_y_lower - 1: pos_y_upper - 1, pos_x_lower - 1: pos_x_upper - 1] = np.nan
+            if len(upper_wl_dis) < k_nearest:
+                upper_wl_dis_list = []
+                if (arr_tt == wl_centre).any():
+                    for pos_ttt in np.argwhere(arr_tt == wl_centre):
+                        upper_wl_dis_list.append(np.sqrt((pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2))
+                    upper_wl_dis_list.sort()
+                    upper_wl_dis.extend(upper_wl_dis_list[: k_nearest - len(upper_wl_dis)])
+
+            if len(lower_wl_dis) < k_nearest:
+                lower_wl_dat_list = []
+                arr_tt[arr_tt < 0] = 100000
+                if (arr_tt < wl_centre).any():
+                    for pos_ttt in np.argwhere(arr_tt <= wl_centre):
+                        lower_wl_dat_list.append([arr_tt[pos_ttt[0], pos_ttt[1]], np.sqrt((pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2)])
+                    lower_wl_dat_list.sort()
+                    lower_wl_dat_list = lower_wl_dat_list[: k_nearest - len(lower_wl_dis)]
+                    lower_wl_dis.extend([_[1] for _ in lower_wl_dat_list])
+                    lower_wl.extend([_[0] for _ in lower_wl_dat_list])
+
+            if len(upper_wl_dis) == k_nearest and len(lower_wl_dis) == k_nearest:
+                break
+
+        if len(upper_wl_dis) == 0:
+            upper_wl_dis = [0.00001]
+        elif len(lower_wl_dis) == 0:
+            lower_wl_dis = [0.00001]
+            lower_wl = [wl_centre]
+        elif len(upper_wl_dis) != len(lower_wl_dis):
+            size_ = min(len(upper_wl_dis), len(lower_wl_dis))
+            upper_wl_dis, lower_wl_dis, lower_wl = upper_wl_dis[: size_], lower_wl_dis[: size_], lower_wl[: size_]
+
+        upper_wl_dis = [(1 / _) ** idw_power for _ in upper_wl_dis]
+        lower_wl_dis = [(1 / _) ** idw_power for _ in lower_wl_dis]
+        upper_wl = [wl_centre * _ for _ in upper_wl_dis]
+        lower_wl = [lower_wl[_] * lower_wl_dis[_] for _ in range(len(lower_wl_dis))]
+        refined_arr[pos_y, pos_x] = sum([sum(upper_wl), sum(lower_wl)]) / sum([sum(upper_wl_dis), sum(lower_wl_dis)])
+    return refined_arr
+
+
+def refine_inundation_wl(min_wl_arr: np.ndarray, max_wl_arr: np.ndarray, water_level_data: np.ndarray, doy_list, k_nearest: int = 10, idw_power: float = 2, max_radius: int = 99, wl_refine: str = 'legacy'):
+
+    # Refine the min inundation wl of one inundation region (nan outside the region and -1 for the permanent water)
+    if wl_refine not in ['legacy', 'nearest']:
+        raise ValueError(f'The wl_refine {str(wl_refine)} is not supported!')
+    status_arr = assign_wl_status_map(min_wl_arr)
+    refined_arr = pre_assign_wl_map(min_wl_arr, max_wl_arr, status_arr, water_level_data, doy_list)
+
+    # The wl without any pre-assigned pixel is seeded at the median pixel of its status 0 pixels
+    seed_arr = np.zeros(min_wl_arr.shape, dtype=bool)
+    for wl_temp in np.unique(min_wl_arr[status_arr == 0]):
+        if not (refined_arr == wl_temp).any():
+            pos_y_em_list, pos_x_em_list = np.nonzero(np.logical_and(status_arr == 0, min_wl_arr == wl_temp))
+            pos_x_mid = int(np.nanmedian(pos_x_em_list))
+            if pos_x_mid in pos_x_em_list:
+                pos_y_mid = int(np.nanmedian(pos_y_em_list[pos_x_em_list == pos_x_mid]))
+            else:
+                pos_y_mid, pos_x_mid = pos_y_em_list[int(pos_y_em_list.shape[0] / 2)], pos_x_em_list[int(pos_x_em_list.shape[0] / 2)]
+            refined_arr[pos_y_mid, pos_x_mid] = wl_temp
+            seed_arr[pos_y_mid, pos_x_mid] = True
+
+    if wl_refine == 'legacy':
+        # The seeded pixel is refined as well, in the order of the sorted wl and then row by row
+        target_yx = np.argwhere(status_arr == 0)
+        target_yx = target_yx[np.argsort(min_wl_arr[status_arr == 0], kind='stable')]
+        return refine_wl_window(refined_arr, min_wl_arr, target_yx, k_nearest=k_nearest, idw_power=idw_power, max_radius=max_radius)
+    else:
+        target_arr = np.logical_and(np.logical_and(status_arr == 0, np.isnan(refined_arr)), ~seed_arr)
+        return refine_wl_nearest(refined_arr, min_wl_arr, target_arr, k_nearest=k_nearest, idw_power=idw_power, max_radius=max_radius)
+
+
+def mp_static_wi_detection(dc: NDSparseMatrix, sz_f, zoffset, nodata, thr, z_namelist: list = None):
+
+    # The z_namelist specifies the layers processed in this worker if the whole (shared) dc is passed
+    z_namelist = dc.SM_namelist if z_namelist is None else z_namelist
     inundation_arr_list = []
     name_list = []
-    for z_temp in range(len(dc.SM_namelist)):
-        inundation_array = dc.SM_group[dc.SM_namelist[z_temp]]
+    for z_temp in range(len(z_namelist)):
+        inundation_array = dc.SM_group[z_namelist[z_temp]]
         dtype_temp = type(inundation_array)
 
         inundation_array = invert_data(inundation_array, sz_f, zoffset, nodata)
@@ -274,7 +472,7 @@ def mp_static_wi_detection(dc: NDSparseMatrix, sz_f, zoffset, nodata, thr):
         inundation_array[np.isnan(inundation_array)] = 0
         inundation_array = inundation_array.astype(np.byte)
         inundation_arr_list.append(dtype_temp(inundation_array))
-        name_list.append(dc.SM_namelist[z_temp])
+        name_list.append(z_namelist[z_temp])
     return inundation_arr_list, name_list
 
 
@@ -411,6 +609,96 @@ def bimodal_histogram_threshold(input_temp, method = None, init_threshold=0.123)
                 return i1th_threshold
 
 
+def bimodal_DT_threshold_batch(wi_arr: np.ndarray, doy_array, variance_num, bimodal_factor: bool = True, init_threshold: float = 0.1, max_iter: int = 200):
+
+    ### Batched version of the bimodal_histogram_threshold and the dynamic threshold of the create_bimodal_histogram_threshold
+    # (1) The wi_arr is the (n_pixels, n_dates) water index (already inverted) with NaN as nodata
+    # (2) The iterative intermeans threshold is updated for all the unconverged pixels at once, the comparisons are made under float32 as the per-pixel version
+    # (3) The iteration is capped by the max_iter, the pixel oscillating between two thresholds keeps the last one
+    # Return the DT_threshold and the bh_threshold of the pixels (both NaN for the pixel without enough dry observations)
+    wi_arr = np.asarray(wi_arr, dtype=np.float32)
+    if wi_arr.ndim != 2 or wi_arr.shape[1] != len(doy_array):
+        raise ValueError('The wi array should be a (n_pixels, n_dates) array consistent with the doy array!')
+    valid = ~np.isnan(wi_arr)
+    wi_filled = np.where(valid, wi_arr, 0).astype(np.float64)
+    n_valid = valid.sum(axis=1)
+
+    # The bimodal threshold
+    if bimodal_factor:
+        bh_threshold = np.full(wi_arr.shape[0], np.nan)
+        init_temp = np.float32(init_threshold)
+        greater_count = (valid & (wi_arr >= init_temp)).sum(axis=1)
+        active = np.flatnonzero((n_valid >= 8) & (greater_count > 0) & (greater_count < n_valid) & (greater_count < 0.9 * n_valid))
+
+        ith_threshold = np.full(active.shape[0], init_temp, dtype=np.float32)
+        i1th_threshold = np.full(active.shape[0], np.nan, dtype=np.float32)
+        converged = np.zeros(active.shape[0], dtype=bool)
+        for _ in range(max_iter):
+            unconverged = np.flatnonzero(~converged)
+            if unconverged.shape[0] == 0:
+                break
+            wi_temp, valid_temp, filled_temp = wi_arr[active[unconverged]], valid[active[unconverged]], wi_filled[active[unconverged]]
+            lower = valid_temp & (wi_temp < ith_threshold[unconverged][:, None])
+            greater = valid_temp & ~lower
+            with np.errstate(invalid='ignore', divide='ignore'):
+                lower_mean = ((filled_temp * lower).sum(axis=1) / lower.sum(axis=1)).astype(np.float32)
+                greater_mean = ((filled_temp * greater).sum(axis=1) / greater.sum(axis=1)).astype(np.float32)
+            i1th_temp = (greater_mean + lower_mean) / np.float32(2)
+            i1th_threshold[unconverged] = i1th_temp
+            stop = (i1th_temp == ith_threshold[unconverged]) | np.isnan(i1th_temp)
+            converged[unconverged[stop]] = True
+            ith_threshold[unconverged[~stop]] = i1th_temp[~stop]
+
+        bh_temp = i1th_threshold.astype(np.float64)
+        bh_temp[(bh_temp < -0.05) | (bh_temp > 0.2)] = 0.123
+        bh_temp[np.isnan(i1th_threshold)] = init_threshold
+        bh_threshold[active] = bh_temp
+        bh_threshold[np.isnan(bh_threshold)] = -2
+    else:
+        bh_threshold = np.full(wi_arr.shape[0], 0.123)
+
+    # The dynamic threshold based on the dry observations out of the flood season (doy 182-300)
+    doy_temp = np.mod(np.asarray(doy_array), 1000)
+    dry = valid & ~((doy_temp >= 182) & (doy_temp <= 300))[None, :] & ~(wi_arr < -0.7)
+    all_dry_sum = dry.sum(axis=1)
+    dry = dry & ~(wi_arr > bh_threshold.astype(np.float32)[:, None])
+    dry_sum = dry.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dry_mean = (wi_filled * dry).sum(axis=1) / dry_sum
+        dry_std = np.sqrt((((wi_filled - dry_mean[:, None]) ** 2) * dry).sum(axis=1) / dry_sum)
+    DT_threshold = np.minimum(dry_mean.astype(np.float32) + variance_num * dry_std.astype(np.float32), bh_threshold)
+
+    invalid_pixel = (dry_sum < 5) | (dry_sum < 0.5 * all_dry_sum)
+    DT_threshold[invalid_pixel] = np.nan
+    bh_threshold = bh_threshold.copy()
+    bh_threshold[invalid_pixel] = np.nan
+    return DT_threshold, bh_threshold
+
+
+def create_DT_threshold_map(wi_dc, roi_arr: np.ndarray, doy_array, size_control_factor, zoffset, nodata_value, variance_num, bimodal_factor, block_bytes: int = 256 * 1024 ** 2):
+
+    # Generate the DT threshold map and the bimodal threshold map of the ROI (roi_arr == 1) block by block
+    # The wi dc is the NDsm, the dense array or the Dc_view, the thresholds out of the ROI are NaN
+    if list(roi_arr.shape) != list(wi_dc.shape[:2]):
+        raise ValueError('The ROI array is not consistent with the wi dc!')
+    DT_threshold_arr = np.ones([wi_dc.shape[0], wi_dc.shape[1]]) * np.nan
+    bh_threshold_arr = np.ones([wi_dc.shape[0], wi_dc.shape[1]]) * np.nan
+    roi_mask = roi_arr == 1
+
+    with tqdm(total=int(roi_mask.sum()), desc=f'Create DT threshold', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
+        for window, (wi_block, ) in iter_dc_blocks(wi_dc, block_bytes=block_bytes):
+            y_range, x_range = window['y_range'], window['x_range']
+            roi_block = roi_mask[y_range[0]: y_range[1], x_range[0]: x_range[1]]
+            if not roi_block.any():
+                continue
+            wi_series = invert_data(wi_block[roi_block], size_control_factor, zoffset, nodata_value)
+            DT_temp, bh_temp = bimodal_DT_threshold_batch(wi_series, doy_array, variance_num, bimodal_factor=bimodal_factor)
+            DT_threshold_arr[y_range[0]: y_range[1], x_range[0]: x_range[1]][roi_block] = DT_temp
+            bh_threshold_arr[y_range[0]: y_range[1], x_range[0]: x_range[1]][roi_block] = bh_temp
+            pbar.update(int(roi_block.sum()))
+    return DT_threshold_arr, bh_threshold_arr
+
+
 def slice_datacube(datacube, pos, sort_y_x='x'):
 
     # Process para
@@ -433,12 +721,14 @@ def slice_datacube(datacube, pos, sort_y_x='x'):
         pos_ = pos[_ * indi_len: min((_ + 1) * indi_len, pos.shape[0])].reset_index(drop=True)
         pos_list.append(pos_)
         y_min, y_max, x_min, x_max = pos_['y'].min(), pos_['y'].max(), pos_['x'].min(), pos_['x'].max()
-        if isinstance(datacube, NDSparseMatrix):
+        if isinstance(datacube, Dc_view):
+            datacube_list.append(datacube.crop([y_min, y_max + 1], [x_min, x_max + 1]).materialize())
+        elif isinstance(datacube, NDSparseMatrix):
             datacube_list.append(datacube.extract_matrix(([y_min, y_max + 1], [x_min, x_max + 1], ['all'])))
         elif isinstance(datacube, np.ndarray):
             datacube_list.append(datacube[y_min: y_max + 1, x_min: x_max + 1, :])
         else:
-            raise TypeError('The slicing datacube is not under NDSM or datacube type!')
+            raise TypeError('The slicing datacube is not under NDSM, Dc_view or datacube type!')
         yxoffset_list.append([y_min, x_min])
 
     return datacube_list, pos_list, yxoffset_list
@@ -468,37 +758,304 @@ def create_indi_DT_inundation_map(inundated_arr, doy_array: np.ndarray, date_num
         return date_num, inundation_map
 
 
+def curfit_bound_by_paras(doy_temp: np.ndarray, vi_all: np.ndarray, paras, curfit_algorithm, para_num: int):
+
+    # Generate the per-pixel parameter boundary based on the initial fitting of all the observations
+    paras_max_dic = [np.nan for _ in range(para_num)]
+    paras_min_dic = [np.nan for _ in range(para_num)]
+
+    vi_dormancy, doy_dormancy, vi_max, doy_max = [], [], [], []
+    doy_index_max = np.argmax(curfit_algorithm(np.linspace(0, 366, 365), paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6]))
+
+    # Generate the parameter boundary
+    senescence_t = paras[4] - 4 * paras[5]
+
+    for doy_index in range(doy_temp.shape[0]):
+        if 0 < doy_temp[doy_index] < paras[2] or paras[4] < doy_temp[doy_index] < 366:
+            vi_dormancy.append(vi_all[doy_index])
+            doy_dormancy.append(doy_temp[doy_index])
+        if doy_index_max - 5 < doy_temp[doy_index] < doy_index_max + 5:
+            vi_max.append(vi_all[doy_index])
+            doy_max.append(doy_temp[doy_index])
+
+    if vi_max == []:
+        vi_max = [np.max(vi_all)]
+        doy_max = [doy_temp[np.argmax(vi_all)]]
+
+    itr = 5
+    while itr < 10:
+        doy_senescence, vi_senescence = [], []
+        for doy_index in range(doy_temp.shape[0]):
+            if senescence_t - itr < doy_temp[doy_index] < senescence_t + itr:
+                vi_senescence.append(vi_all[doy_index])
+                doy_senescence.append(doy_temp[doy_index])
+        if doy_senescence != [] and vi_senescence != []:
+            break
+        else:
+            itr += 1
+
+    # define the para1
+    if vi_dormancy != []:
+        vi_dormancy_sort = np.sort(vi_dormancy)
+        vi_max_sort = np.sort(vi_max)
+        paras_max_dic[0] = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.95))]
+        paras_min_dic[0] = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.05))]
+        paras_max_dic[0] = min(paras_max_dic[0], 0.5)
+        paras_min_dic[0] = max(paras_min_dic[0], 0)
+    else:
+        paras_max_dic[0], paras_min_dic[0] = 0.5, 0
+
+    # define the para2
+    paras_max_dic[1] = vi_max[-1] - paras_min_dic[0]
+    paras_min_dic[1] = vi_max[0] - paras_max_dic[0]
+    if paras_min_dic[1] < 0.2:
+        paras_min_dic[1] = 0.2
+    if paras_max_dic[1] > 0.7 or paras_max_dic[1] < 0.2:
+        paras_max_dic[1] = 0.7
+
+    # define the para3
+    paras_max_dic[2] = 0
+    for doy_index in range(len(doy_temp)):
+        if paras_min_dic[0] < vi_all[doy_index] < paras_max_dic[0] and doy_temp[doy_index] < 180:
+            paras_max_dic[2] = max(float(paras_max_dic[2]), doy_temp[doy_index])
+
+    paras_min_dic[2] = 180
+    for doy_index in range(len(doy_temp)):
+        if vi_all[doy_index] > paras_max_dic[0]:
+            paras_min_dic[2] = min(paras_min_dic[2], doy_temp[doy_index])
+
+    if paras_min_dic[2] > paras[2] or paras_min_dic[2] < paras[2] - 15:
+        paras_min_dic[2] = paras[2] - 15
+
+    if paras_max_dic[2] < paras[2] or paras_max_dic[2] > paras[2] + 15:
+        paras_max_dic[2] = paras[2] + 15
+
+    # define the para5
+    paras_max_dic[4] = 0
+    for doy_index in range(len(doy_temp)):
+        if vi_all[doy_index] > paras_max_dic[0]:
+            paras_max_dic[4] = max(paras_max_dic[4], doy_temp[doy_index])
+    paras_min_dic[4] = 365
+    for doy_index in range(len(doy_temp)):
+        if paras_min_dic[0] < vi_all[doy_index] < paras_max_dic[0] and doy_temp[doy_index] > 180:
+            paras_min_dic[4] = min(paras_min_dic[4], doy_temp[doy_index])
+    if paras_min_dic[4] > paras[4] or paras_min_dic[4] < paras[4] - 15:
+        paras_min_dic[4] = paras[4] - 15
+
+    if paras_max_dic[4] < paras[4] or paras_max_dic[4] > paras[4] + 15:
+        paras_max_dic[4] = paras[4] + 15
+
+    # define the para 4
+    if len(doy_max) != 1:
+        paras_max_dic[3] = (np.nanmax(doy_max) - paras_min_dic[2]) / 4
+        paras_min_dic[3] = (np.nanmin(doy_max) - paras_max_dic[2]) / 4
+    else:
+        paras_max_dic[3] = (np.nanmax(doy_max) + 5 - paras_min_dic[2]) / 4
+        paras_min_dic[3] = (np.nanmin(doy_max) - 5 - paras_max_dic[2]) / 4
+    paras_min_dic[3] = max(3, paras_min_dic[3])
+    paras_max_dic[3] = min(17, paras_max_dic[3])
+    if paras_min_dic[3] > 17:
+        paras_min_dic[3] = 3
+    if paras_max_dic[3] < 3:
+        paras_max_dic[3] = 17
+    paras_max_dic[5] = paras_max_dic[3]
+    paras_min_dic[5] = paras_min_dic[3]
+    if doy_senescence == [] or vi_senescence == []:
+        paras_max_dic[6] = 0.01
+        paras_min_dic[6] = 0.00001
+    else:
+        paras_max_dic[6] = (np.nanmax(vi_max) - np.nanmin(vi_senescence)) / (
+                doy_senescence[np.argmin(vi_senescence)] - doy_max[np.argmax(vi_max)])
+        paras_min_dic[6] = (np.nanmin(vi_max) - np.nanmax(vi_senescence)) / (
+                doy_senescence[np.argmax(vi_senescence)] - doy_max[np.argmin(vi_max)])
+    if np.isnan(paras_min_dic[6]):
+        paras_min_dic[6] = 0.00001
+    if np.isnan(paras_max_dic[6]):
+        paras_max_dic[6] = 0.01
+    paras_max_dic[6] = min(paras_max_dic[6], 0.01)
+    paras_min_dic[6] = max(paras_min_dic[6], 0.00001)
+    if paras_max_dic[6] < 0.00001:
+        paras_max_dic[6] = 0.01
+    if paras_min_dic[6] > 0.01:
+        paras_min_dic[6] = 0.00001
+    if paras_min_dic[0] > paras[0]:
+        paras_min_dic[0] = paras[0] - 0.01
+    if paras_max_dic[0] < paras[0]:
+        paras_max_dic[0] = paras[0] + 0.01
+    if paras_min_dic[1] > paras[1]:
+        paras_min_dic[1] = paras[1] - 0.01
+    if paras_max_dic[1] < paras[1]:
+        paras_max_dic[1] = paras[1] + 0.01
+    if paras_min_dic[2] > paras[2]:
+        paras_min_dic[2] = paras[2] - 1
+    if paras_max_dic[2] < paras[2]:
+        paras_max_dic[2] = paras[2] + 1
+    if paras_min_dic[3] > paras[3]:
+        paras_min_dic[3] = paras[3] - 0.1
+    if paras_max_dic[3] < paras[3]:
+        paras_max_dic[3] = paras[3] + 0.1
+    if paras_min_dic[4] > paras[4]:
+        paras_min_dic[4] = paras[4] - 1
+    if paras_max_dic[4] < paras[4]:
+        paras_max_dic[4] = paras[4] + 1
+    if paras_min_dic[5] > paras[5]:
+        paras_min_dic[5] = paras[5] - 0.5
+    if paras_max_dic[5] < paras[5]:
+        paras_max_dic[5] = paras[5] + 0.5
+    if paras_min_dic[6] > paras[6]:
+        paras_min_dic[6] = paras[6] - 0.00001
+    if paras_max_dic[6] < paras[6]:
+        paras_max_dic[6] = paras[6] + 0.00001
+
+    return paras_min_dic, paras_max_dic
+
+
+def _spl_batch_model(x: np.ndarray, paras: np.ndarray):
+    m1, m2, m3, m4, m5, m6, m7 = [paras[:, _: _ + 1] for _ in range(7)]
+    return m1 + (m2 - m7 * x) * (expit((x - m3) / m4) - expit((x - m5) / m6))
+
+
+def _spl_batch_jacobian(x: np.ndarray, paras: np.ndarray):
+    m1, m2, m3, m4, m5, m6, m7 = [paras[:, _: _ + 1] for _ in range(7)]
+    s1, s2 = expit((x - m3) / m4), expit((x - m5) / m6)
+    amp, ds1, ds2 = m2 - m7 * x, s1 * (1 - s1), s2 * (1 - s2)
+    return np.stack([np.ones_like(x * m1), s1 - s2, - amp * ds1 / m4, amp * ds1 * (m3 - x) / m4 ** 2,
+                     amp * ds2 / m6, - amp * ds2 * (m5 - x) / m6 ** 2, - x * (s1 - s2)], axis=2)
+
+
+def _ttf_batch_model(x: np.ndarray, paras: np.ndarray):
+    a0, a1, b1, a2, b2, w = [paras[:, _: _ + 1] for _ in range(6)]
+    return a0 + a1 * np.cos(w * x) + b1 * np.sin(w * x) + a2 * np.cos(2 * w * x) + b2 * np.sin(2 * w * x)
+
+
+def _ttf_batch_jacobian(x: np.ndarray, paras: np.ndarray):
+    a0, a1, b1, a2, b2, w = [paras[:, _: _ + 1] for _ in range(6)]
+    cos1, sin1, cos2, sin2 = np.cos(w * x), np.sin(w * x), np.cos(2 * w * x), np.sin(2 * w * x)
+    return np.stack([np.ones_like(x * a0), cos1, sin1, cos2, sin2,
+                     x * (- a1 * sin1 + b1 * cos1 - 2 * a2 * sin2 + 2 * b2 * cos2)], axis=2)
+
+
+_batch_curfit_model = {'SPL': (_spl_batch_model, _spl_batch_jacobian, 7), 'TTF': (_ttf_batch_model, _ttf_batch_jacobian, 6)}
+
+
+def batch_curve_fit(x, y: np.ndarray, curfit_method: str, p0, bounds: tuple, max_iter: int = 200, ftol: float = 1e-5, xtol: float = 1e-8):
+
+    # Fit the seven-para logistic (SPL) or two-term fourier (TTF) function for a batch of pixels at once
+    # (1) The y is a (n_pixels, n_obs) array with nan for the invalid observation, the x is either (n_obs,) or (n_pixels, n_obs)
+    # (2) The p0 and the bounds are either shared by all pixels or specified per pixel as (n_pixels, para_num)
+    # (3) A projected Levenberg-Marquardt with analytic jacobian is iterated for all the unconverged pixels together
+    # (4) The paras, the convergence mask and the R square of each pixel are returned
+    if curfit_method not in _batch_curfit_model.keys():
+        raise ValueError(f'The curve fitting method {str(curfit_method)} is not supported for the batch fitting!')
+    model, jacobian, para_num = _batch_curfit_model[curfit_method]
+
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim != 2:
+        raise ValueError('Please input the y as a (n_pixels, n_obs) array!')
+    pixel_num = y.shape[0]
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), y.shape)
+    lower = np.broadcast_to(np.asarray(bounds[0], dtype=np.float64), (pixel_num, para_num))
+    upper = np.broadcast_to(np.asarray(bounds[1], dtype=np.float64), (pixel_num, para_num))
+    paras = np.array(np.broadcast_to(np.asarray(p0, dtype=np.float64), (pixel_num, para_num)))
+
+    # Mask the invalid observation with zero weight
+    weight = (~np.isnan(y) & ~np.isnan(x)).astype(np.float64)
+    x, y = np.where(weight > 0, x, 0), np.where(weight > 0, y, 0)
+
+    # The pixel with infeasible bounds or initial paras is not fitted (same as the ValueError of curve_fit)
+    feasible = np.all(lower < upper, axis=1) & np.all(lower <= paras, axis=1) & np.all(paras <= upper, axis=1) & (weight.sum(axis=1) >= para_num)
+    converged = np.zeros(pixel_num, dtype=bool)
+    damping = np.full(pixel_num, 0.001)
+    cost = np.sum(((model(x, paras) - y) * weight) ** 2, axis=1)
+    active = np.argwhere(feasible & np.isfinite(cost)).flatten()
+
+    for _ in range(max_iter):
+        if active.shape[0] == 0:
+            break
+        x_a, y_a, w_a, paras_a, cost_a = x[active], y[active], weight[active], paras[active], cost[active]
+
+        # Solve the damped normal equations of all the active pixels
+        residual = (model(x_a, paras_a) - y_a) * w_a
+        jac = jacobian(x_a, paras_a) * w_a[:, :, None]
+        jtj = np.einsum('kmi,kmj->kij', jac, jac)
+        jtr = np.einsum('kmi,km->ki', jac, residual)
+        diag = np.einsum('kii->ki', jtj)
+        jtj[:, np.arange(para_num), np.arange(para_num)] += damping[active, None] * np.maximum(diag, 1e-12)
+
+        # Freeze the paras at the bound with the descent direction pointing outward
+        frozen = ((paras_a <= lower[active]) & (jtr > 0)) | ((paras_a >= upper[active]) & (jtr < 0))
+        jtj[np.repeat(frozen[:, :, None], para_num, axis=2) | np.repeat(frozen[:, None, :], para_num, axis=1)] = 0
+        jtj[:, np.arange(para_num), np.arange(para_num)] += frozen
+        jtr[frozen] = 0
+        try:
+            step = np.linalg.solve(jtj, - jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = - np.einsum('kij,kj->ki', np.linalg.pinv(jtj), jtr)
+
+        # Project the step into the bounds and evaluate the new cost
+        paras_new = np.clip(paras_a + np.nan_to_num(step), lower[active], upper[active])
+        cost_new = np.sum(((model(x_a, paras_new) - y_a) * w_a) ** 2, axis=1)
+        accept = np.isfinite(cost_new) & (cost_new < cost_a)
+        small_step = np.all(np.abs(paras_new - paras_a) <= xtol * (xtol + np.abs(paras_a)), axis=1)
+        small_reduction = accept & (cost_a - cost_new <= ftol * cost_a) & (damping[active] <= 1)
+
+        paras[active[accept]], cost[active[accept]] = paras_new[accept], cost_new[accept]
+        damping[active[accept]] = np.maximum(damping[active[accept]] / 10, 1e-12)
+        damping[active[~accept]] = damping[active[~accept]] * 10
+
+        done = small_reduction | small_step | (cost_new == 0)
+        converged[active[done]] = True
+        active = active[~done]
+
+    # Calculate the R square of each pixel
+    y_mean = np.sum(y * weight, axis=1) / np.maximum(weight.sum(axis=1), 1)
+    ss_tot = np.sum(((y - y_mean[:, None]) * weight) ** 2, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r_square = 1 - cost / ss_tot
+    r_square[~feasible] = np.nan
+    return paras, converged, r_square
+
+
 def curfit4bound_annual(pos_df: pd.DataFrame, index_dc_temp, doy_all: list, curfit_dic: dict, sparse_matrix_factor: bool, size_control_factor: bool, xy_offset: list, cache_folder: str, nd_v, zoff, divider: int = 10000):
 
+    store_file = None
     try:
         # Set up initial var
         print(str(xy_offset[0]) + '_' + str(xy_offset[1]))
-        start_time1 = time.time()
         year_all = np.unique(np.array([temp // 1000 for temp in doy_all]))
         year_range = range(np.min(year_all), np.max(year_all) + 1)
         pos_len = pos_df.shape[0]
-        pos_df = pos_df.reset_index()
+        para_num = curfit_dic['para_num']
 
-        # Set up the Cache folder
-        cache_folder = bf.Path(cache_folder).path_name
-        if os.path.exists(f'{cache_folder}postemp_{str(xy_offset[1])}.csv'):
-            pos_df = pd.read_csv(f'{cache_folder}postemp_{str(xy_offset[1])}.csv')
-            pos_init = int(np.ceil(max(pos_df.loc[~np.isnan(pos_df.para_ori_0)].index) / divider) * divider) + 1
-            pos_init = pos_len - 1 if pos_init > pos_len else pos_init
-            q_all = pos_init
-            q_temp = np.mod(q_all, 100)
-        else:
-            q_all, q_temp, pos_init = 0, 0, 0
-            # insert columns
+        # Define the columns of the result store
+        bound_col = [f'para_ori_{str(num)}' for num in range(para_num)] + [f'para_bound_min_{str(num)}' for num in range(para_num)] + [f'para_bound_max_{str(num)}' for num in range(para_num)]
+        annual_col = {year_temp: [f'{str(year_temp)}_para_{str(num)}' for num in range(para_num)] + [f'{str(year_temp)}_Rsquare'] for year_temp in year_range}
+        # The y and x are kept as int64, thus the csv exported from the store could be rasterised by the curfit_pd2tif
+        store_dtype = np.dtype([('y', np.int64), ('x', np.int64)] + [(col, np.float64) for col in bound_col + [_ for year_temp in year_range for _ in annual_col[year_temp]]])
 
-            pos_df = pd.concat([pos_df, pd.DataFrame([[np.nan for q in range(curfit_dic['para_num'])] for qq in range(pos_df.shape[0])], index=pos_df.index, columns=[f'para_ori_{str(i)}' for i in range(curfit_dic['para_num'])])], axis=1)
-            pos_df = pd.concat([pos_df, pd.DataFrame([[np.nan for q in range(curfit_dic['para_num'])] for qq in range(pos_df.shape[0])], index=pos_df.index, columns=[f'para_bound_min_{str(i)}' for i in range(curfit_dic['para_num'])])], axis=1)
-            pos_df = pd.concat([pos_df, pd.DataFrame([[np.nan for q in range(curfit_dic['para_num'])] for qq in range(pos_df.shape[0])], index=pos_df.index, columns=[f'para_bound_max_{str(i)}' for i in range(curfit_dic['para_num'])])], axis=1)
-
-            for year_temp in year_range:
-                col = [f'{str(year_temp)}_para_{str(i)}' for i in range(curfit_dic['para_num'])]
-                col.append(f'{str(year_temp)}_Rsquare')
-                pos_df = pd.concat([pos_df, pd.DataFrame([[np.nan for q in range(curfit_dic['para_num'] + 1)] for qq in range(pos_df.shape[0])], index=pos_df.index, columns=col)], axis=1)
+        # Set up the array-backed result store (one row per pixel) and its append-only checkpoint in the cache folder
+        # The checkpoint is a binary sequence of the (begin, end) of the finished batches
+        cache_folder = bf.Path(cache_folder).path_name
+        store_file = f'{cache_folder}curfit_{str(xy_offset[0])}_{str(xy_offset[1])}.npy'
+        checkpoint_file = f'{cache_folder}curfit_{str(xy_offset[0])}_{str(xy_offset[1])}.ckpt'
+        result_store = None
+        if os.path.exists(store_file) and os.path.exists(checkpoint_file):
+            result_store = np.lib.format.open_memmap(store_file, mode='r+')
+            if result_store.dtype != store_dtype or result_store.shape[0] != pos_len:
+                result_store = None
+
+        if result_store is None:
+            result_store = np.lib.format.open_memmap(store_file, mode='w+', dtype=store_dtype, shape=(pos_len,))
+            for col in store_dtype.names[2:]:
+                result_store[col] = np.nan
+            result_store['y'], result_store['x'] = pos_df['y'].to_numpy(), pos_df['x'].to_numpy()
+            result_store.flush()
+            open(checkpoint_file, 'wb').close()
+
+        # Resume from the checkpoint
+        finished = np.zeros(pos_len, dtype=bool)
+        for batch_beg, batch_end in np.fromfile(checkpoint_file, dtype=np.int64).reshape(-1, 2):
+            finished[batch_beg: batch_end] = True
 
         # Define the fitting curve algorithm
         if curfit_dic['CFM'] == 'SPL':
@@ -511,244 +1068,103 @@ def curfit4bound_annual(pos_df: pd.DataFrame, index_dc_temp, doy_all: list, curf
             para_ori = [0, 0, 0, 0, 0, 0.017]
             para_upbound = [1, 0.5, 0.5, 0.05, 0.05, 0.019]
             para_lowerbound = [0, -0.5, -0.5, -0.05, -0.05, 0.015]
-        t1, t2, t3, t4, t5 = 0, 0, 0, 0, 0
-
-        # # Create name_dic
-        # name_dic = {}
-        # col_list = [f'para_bound_max_{str(num)}' for num in range(curfit_dic['para_num'])]
-        # col_list.extend([f'para_bound_min_{str(num)}' for num in range(curfit_dic['para_num'])])
-        # col_list.extend([f'para_ori_{str(num)}' for num in range(curfit_dic['para_num'])])
-        # name_dic['bounds'] = col_list
-        # for year_temp in year_range:
-        #     col_list = [f'{str(year_temp)}_para_{str(num)}' for num in range(curfit_dic['para_num'])]
-        #     col_list.append(f'{str(year_temp)}_Rsquare')
-        #     name_dic[year_temp] = col_list
+
+        # Pixel position within the block and the doy of all the layers
+        pos_y = (pos_df['y'].to_numpy() - xy_offset[0]).astype(np.int64)
+        pos_x = (pos_df['x'].to_numpy() - xy_offset[1]).astype(np.int64)
+        year_doy_all = np.array(doy_all)
+        doy_temp = np.mod(year_doy_all, 1000)
 
         # Start generate the boundary and paras based on curve fitting
-        with tqdm(total=pos_len - pos_init, desc=f'Curve fitting Y{str(xy_offset[0])} X{str(xy_offset[1])}', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
-            for pos_len_temp in range(pos_init, pos_len):
-
-                # start_time = time.time()
-                # Define the key var
-                y_t, x_t = pos_df.loc[pos_len_temp, 'y'], pos_df.loc[pos_len_temp, 'x']
-                y_t = int(y_t - xy_offset[0])
-                x_t = int(x_t - xy_offset[1])
-
-                if not sparse_matrix_factor:
-                    vi_all = index_dc_temp[y_t, x_t, :].flatten()
-                elif sparse_matrix_factor:
-                    vi_all = index_dc_temp[y_t, x_t, :]
-                    vi_all = vi_all.flatten()
-                doy_temp = copy.deepcopy(doy_all)
-                doy_temp = np.mod(doy_temp, 1000)
-                year_doy_all = copy.deepcopy(doy_all)
-                vi_all = invert_data(vi_all, size_control_factor, zoff, nd_v)
-
-                vi_pos = np.argwhere(np.logical_or(vi_all < 0, np.isnan(vi_all)))
-                doy_temp = np.delete(doy_temp, vi_pos)
-                year_doy_all = np.delete(year_doy_all, vi_pos)
-                vi_all = np.delete(vi_all, vi_pos)
-
-                paras_max_dic = [np.nan for _ in range(curfit_dic['para_num'])]
-                paras_min_dic = [np.nan for _ in range(curfit_dic['para_num'])]
-
-                if doy_temp.shape[0] >= 7:
+        with tqdm(total=int(pos_len - finished.sum()), desc=f'Curve fitting Y{str(xy_offset[0])} X{str(xy_offset[1])}', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}') as pbar:
+            for batch_beg in range(0, pos_len, divider):
+
+                batch_end = min(batch_beg + divider, pos_len)
+                if finished[batch_beg: batch_end].all():
+                    continue
+
+                # Extract the time series of the batch of pixels in one pass
+                if sparse_matrix_factor:
+                    vi_batch = index_dc_temp.extract_pixel_series(pos_y[batch_beg: batch_end], pos_x[batch_beg: batch_end])
+                else:
+                    vi_batch = index_dc_temp[pos_y[batch_beg: batch_end], pos_x[batch_beg: batch_end], :]
+                vi_batch = invert_data(vi_batch, size_control_factor, zoff, nd_v).astype(np.float64)
+                vi_batch[vi_batch < 0] = np.nan
+
+                # Fit all the observations of the pixels with at least seven valid observations
+                fit_pos = np.argwhere(np.sum(~np.isnan(vi_batch), axis=1) >= 7).flatten()
+                paras_all, converged_all, r_square_all = batch_curve_fit(doy_temp, vi_batch[fit_pos], curfit_dic['CFM'], curfit_dic['initial_para_ori'], curfit_dic['initial_para_boundary'])
+
+                # Generate the per-pixel boundary (default boundary for the failed pixel)
+                # The pixel reaching max_iter is kept as curve_fit did with its best paras before maxfev
+                bound_arr = np.full([batch_end - batch_beg, 3 * para_num], np.nan)
+                for _, pos_temp in enumerate(fit_pos):
+                    valid_pos = ~np.isnan(vi_batch[pos_temp])
                     try:
-                        paras, extras = curve_fit(curfit_algorithm, doy_temp, vi_all, maxfev=50000, p0=curfit_dic['initial_para_ori'], bounds=curfit_dic['initial_para_boundary'], ftol=0.001)
-                        # t2 += time.time() - start_time
-
-                        vi_dormancy, doy_dormancy, vi_max, doy_max = [], [], [], []
-                        doy_index_max = np.argmax(curfit_algorithm(np.linspace(0, 366, 365), paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6]))
-
-                        # Generate the parameter boundary
-                        senescence_t = paras[4] - 4 * paras[5]
-
-                        for doy_index in range(doy_temp.shape[0]):
-                            if 0 < doy_temp[doy_index] < paras[2] or paras[4] < doy_temp[doy_index] < 366:
-                                vi_dormancy.append(vi_all[doy_index])
-                                doy_dormancy.append(doy_temp[doy_index])
-                            if doy_index_max - 5 < doy_temp[doy_index] < doy_index_max + 5:
-                                vi_max.append(vi_all[doy_index])
-                                doy_max.append(doy_temp[doy_index])
-
-                        if vi_max == []:
-                            vi_max = [np.max(vi_all)]
-                            doy_max = [doy_temp[np.argmax(vi_all)]]
-
-                        itr = 5
-                        while itr < 10:
-                            doy_senescence, vi_senescence = [], []
-                            for doy_index in range(doy_temp.shape[0]):
-                                if senescence_t - itr < doy_temp[doy_index] < senescence_t + itr:
-                                    vi_senescence.append(vi_all[doy_index])
-                                    doy_senescence.append(doy_temp[doy_index])
-                            if doy_senescence != [] and vi_senescence != []:
-                                break
-                            else:
-                                itr += 1
-
-                        # define the para1
-                        if vi_dormancy != []:
-                            vi_dormancy_sort = np.sort(vi_dormancy)
-                            vi_max_sort = np.sort(vi_max)
-                            paras_max_dic[0] = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.95))]
-                            paras_min_dic[0] = vi_dormancy_sort[int(np.fix(vi_dormancy_sort.shape[0] * 0.05))]
-                            paras_max_dic[0] = min(paras_max_dic[0], 0.5)
-                            paras_min_dic[0] = max(paras_min_dic[0], 0)
-                        else:
-                            paras_max_dic[0], paras_min_dic[0] = 0.5, 0
-
-                        # define the para2
-                        paras_max_dic[1] = vi_max[-1] - paras_min_dic[0]
-                        paras_min_dic[1] = vi_max[0] - paras_max_dic[0]
-                        if paras_min_dic[1] < 0.2:
-                            paras_min_dic[1] = 0.2
-                        if paras_max_dic[1] > 0.7 or paras_max_dic[1] < 0.2:
-                            paras_max_dic[1] = 0.7
-
-                        # define the para3
-                        paras_max_dic[2] = 0
-                        for doy_index in range(len(doy_temp)):
-                            if paras_min_dic[0] < vi_all[doy_index] < paras_max_dic[0] and doy_temp[doy_index] < 180:
-                                paras_max_dic[2] = max(float(paras_max_dic[2]), doy_temp[doy_index])
-
-                        paras_min_dic[2] = 180
-                        for doy_index in range(len(doy_temp)):
-                            if vi_all[doy_index] > paras_max_dic[0]:
-                                paras_min_dic[2] = min(paras_min_dic[2], doy_temp[doy_index])
-
-                        if paras_min_dic[2] > paras[2] or paras_min_dic[2] < paras[2] - 15:
-                            paras_min_dic[2] = paras[2] - 15
-
-                        if paras_max_dic[2] < paras[2] or paras_max_dic[2] > paras[2] + 15:
-                            paras_max_dic[2] = paras[2] + 15
-
-                        # define the para5
-                        paras_max_dic[4] = 0
-                        for doy_index in range(len(doy_temp)):
-                            if vi_all[doy_index] > paras_max_dic[0]:
-                                paras_max_dic[4] = max(paras_max_dic[4], doy_temp[doy_index])
-                        paras_min_dic[4] = 365
-                        for doy_index in range(len(doy_temp)):
-                            if paras_min_dic[0] < vi_all[doy_index] < paras_max_dic[0] and doy_temp[doy_index] > 180:
-                                paras_min_dic[4] = min(paras_min_dic[4], doy_temp[doy_index])
-                        if paras_min_dic[4] > paras[4] or paras_min_dic[4] < paras[4] - 15:
-                            paras_min_dic[4] = paras[4] - 15
-
-                        if paras_max_dic[4] < paras[4] or paras_max_dic[4] > paras[4] + 15:
-                            paras_max_dic[4] = paras[4] + 15
-
-                        # define the para 4
-                        if len(doy_max) != 1:
-                            paras_max_dic[3] = (np.nanmax(doy_max) - paras_min_dic[2]) / 4
-                            paras_min_dic[3] = (np.nanmin(doy_max) - paras_max_dic[2]) / 4
-                        else:
-                            paras_max_dic[3] = (np.nanmax(doy_max) + 5 - paras_min_dic[2]) / 4
-                            paras_min_dic[3] = (np.nanmin(doy_max) - 5 - paras_max_dic[2]) / 4
-                        paras_min_dic[3] = max(3, paras_min_dic[3])
-                        paras_max_dic[3] = min(17, paras_max_dic[3])
-                        if paras_min_dic[3] > 17:
-                            paras_min_dic[3] = 3
-                        if paras_max_dic[3] < 3:
-                            paras_max_dic[3] = 17
-                        paras_max_dic[5] = paras_max_dic[3]
-                        paras_min_dic[5] = paras_min_dic[3]
-                        if doy_senescence == [] or vi_senescence == []:
-                            paras_max_dic[6] = 0.01
-                            paras_min_dic[6] = 0.00001
-                        else:
-                            paras_max_dic[6] = (np.nanmax(vi_max) - np.nanmin(vi_senescence)) / (
-                                    doy_senescence[np.argmin(vi_senescence)] - doy_max[np.argmax(vi_max)])
-                            paras_min_dic[6] = (np.nanmin(vi_max) - np.nanmax(vi_senescence)) / (
-                                    doy_senescence[np.argmax(vi_senescence)] - doy_max[np.argmin(vi_max)])
-                        if np.isnan(paras_min_dic[6]):
-                            paras_min_dic[6] = 0.00001
-                        if np.isnan(paras_max_dic[6]):
-                            paras_max_dic[6] = 0.01
-                        paras_max_dic[6] = min(paras_max_dic[6], 0.01)
-                        paras_min_dic[6] = max(paras_min_dic[6], 0.00001)
-                        if paras_max_dic[6] < 0.00001:
-                            paras_max_dic[6] = 0.01
-                        if paras_min_dic[6] > 0.01:
-                            paras_min_dic[6] = 0.00001
-                        if paras_min_dic[0] > paras[0]:
-                            paras_min_dic[0] = paras[0] - 0.01
-                        if paras_max_dic[0] < paras[0]:
-                            paras_max_dic[0] = paras[0] + 0.01
-                        if paras_min_dic[1] > paras[1]:
-                            paras_min_dic[1] = paras[1] - 0.01
-                        if paras_max_dic[1] < paras[1]:
-                            paras_max_dic[1] = paras[1] + 0.01
-                        if paras_min_dic[2] > paras[2]:
-                            paras_min_dic[2] = paras[2] - 1
-                        if paras_max_dic[2] < paras[2]:
-                            paras_max_dic[2] = paras[2] + 1
-                        if paras_min_dic[3] > paras[3]:
-                            paras_min_dic[3] = paras[3] - 0.1
-                        if paras_max_dic[3] < paras[3]:
-                            paras_max_dic[3] = paras[3] + 0.1
-                        if paras_min_dic[4] > paras[4]:
-                            paras_min_dic[4] = paras[4] - 1
-                        if paras_max_dic[4] < paras[4]:
-                            paras_max_dic[4] = paras[4] + 1
-                        if paras_min_dic[5] > paras[5]:
-                            paras_min_dic[5] = paras[5] - 0.5
-                        if paras_max_dic[5] < paras[5]:
-                            paras_max_dic[5] = paras[5] + 0.5
-                        if paras_min_dic[6] > paras[6]:
-                            paras_min_dic[6] = paras[6] - 0.00001
-                        if paras_max_dic[6] < paras[6]:
-                            paras_max_dic[6] = paras[6] + 0.00001
-                        # t2 += time.time() - start_time
-                        # start_time = time.time()
-                        for num in range(curfit_dic['para_num']):
-                            pos_df.loc[pos_len_temp, f'para_bound_max_{str(num)}'] = paras_max_dic[num]
-                            pos_df.loc[pos_len_temp, f'para_bound_min_{str(num)}'] = paras_min_dic[num]
-                            pos_df.loc[pos_len_temp, f'para_ori_{str(num)}'] = paras[num]
-                        # t3 += time.time() - start_time
+                        if np.isnan(r_square_all[_]):
+                            raise RuntimeError('The curve fitting failed')
+                        paras_min_dic, paras_max_dic = curfit_bound_by_paras(doy_temp[valid_pos], vi_batch[pos_temp][valid_pos], paras_all[_], curfit_algorithm, para_num)
+                        bound_arr[pos_temp] = np.concatenate([paras_all[_], paras_min_dic, paras_max_dic])
                     except:
-                        for num in range(curfit_dic['para_num']):
-                            pos_df.loc[pos_len_temp, f'para_bound_max_{str(num)}'] = para_upbound[num]
-                            pos_df.loc[pos_len_temp, f'para_bound_min_{str(num)}'] = para_lowerbound[num]
-                            pos_df.loc[pos_len_temp, f'para_ori_{str(num)}'] = para_ori[num]
-
-                    ori_temp = [pos_df.loc[pos_len_temp, f'para_ori_{str(num)}'] for num in range(curfit_dic['para_num'])]
-                    bounds_temp = ([pos_df.loc[pos_len_temp, f'para_bound_min_{str(num)}'] for num in range(curfit_dic['para_num'])],
-                                   [pos_df.loc[pos_len_temp, f'para_bound_max_{str(num)}'] for num in range(curfit_dic['para_num'])])
-
-                    for year_temp in year_range:
-                        year_pos = np.argwhere(np.floor(year_doy_all / 1000) == year_temp)
-                        annual_doy = doy_temp[year_pos].flatten()
-                        annual_vi = vi_all[year_pos].flatten()
-                        if np.sum(~np.isnan(annual_vi)) >= curfit_dic['para_num']:
-
-                            try:
-                                # start_time = time.time()
-                                paras, extras = curve_fit(curfit_algorithm, annual_doy, annual_vi, maxfev=50000, p0=ori_temp, bounds=bounds_temp, ftol=0.001)
-                                predicted_y_data = curfit_algorithm(annual_doy, paras[0], paras[1], paras[2], paras[3], paras[4], paras[5], paras[6])
-                                R_square = (1 - np.sum((predicted_y_data - annual_vi) ** 2) / np.sum((annual_vi - np.mean(annual_vi)) ** 2))
-                                # t4 += time.time()-start_time
-                                # start_time = time.time()
-                                for num in range(curfit_dic['para_num']):
-                                    pos_df.loc[pos_len_temp, f'{str(year_temp)}_para_{str(num)}'] = paras[num]
-                                    pos_df.loc[pos_len_temp, f'{str(year_temp)}_Rsquare'] = R_square
-                                # t5 += time.time()-start_time
-                            except:
-                                for num in range(curfit_dic['para_num']):
-                                    pos_df.loc[pos_len_temp, f'{str(year_temp)}_para_{str(num)}'] = -1
-                                    pos_df.loc[pos_len_temp, f'{str(year_temp)}_Rsquare'] = -1
-                        else:
-                            for num in range(curfit_dic['para_num']):
-                                pos_df.loc[pos_len_temp, f'{str(year_temp)}_para_{str(num)}'] = -1
-                                pos_df.loc[pos_len_temp, f'{str(year_temp)}_Rsquare'] = -1
-                pbar.update()
-
-                if (np.mod(q_all, divider) == 0 and q_all != 0) or q_all == pos_len - 1:
-                    pos_df.to_csv(f'{cache_folder}postemp_{str(xy_offset[1])}.csv')
-                q_all += 1
+                        bound_arr[pos_temp] = np.concatenate([para_ori, para_lowerbound, para_upbound])
+                for col_num, col in enumerate(bound_col):
+                    result_store[col][batch_beg: batch_end] = bound_arr[:, col_num]
+
+                # Fit the annual observations with the per-pixel boundary
+                for year_temp in year_range:
+                    year_pos = np.floor(year_doy_all / 1000) == year_temp
+                    annual_arr = np.full([batch_end - batch_beg, para_num + 1], np.nan)
+                    annual_arr[fit_pos] = -1
+
+                    annual_fit_pos = fit_pos[np.sum(~np.isnan(vi_batch[fit_pos][:, year_pos]), axis=1) >= para_num]
+                    if annual_fit_pos.shape[0] > 0:
+                        paras, converged, r_square = batch_curve_fit(doy_temp[year_pos], vi_batch[annual_fit_pos][:, year_pos], curfit_dic['CFM'], bound_arr[annual_fit_pos, 0: para_num],
+                                                                     (bound_arr[annual_fit_pos, para_num: 2 * para_num], bound_arr[annual_fit_pos, 2 * para_num:]))
+                        fitted = ~np.isnan(r_square)
+                        annual_arr[annual_fit_pos[fitted], 0: para_num] = paras[fitted]
+                        annual_arr[annual_fit_pos[fitted], para_num] = r_square[fitted]
+
+                    for col_num, col in enumerate(annual_col[year_temp]):
+                        result_store[col][batch_beg: batch_end] = annual_arr[:, col_num]
+
+                # Flush the batch before appending it to the checkpoint
+                result_store.flush()
+                with open(checkpoint_file, 'ab') as ckpt_temp:
+                    ckpt_temp.write(np.array([batch_beg, batch_end], dtype=np.int64).tobytes())
+                pbar.update(batch_end - batch_beg)
+
+        del result_store
     except:
+        # The failed store is not returned, thus it is never exported or resumed as a finished one
         print(traceback.format_exc())
-    return pos_df
+        return None
+    return store_file
+
+
+def curfit_store_finished(store_file: str):
+
+    # Check whether the checkpoint of the curve fitting store covers all the pixel of the store
+    if store_file is None or not os.path.exists(store_file) or not os.path.exists(store_file[:-4] + '.ckpt'):
+        return False
+    pos_len = np.load(store_file, mmap_mode='r').shape[0]
+    finished = np.zeros(pos_len, dtype=bool)
+    for batch_beg, batch_end in np.fromfile(store_file[:-4] + '.ckpt', dtype=np.int64).reshape(-1, 2):
+        finished[batch_beg: batch_end] = True
+    return bool(finished.all())
+
+
+def curfit4tile(tile_dc, tile: dict, doy_all: list, curfit_dic: dict, sparse_matrix_factor: bool, size_control_factor: bool, cache_folder: str, nd_v, zoff):
+
+    # Adapter of the curfit4bound_annual for the Tile_scheduler, the result store of each tile is kept in its own cache folder
+    pos_df = pd.DataFrame(tile['pos'], columns=['y', 'x'])
+    if sparse_matrix_factor:
+        tile_dc = tile_dc.drop_nanlayer()
+        doy_all = bf.date2doy(tile_dc.SM_namelist)
+
+    tile_cache_folder = f'{bf.Path(cache_folder).path_name}tile_{str(tile["id"])}\\'
+    bf.create_folder(tile_cache_folder)
+    return curfit4bound_annual(pos_df, tile_dc, doy_all, curfit_dic, sparse_matrix_factor, size_control_factor,
+                               [tile['y_range'][0], tile['x_range'][0]], tile_cache_folder, nd_v, zoff)
 
 
 def curfit_pd2tif(tif_output_path: str, df: pd.DataFrame, key: str, ds_path: str):
@@ -759,9 +1175,11 @@ def curfit_pd2tif(tif_output_path: str, df: pd.DataFrame, key: str, ds_path: str
         ds_temp = gdal.Open(ds_path)
         ysize, xsize = ds_temp.RasterYSize, ds_temp.RasterXSize
         array_temp = np.zeros([ysize, xsize], dtype=np.float32) * np.nan
-        for pos in range(len(df)):
-            if df.loc[pos, key] != -1:
-                array_temp[df.loc[pos, 'y'], df.loc[pos, 'x']] = df.loc[pos, key]
+
+        # The y and x might be read as float from the csv of the previous version
+        valid_pos = (df[key] != -1).to_numpy()
+        y_arr, x_arr = df['y'].to_numpy()[valid_pos].astype(np.int64), df['x'].to_numpy()[valid_pos].astype(np.int64)
+        array_temp[y_arr, x_arr] = df[key].to_numpy()[valid_pos]
 
         bf.write_raster(ds_temp,  array_temp, tif_output_path, key + '.TIF', raster_datatype=gdal.GDT_Float32, nodatavalue=np.nan)
 
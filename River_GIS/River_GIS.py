@@ -592,7 +592,7 @@ class HydroDatacube(object):
 
         print(f'Finish loading the Hydrodatacube of \033[1;31m{str(self.year)}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
 
-    def simplified_conceptual_inundation_model(self, demfile, thalweg_temp, output_path, inun_factor=True, construct_inunfac_dc_factor=True, meta_dic=None):
+    def simplified_conceptual_inundation_model(self, demfile, thalweg_temp, output_path, inun_factor=True, construct_inunfac_dc_factor=True, meta_dic=None, connectivity_factor=True):
 
         # Check the thalweg
         if isinstance(thalweg_temp,Thalweg):
@@ -607,81 +607,101 @@ class HydroDatacube(object):
         # create folder
         bf.create_folder(output_path)
 
-        # Compare with dem
-        if self.sparse_factor:
-            cpu_amount = os.cpu_count() - 2
-            itr = int(np.floor(self.hydrodatacube.shape[2]/cpu_amount))
-            sm_list, nm_list = [], []
-            for _ in range(cpu_amount):
-                if _ != cpu_amount - 1:
-                    nm_list.append(self.hydrodatacube.SM_namelist[_ * itr: (_ + 1) * itr])
-                else:
-                    nm_list.append(self.hydrodatacube.SM_namelist[_ * itr:])
-                sm_list.append([self.hydrodatacube.SM_group[__] for __ in nm_list[-1]])
-
-            with concurrent.futures.ProcessPoolExecutor() as exe:
-                exe.map(concept_inundation_model, nm_list, sm_list, repeat(demfile), repeat(thelwag_linesting), repeat(output_path))
-
-            # Create inun factor
+        # Without the connectivity to the thalweg, the inundation factor is derived from the sorted water levels in one pass
+        # instead of comparing the dem with the water level day by day
+        if not connectivity_factor:
             if inun_factor:
-                bf.create_folder(f'{output_path}\\inundation_factor\\{str(self.year)}\\')
                 dem_ds = gdal.Open(demfile)
-                dem_arr = dem_ds.GetRasterBand(1).ReadAsArray()
-                dem_nodata = np.nan
+                dem_arr = dem_ds.GetRasterBand(1).ReadAsArray().astype(np.float64)
+                doy_list = None if self.sparse_factor else [self.year * 1000 + _ + 1 for _ in range(self.hydrodatacube.shape[2])]
+                input_arr = sorted_threshold_inundation_dc(self.hydrodatacube, dem_arr, doy_list=doy_list)
+                input_arr = {_: input_arr[_] for _ in ['inun_duration', 'inun_max_wl', 'inun_mean_wl', 'inun_first_doy', 'inun_last_doy']}
+                self._output_inundation_factor(dem_ds, input_arr, output_path, construct_inunfac_dc_factor, meta_dic)
+            return
 
-                inun_duration = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
-                inun_mean_waterlevel = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
-                inun_max_waterlevel = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
-
-                if np.isnan(dem_nodata):
-                    inun_duration[np.isnan(dem_arr)] = np.nan
-                    inun_mean_waterlevel[np.isnan(dem_arr)] = np.nan
-                    inun_max_waterlevel[np.isnan(dem_arr)] = np.nan
-                else:
-                    inun_duration[inun_duration == dem_nodata] = np.nan
-                    inun_mean_waterlevel[inun_mean_waterlevel == dem_nodata] = np.nan
-                    inun_max_waterlevel[inun_max_waterlevel == dem_nodata] = np.nan
+        # Compare with dem
+        if self.sparse_factor:
 
-                cpu_amount = int(os.cpu_count() / 2)
-                indi_list_amount = int(np.floor(len(self.hydrodatacube.SM_namelist) / cpu_amount))
-                sm_name_list, sm_group_list = [], []
+            # The workers attach the shared hydrodatacube instead of receiving the pickled layers
+            shared_hydrodc = self.hydrodatacube.share_memory()
+            try:
+                cpu_amount = os.cpu_count() - 2
+                itr = int(np.floor(self.hydrodatacube.shape[2]/cpu_amount))
+                nm_list = []
                 for _ in range(cpu_amount):
                     if _ != cpu_amount - 1:
-                        sm_name_list.append(self.hydrodatacube.SM_namelist[_ * indi_list_amount: (_ + 1) * indi_list_amount])
+                        nm_list.append(self.hydrodatacube.SM_namelist[_ * itr: (_ + 1) * itr])
                     else:
-                        sm_name_list.append(self.hydrodatacube.SM_namelist[_ * indi_list_amount:])
-                    sm_group_list.append([self.hydrodatacube.SM_group[__] for __ in sm_name_list[-1]])
+                        nm_list.append(self.hydrodatacube.SM_namelist[_ * itr:])
 
                 with concurrent.futures.ProcessPoolExecutor() as exe:
-                    res = exe.map(generate_inundation_indicator, sm_name_list, sm_group_list, repeat(dem_arr), repeat(dem_nodata), repeat(output_path))
-
-                res = list(res)
-                for _ in res:
-                    inun_duration = inun_duration + _[0]
-                    inun_mean_waterlevel = inun_mean_waterlevel + _[1]
-                    inun_max_waterlevel = np.nanmax([inun_max_waterlevel, _[2]], axis=0)
-                exe = None
-
-                inun_mean_waterlevel = inun_mean_waterlevel / inun_duration
-                bf.write_raster(dem_ds, inun_duration, f'{output_path}\\inundation_factor\\{str(self.year)}\\', 'inun_duration.tif')
-                bf.write_raster(dem_ds, inun_mean_waterlevel, f'{output_path}\\inundation_factor\\{str(self.year)}\\', 'inun_mean_wl.tif')
-                bf.write_raster(dem_ds, inun_max_waterlevel, f'{output_path}\\inundation_factor\\{str(self.year)}\\', 'inun_max_wl.tif')
-
-                if construct_inunfac_dc_factor:
-                    if meta_dic is not None and isinstance(meta_dic, str) and meta_dic.endswith('.json'):
-                        with open(meta_dic) as js_temp:
-                            dc_metadata = json.load(js_temp)
-                        metadata_dic = {'ROI_name': dc_metadata['ROI_name'], 'index': 'Inundation_factor', 'Datatype': 'float', 'ROI': dc_metadata['ROI'],
-                                        'ROI_array': dc_metadata['ROI_array'], 'ROI_tif': dc_metadata['ROI_tif'], 'Inunfac_factor': True,
-                                        'coordinate_system': dc_metadata['coordinate_system'], 'size_control_factor': False,
-                                        'oritif_folder': f'{output_path}\\inundation_factor\\{str(self.year)}\\', 'dc_group_list': None, 'tiles': None,
-                                        'Zoffset': None, 'sparse_matrix': True, 'huge_matrix': True, 'Nodata_value': np.nan}
+                    list(exe.map(concept_inundation_model, nm_list, repeat(shared_hydrodc), repeat(demfile), repeat(thelwag_linesting), repeat(output_path)))
+
+                # Create inun factor
+                if inun_factor:
+                    bf.create_folder(f'{output_path}\\inundation_factor\\{str(self.year)}\\')
+                    dem_ds = gdal.Open(demfile)
+                    dem_arr = dem_ds.GetRasterBand(1).ReadAsArray()
+                    dem_nodata = np.nan
+
+                    inun_duration = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
+                    inun_mean_waterlevel = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
+                    inun_max_waterlevel = np.zeros([self.hydrodatacube.shape[0], self.hydrodatacube.shape[1]])
+
+                    if np.isnan(dem_nodata):
+                        inun_duration[np.isnan(dem_arr)] = np.nan
+                        inun_mean_waterlevel[np.isnan(dem_arr)] = np.nan
+                        inun_max_waterlevel[np.isnan(dem_arr)] = np.nan
                     else:
-                        raise Exception('Please input related metadata dic before the dc construction')
+                        inun_duration[inun_duration == dem_nodata] = np.nan
+                        inun_mean_waterlevel[inun_mean_waterlevel == dem_nodata] = np.nan
+                        inun_max_waterlevel[inun_max_waterlevel == dem_nodata] = np.nan
+
+                    cpu_amount = int(os.cpu_count() / 2)
+                    indi_list_amount = int(np.floor(len(self.hydrodatacube.SM_namelist) / cpu_amount))
+                    sm_name_list = []
+                    for _ in range(cpu_amount):
+                        if _ != cpu_amount - 1:
+                            sm_name_list.append(self.hydrodatacube.SM_namelist[_ * indi_list_amount: (_ + 1) * indi_list_amount])
+                        else:
+                            sm_name_list.append(self.hydrodatacube.SM_namelist[_ * indi_list_amount:])
+
+                    with concurrent.futures.ProcessPoolExecutor() as exe:
+                        res = list(exe.map(generate_inundation_indicator, sm_name_list, repeat(shared_hydrodc), repeat(dem_arr), repeat(dem_nodata), repeat(output_path)))
+
+                    for _ in res:
+                        inun_duration = inun_duration + _[0]
+                        inun_mean_waterlevel = inun_mean_waterlevel + _[1]
+                        inun_max_waterlevel = np.nanmax([inun_max_waterlevel, _[2]], axis=0)
+                    exe = None
 
-                    bf.create_folder(f'{output_path}\\inundation_dc\\')
+                    inun_mean_waterlevel = inun_mean_waterlevel / inun_duration
                     input_arr = {'inun_duration': inun_duration, 'inun_max_wl': inun_max_waterlevel, 'inun_mean_wl': inun_mean_waterlevel}
-                    construct_inunfac_dc(input_arr, f'{output_path}\\inundation_dc\\', self.year, metadata_dic)
+                    self._output_inundation_factor(dem_ds, input_arr, output_path, construct_inunfac_dc_factor, meta_dic)
+            finally:
+                shared_hydrodc.release_shared_memory()
+
+    def _output_inundation_factor(self, dem_ds, input_arr: dict, output_path, construct_inunfac_dc_factor, meta_dic):
+
+        # Write each inundation factor into the tif and construct the Inunfac dc of the year
+        bf.create_folder(f'{output_path}\\inundation_factor\\{str(self.year)}\\')
+        for _ in input_arr.keys():
+            bf.write_raster(dem_ds, input_arr[_], f'{output_path}\\inundation_factor\\{str(self.year)}\\', f'{_}.tif')
+
+        if construct_inunfac_dc_factor:
+            if meta_dic is not None and isinstance(meta_dic, str) and meta_dic.endswith('.json'):
+                with open(meta_dic) as js_temp:
+                    dc_metadata = json.load(js_temp)
+                metadata_dic = {'ROI_name': dc_metadata['ROI_name'], 'index': 'Inundation_factor', 'Datatype': 'float', 'ROI': dc_metadata['ROI'],
+                                'ROI_array': dc_metadata['ROI_array'], 'ROI_tif': dc_metadata['ROI_tif'], 'Inunfac_factor': True,
+                                'coordinate_system': dc_metadata['coordinate_system'], 'size_control_factor': False,
+                                'oritif_folder': f'{output_path}\\inundation_factor\\{str(self.year)}\\', 'dc_group_list': None, 'tiles': None,
+                                'Zoffset': None, 'sparse_matrix': True, 'huge_matrix': True, 'Nodata_value': np.nan}
+            else:
+                raise Exception('Please input related metadata dic before the dc construction')
+
+            bf.create_folder(f'{output_path}\\inundation_dc\\')
+            construct_inunfac_dc(input_arr, f'{output_path}\\inundation_dc\\', self.year, metadata_dic)
 
     def seq_simplified_conceptual_inundation_model(self, demfile, thalweg_temp, output_path, inun_factor = True):
 
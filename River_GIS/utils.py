@@ -15,6 +15,7 @@ from shapely.ops import nearest_points
 from datetime import datetime
 import scipy.sparse as sm
 import json
+from RSDatacube.tiling import iter_dc_blocks
 
 
 def construct_inunfac_dc(input_dic: dict, output_path, year, metadata_dic):
@@ -86,6 +87,10 @@ def construct_inunfac_dc(input_dic: dict, output_path, year, metadata_dic):
 
 def generate_inundation_indicator(namelist, datacube_list, dem_arr, dem_nodata, output_path):
 
+    # The datacube_list could be the (shared) NDsm, which is viewed layer by layer without copy
+    if isinstance(datacube_list, NDSparseMatrix):
+        datacube_list = [datacube_list.SM_group[_] for _ in namelist]
+
     inun_duration = np.zeros([dem_arr.shape[0], dem_arr.shape[1]])
     inun_mean_waterlevel = np.zeros([dem_arr.shape[0], dem_arr.shape[1]])
     inun_max_waterlevel = np.zeros([dem_arr.shape[0], dem_arr.shape[1]])
@@ -111,8 +116,137 @@ def generate_inundation_indicator(namelist, datacube_list, dem_arr, dem_nodata,
     return [inun_duration, inun_mean_waterlevel, inun_max_waterlevel]
 
 
+### The sorted-threshold engine of the inundation indicators
+# (1) For a fixed pixel, it is inundated on the day when the water level is above its elevation (wl > dem),
+#     thus the indicators of the year only depend on the daily water levels above the dem
+# (2) The pixels sharing the same daily water levels form one hydro unit, the water levels of each unit are sorted once,
+#     and the suffix sum/max/min (day) of the sorted water levels give the indicators of any elevation
+# (3) The elevation of each pixel is located within the sorted water levels of its unit by a vectorised bisection (searchsorted)
+# (4) Unlike the concept_inundation_model, the inundated area is not required to be connected to the thalweg
+
+
+def _hydro_unit(pixel_wl: np.ndarray):
+
+    # Group the pixels of the identical daily water levels into the hydro unit through the hash of their bytes
+    # The hash collision is detected by comparing each pixel with its unit, and the exact np.unique is used instead
+    multiplier = (np.arange(pixel_wl.shape[1], dtype=np.uint64) * np.uint64(2654435761) + np.uint64(40503)) | np.uint64(1)
+    hash_arr = (np.ascontiguousarray(pixel_wl).view(np.uint64) * multiplier[None, :]).sum(axis=1, dtype=np.uint64)
+    unit_hash, unit_pixel, unit_index = np.unique(hash_arr, return_index=True, return_inverse=True)
+    unit_wl, unit_index = pixel_wl[unit_pixel], unit_index.ravel()
+    if not np.array_equal(unit_wl[unit_index], pixel_wl):
+        unit_wl, unit_index = np.unique(pixel_wl, axis=0, return_inverse=True)
+        unit_index = unit_index.ravel()
+    return unit_wl, unit_index
+
+
+def _sorted_threshold_table(unit_wl: np.ndarray):
+
+    # The sorted water levels of each unit and the suffix tables (one extra column for the empty suffix)
+    # The nodata day of the unit is -inf, thus it is sorted to the beginning and never above the dem
+    unit_num, day_num = unit_wl.shape
+    day_order = np.argsort(unit_wl, axis=1, kind='stable')
+    sorted_wl = np.take_along_axis(unit_wl, day_order, axis=1)
+
+    suffix_sum = np.zeros([unit_num, day_num + 1])
+    suffix_sum[:, :-1] = np.cumsum(np.where(np.isinf(sorted_wl), 0, sorted_wl)[:, ::-1], axis=1)[:, ::-1]
+    first_day = np.full([unit_num, day_num + 1], day_num, dtype=np.int64)
+    first_day[:, :-1] = np.minimum.accumulate(day_order[:, ::-1], axis=1)[:, ::-1]
+    last_day = np.full([unit_num, day_num + 1], -1, dtype=np.int64)
+    last_day[:, :-1] = np.maximum.accumulate(day_order[:, ::-1], axis=1)[:, ::-1]
+    return sorted_wl, suffix_sum, first_day, last_day
+
+
+def _unit_searchsorted(sorted_wl: np.ndarray, unit_index: np.ndarray, value: np.ndarray):
+
+    # The number of the water levels not above the value within the sorted water levels of the unit (searchsorted, side='right')
+    day_num = sorted_wl.shape[1]
+    lo, hi = np.zeros(unit_index.shape[0], dtype=np.int64), np.full(unit_index.shape[0], day_num, dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        right_factor = sorted_wl[unit_index, np.minimum(mid, day_num - 1)] <= value
+        lo = np.where(np.logical_and(active, right_factor), mid + 1, lo)
+        hi = np.where(np.logical_and(active, ~right_factor), mid, hi)
+        active = lo < hi
+    return lo
+
+
+def sorted_threshold_inundation_indicator(wl_arr: np.ndarray, dem_arr: np.ndarray, doy_list: list, nodata_value=0):
+
+    # The annual inundation indicators of the (y, x, day) water level array against the dem in one vectorised pass
+    # Return the dic of the inun_duration, inun_mean_wl and inun_max_wl (above the dem as the generate_inundation_indicator),
+    # and the inun_first_doy and inun_last_doy (day of the year of the first/last inundated day)
+    if wl_arr.ndim != 3 or wl_arr.shape[:2] != dem_arr.shape or wl_arr.shape[2] != len(doy_list):
+        raise ValueError('The water level array is not consistent with the dem or the doy list!')
+
+    inun_duration = np.zeros(dem_arr.shape)
+    inun_mean_wl = np.full(dem_arr.shape, np.nan)
+    inun_max_wl = np.zeros(dem_arr.shape)
+    inun_first_doy = np.full(dem_arr.shape, np.nan)
+    inun_last_doy = np.full(dem_arr.shape, np.nan)
+
+    # The pixel with any water level is grouped into the hydro unit by its daily water levels
+    pixel_pos = np.flatnonzero(~np.isnan(dem_arr))
+    pixel_wl = np.array(wl_arr.reshape(dem_arr.size, wl_arr.shape[2])[pixel_pos], dtype=np.float64)
+    pixel_wl[np.isnan(pixel_wl)] = -np.inf
+    if nodata_value is not None and not np.isnan(nodata_value):
+        pixel_wl[pixel_wl == nodata_value] = -np.inf
+    hydro_factor = (pixel_wl != -np.inf).any(axis=1)
+    hydro_arr = np.zeros(dem_arr.shape, dtype=bool)
+    hydro_arr.ravel()[pixel_pos[hydro_factor]] = True
+    if hydro_arr.any():
+        unit_wl, unit_index = _hydro_unit(pixel_wl[hydro_factor])
+        pixel_wl = None
+        sorted_wl, suffix_sum, first_day, last_day = _sorted_threshold_table(unit_wl)
+
+        dem_temp = dem_arr[hydro_arr].astype(np.float64)
+        pos = _unit_searchsorted(sorted_wl, unit_index, dem_temp)
+        duration = sorted_wl.shape[1] - pos
+        inun_factor = duration > 0
+
+        doy_arr = (bf.ordinal2doy(bf.Date_index(doy_list).ordinal) % 1000).astype(np.float64)
+        mean_temp, max_temp = np.full(duration.shape, np.nan), np.zeros(duration.shape)
+        first_temp, last_temp = np.full(duration.shape, np.nan), np.full(duration.shape, np.nan)
+        mean_temp[inun_factor] = suffix_sum[unit_index[inun_factor], pos[inun_factor]] / duration[inun_factor] - dem_temp[inun_factor]
+        max_temp[inun_factor] = sorted_wl[unit_index[inun_factor], -1] - dem_temp[inun_factor]
+        first_temp[inun_factor] = doy_arr[first_day[unit_index[inun_factor], pos[inun_factor]]]
+        last_temp[inun_factor] = doy_arr[last_day[unit_index[inun_factor], pos[inun_factor]]]
+
+        inun_duration[hydro_arr], inun_mean_wl[hydro_arr], inun_max_wl[hydro_arr] = duration, mean_temp, max_temp
+        inun_first_doy[hydro_arr], inun_last_doy[hydro_arr] = first_temp, last_temp
+
+    for arr_temp in (inun_duration, inun_mean_wl, inun_max_wl):
+        arr_temp[np.isnan(dem_arr)] = np.nan
+    return {'inun_duration': inun_duration, 'inun_mean_wl': inun_mean_wl, 'inun_max_wl': inun_max_wl,
+            'inun_first_doy': inun_first_doy, 'inun_last_doy': inun_last_doy}
+
+
+def sorted_threshold_inundation_dc(hydrodc, dem_arr: np.ndarray, doy_list: list = None, nodata_value=0, block_bytes: int = 64 * 1024 ** 2):
+
+    # The inundation indicators of the whole hydro datacube (NDsm or dense), block by block through the iter_dc_blocks
+    # The dem exceeding the extent of the hydro datacube is regarded as not inundated (as the zero padding of the concept_inundation_model)
+    if isinstance(hydrodc, NDSparseMatrix):
+        doy_list = hydrodc.SM_namelist if doy_list is None else doy_list
+    elif doy_list is None:
+        raise ValueError('Please input the doy list of the dense hydro datacube!')
+    if hydrodc.shape[0] > dem_arr.shape[0] or hydrodc.shape[1] > dem_arr.shape[1]:
+        raise ValueError('The hydro datacube exceeds the extent of the dem!')
+
+    indicator_dic = sorted_threshold_inundation_indicator(np.zeros([dem_arr.shape[0], dem_arr.shape[1], 0]), dem_arr, [], nodata_value=nodata_value)
+    for window, (wl_blk, ) in iter_dc_blocks(hydrodc, block_bytes=block_bytes):
+        y_range, x_range = window['y_range'], window['x_range']
+        block_dic = sorted_threshold_inundation_indicator(wl_blk, dem_arr[y_range[0]: y_range[1], x_range[0]: x_range[1]], doy_list, nodata_value=nodata_value)
+        for key_temp in indicator_dic.keys():
+            indicator_dic[key_temp][y_range[0]: y_range[1], x_range[0]: x_range[1]] = block_dic[key_temp]
+    return indicator_dic
+
+
 def concept_inundation_model(wl_nm, wl_sm, demfile, thalweg, output_filepath):
 
+    # The wl_sm could be the (shared) NDsm, which is viewed layer by layer without copy
+    if isinstance(wl_sm, NDSparseMatrix):
+        wl_sm = [wl_sm.SM_group[_] for _ in wl_nm]
+
     # Import datacube
     if demfile.endswith('.tif') or demfile.endswith('.TIF'):
         dem_file_ds = gdal.Open(demfile)
@@ -8,6 +8,7 @@ import zipfile
 import shutil
 import scipy.sparse as sp
 import copy
+import gc
 import time
 from basic_function import Path
 import basic_function as bf
@@ -23,6 +24,7 @@ from .utils import retrieve_srs, write_raster, remove_all_file_and_folder
 from .built_in_index import built_in_index
 from lxml import etree
 from NDsm import NDSparseMatrix
+import layer_codec
 import json
 
 
@@ -1716,11 +1718,24 @@ class Sentinel2_ds(object):
             with open(self._dc_infr[index] + 'metadata.json', 'w') as js_temp:
                 json.dump(metadata_dic, js_temp)
 
+        else:
+            # Ingest the new dates into the existing dc instead of rebuilding it
+            doy_exist = set([int(doy_temp) for doy_temp in np.load(self._dc_infr[index] + 'doy.npy', allow_pickle=True)])
+            removed_date = set(self._manually_remove_datelist) if self._manually_remove_para else set()
+            new_doy_list = []
+            for file_temp in os.listdir(self._dc_infr[index + 'input_path']):
+                if file_temp.endswith(f'_{index}.TIF') and file_temp[0:8].isdigit():
+                    if int(file_temp[0:8]) not in doy_exist and int(file_temp[0:8]) not in removed_date:
+                        new_doy_list.append(int(file_temp[0:8]))
+
+            if len(new_doy_list) > 0:
+                Sentinel2_dc(self._dc_infr[index], metadata_only=True).ingest(date_list=sorted(new_doy_list), remove_nan_layer=self._remove_nan_layer)
+
         print(f'Finished writing the sdc in \033[1;31m{str(time.time() - start_time)} s\033[0m.')
 
 
 class Sentinel2_dc(object):
-    def __init__(self, dc_filepath, work_env=None):
+    def __init__(self, dc_filepath, work_env=None, metadata_only: bool = False):
 
         # Check the dcfile path
         self.dc_filepath = bf.Path(dc_filepath).path_name
@@ -1730,7 +1745,10 @@ class Sentinel2_dc(object):
         self.index, self.Datatype, self.coordinate_system = None, None, None
         self.dc_group_list, self.tiles = None, None
         self.sdc_factor, self.sparse_matrix, self.size_control_factor, self.huge_matrix = False, False, False, False
+        self.pixel_major = False
+        self.codec = None
         self.Zoffset, self.Nodata_value = None, None
+        self._metadata_only, self._pending_upgrade = metadata_only, False
 
         # Check work env
         if work_env is not None:
@@ -1762,6 +1780,12 @@ class Sentinel2_dc(object):
                             raise Exception(f'The {dic_name} is not in the dc metadata, double check!')
                         else:
                             self.__dict__[dic_name] = dc_metadata[dic_name]
+                    # The pixel-major factor is optional for the dc generated by the previous version
+                    if 'pixel_major' in dc_metadata.keys():
+                        self.pixel_major = dc_metadata['pixel_major']
+                    # The layer codec is optional, the dc without codec is stored as the npz/npy
+                    if 'codec' in dc_metadata.keys():
+                        self.codec = dc_metadata['codec']
             except:
                 print(traceback.format_exc())
                 raise Exception('Something went wrong when reading the metadata!')
@@ -1787,10 +1811,50 @@ class Sentinel2_dc(object):
             raise Exception('Something went wrong when reading the doy list!')
 
         # Read datacube
+        # With the metadata_only, the sparse dc is opened lazily and the dense dc is only peeked for its shape and dtype
+        if metadata_only and not (self.sparse_matrix and self.huge_matrix):
+            self._peek_dc()
+        else:
+            self._load_dc()
+
+        # The format migration is kept in memory until the upgrade() is called
+        if self._pending_upgrade:
+            print(f'The Sentinel2 dc of \033[1;31m{self.index}\033[0m is migrated in memory, run the upgrade() to persist it')
+
+        print(f'Finish loading the Sentinel2 dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+
+    def __sizeof__(self):
+        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+
+    def __getattr__(self, name):
+        # The dc of the metadata-only Sentinel2 dc is materialised on first access
+        if name == 'dc' and self.__dict__.get('_metadata_only', False):
+            self._load_dc()
+            return self.__dict__['dc']
+        raise AttributeError(name)
+
+    def _peek_dc(self):
+
+        # Read the shape and dtype from the npy header (or the codec header) without reading the cube
+        if self.codec is not None:
+            _, dc_shape, self.dc_dtype = layer_codec.peek_codec_cube(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+            self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_shape[0], dc_shape[1], dc_shape[2]
+            return
+        dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube.npy'])
+        if len(dc_filename) != 1:
+            raise ValueError('There has no valid dc or more than one dc in the dc dir!')
+        dc_temp = np.load(dc_filename[0], mmap_mode='r')
+        self.dc_YSize, self.dc_XSize, self.dc_ZSize = dc_temp.shape[0], dc_temp.shape[1], dc_temp.shape[2]
+        self.dc_dtype = dc_temp.dtype
+
+    def _load_dc(self):
+
         try:
-            if self.sparse_matrix and self.huge_matrix:
+            if not self.sparse_matrix and self.codec is not None:
+                self.dc = layer_codec.load_codec_cube(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+            elif self.sparse_matrix and self.huge_matrix:
                 if os.path.exists(self.dc_filepath + f'{self.index}_sequenced_datacube\\'):
-                    self.dc = NDSparseMatrix().load(self.dc_filepath + f'{self.index}_sequenced_datacube\\')
+                    self.dc = NDSparseMatrix().load(self.dc_filepath + f'{self.index}_sequenced_datacube\\', lazy=self._metadata_only)
                 else:
                     raise Exception('Please double check the code if the sparse huge matrix is generated properly')
             elif not self.huge_matrix:
@@ -1802,30 +1866,47 @@ class Sentinel2_dc(object):
                 else:
                     self.dc = np.load(self.dc_filename[0], allow_pickle=True)
             elif self.huge_matrix and not self.sparse_matrix:
-                self.dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and')
+                # The huge dense dc is memory-mapped (copy-on-write) instead of being read into memory,
+                # process it blockwise through the iter_dc_blocks to keep the memory bounded
+                # (the _tmp.npy left by an interrupted save of the former versions is not a dc)
+                self.dc_filename = bf.file_filter(self.dc_filepath, ['sequenced_datacube', '.npy'], and_or_factor='and', exclude_word_list=['_tmp.npy'])
+                if len(self.dc_filename) != 1:
+                    raise ValueError('There has no valid dc or more than one dc in the dc dir!')
+                self.dc = np.load(self.dc_filename[0], mmap_mode='c')
         except:
             raise Exception('Something went wrong when reading the datacube!')
 
         # Autotrans sparse matrix
+        # The conversion decodes every layer, thus it is deferred to the upgrade() for the metadata-only dc
         if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
-            self._autotrans_sparse_matrix()
+            if self._metadata_only:
+                self._pending_upgrade = True
+            else:
+                self._autotrans_sparse_matrix()
 
         # Size check
+        # The SMsequence is committed before the doy list during the ingestion, thus the doy list is recovered from it
         if len(self.sdc_doylist) != self.dc.shape[2]:
             if self.sparse_matrix:
-                self.sdc_doylist = self.dc.SM_namelist
-                self.save(self.dc_filepath)
-                self.__init__(self.dc_filepath)
+                self.sdc_doylist = [int(_) for _ in self.dc.SM_namelist]
+                self._pending_upgrade = True
             else:
                 raise ValueError('The dc and doy is not consistent!')
 
         # Size calculation and shape definition
         self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+        self.dc_dtype = self.dc.dtype
 
-        print(f'Finish loading the Sentinel2 dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+    def upgrade(self, storage: str = None, chunk_shape: tuple = None):
 
-    def __sizeof__(self):
-        return self.dc.__sizeof__() + self.sdc_doylist.__sizeof__()
+        # Persist the migration deferred by the loading (COO to CSR and recovered doy list)
+        if self.sparse_matrix and self.dc._matrix_type == sm.coo_matrix:
+            self._autotrans_sparse_matrix()
+        # The storage or the chunk shape converts the sparse dc (e.g. into the chunked container)
+        if self._pending_upgrade or storage is not None or chunk_shape is not None:
+            self.save(self.dc_filepath, storage=storage, chunk_shape=chunk_shape)
+            self._pending_upgrade = False
+        return self
 
     def _autotrans_sparse_matrix(self):
 
@@ -1837,31 +1918,135 @@ class Sentinel2_dc(object):
                 self.dc.SM_group[_] = sm.csr_matrix(self.dc.SM_group[_])
         self.dc._update_size_para()
         self.dc._matrix_type = sm.csr_matrix
-        self.save(self.dc_filepath)
+        self._pending_upgrade = True
 
-    def save(self, output_path: str):
-        start_time = time.time()
-        print(f'Start saving the Sentinel2 dc of \033[1;31m{self.index}\033[0m in the \033[1;34m{self.ROI_name}\033[0m')
+    def _save_dense_dc(self, filename: str):
 
-        if not os.path.exists(output_path):
-            bf.create_folder(output_path)
-        output_path = bf.Path(output_path).path_name
+        # The dense dc is replaced atomically. The memory-mapped dc saved onto its own file is released before the replacement,
+        # since a file still mapped cannot be replaced on Windows, and then mapped again from the new file
+        if isinstance(self.dc, np.memmap) and self.dc.filename is not None and os.path.abspath(self.dc.filename) == os.path.abspath(filename):
+            try:
+                bf.save_npy_atomic(filename, self.dc, before_replace=self._release_dc)
+            finally:
+                if self.dc is None:
+                    self.dc = np.load(filename, mmap_mode='c')
+        else:
+            bf.save_npy_atomic(filename, self.dc)
 
+    def _release_dc(self):
+        self.dc = None
+        gc.collect()
+
+    def _save_header(self, output_path: str):
+
+        # The doy list and metadata are replaced atomically, thus an interrupted ingestion never leaves a partial header
         metadata_dic = {'ROI_name': self.ROI_name, 'index': self.index, 'Datatype': self.Datatype, 'ROI': self.ROI, 'ROI_array': self.ROI_array,
                         'ROI_tif': self.ROI_tif, 'sdc_factor': self.sdc_factor, 'coordinate_system': self.coordinate_system,
                         'sparse_matrix': self.sparse_matrix, 'huge_matrix': self.huge_matrix, 'size_control_factor': self.size_control_factor,
                         'oritif_folder': self.oritif_folder, 'dc_group_list': self.dc_group_list, 'tiles': self.tiles,
-                        'Zoffset': self.Zoffset, 'Nodata_value': self.Nodata_value}
+                        'Zoffset': self.Zoffset, 'Nodata_value': self.Nodata_value, 'pixel_major': self.pixel_major, 'codec': self.codec}
+        bf.save_npy_atomic(f'{output_path}doy.npy', np.array(self.sdc_doylist))
+        bf.dump_json_atomic(f'{output_path}metadata.json', metadata_dic)
+
+    def _read_oritif_layer(self, file_path: str):
+
+        # Convert the sequenced tif of one date into the dc layer as the _ds2sdc
+        ds_temp = gdal.Open(file_path)
+        array_temp = ds_temp.GetRasterBand(1).ReadAsArray()
+        nodata_value = ds_temp.GetRasterBand(1).GetNoDataValue()
+
+        if self.sparse_matrix:
+            if self.Zoffset == 32768:
+                array_temp = array_temp.astype(int) + 32768
+            elif nodata_value is None or np.isnan(nodata_value):
+                array_temp[np.isnan(array_temp)] = 0
+            else:
+                array_temp[array_temp == nodata_value] = 0
+            return sm.csr_matrix(array_temp.astype(self.dc.dtype))
+        else:
+            return array_temp.astype(self.dc.dtype)
+
+    def ingest(self, date_list: list = None, remove_nan_layer: bool = False):
+
+        # Add the dates in the oritif folder which are not in the dc, the untouched layers are not rewritten
+        # (1) For the sparse dc, only the npz of the new dates, the SMsequence, doy.npy and metadata.json are written
+        # (2) For the dense dc, the npy cube has to be re-saved as a whole
+        tif_dic = {}
+        for file_temp in os.listdir(self.oritif_folder):
+            if file_temp.endswith(f'_{self.index}.TIF') and file_temp[0:8].isdigit():
+                tif_dic[int(file_temp[0:8])] = self.oritif_folder + file_temp
+
+        new_date_list = [_ for _ in tif_dic.keys() if _ not in self.sdc_doylist]
+        if date_list is not None:
+            new_date_list = [_ for _ in new_date_list if _ in date_list]
+        new_date_list.sort()
+        if len(new_date_list) == 0:
+            return self
+
+        start_time = time.time()
+        layer_list, name_list = [], []
+        for date_temp in new_date_list:
+            layer_temp = self._read_oritif_layer(tif_dic[date_temp])
+            if remove_nan_layer and ((self.sparse_matrix and layer_temp.nnz == 0) or (not self.sparse_matrix and np.all(layer_temp == self.Nodata_value))):
+                continue
+            layer_list.append(layer_temp)
+            name_list.append(date_temp)
+
+        if len(name_list) > 0:
+            if self.sparse_matrix:
+                self.dc.ingest(layer_list, name_list)
+                self.sdc_doylist = [int(_) for _ in self.dc.SM_namelist]
+            else:
+                doy_list = self.sdc_doylist + name_list
+                order = np.argsort(doy_list, kind='stable')
+                self.dc = np.concatenate([self.dc] + [_[:, :, None] for _ in layer_list], axis=2)[:, :, order]
+                self.sdc_doylist = [int(doy_list[_]) for _ in order]
+                if self.codec is not None:
+                    layer_codec.save_codec_cube(f'{self.dc_filepath}{str(self.index)}_sequenced_datacube\\', self.dc, self.sdc_doylist, self.codec,
+                                                layer_index=[self.sdc_doylist.index(_) for _ in name_list])
+                else:
+                    self._save_dense_dc(f'{self.dc_filepath}{str(self.index)}_sequenced_datacube.npy')
+
+            self._save_header(self.dc_filepath)
+            self.dc_XSize, self.dc_YSize, self.dc_ZSize = self.dc.shape[1], self.dc.shape[0], self.dc.shape[2]
+
+        print(f'Finish ingesting \033[1;31m{str(len(name_list))}\033[0m dates into the Sentinel2 dc of \033[1;31m{self.index}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
+        return self
+
+    def save(self, output_path: str, pixel_major: bool = None, codec: str = None, storage: str = None, chunk_shape: tuple = None):
+        start_time = time.time()
+        print(f'Start saving the Sentinel2 dc of \033[1;31m{self.index}\033[0m in the \033[1;34m{self.ROI_name}\033[0m')
+
+        # The pixel-major (time-series-contiguous) cube is persisted for the sparse dc if required
+        if pixel_major is not None:
+            self.pixel_major = pixel_major
+
+        # The storage ('npz', 'chunk' or 'codec') and the chunk shape of the sparse dc are passed through to the NDSparseMatrix.save
+        # The dc saved in the single chunked container is opened lazily and only the touched chunks are read
+        if (storage is not None or chunk_shape is not None) and not self.sparse_matrix:
+            raise ValueError('The storage and the chunk shape are only supported for the sparse dc!')
+        elif storage in ['npz', 'chunk'] or chunk_shape is not None:
+            self.codec = None
+
+        # The layer codec of the dc (see the layer_codec) is recorded in the metadata, None for the npz/npy storage
+        if codec is not None:
+            layer_codec.parse_codec(codec)
+            self.codec = codec
+
+        if not os.path.exists(output_path):
+            bf.create_folder(output_path)
+        output_path = bf.Path(output_path).path_name
 
-        doy = self.sdc_doylist
-        np.save(f'{output_path}doy.npy', doy)
-        with open(f'{output_path}metadata.json', 'w') as js_temp:
-            json.dump(metadata_dic, js_temp)
+        self._save_header(output_path)
 
         if self.sparse_matrix:
-            self.dc.save(f'{output_path}{str(self.index)}_sequenced_datacube\\')
+            self.dc.save(f'{output_path}{str(self.index)}_sequenced_datacube\\', storage=storage, chunk_shape=chunk_shape, codec=self.codec)
+            if self.pixel_major:
+                self.dc.save_pixel_major(f'{output_path}{str(self.index)}_sequenced_datacube\\')
+        elif self.codec is not None:
+            layer_codec.save_codec_cube(f'{output_path}{str(self.index)}_sequenced_datacube\\', self.dc, self.sdc_doylist, self.codec)
         else:
-            np.save(f'{output_path}{str(self.index)}_sequenced_datacube.npy', self.dc)
+            self._save_dense_dc(f'{output_path}{str(self.index)}_sequenced_datacube.npy')
 
         print(f'Finish saving the Sentinel2 dc of \033[1;31m{self.index}\033[0m for the \033[1;34m{self.ROI_name}\033[0m using \033[1;31m{str(time.time() - start_time)}\033[0ms')
 
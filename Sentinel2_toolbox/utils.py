@@ -833,7 +833,39 @@ def link_GEDI_inform(RSdc, RSdc_GeoTransform, RSdc_doy_list, RSdc_index, gedi_df
             gedi_df.insert(loc=len(gedi_df.columns), column=f'{RSdc_index}_{spatial_method}_{temporal_method}', value=np.nan)
             gedi_df.insert(loc=len(gedi_df.columns), column=f'{RSdc_index}_{spatial_method}_{temporal_method}_reliability', value=np.nan)
 
-    # itr through the gedi_df
+    # The nearest neighbor is linked for all the footprints at once through the batched engine
+    if 'nearest_neighbor' in GEDI_link_RS_spatial_interpolate_method_list:
+        t1 = time.time()
+        lat_arr, lon_arr = np.array(gedi_df[furlat], dtype=np.float64), np.array(gedi_df[furlon], dtype=np.float64)
+        GEDI_doy_arr = np.array(gedi_df['Date'], dtype=np.float64)
+        y_arr = np.floor((lat_arr - RSdc_GeoTransform[3]) / RSdc_GeoTransform[5])
+        x_arr = np.floor((lon_arr - RSdc_GeoTransform[0]) / RSdc_GeoTransform[1])
+        link_factor = (y_arr >= 0) & (y_arr < RSdc.shape[0]) & (x_arr >= 0) & (x_arr < RSdc.shape[1]) & \
+                      (GEDI_doy_arr >= np.min(RSdc_doy_list)) & (GEDI_doy_arr <= np.max(RSdc_doy_list))
+        nodata_value = 0 if isinstance(RSdc, NDSparseMatrix) else None
+        y_arr, x_arr, GEDI_doy_arr = y_arr[link_factor].astype(np.int64), x_arr[link_factor].astype(np.int64), GEDI_doy_arr[link_factor]
+
+        for temporal_method in GEDI_link_RS_temporal_interpolate_method_list:
+            if temporal_method == 'linear_interpolation':
+                value_arr = nearest_valid_observation(RSdc, RSdc_doy_list, y_arr, x_arr, GEDI_doy_arr, max_gap=temporal_search_window, nodata_value=nodata_value)['value']
+            elif temporal_method == '24days_max':
+                value_arr = window_valid_statistics(RSdc, RSdc_doy_list, y_arr, x_arr, GEDI_doy_arr, 24, 'max', nodata_value=nodata_value)
+            elif temporal_method == '24days_ave':
+                value_arr = window_valid_statistics(RSdc, RSdc_doy_list, y_arr, x_arr, GEDI_doy_arr, 24, 'mean', nodata_value=nodata_value)
+            else:
+                raise Exception('Not supported temporal interpolation method!')
+
+            # The reliability of the nearest neighbor is 1 for every valid observation
+            row_arr = np.argwhere(link_factor).flatten()[~np.isnan(value_arr)]
+            gedi_df.loc[row_arr, f'{RSdc_index}_nearest_neighbor_{temporal_method}'] = value_arr[~np.isnan(value_arr)]
+            gedi_df.loc[row_arr, f'{RSdc_index}_nearest_neighbor_{temporal_method}_reliability'] = 1.0
+        print(f'Finish linking the {RSdc_index} with the GEDI dataframe through the nearest neighbor in {str(time.time() - t1)[0:6]}s ({str(df_size)} footprints)')
+
+        GEDI_link_RS_spatial_interpolate_method_list = [_ for _ in GEDI_link_RS_spatial_interpolate_method_list if _ != 'nearest_neighbor']
+        if len(GEDI_link_RS_spatial_interpolate_method_list) == 0:
+            return gedi_df
+
+    # itr through the gedi_df for the focal and area average
     for i in range(df_size):
 
         # Timing
@@ -1050,6 +1082,124 @@ def link_GEDI_inform(RSdc, RSdc_GeoTransform, RSdc_doy_list, RSdc_index, gedi_df
     return gedi_df
 
 
+def _iter_pixel_series(dc, layer_order: np.ndarray, y_arr: np.ndarray, x_arr: np.ndarray, nodata_value, batch_size: int):
+
+    # Yield the query ids, the row of their pixels and the date-sorted time series of the pixels batch by batch
+    # Each pixel is extracted once no matter how many queries fall on it
+    if isinstance(dc, NDSparseMatrix):
+        extract_series = dc.extract_pixel_series
+    elif isinstance(dc, np.ndarray):
+        extract_series = lambda y_temp, x_temp: np.asarray(dc[y_temp, x_temp, :])
+    else:
+        raise TypeError('The datacube is not under NDSM or datacube type!')
+
+    pixel_arr = y_arr * dc.shape[1] + x_arr
+    pixel_unique, inverse = np.unique(pixel_arr, return_inverse=True)
+    query_order = np.argsort(inverse, kind='stable')
+    inverse_sorted = inverse[query_order]
+    for batch_start in range(0, pixel_unique.shape[0], batch_size):
+        pixel_batch = pixel_unique[batch_start: batch_start + batch_size]
+        series = extract_series(pixel_batch // dc.shape[1], pixel_batch % dc.shape[1])[:, layer_order].astype(np.float64)
+        valid = ~np.isnan(series) if nodata_value is None or np.isnan(nodata_value) else ~np.isnan(series) & (series != nodata_value)
+        query_ids = query_order[np.searchsorted(inverse_sorted, batch_start): np.searchsorted(inverse_sorted, batch_start + pixel_batch.shape[0])]
+        yield query_ids, inverse[query_ids] - batch_start, series, valid
+
+
+def nearest_valid_observation(dc, doy_list: list, y_arr, x_arr, date_arr, max_gap: int = 39, nodata_value=0, batch_size: int = 8192):
+
+    ### Batched query of the nearest valid observation within max_gap days before and after N (y, x, date) triples
+    # (1) The time series of the pixels are extracted at once (the transposed pixel-major cube for the NDsm) and sorted by date
+    # (2) The last valid layer at or before and the next valid layer at or after each layer are located by the running max/min
+    # (3) Each query is located in the sorted dates by searchsorted, the gap is measured in days across the years
+    # (4) The value is the observation at the query date if valid, otherwise the linear interpolation of the before/after observations
+    # Return the dict of the value, value_before, date_before, value_after and date_after (nan for absent, the date under the doy_list format)
+    y_arr, x_arr = np.asarray(y_arr, dtype=np.int64).flatten(), np.asarray(x_arr, dtype=np.int64).flatten()
+    date_arr = np.asarray(date_arr, dtype=np.float64).flatten()
+    if not y_arr.shape[0] == x_arr.shape[0] == date_arr.shape[0]:
+        raise ValueError('The y, x and date of the queries are not consistent!')
+    elif y_arr.shape[0] > 0 and (y_arr.min() < 0 or y_arr.max() >= dc.shape[0] or x_arr.min() < 0 or x_arr.max() >= dc.shape[1]):
+        raise ValueError('The query is out of the range of the datacube!')
+
+    date_index = bf.Date_index(doy_list)
+    layer_order = np.argsort(date_index.ordinal, kind='stable')
+    layer_ordinal = date_index.ordinal[layer_order]
+    layer_date = np.array(date_index.date_list, dtype=np.float64)[layer_order]
+    z_size = layer_ordinal.shape[0]
+
+    result = {key: np.full(date_arr.shape[0], np.nan) for key in ['value', 'value_before', 'date_before', 'value_after', 'date_after']}
+    query_valid = ~np.isnan(date_arr)
+    query_ordinal = np.zeros(date_arr.shape[0], dtype=np.int64)
+    query_ordinal[query_valid] = date_index.to_ordinal(date_arr[query_valid].astype(np.int64))
+    if z_size == 0:
+        return result
+
+    for query_ids, rows, series, valid in _iter_pixel_series(dc, layer_order, y_arr, x_arr, nodata_value, batch_size):
+        query_ids, rows = query_ids[query_valid[query_ids]], rows[query_valid[query_ids]]
+        ordinal = query_ordinal[query_ids]
+        last_valid = np.maximum.accumulate(np.where(valid, np.arange(z_size), -1), axis=1)
+        next_valid = np.minimum.accumulate(np.where(valid, np.arange(z_size), z_size)[:, ::-1], axis=1)[:, ::-1]
+
+        pos_before = np.searchsorted(layer_ordinal, ordinal, side='right') - 1
+        pos_before[pos_before >= 0] = last_valid[rows[pos_before >= 0], pos_before[pos_before >= 0]]
+        before_factor = pos_before >= 0
+        before_factor[before_factor] = ordinal[before_factor] - layer_ordinal[pos_before[before_factor]] <= max_gap
+
+        pos_after = np.searchsorted(layer_ordinal, ordinal, side='left')
+        pos_after[pos_after < z_size] = next_valid[rows[pos_after < z_size], pos_after[pos_after < z_size]]
+        after_factor = pos_after < z_size
+        after_factor[after_factor] = layer_ordinal[pos_after[after_factor]] - ordinal[after_factor] <= max_gap
+
+        result['value_before'][query_ids[before_factor]] = series[rows[before_factor], pos_before[before_factor]]
+        result['date_before'][query_ids[before_factor]] = layer_date[pos_before[before_factor]]
+        result['value_after'][query_ids[after_factor]] = series[rows[after_factor], pos_after[after_factor]]
+        result['date_after'][query_ids[after_factor]] = layer_date[pos_after[after_factor]]
+
+        # The exact observation or the interpolation between the before and after observations
+        exact_factor = before_factor.copy()
+        exact_factor[exact_factor] = layer_ordinal[pos_before[exact_factor]] == ordinal[exact_factor]
+        interp_factor = before_factor & after_factor & ~exact_factor
+        value_before, value_after = series[rows[interp_factor], pos_before[interp_factor]], series[rows[interp_factor], pos_after[interp_factor]]
+        ordinal_before, ordinal_after = layer_ordinal[pos_before[interp_factor]], layer_ordinal[pos_after[interp_factor]]
+        result['value'][query_ids[exact_factor]] = series[rows[exact_factor], pos_before[exact_factor]]
+        result['value'][query_ids[interp_factor]] = value_before + (ordinal[interp_factor] - ordinal_before) * (value_after - value_before) / (ordinal_after - ordinal_before)
+
+    return result
+
+
+def window_valid_statistics(dc, doy_list: list, y_arr, x_arr, date_arr, half_window: int, method: str, nodata_value=0, batch_size: int = 8192):
+
+    # Batched maximum or mean of the valid observations within [date - half_window, date + half_window] of N (y, x, date) triples
+    if method not in ['max', 'mean']:
+        raise ValueError('The window statistics only supports max and mean!')
+    y_arr, x_arr = np.asarray(y_arr, dtype=np.int64).flatten(), np.asarray(x_arr, dtype=np.int64).flatten()
+    date_arr = np.asarray(date_arr, dtype=np.float64).flatten()
+
+    date_index = bf.Date_index(doy_list)
+    layer_order = np.argsort(date_index.ordinal, kind='stable')
+    layer_ordinal = date_index.ordinal[layer_order]
+    value_arr = np.full(date_arr.shape[0], np.nan)
+    query_valid = ~np.isnan(date_arr)
+    query_ordinal = np.zeros(date_arr.shape[0], dtype=np.int64)
+    query_ordinal[query_valid] = date_index.to_ordinal(date_arr[query_valid].astype(np.int64))
+
+    for query_ids, rows, series, valid in _iter_pixel_series(dc, layer_order, y_arr, x_arr, nodata_value, batch_size):
+        query_ids, rows = query_ids[query_valid[query_ids]], rows[query_valid[query_ids]]
+        ordinal = query_ordinal[query_ids]
+        lower = np.searchsorted(layer_ordinal, ordinal - half_window, side='left')
+        upper = np.searchsorted(layer_ordinal, ordinal + half_window, side='right')
+        z_arange = np.arange(layer_ordinal.shape[0])
+        in_window = (z_arange[None, :] >= lower[:, None]) & (z_arange[None, :] < upper[:, None]) & valid[rows]
+        value_temp = np.where(in_window, series[rows], np.nan)
+        count = in_window.sum(axis=1)
+        if method == 'max':
+            value_temp = np.where(count > 0, np.max(np.where(in_window, value_temp, -np.inf), axis=1), np.nan)
+        else:
+            value_temp = np.where(count > 0, np.where(in_window, value_temp, 0).sum(axis=1) / np.maximum(count, 1), np.nan)
+        value_arr[query_ids] = value_temp
+
+    return value_arr
+
+
 def get_index_by_date(dc_blocked, y_all_blocked: list, x_all_blocked: list, doy_list: list, req_date_list: list, xy_offset_blocked: list, index: str, date_name: list, mode: str, search_window: int = 40):
 
     if len(y_all_blocked) != len(x_all_blocked):
@@ -1061,57 +1211,14 @@ def get_index_by_date(dc_blocked, y_all_blocked: list, x_all_blocked: list, doy_
     res = [np.nan for _ in range(len(y_all_blocked))]
     res_out = [copy.copy(res) for _ in range(len(req_date_list))]
     if mode == 'index':
-        with tqdm(total=len(req_date_list) * len(y_all_blocked), desc=f'Get {index} xyoffset={str(xy_offset_blocked[0])}, {str(xy_offset_blocked[1])}', bar_format='{l_bar}{bar:24}{r_bar}{bar:-24b}', position=0, leave=True) as pbar:
-            for __ in range(len(req_date_list)):
-                for _ in range(len(y_all_blocked)):
-                    y_, x_ = y_all_blocked[_] - xy_offset_blocked[0], x_all_blocked[_] - xy_offset_blocked[1]
-
-                    date_temp = req_date_list[__][_]
-                    if ~np.isnan(date_temp):
-                        date_temp = int(date_temp)
-                        data_positive, date_positive, data_negative, date_negative = None, None, None, None
-
-                        for date_interval in range(search_window):
-                            if date_interval == 0 and date_interval + date_temp in doy_list:
-                                if isinstance(dc_blocked, NDSparseMatrix):
-                                    if isinstance(dc_blocked.SM_group[bf.doy2date(date_temp)], sm.coo_matrix):
-                                        info_temp = sm.csr_matrix(dc_blocked.SM_group[bf.doy2date(date_temp)])[y_, x_]
-                                    else:
-                                        info_temp = dc_blocked.SM_group[bf.doy2date(date_temp)][y_, x_]
-
-                                if info_temp != 0:
-                                    res_out[__][_] = info_temp
-                                    break
-
-                            else:
-                                if data_negative is None and date_temp - date_interval in doy_list:
-                                    date_temp_temp = date_temp - date_interval
-                                    if isinstance(dc_blocked, NDSparseMatrix):
-                                        if isinstance(dc_blocked.SM_group[bf.doy2date(date_temp_temp)], sm.coo_matrix):
-                                            info_temp = sm.csr_matrix(dc_blocked.SM_group[bf.doy2date(date_temp_temp)])[y_, x_]
-                                        else:
-                                            info_temp = dc_blocked.SM_group[bf.doy2date(date_temp_temp)][y_, x_]
-
-                                    if info_temp != 0:
-                                        data_negative = np.float(info_temp)
-                                        date_negative = date_temp_temp
-
-                                if data_positive is None and date_temp + date_interval in doy_list:
-                                    date_temp_temp = date_temp + date_interval
-                                    if isinstance(dc_blocked, NDSparseMatrix):
-                                        if isinstance(dc_blocked.SM_group[bf.doy2date(date_temp_temp)], sm.coo_matrix):
-                                            info_temp = sm.csr_matrix(dc_blocked.SM_group[bf.doy2date(date_temp_temp)])[y_, x_]
-                                        else:
-                                            info_temp = dc_blocked.SM_group[bf.doy2date(date_temp_temp)][y_, x_]
-
-                                    if info_temp != 0:
-                                        data_positive = np.float(info_temp)
-                                        date_positive = date_temp_temp
-
-                                if data_positive is not None and data_negative is not None:
-                                    res_out[__][_] = data_negative + (date_temp - date_negative) * (data_positive - data_negative) / (date_positive - date_negative)
-                                    break
-                    pbar.update()
+        # Query all the (pixel, date) pairs through the batched nearest-valid-observation engine
+        y_arr = np.array(y_all_blocked, dtype=np.int64) - xy_offset_blocked[0]
+        x_arr = np.array(x_all_blocked, dtype=np.int64) - xy_offset_blocked[1]
+        date_arr = np.concatenate([np.array(_, dtype=np.float64).flatten() for _ in req_date_list]) if len(req_date_list) > 0 else np.zeros(0)
+        print(f'Get {index} xyoffset={str(xy_offset_blocked[0])}, {str(xy_offset_blocked[1])}')
+        res = nearest_valid_observation(dc_blocked, doy_list, np.tile(y_arr, len(req_date_list)), np.tile(x_arr, len(req_date_list)),
+                                        date_arr, max_gap=search_window - 1, nodata_value=0)
+        res_out = [res['value'][__ * y_arr.shape[0]: (__ + 1) * y_arr.shape[0]].tolist() for __ in range(len(req_date_list))]
 
         res_return = {'x': x_all_blocked, 'y': y_all_blocked}
         for _ in range(len(date_name)):
@@ -3,11 +3,14 @@ import os
 import sys
 import numpy as np
 import datetime
+import time
+import json
 from osgeo import gdal, osr
 import shutil
 import geopandas as gp
 from types import ModuleType, FunctionType
 from gc import get_referents
+from multiprocessing import shared_memory
 
 
 class Path(object):
@@ -216,17 +219,9 @@ def doy2date(self):
         date_temp = datetime.date.fromordinal(datetime.date(year=year_temp, month=1, day=1).toordinal() + np.mod(self_temp, 1000) - 1).month * 100 + datetime.date.fromordinal(datetime.date(year=year_temp, month=1, day=1).toordinal() + np.mod(self_temp, 1000) - 1).day
         return year_temp * 10000 + date_temp
     elif type(self_temp) == list:
-        i = 0
-        while i < len(self_temp):
-            self_temp[i] = doy2date(self_temp[i])
-            i += 1
-        return self_temp
+        return ordinal2date(doy2ordinal(_date_array(self_temp, 'doy2date'))).tolist()
     elif type(self_temp) is np.ndarray:
-        i = 0
-        while i < self_temp.shape[0]:
-            self_temp[i] = doy2date(self_temp[i])
-            i += 1
-        return self_temp
+        return ordinal2date(doy2ordinal(_date_array(self_temp, 'doy2date'))).astype(self_temp.dtype)
     else:
         raise TypeError('The doy2date method did not support this data type')
 
@@ -247,21 +242,268 @@ def date2doy(self):
         date_temp = datetime.date(year=year_temp, month= np.mod(self_temp, 10000) // 100, day=np.mod(self_temp, 100)).toordinal() - datetime.date(year=year_temp, month=1, day=1).toordinal() + 1
         return year_temp * 1000 + date_temp
     elif type(self_temp) == list:
-        i = 0
-        while i < len(self_temp):
-            self_temp[i] = date2doy(self_temp[i])
-            i += 1
-        return self_temp
+        return ordinal2doy(date2ordinal(_date_array(self_temp, 'date2doy'))).tolist()
     elif type(self_temp) is np.ndarray:
-        i = 0
-        while i < self_temp.shape[0]:
-            self_temp[i] = date2doy(self_temp[i])
-            i += 1
-        return self_temp
+        return ordinal2doy(date2ordinal(_date_array(self_temp, 'date2doy'))).astype(self_temp.dtype)
     else:
         raise TypeError('The date2doy method did not support this data type')
 
 
+def _date_array(date_temp, func_name: str):
+
+    # Convert the list or array of the YYYYMMDD/YYYYDOY (int or str) into an int64 array
+    try:
+        date_arr = np.asarray(date_temp)
+        if date_arr.size == 0:
+            return date_arr.astype(np.int64)
+        elif date_arr.dtype.kind in ('U', 'S', 'O'):
+            date_arr = date_arr.astype(np.int64)
+        elif date_arr.dtype.kind not in ('i', 'u'):
+            raise TypeError
+        return date_arr.astype(np.int64)
+    except (TypeError, ValueError):
+        raise TypeError(f'The {func_name} method did not support this data type')
+
+
+def date2ordinal(date_arr):
+
+    # Vectorised YYYYMMDD to the proleptic Gregorian ordinal (datetime.date.toordinal)
+    date_arr = np.asarray(date_arr, dtype=np.int64)
+    if date_arr.size > 0 and (date_arr.min() < 10000000 or date_arr.max() > 99999999):
+        raise ValueError('The date length is not correct!')
+    year, month, day = date_arr // 10000, np.mod(date_arr, 10000) // 100, np.mod(date_arr, 100)
+    days = ((year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (month - 1)).astype('datetime64[D]') + (day - 1)
+    if date_arr.size > 0 and (month.min() < 1 or month.max() > 12 or day.min() < 1 or not np.array_equal(_days2date(days), date_arr)):
+        raise ValueError('The date is not valid!')
+    return days.astype(np.int64) + _ORDINAL_1970
+
+
+def doy2ordinal(doy_arr):
+
+    # Vectorised YYYYDOY to the ordinal, the 8-digit input is regarded as YYYY0DOY as the doy2date
+    doy_arr = np.asarray(doy_arr, dtype=np.int64)
+    if doy_arr.size > 0 and (doy_arr.min() < 1000000 or doy_arr.max() > 99999999):
+        raise ValueError('The doy length is not correct!')
+    year = np.where(doy_arr < 10000000, doy_arr // 1000, doy_arr // 10000)
+    days = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]') + (np.mod(doy_arr, 1000) - 1)
+    return days.astype(np.int64) + _ORDINAL_1970
+
+
+def _days2date(days):
+    year = days.astype('datetime64[Y]')
+    month = days.astype('datetime64[M]')
+    return (year.astype(np.int64) + 1970) * 10000 + (month - year.astype('datetime64[M]')).astype(np.int64) * 100 + 100 + (days - month.astype('datetime64[D]')).astype(np.int64) + 1
+
+
+def ordinal2date(ordinal_arr):
+
+    # Vectorised ordinal to YYYYMMDD
+    days = (np.asarray(ordinal_arr, dtype=np.int64) - _ORDINAL_1970).astype('datetime64[D]')
+    return _days2date(days)
+
+
+def ordinal2doy(ordinal_arr):
+
+    # Vectorised ordinal to YYYYDOY
+    days = (np.asarray(ordinal_arr, dtype=np.int64) - _ORDINAL_1970).astype('datetime64[D]')
+    year = days.astype('datetime64[Y]')
+    return (year.astype(np.int64) + 1970) * 1000 + (days - year.astype('datetime64[D]')).astype(np.int64) + 1
+
+
+_ORDINAL_1970 = datetime.date(1970, 1, 1).toordinal()
+
+
+class Date_index(object):
+
+    ### The date index is built once per datacube for the date-to-layer lookup
+    # (1) The date list is under YYYYDOY or YYYYMMDD, both formats are accepted in the query and converted into the ordinal
+    # (2) The position of a date is looked up in O(1) through the dict of the ordinal
+    # (3) The nearest date before/after a query is found by bisection (searchsorted) on the sorted ordinal
+
+    def __init__(self, date_list):
+        self.date_list = list(date_list)
+        self.ordinal = self.to_ordinal(self.date_list)
+        if np.unique(self.ordinal).shape[0] != self.ordinal.shape[0]:
+            raise ValueError('There are duplicate dates in the date list!')
+        self._ordinal_pos = {ordinal: pos for pos, ordinal in enumerate(self.ordinal.tolist())}
+        self._sorted_pos = np.argsort(self.ordinal, kind='stable')
+        self._sorted_ordinal = self.ordinal[self._sorted_pos]
+
+    def to_ordinal(self, date_temp):
+
+        # The 7-digit date is regarded as YYYYDOY and the 8-digit date as YYYYMMDD
+        date_arr = _date_array(date_temp, 'Date_index')
+        ordinal = np.zeros(date_arr.shape, dtype=np.int64)
+        doy_factor = date_arr < 10000000
+        ordinal[doy_factor] = doy2ordinal(date_arr[doy_factor])
+        ordinal[~doy_factor] = date2ordinal(date_arr[~doy_factor])
+        return ordinal
+
+    def __len__(self):
+        return len(self.date_list)
+
+    def __contains__(self, date):
+        try:
+            return int(self.to_ordinal(date)) in self._ordinal_pos
+        except (TypeError, ValueError):
+            return False
+
+    def index(self, date):
+
+        # The position of the date in the datacube, raise ValueError as the list.index if absent
+        pos = self._ordinal_pos.get(int(self.to_ordinal(date)))
+        if pos is None:
+            raise ValueError(f'{str(date)} is not in the date index')
+        return pos
+
+    def get_pos(self, date_arr):
+
+        # Vectorised position of the dates, -1 for the absent date
+        ordinal = self.to_ordinal(date_arr)
+        sorted_loc = np.clip(np.searchsorted(self._sorted_ordinal, ordinal), 0, max(len(self) - 1, 0))
+        if len(self) == 0:
+            return np.full(ordinal.shape, -1, dtype=np.int64)
+        return np.where(self._sorted_ordinal[sorted_loc] == ordinal, self._sorted_pos[sorted_loc], -1)
+
+    def nearest(self, date_arr, direction: str = 'both', max_gap: int = None, exclude_self: bool = False):
+
+        # The position and the gap (in days) of the nearest date before/after/both of each query, -1 if absent
+        # (1) The 'before' and 'after' include the query date itself unless exclude_self
+        # (2) For the 'both', the earlier date is preferred when the gaps are equal
+        if direction not in ['before', 'after', 'both']:
+            raise ValueError('The direction should be before, after or both!')
+
+        ordinal = np.atleast_1d(self.to_ordinal(date_arr))
+        n = len(self)
+        pos_before, gap_before = np.full(ordinal.shape, -1, dtype=np.int64), np.full(ordinal.shape, -1, dtype=np.int64)
+        pos_after, gap_after = np.full(ordinal.shape, -1, dtype=np.int64), np.full(ordinal.shape, -1, dtype=np.int64)
+
+        if n > 0:
+            loc = np.searchsorted(self._sorted_ordinal, ordinal, side='left' if exclude_self else 'right') - 1
+            valid = loc >= 0
+            pos_before[valid] = self._sorted_pos[loc[valid]]
+            gap_before[valid] = ordinal[valid] - self._sorted_ordinal[loc[valid]]
+
+            loc = np.searchsorted(self._sorted_ordinal, ordinal, side='right' if exclude_self else 'left')
+            valid = loc < n
+            pos_after[valid] = self._sorted_pos[loc[valid]]
+            gap_after[valid] = self._sorted_ordinal[loc[valid]] - ordinal[valid]
+
+        if max_gap is not None:
+            beyond_before, beyond_after = gap_before > max_gap, gap_after > max_gap
+            pos_before[beyond_before], gap_before[beyond_before] = -1, -1
+            pos_after[beyond_after], gap_after[beyond_after] = -1, -1
+
+        if direction == 'before':
+            return pos_before, gap_before
+        elif direction == 'after':
+            return pos_after, gap_after
+        else:
+            after_factor = (pos_before == -1) | ((pos_after != -1) & (gap_after < gap_before))
+            return np.where(after_factor, pos_after, pos_before), np.where(after_factor, gap_after, gap_before)
+
+
+class Dir_index(object):
+
+    ### The directory index caches the listing of the folders to avoid rescanning them in every file_filter call
+    # (1) Each folder is listed once with the os.scandir and the listing is keyed by the path and the mtime of the folder
+    # (2) The listing is reused as long as the mtime is unchanged, any entry added, removed or renamed in the folder updates its mtime
+    # (3) The listing scanned within racy_interval seconds after the last modification is not trusted (coarse mtime of the network storage) and rescanned next time
+    # (4) For the folder with more than trigram_threshold entries, a trigram token map of the names is built for fast substring matching
+
+    def __init__(self, racy_interval: float = 2.0, trigram_threshold: int = 256):
+        self.racy_interval = racy_interval
+        self.trigram_threshold = trigram_threshold
+        self._listing = {}
+
+    def invalidate(self, dir_path: str = None):
+        if dir_path is None:
+            self._listing = {}
+        else:
+            self._listing.pop(dir_path, None)
+
+    def _get_listing(self, dir_path: str):
+
+        # Reuse the cached listing if the mtime of the folder is unchanged and not within the racy interval
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        listing = self._listing.get(dir_path)
+        if listing is not None and listing['stable'] and listing['mtime_ns'] == mtime_ns:
+            return listing
+
+        scan_ns = time.time_ns()
+        with os.scandir(dir_path) as it:
+            entries = [(entry.name, entry.is_dir()) for entry in it]
+        listing = {'mtime_ns': mtime_ns, 'stable': scan_ns - mtime_ns >= self.racy_interval * 1e9,
+                   'names': [_[0] for _ in entries], 'is_dir': [_[1] for _ in entries], 'trigram': None}
+        self._listing[dir_path] = listing
+        return listing
+
+    def listdir(self, dir_path: str):
+        return list(self._get_listing(dir_path)['names'])
+
+    def _build_trigram(self, listing: dict):
+
+        # The trigram token map maps each 3-character token to the position of the names containing it
+        trigram = {}
+        for pos, name in enumerate(listing['names']):
+            for token in set(name[_: _ + 3] for _ in range(len(name) - 2)):
+                trigram.setdefault(token, []).append(pos)
+        listing['trigram'] = {token: np.array(pos_list, dtype=np.int32) for token, pos_list in trigram.items()}
+
+    def _match(self, listing: dict, dir_path: str, word: str):
+
+        # Return the position of the entries whose full path (dir_path + name) contains the word
+        names = listing['names']
+        if word in dir_path:
+            return set(range(len(names)))
+
+        # The word straddling the dir_path and the name, the short word, the small folder and the racy listing are matched by scanning the names
+        straddle = True in [dir_path.endswith(word[:_]) for _ in range(1, len(word))]
+        if straddle or len(word) < 3 or len(names) < self.trigram_threshold or not listing['stable']:
+            return set([pos for pos, name in enumerate(names) if word in dir_path + name])
+
+        if listing['trigram'] is None:
+            self._build_trigram(listing)
+        candidate = None
+        for token in set(word[_: _ + 3] for _ in range(len(word) - 2)):
+            pos_arr = listing['trigram'].get(token)
+            if pos_arr is None:
+                return set()
+            elif candidate is None or pos_arr.shape[0] < candidate.shape[0]:
+                candidate = pos_arr
+        return set([pos for pos in candidate.tolist() if word in names[pos]])
+
+    def filter(self, file_path_temp: str, containing_word_list: list, subfolder_detection: bool, and_or_factor: str, exclude_word_list: list):
+
+        listing = self._get_listing(file_path_temp)
+        names, is_dir = listing['names'], listing['is_dir']
+        containing_match = [self._match(listing, file_path_temp, _) for _ in containing_word_list]
+        exclude_match = set().union(*[self._match(listing, file_path_temp, _) for _ in exclude_word_list])
+        if and_or_factor == 'or':
+            file_match = set().union(*containing_match) - exclude_match
+        else:
+            file_match = (set.intersection(*containing_match) if containing_match else set(range(len(names)))) - exclude_match
+
+        filter_list = []
+        for pos, file in enumerate(names):
+            if is_dir[pos] and subfolder_detection:
+                # The exclude word list is not passed into the subfolder for the 'and' mode as the recursive scan before
+                filter_list.extend(self.filter(file_path_temp + file + '\\', containing_word_list, True, and_or_factor,
+                                               exclude_word_list if and_or_factor == 'or' else []))
+            elif pos in file_match:
+                filter_list.append(file_path_temp + file)
+        return filter_list
+
+
+_dir_index = Dir_index()
+
+
+def list_dir(dir_path: str):
+
+    # The listing of the folder through the directory index
+    return _dir_index.listdir(Path(dir_path).path_name)
+
+
 def file_filter(file_path_temp, containing_word_list: list, subfolder_detection=False, and_or_factor=None, exclude_word_list=[]):
 
     file_path_temp = Path(file_path_temp).path_name
@@ -272,51 +514,8 @@ def file_filter(file_path_temp, containing_word_list: list, subfolder_detection=
         print("Caution the and or should exactly be string as 'and' or 'or'")
         sys.exit(-1)
 
-    if and_or_factor == 'or':
-        file_list = os.listdir(file_path_temp)
-        filter_list = []
-        for file in file_list:
-            if os.path.isdir(file_path_temp + file) and subfolder_detection:
-                filter_list_temp = file_filter(file_path_temp + file + '\\', containing_word_list, subfolder_detection=True, exclude_word_list=exclude_word_list, and_or_factor=and_or_factor)
-                if filter_list_temp != []:
-                    filter_list.extend(filter_list_temp)
-            else:
-                for containing_word in containing_word_list:
-                    if containing_word in file_path_temp + file:
-                        if exclude_word_list == []:
-                            filter_list.append(file_path_temp + file)
-                        else:
-                            exclude_factor = False
-                            for exclude_word in exclude_word_list:
-                                if exclude_word in file_path_temp + file:
-                                    exclude_factor = True
-                                    break
-                            if not exclude_factor:
-                                filter_list.append(file_path_temp + file)
-                        break
-        return filter_list
-    elif and_or_factor == 'and':
-        file_list = os.listdir(file_path_temp)
-        filter_list = []
-        for file in file_list:
-            file_factor = True
-            if os.path.isdir(file_path_temp + file) and subfolder_detection:
-                filter_list_temp = file_filter(file_path_temp + file + '\\', containing_word_list,
-                                               subfolder_detection=True, and_or_factor=and_or_factor)
-                if filter_list_temp != []:
-                    filter_list.extend(filter_list_temp)
-            else:
-                for containing_word in containing_word_list:
-                    if containing_word not in file_path_temp + file:
-                        file_factor = False
-                        break
-                for exclude_word in exclude_word_list:
-                    if exclude_word in file_path_temp + file:
-                        file_factor = False
-                        break
-                if file_factor:
-                    filter_list.append(file_path_temp + file)
-        return filter_list
+    # Query the cached directory index instead of listing the folder in every call
+    return _dir_index.filter(file_path_temp, containing_word_list, subfolder_detection, and_or_factor, exclude_word_list)
 
 
 def create_folder(path_name, print_existence=False):
@@ -331,6 +530,30 @@ def create_folder(path_name, print_existence=False):
             print('Folder already exist  (' + path_name + ')')
 
 
+def save_npy_atomic(filename: str, arr, before_replace=None):
+
+    # Write the array into a temporary file and replace the target, thus the reader never sees a partial file
+    # The temporary file ends with .partial rather than .npy, thus a leftover of an interrupted save is never matched as a npy file
+    # The before_replace is called between the writing and the replacement (e.g. to release a memmap of the target file,
+    # which cannot be replaced on Windows while it is still mapped)
+    filename = filename if filename.endswith('.npy') else filename + '.npy'
+    tmp_filename = filename[:-4] + '.partial'
+    with open(tmp_filename, 'wb') as npy_temp:
+        np.save(npy_temp, arr)
+    if before_replace is not None:
+        before_replace()
+    os.replace(tmp_filename, filename)
+
+
+def dump_json_atomic(filename: str, dic: dict):
+
+    # Write the dict into a temporary json and replace the target
+    tmp_filename = os.path.splitext(filename)[0] + '_tmp' + os.path.splitext(filename)[1]
+    with open(tmp_filename, 'w') as js_temp:
+        json.dump(dic, js_temp)
+    os.replace(tmp_filename, filename)
+
+
 def check_file_path(file_path: str):
     # Check the type of filepath
     if type(file_path) != str:
@@ -410,6 +633,43 @@ def getsize(obj: object):
     return size
 
 
+class Shared_array(object):
+
+    ### The shared array copies the dense ndarray into a shared memory block once
+    # (1) Pickling only ships the block name, shape and dtype, the worker attaches the block as a read-only zero-copy array
+    # (2) Only the owner (the process created the block) unlinks it in the release()
+
+    def __init__(self, array: np.ndarray):
+        array = np.asarray(array)
+        self.shape, self.dtype = array.shape, array.dtype
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.shm_name = self._shm.name
+        self._owner = True
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self.array[...] = array
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype, 'shm_name': self.shm_name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=self.shm_name)
+        self._owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        self.array.flags.writeable = False
+
+    def __getitem__(self, keys):
+        return self.array[keys]
+
+    def release(self):
+        if self._shm is not None:
+            self.array = None
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm, self._owner = None, False
+
+
 def raster_ds2bounds(filename: str):
     
     # Read raster file
@@ -0,0 +1,234 @@
+import os
+import json
+import zlib
+import struct
+import numpy as np
+import basic_function as bf
+
+# The optional compressors are only required by the codec using them
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+### The layer codec encodes one 2D layer of the datacube into a self-described .lyr file
+# (1) The codec is a filter followed by a compressor, written as 'filter+compressor' or one of the aliases in CODEC_ALIAS
+# (2) The filters are 'none', 'shuffle' (byte shuffle), 'delta' (row-wise delta of the integer layer then byte shuffle)
+#     and 'bitpack' (the offset value - vmin packed into 1/2/4-bit fields or narrowed to the smallest unsigned type,
+#     e.g. four 0/1/2 inundation pixels per byte)
+# (3) The compressors are 'none', 'zlib', 'zstd', 'lz4' and 'blosc', the last three are only available with the corresponding package
+# (4) The .lyr file is the magic, the length of the json header and the header padded to 64 bytes, followed by the payload
+#     thus the uncompressed ('raw') layer is memory-mapped instead of being read
+
+CODEC_ALIAS = {'raw': 'none+none', 'zlib': 'shuffle+zlib', 'zstd': 'shuffle+zstd', 'lz4': 'shuffle+lz4', 'blosc': 'none+blosc',
+               'bitpack': 'bitpack+zlib', 'bitpack-zstd': 'bitpack+zstd', 'bitpack-lz4': 'bitpack+lz4',
+               'delta': 'delta+zlib', 'delta-zstd': 'delta+zstd', 'delta-lz4': 'delta+lz4'}
+FILTER_LIST = ['none', 'shuffle', 'delta', 'bitpack']
+COMPRESSOR_LIST = ['none', 'zlib', 'zstd', 'lz4', 'blosc']
+_MAGIC = b'LYR1'
+
+# The lookup table unpacking one byte into its 8/4/2 fields of 1/2/4 bits, each row is viewed as one little-endian word for a 1D gather
+_UNPACK_TABLE = {nbits: np.ascontiguousarray(((np.arange(256, dtype=np.uint8)[:, None] >> (np.arange(8 // nbits, dtype=np.uint8) * nbits)) & ((1 << nbits) - 1)).astype(np.uint8)).view(f'<u{8 // nbits}').ravel()
+                 for nbits in (1, 2, 4)}
+
+
+def _compressor_available(compressor: str):
+    return {'none': True, 'zlib': True, 'zstd': zstandard is not None, 'lz4': lz4_frame is not None, 'blosc': blosc is not None}[compressor]
+
+
+def parse_codec(codec: str):
+
+    # Convert the codec (alias or 'filter+compressor') into the filter and compressor
+    codec_temp = CODEC_ALIAS.get(codec, codec) if isinstance(codec, str) else None
+    if codec_temp is None or codec_temp.count('+') != 1:
+        raise ValueError(f'The codec {str(codec)} is not supported!')
+    filter_temp, compressor = codec_temp.split('+')
+    if filter_temp not in FILTER_LIST or compressor not in COMPRESSOR_LIST:
+        raise ValueError(f'The codec {str(codec)} is not supported!')
+    elif not _compressor_available(compressor):
+        raise Exception(f'The compressor {compressor} of the codec {str(codec)} is not installed!')
+    return filter_temp, compressor
+
+
+def available_codecs():
+    return [codec for codec, codec_temp in CODEC_ALIAS.items() if _compressor_available(codec_temp.split('+')[1])]
+
+
+def _unsigned(dtype):
+    return np.dtype(f'u{np.dtype(dtype).itemsize}')
+
+
+def _compress(data: bytes, compressor: str, typesize: int):
+    if compressor == 'zlib':
+        return zlib.compress(data, 3)
+    elif compressor == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif compressor == 'lz4':
+        return lz4_frame.compress(data)
+    elif compressor == 'blosc':
+        return blosc.compress(data, typesize=typesize, cname='zstd', clevel=5, shuffle=blosc.SHUFFLE)
+    return data
+
+
+def _decompress(data, compressor: str):
+    if compressor == 'zlib':
+        return zlib.decompress(data)
+    elif compressor == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif compressor == 'lz4':
+        return lz4_frame.decompress(data)
+    elif compressor == 'blosc':
+        return blosc.decompress(bytes(data))
+    return data
+
+
+def encode_layer(layer: np.ndarray, codec: str):
+
+    # Encode a dense 2D layer into the header dict and the payload bytes
+    filter_temp, compressor = parse_codec(codec)
+    layer = np.ascontiguousarray(layer)
+    if layer.ndim != 2:
+        raise ValueError('Only the 2D layer can be encoded!')
+    if layer.dtype == np.bool_:
+        layer = layer.view(np.uint8)
+    header = {'filter': filter_temp, 'compressor': compressor, 'shape': list(layer.shape), 'dtype': layer.dtype.str}
+
+    if filter_temp in ['delta', 'bitpack'] and layer.dtype.kind not in ('i', 'u'):
+        raise ValueError(f'The {filter_temp} filter only supports the integer layer!')
+
+    if filter_temp == 'none':
+        data = layer.tobytes()
+    elif filter_temp == 'shuffle':
+        data = layer.view(np.uint8).reshape(-1, layer.dtype.itemsize).T.tobytes()
+    elif filter_temp == 'delta':
+        # The difference is taken under the unsigned type, thus the wraparound is reversed by the cumsum in decoding
+        delta = layer.view(_unsigned(layer.dtype)).copy()
+        delta[:, 1:] -= layer.view(_unsigned(layer.dtype))[:, :-1]
+        data = delta.view(np.uint8).reshape(-1, layer.dtype.itemsize).T.tobytes()
+    else:
+        # The offset value (value - vmin) is taken under the unsigned type, and its bit width is rounded up to 1/2/4/8/16/32/64
+        vmin = layer.min().item() if layer.size > 0 else 0
+        offset = (layer.view(_unsigned(layer.dtype)) - np.array(vmin, dtype=layer.dtype).view(_unsigned(layer.dtype))).ravel()
+        nbits = max(int(offset.max()).bit_length(), 1) if layer.size > 0 else 1
+        nbits = [_ for _ in (1, 2, 4, 8, 16, 32, 64) if _ >= nbits][0]
+        header['vmin'], header['nbits'] = vmin, nbits
+        if nbits >= 8:
+            data = offset.astype(np.dtype(f'u{nbits // 8}')).view(np.uint8).reshape(-1, nbits // 8).T.tobytes()
+        else:
+            per_byte = 8 // nbits
+            fields = np.zeros(-(-offset.shape[0] // per_byte) * per_byte, dtype=np.uint8)
+            fields[:offset.shape[0]] = offset
+            fields = fields.reshape(-1, per_byte)
+            packed = fields[:, 0].copy()
+            for field in range(1, per_byte):
+                packed |= fields[:, field] << (field * nbits)
+            data = packed.tobytes()
+
+    return header, _compress(data, compressor, layer.dtype.itemsize)
+
+
+def decode_layer(header: dict, payload):
+
+    # Decode the payload into the dense 2D layer
+    shape, dtype = tuple(header['shape']), np.dtype(header['dtype'])
+    size = int(np.prod(shape))
+    data = _decompress(payload, header['compressor'])
+
+    if header['filter'] == 'none':
+        return np.frombuffer(data, dtype=dtype, count=size).reshape(shape)
+    elif header['filter'] == 'shuffle':
+        return np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, size).T.copy().view(dtype).reshape(shape)
+    elif header['filter'] == 'delta':
+        delta = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, size).T.copy().view(_unsigned(dtype)).reshape(shape)
+        return np.cumsum(delta, axis=1, dtype=_unsigned(dtype)).view(dtype)
+    elif header['filter'] == 'bitpack':
+        nbits = header['nbits']
+        if nbits >= 8:
+            offset = np.frombuffer(data, dtype=np.uint8).reshape(nbits // 8, size).T.copy().view(np.dtype(f'u{nbits // 8}')).ravel()
+        else:
+            offset = _UNPACK_TABLE[nbits][np.frombuffer(data, dtype=np.uint8)].view(np.uint8)[:size]
+        offset = offset.astype(_unsigned(dtype))
+        return (offset + np.array(header['vmin'], dtype=dtype).view(_unsigned(dtype))).view(dtype).reshape(shape)
+    else:
+        raise ValueError(f'The filter {header["filter"]} is not supported!')
+
+
+def write_layer(filename: str, layer, codec: str):
+
+    # Write the layer into the .lyr file through a temporary file, the sparse layer is densified before encoding
+    if not isinstance(layer, np.ndarray):
+        layer = layer.toarray()
+    header, payload = encode_layer(layer, codec)
+    header_bytes = json.dumps(header).encode()
+    header_bytes = header_bytes + b' ' * (-(len(_MAGIC) + 4 + len(header_bytes)) % 64)
+    tmp_filename = filename[:-len('.lyr')] + '_tmp.lyr' if filename.endswith('.lyr') else filename + '_tmp'
+    with open(tmp_filename, 'wb') as lyr_temp:
+        lyr_temp.write(_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+        lyr_temp.write(payload)
+    os.replace(tmp_filename, filename)
+
+
+def read_layer_header(filename: str):
+
+    with open(filename, 'rb') as lyr_temp:
+        if lyr_temp.read(len(_MAGIC)) != _MAGIC:
+            raise Exception(f'The {filename} is not a valid layer file!')
+        header_len = struct.unpack('<I', lyr_temp.read(4))[0]
+        header = json.loads(lyr_temp.read(header_len).decode())
+    return header, len(_MAGIC) + 4 + header_len
+
+
+def read_layer(filename: str, mmap: bool = True):
+
+    # Read the .lyr file, the uncompressed layer is memory-mapped (read-only) if mmap
+    header, offset = read_layer_header(filename)
+    if mmap and header['filter'] == 'none' and header['compressor'] == 'none':
+        return np.memmap(filename, dtype=np.dtype(header['dtype']), mode='r', offset=offset, shape=tuple(header['shape']))
+    with open(filename, 'rb') as lyr_temp:
+        lyr_temp.seek(offset)
+        return decode_layer(header, lyr_temp.read())
+
+
+def save_codec_cube(output_path: str, dc: np.ndarray, namelist: list, codec: str, layer_index: list = None):
+
+    # Save the dense datacube as one .lyr file per layer with the SMcodec.json and the SMsequence.npz.npy (as the NDsm)
+    # Only the layers in the layer_index are (re)written if it is given, e.g. the new layers of the ingestion
+    parse_codec(codec)
+    if dc.ndim != 3 or dc.shape[2] != len(namelist):
+        raise ValueError('The dense datacube is not consistent with the namelist!')
+    bf.create_folder(output_path)
+    output_path = bf.Path(output_path).path_name
+    for z in (range(dc.shape[2]) if layer_index is None else layer_index):
+        write_layer(f'{output_path}{str(namelist[z])}.lyr', dc[:, :, z], codec)
+    bf.dump_json_atomic(output_path + 'SMcodec.json', {'codec': codec, 'shape': list(dc.shape), 'dtype': dc.dtype.str})
+    bf.save_npy_atomic(output_path + 'SMsequence.npz.npy', np.array(namelist))
+
+
+def peek_codec_cube(input_path: str):
+
+    # Return the codec, the shape and the dtype of the codec cube without reading the layers
+    input_path = bf.Path(input_path).path_name
+    with open(input_path + 'SMcodec.json') as js_temp:
+        codec_header = json.load(js_temp)
+    return codec_header['codec'], codec_header['shape'], np.dtype(codec_header['dtype'])
+
+
+def load_codec_cube(input_path: str):
+
+    # Load the dense datacube saved by the save_codec_cube into an ndarray ordered by the SMsequence
+    input_path = bf.Path(input_path).path_name
+    codec, shape, dtype = peek_codec_cube(input_path)
+    namelist = np.load(input_path + 'SMsequence.npz.npy', allow_pickle=True).tolist()
+    dc = np.zeros([shape[0], shape[1], len(namelist)], dtype=dtype)
+    for z, name in enumerate(namelist):
+        dc[:, :, z] = read_layer(f'{input_path}{str(name)}.lyr', mmap=False)
+    return dc
@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import scipy.sparse as sm
+import layer_codec
+from NDsm import NDSparseMatrix
+
+
+### Benchmark the layer codecs on the synthetic datacubes
+# (1) The inundation cube is the int8 0/1/2 cube (0 outside the ROI, 1 dry, 2 inundated) with the spatially coherent water body
+# (2) The VI cube is the int16 scaled VI cube with the nodata (0) outside the ROI
+# (3) For each codec, the write/read throughput (MB/s of the decoded cube) and the on-disk size are reported against the npz (zlib-CSR)
+# Usage: python layer_codec_benchmark.py --rows 2000 --cols 2000 --layers 20
+
+
+def synthetic_inundation_cube(rows: int, cols: int, layers: int, seed: int = 0):
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0: rows, 0: cols]
+    roi = ((yy - rows / 2) / (rows / 2)) ** 2 + ((xx - cols / 2) / (cols / 2.5)) ** 2 < 1
+    river = np.abs(yy - rows / 2 - rows / 8 * np.sin(xx / cols * 6))
+    dc = np.zeros([rows, cols, layers], dtype=np.int8)
+    for z in range(layers):
+        water_level = rows / 30 * (1 + np.sin(z / max(layers, 1) * 2 * np.pi)) + rows / 60
+        layer = np.where(river < water_level, 2, 1).astype(np.int8)
+        layer[rng.random([rows, cols]) < 0.002] = 2
+        layer[~roi] = 0
+        dc[:, :, z] = layer
+    return dc
+
+
+def synthetic_vi_cube(rows: int, cols: int, layers: int, seed: int = 0):
+
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0: rows, 0: cols]
+    roi = ((yy - rows / 2) / (rows / 2)) ** 2 + ((xx - cols / 2) / (cols / 2.5)) ** 2 < 1
+    base = 0.3 + 0.2 * np.sin(yy / 50) * np.cos(xx / 70)
+    dc = np.zeros([rows, cols, layers], dtype=np.int16)
+    for z in range(layers):
+        layer = (base + 0.25 * np.sin(z / max(layers, 1) * 2 * np.pi) + rng.normal(0, 0.02, [rows, cols])) * 10000
+        layer = np.clip(layer, 1, 10000).astype(np.int16)
+        layer[~roi] = 0
+        dc[:, :, z] = layer
+    return dc
+
+
+def _folder_size(path: str):
+    return sum([os.path.getsize(os.path.join(path, _)) for _ in os.listdir(path)])
+
+
+def benchmark_cube(dc: np.ndarray, codec_list: list, work_path: str, repeat: int = 3):
+
+    namelist = list(range(dc.shape[2]))
+    mb = dc.nbytes / 1024 ** 2
+    result = []
+
+    # The npz (zlib-CSR) baseline of the NDsm
+    ndsm = NDSparseMatrix(*[sm.csr_matrix(dc[:, :, z]) for z in namelist], SM_namelist=namelist)
+    path_temp = os.path.join(work_path, 'npz') + os.sep
+    write_time, read_time = [], []
+    for _ in range(repeat):
+        shutil.rmtree(path_temp, ignore_errors=True)
+        os.makedirs(path_temp)
+        st = time.time()
+        for z in namelist:
+            sm.save_npz(f'{path_temp}{str(z)}.npz', ndsm.SM_group[z])
+        write_time.append(time.time() - st)
+        st = time.time()
+        for z in namelist:
+            sm.load_npz(f'{path_temp}{str(z)}.npz').toarray()
+        read_time.append(time.time() - st)
+    result.append(['npz (zlib-CSR)', mb / min(write_time), mb / min(read_time), _folder_size(path_temp) / 1024 ** 2])
+
+    # The layer codecs
+    for codec in codec_list:
+        try:
+            layer_codec.encode_layer(dc[:1, :1, 0], codec)
+        except ValueError:
+            continue
+        path_temp = os.path.join(work_path, codec) + os.sep
+        write_time, read_time = [], []
+        for _ in range(repeat):
+            shutil.rmtree(path_temp, ignore_errors=True)
+            os.makedirs(path_temp)
+            st = time.time()
+            for z in namelist:
+                layer_codec.write_layer(f'{path_temp}{str(z)}.lyr', dc[:, :, z], codec)
+            write_time.append(time.time() - st)
+            st = time.time()
+            for z in namelist:
+                layer_temp = layer_codec.read_layer(f'{path_temp}{str(z)}.lyr', mmap=False)
+            read_time.append(time.time() - st)
+        if not np.array_equal(layer_temp, dc[:, :, namelist[-1]]):
+            raise Exception(f'The codec {codec} is not lossless!')
+        result.append([codec, mb / min(write_time), mb / min(read_time), _folder_size(path_temp) / 1024 ** 2])
+    return result
+
+
+def print_result(title: str, dc: np.ndarray, result: list):
+    print(f'\n{title} {str(dc.shape)} {str(dc.dtype)}, {dc.nbytes / 1024 ** 2:.1f} MB decoded')
+    print(f'{"codec":<16}{"write MB/s":>12}{"read MB/s":>12}{"size MB":>10}{"ratio":>8}')
+    for codec, write_speed, read_speed, size in result:
+        print(f'{codec:<16}{write_speed:>12.1f}{read_speed:>12.1f}{size:>10.2f}{dc.nbytes / 1024 ** 2 / max(size, 1e-9):>8.1f}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the layer codecs on the synthetic datacubes')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--cols', type=int, default=2000)
+    parser.add_argument('--layers', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'Available codecs: {", ".join(layer_codec.available_codecs())}')
+    work_path = tempfile.mkdtemp(prefix='layer_codec_')
+    try:
+        inundation_dc = synthetic_inundation_cube(args.rows, args.cols, args.layers)
+        print_result('Inundation cube', inundation_dc, benchmark_cube(inundation_dc, layer_codec.available_codecs(), work_path, repeat=args.repeat))
+        vi_dc = synthetic_vi_cube(args.rows, args.cols, args.layers)
+        print_result('VI cube', vi_dc, benchmark_cube(vi_dc, layer_codec.available_codecs(), work_path, repeat=args.repeat))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
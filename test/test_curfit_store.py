@@ -0,0 +1,66 @@
+import sys
+import os
+import types
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('osgeo')
+import RSDatacube.utils as ru
+
+
+### Round trip of the curve fitting result: the memmap store of the curfit4bound_annual, the csv and the tif of the curfit_pd2tif
+
+
+def synthetic_vi_dc(rows=4, cols=5, seed=0):
+
+    # The double logistic NDVI of two years observed every 16 days, 0 for the nodata
+    rng = np.random.default_rng(seed)
+    doy_list = [year * 1000 + doy for year in (2019, 2020) for doy in range(1, 366, 16)]
+    doy_arr = np.mod(np.array(doy_list), 1000)
+    vi_curve = 0.1 + 0.5 * (1 / (1 + np.exp((110 - doy_arr) / 8)) - 1 / (1 + np.exp((300 - doy_arr) / 8)))
+    dc = np.clip(vi_curve[None, None, :] + rng.normal(0, 0.01, [rows, cols, len(doy_list)]), 0.01, 1)
+    return dc, doy_list
+
+
+def test_curfit_store_csv_tif(tmp_path, monkeypatch):
+    dc, doy_list = synthetic_vi_dc()
+    pos_df = pd.DataFrame(np.argwhere(np.ones(dc.shape[:2], dtype=bool)), columns=['y', 'x'])
+    curfit_dic = {'CFM': 'SPL', 'para_num': 7, 'initial_para_ori': [0.10, 0.5, 108.2, 7.596, 311.4, 7.473, 0.00225],
+                  'initial_para_boundary': ([0.08, 0, 40, 3, 180, 3, 0.0001], [0.6, 0.8, 180, 20, 330, 20, 0.01])}
+    monkeypatch.setattr(ru.bf, 'Path', lambda path: types.SimpleNamespace(path_name=os.path.join(str(path), '')))
+
+    store_file = ru.curfit4bound_annual(pos_df, dc, doy_list, curfit_dic, False, False, [0, 0], str(tmp_path), 0, 0)
+    store = np.load(store_file)
+    assert store.dtype['y'] == np.int64 and store.dtype['x'] == np.int64
+    assert ru.curfit_store_finished(store_file)
+
+    # The csv is read back as the RS_dcs.curve_fitting does for the existing curfit_all.csv
+    pd.DataFrame(store).to_csv(tmp_path / 'curfit_all.csv')
+    df = pd.read_csv(tmp_path / 'curfit_all.csv')
+
+    written = {}
+    monkeypatch.setattr(ru.gdal, 'Open', lambda path: types.SimpleNamespace(RasterYSize=dc.shape[0], RasterXSize=dc.shape[1]), raising=False)
+    monkeypatch.setattr(ru.bf, 'write_raster', lambda ds, arr, path, name, **kwargs: written.update({name: arr}))
+    ru.curfit_pd2tif(str(tmp_path) + os.sep, df.loc[:, ['y', 'x', 'para_ori_2']], 'para_ori_2', 'roi.TIF')
+
+    expected = np.full(dc.shape[:2], np.nan, dtype=np.float32)
+    expected[store['y'], store['x']] = store['para_ori_2']
+    assert np.allclose(written['para_ori_2.TIF'], expected, equal_nan=True)
+    assert not np.isnan(written['para_ori_2.TIF']).all()
+
+
+def test_curfit_store_failure(tmp_path, monkeypatch):
+    # The failed fitting returns None rather than the partly filled store
+    dc, doy_list = synthetic_vi_dc()
+    pos_df = pd.DataFrame(np.argwhere(np.ones(dc.shape[:2], dtype=bool)), columns=['y', 'x'])
+    curfit_dic = {'CFM': 'SPL', 'para_num': 7, 'initial_para_ori': [0.10, 0.5, 108.2, 7.596, 311.4, 7.473, 0.00225],
+                  'initial_para_boundary': ([0.08, 0, 40, 3, 180, 3, 0.0001], [0.6, 0.8, 180, 20, 330, 20, 0.01])}
+    monkeypatch.setattr(ru.bf, 'Path', lambda path: types.SimpleNamespace(path_name=os.path.join(str(path), '')))
+
+    def batch_curve_fit_fail(*args, **kwargs):
+        raise RuntimeError('The curve fitting failed')
+    monkeypatch.setattr(ru, 'batch_curve_fit', batch_curve_fit_fail)
+    assert ru.curfit4bound_annual(pos_df, dc, doy_list, curfit_dic, False, False, [0, 0], str(tmp_path), 0, 0) is None
+    assert not ru.curfit_store_finished(str(tmp_path / 'curfit_0_0.npy'))
@@ -0,0 +1,111 @@
+import sys
+import os
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('osgeo')
+import Landsat_toolbox.utils as lu
+
+
+### Regression test of the connected-component inundated area engine against the pixel-list functions
+# The synthetic rasters are framed by the nodata (255) as the clipped Landsat tiles
+
+
+def synthetic_inundated_array(rows=30, cols=40, seed=0):
+
+    # 1 for the water, 0 for the non-water and 255 for the nodata frame
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0: rows, 0: cols]
+    river = np.abs(yy - rows / 2 - 4 * np.sin(xx / 5)) < 2
+    inundated_array = np.where(np.logical_or(river, rng.random([rows, cols]) < 0.15), 1, 0).astype(np.uint8)
+    inundated_array[[0, -1], :] = 255
+    inundated_array[:, [0, -1]] = 255
+    return inundated_array
+
+
+def synthetic_dem_fix(rows=24, cols=30):
+
+    # The river (1) along the bottom, the sole inundated puddles (2) in the depressions and the dry floodplain (255)
+    yy, xx = np.mgrid[0: rows, 0: cols]
+    dem = (rows - yy) * 1.0 + 0.3 * np.sin(xx / 2.0)
+    puddle_list = [(5, 6), (6, 20), (11, 13), (12, 14)]
+    for y, x in puddle_list:
+        dem[y - 1: y + 2, x - 1: x + 2] -= 4
+    inundated = np.full([rows, cols], 255, dtype=np.int32)
+    inundated[rows - 4:, :] = 1
+    for y, x in puddle_list:
+        inundated[y, x] = 2
+    sole = lu.identify_all_inundated_area_batch(np.where(inundated == 255, 0, 1), nanvalue_pixel_indicator=255)
+    return dem, sole, inundated
+
+
+def _legacy_surrounding_pixel_cor(water_pixel, x_max, y_max, window_size=0, detection_method='EightP'):
+
+    # The 3x3 surrounding_pixel_cor(window_size=0) which the DEM_fix_sole was written against
+    yy, xx = np.mgrid[-1: 2, -1: 2]
+    y_arr = np.clip(yy.ravel() + water_pixel[0], 0, y_max - 1)
+    x_arr = np.clip(xx.ravel() + water_pixel[1], 0, x_max - 1)
+    pixel_list = [[y, x] for y, x in zip(y_arr, x_arr) if [y, x] != [water_pixel[0], water_pixel[1]]]
+    return np.array(pixel_list), np.array([water_pixel])
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('surrounding_factor', [False, True])
+def test_identify_all_inundated_area(seed, surrounding_factor):
+    inundated_array = synthetic_inundated_array(seed=seed)
+    legacy = lu.identify_all_inundated_area(inundated_array, inundated_pixel_indicator=1, nanvalue_pixel_indicator=255, surrounding_pixel_identification_factor=surrounding_factor)
+    batch = lu.identify_all_inundated_area_batch(inundated_array, inundated_pixel_indicator=1, nanvalue_pixel_indicator=255, surrounding_pixel_identification_factor=surrounding_factor)
+    assert np.array_equal(legacy, batch)
+
+
+def test_identify_all_inundated_area_stack():
+    stack = np.stack([synthetic_inundated_array(seed=seed) for seed in range(4)], axis=2)
+    batch = lu.identify_all_inundated_area_batch(stack, surrounding_pixel_identification_factor=True)
+    for z in range(stack.shape[2]):
+        assert np.array_equal(batch[:, :, z], lu.identify_all_inundated_area_batch(stack[:, :, z], surrounding_pixel_identification_factor=True))
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_detect_sole_inundated_area(seed):
+    inundated_array = synthetic_inundated_array(seed=seed)
+    for y, x in np.argwhere(inundated_array == 1)[::37]:
+        legacy = lu.detect_sole_inundated_area(inundated_array, [[y, x]], None, None, water_pixel_value=1, detection_method='EightP', nodata_value=255)
+        batch = lu.detect_sole_inundated_area_batch(inundated_array, [[y, x]], water_pixel_value=1, detection_method='EightP', nodata_value=255)
+        assert np.array_equal(legacy, batch)
+
+
+@pytest.mark.parametrize('water_level', [8.0, 12.5, 17.0])
+def test_inundated_area_detection(water_level):
+    dem = synthetic_dem_fix()[0]
+    water_pixel = np.array([[dem.shape[0] - 1, 3]])
+    legacy = lu.inundated_area_detection(dem.copy(), water_pixel, water_level_indicator=water_level)
+    batch = lu.inundated_area_detection_batch(dem, water_pixel, water_level_indicator=water_level)
+    assert np.array_equal(legacy[0], batch[0])
+    assert set(map(tuple, legacy.tolist())) == set(map(tuple, batch.tolist()))
+    assert batch.shape[0] == len(set(map(tuple, batch.tolist())))
+
+
+def test_DEM_fix_sole(monkeypatch):
+    dem, sole, inundated = synthetic_dem_fix()
+    monkeypatch.setattr(lu, 'surrounding_pixel_cor', _legacy_surrounding_pixel_cor)
+    for indicator in np.unique(sole[inundated == 2]):
+        legacy_indicator, legacy_water, _ = lu.DEM_fix_sole(dem, sole, inundated, indicator_list=int(indicator))
+        batch_indicator, batch_water, _ = lu.DEM_fix_sole_batch(dem, sole, inundated, indicator_list=int(indicator))
+        assert sorted(legacy_indicator) == sorted(batch_indicator)
+        assert set(map(tuple, legacy_water.tolist())) == set(map(tuple, batch_water.tolist()))
+
+
+@pytest.mark.parametrize('river_largest', [True, False])
+def test_complement_all_inundated_area(monkeypatch, river_largest):
+    # The legacy function skips the largest label, either the river or a sole inundated puddle
+    dem, sole, inundated = synthetic_dem_fix()
+    assert sole.max() == sole[-1, 0]
+    if not river_largest:
+        puddle_label = sole[5, 6]
+        sole = np.where(sole == puddle_label, sole.max(), np.where(sole == sole.max(), puddle_label, sole))
+    monkeypatch.setattr(lu, 'surrounding_pixel_cor', _legacy_surrounding_pixel_cor)
+    legacy = lu.complement_all_inundated_area(dem, sole, inundated)
+    batch = lu.complement_all_inundated_area_batch(dem, sole, inundated)
+    assert np.array_equal(legacy, batch)
+    assert (batch == 3).any()
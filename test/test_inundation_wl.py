@@ -0,0 +1,231 @@
+import sys
+import os
+import copy
+import numpy as np
+from scipy import ndimage
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('osgeo')
+import RSDatacube.utils as ru
+
+
+### Regression test of the inundation water level refinement against the per-pixel loop of the est_inunduration
+# The synthetic basin holds two inundation regions split by a dry ridge and a permanent water channel
+
+
+def synthetic_basin(rows=40, cols=56):
+
+    # The daily water level of one year (rounded as the gauge record) and the acquisition every 8 days
+    doy_arr = np.arange(2020001, 2020367)
+    wl_arr = np.round(20 + 4 * np.sin((doy_arr - 2020001) / 366 * 2 * np.pi) + 0.5 * np.sin(doy_arr / 9), 2)
+    water_level_data = np.stack([doy_arr, wl_arr], axis=1).astype(np.float64)
+    doy_list = list(doy_arr[10:: 8])
+    level_list = np.sort(np.unique(wl_arr[10:: 8]))
+
+    # The min inundation wl is the lowest acquired wl above the dem
+    yy, xx = np.mgrid[0: rows, 0: cols]
+    dem = 16 + 0.25 * np.hypot(yy - rows / 2, (xx - cols / 2) / 1.4) + 0.3 * np.sin(xx / 3)
+    level_pos = np.clip(np.searchsorted(level_list, dem), 0, level_list.shape[0] - 1)
+    min_inun_wl_arr = level_list[level_pos].astype(np.float32)
+    max_noninun_wl_arr = np.where(np.sin(yy * xx) > 0.6, min_inun_wl_arr + 0.5, min_inun_wl_arr - 0.5).astype(np.float32)
+
+    permanent_water_arr = np.zeros([rows, cols], dtype=np.int32)
+    permanent_water_arr[rows // 2 - 1: rows // 2 + 2, 8: cols - 8] = 1
+    inun_id_arr = np.where(np.logical_and(dem < level_list[-3], permanent_water_arr == 0), 1, 0).astype(np.int32)
+    inun_id_arr[:, cols // 2 + 6] = 0
+    inun_id_arr[np.logical_and(inun_id_arr == 1, xx > cols // 2 + 6)] = 2
+    inun_id_arr[[0, -1], :] = 0
+    inun_id_arr[:, [0, -1]] = 0
+    return min_inun_wl_arr, max_noninun_wl_arr, permanent_water_arr, inun_id_arr, water_level_data, doy_list
+
+
+def legacy_refine(min_inun_wl_arr, max_noninun_wl_arr, permanent_water_arr, inun_id_arr, water_level_data, doy_list):
+
+    # The removed per-pixel loop of the est_inunduration (the timing and the mp branch dropped)
+    min_wl_arr_refined = copy.deepcopy(min_inun_wl_arr)
+    min_wl_arr_refined[:, :] = 0
+    for inun_id_ in np.unique(inun_id_arr.flatten()):
+        if inun_id_ != 0:
+            inun_inform = []
+            min_wl_arr_t = copy.deepcopy(min_inun_wl_arr)
+            min_wl_arr_t[inun_id_arr != inun_id_] = np.nan
+            min_wl_arr_t[permanent_water_arr == 1] = -1
+            max_wl_arr_t = copy.deepcopy(max_noninun_wl_arr)
+            max_wl_arr_t[inun_id_arr != inun_id_] = np.nan
+            max_wl_arr_t[permanent_water_arr == 1] = -1
+
+            offset_all, bound_all = np.min(np.argwhere(inun_id_arr == inun_id_), axis=0), np.max(np.argwhere(inun_id_arr == inun_id_), axis=0)
+            min_wl_arr_t = min_wl_arr_t[offset_all[0] - 1: bound_all[0] + 2, offset_all[1] - 1: bound_all[1] + 2]
+            max_wl_arr_t = max_wl_arr_t[offset_all[0] - 1: bound_all[0] + 2, offset_all[1] - 1: bound_all[1] + 2]
+            min_wl_arr_list = np.unique(min_wl_arr_t.flatten())
+            min_wl_arr_list = np.sort(np.delete(min_wl_arr_list, np.argwhere(np.logical_or(np.isnan(min_wl_arr_list), min_wl_arr_list == -1))))
+
+            for wl in min_wl_arr_list:
+                for pos_temp in np.argwhere(min_wl_arr_t == wl):
+                    arr_temp = min_wl_arr_t[pos_temp[0] - 1: pos_temp[0] + 2, pos_temp[1] - 1: pos_temp[1] + 2]
+                    inun_inform__ = [wl, pos_temp[0], pos_temp[1]]
+                    if (arr_temp == wl).all():
+                        inun_inform__.append(0)
+                    elif (arr_temp > wl).any():
+                        inun_inform__.append(1)
+                    elif np.isnan(arr_temp).any() == 1:
+                        inun_inform__.append(1)
+                    elif (arr_temp == -1).any():
+                        inun_inform__.append(-1)
+                    elif (arr_temp < wl).any():
+                        inun_inform__.append(0)
+                    else:
+                        raise Exception(str(arr_temp))
+                    inun_inform.append(inun_inform__)
+
+            min_wl_arr_refined_t = np.zeros_like(min_wl_arr_t) * np.nan
+            i_len = 0
+            while i_len < len(inun_inform):
+                min_wl_, pos_y, pos_x, status = inun_inform[i_len]
+                if status == 1:
+                    min_wl_arr_refined_t[pos_y, pos_x] = min_wl_arr_t[pos_y, pos_x]
+                    inun_inform.remove(inun_inform[i_len])
+                elif status == -1:
+                    if max_wl_arr_t[pos_y, pos_x] > min_wl_arr_t[pos_y, pos_x]:
+                        wl_temp = min_wl_arr_t[pos_y, pos_x]
+                        wl_pos = np.argwhere(water_level_data == float(str(wl_temp)))
+                        date, date_pos = [], []
+                        for wl_pos_temp in wl_pos:
+                            if water_level_data[wl_pos_temp[0], 0] in doy_list:
+                                date.append(water_level_data[wl_pos_temp[0]])
+                                date_pos.append(wl_pos_temp[0])
+                        if len(date) == 1:
+                            wl_temp_2 = water_level_data[int(date_pos[0]) - 5, 1]
+                        else:
+                            wl_temp_2 = water_level_data[int(min(date_pos)) - 5, 1]
+                        if wl_temp_2 <= wl_temp and wl_temp - wl_temp_2 < 3:
+                            min_wl_arr_refined_t[pos_y, pos_x] = (wl_temp_2 + wl_temp) / 2
+                        else:
+                            min_wl_arr_refined_t[pos_y, pos_x] = wl_temp - 1
+                    else:
+                        min_wl_arr_refined_t[pos_y, pos_x] = (min_wl_arr_t[pos_y, pos_x] + max_wl_arr_t[pos_y, pos_x]) / 2
+                    inun_inform.remove(inun_inform[i_len])
+                elif status == 0:
+                    inun_inform[i_len].append(np.nan)
+                    i_len += 1
+
+            for min_wl_ in min_wl_arr_list:
+                if not (min_wl_arr_refined_t == min_wl_).any():
+                    pos_x_em_list = np.array([inun_[2] for inun_ in inun_inform if inun_[0] == min_wl_])
+                    pos_y_em_list = np.array([inun_[1] for inun_ in inun_inform if inun_[0] == min_wl_])
+                    if len(pos_x_em_list) != 0:
+                        pos_x_mid = int(np.nanmedian(pos_x_em_list))
+                        if pos_x_mid in pos_x_em_list:
+                            pos_y_mid = int(np.nanmedian(pos_y_em_list[pos_x_em_list == pos_x_mid]))
+                            min_wl_arr_refined_t[pos_y_mid, pos_x_mid] = min_wl_
+                        else:
+                            min_wl_arr_refined_t[pos_y_em_list[int(pos_y_em_list.shape[0] / 2)], pos_x_em_list[int(pos_x_em_list.shape[0] / 2)]] = min_wl_
+
+            for min_wl_, pos_y, pos_x, status, wl_refined in inun_inform:
+                wl_centre = min_wl_
+                upper_wl_dis, lower_wl_dis, lower_wl = [], [], []
+                for r in range(1, 100):
+                    pos_y_lower = 0 if pos_y - r < 0 else pos_y - r
+                    pos_x_lower = 0 if pos_x - r < 0 else pos_x - r
+                    pos_y_upper = min_wl_arr_refined_t.shape[0] if pos_y + r + 1 > min_wl_arr_refined_t.shape[0] else pos_y + r + 1
+                    pos_x_upper = min_wl_arr_refined_t.shape[1] if pos_x + r + 1 > min_wl_arr_refined_t.shape[1] else pos_x + r + 1
+
+                    arr_tt = min_wl_arr_refined_t[pos_y_lower: pos_y_upper, pos_x_lower: pos_x_upper]
+                    arr_tt[pos_y_lower - 1: pos_y_upper - 1, pos_x_lower - 1: pos_x_upper - 1] = np.nan
+                    if len(upper_wl_dis) < 10:
+                        upper_wl_dis_list = []
+                        if (arr_tt == wl_centre).any():
+                            for pos_ttt in np.argwhere(arr_tt == wl_centre):
+                                upper_wl_dis_list.append(np.sqrt((pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2))
+                            upper_wl_dis_list.sort()
+                            upper_wl_dis.extend(upper_wl_dis_list[:10 - len(upper_wl_dis)])
+
+                    if len(lower_wl_dis) < 10:
+                        lower_wl_dat_list = []
+                        arr_tt[arr_tt < 0] = 100000
+                        if (arr_tt < wl_centre).any():
+                            for pos_ttt in np.argwhere(arr_tt <= wl_centre):
+                                lower_wl_dat_list.append([arr_tt[pos_ttt[0], pos_ttt[1]], np.sqrt((pos_ttt[0] - r) ** 2 + (pos_ttt[1] - r) ** 2)])
+                            lower_wl_dat_list.sort()
+                            if len(lower_wl_dat_list) > 10 - len(lower_wl_dis):
+                                lower_wl_dis.extend([lower_wl_dat_list[_][1] for _ in range(10 - len(lower_wl_dis))])
+                                lower_wl.extend([lower_wl_dat_list[_][0] for _ in range(10 - len(lower_wl))])
+                            else:
+                                lower_wl_dis.extend([_[1] for _ in lower_wl_dat_list])
+                                lower_wl.extend([_[0] for _ in lower_wl_dat_list])
+
+                    if len(upper_wl_dis) == 10 and len(lower_wl_dis) == 10 and len(lower_wl) == 10:
+                        break
+                if len(upper_wl_dis) == 0:
+                    upper_wl_dis = [0.00001]
+                elif len(lower_wl_dis) == 0:
+                    lower_wl_dis = [0.00001]
+                    lower_wl = [wl_centre]
+                elif len(upper_wl_dis) != len(lower_wl_dis):
+                    size_ = min(len(upper_wl_dis), len(lower_wl_dis))
+                    upper_wl_dis, lower_wl_dis, lower_wl = upper_wl_dis[: size_], lower_wl_dis[: size_], lower_wl[: size_]
+
+                upper_wl_dis = [(1 / _) ** 2 for _ in upper_wl_dis]
+                lower_wl_dis = [(1 / _) ** 2 for _ in lower_wl_dis]
+                upper_wl = [wl_centre * upper_wl_dis[_] for _ in range(len(upper_wl_dis))]
+                lower_wl = [lower_wl[_] * lower_wl_dis[_] for _ in range(len(lower_wl_dis))]
+                min_wl_arr_refined_t[pos_y, pos_x] = sum([sum(upper_wl), sum(lower_wl)]) / sum([sum(upper_wl_dis), sum(lower_wl_dis)])
+
+            min_wl_arr_refined_t[np.isnan(min_wl_arr_refined_t)] = 0
+            min_wl_arr_refined[offset_all[0] - 1: bound_all[0] + 2, offset_all[1] - 1: bound_all[1] + 2] += min_wl_arr_refined_t
+    min_wl_arr_refined[permanent_water_arr == 1] = -1
+    return min_wl_arr_refined
+
+
+def engine_refine(min_inun_wl_arr, max_noninun_wl_arr, permanent_water_arr, inun_id_arr, water_level_data, doy_list, wl_refine):
+
+    # The loop of the est_inunduration over the bounding box of each inundation region
+    min_wl_arr_refined = copy.deepcopy(min_inun_wl_arr)
+    min_wl_arr_refined[:, :] = 0
+    inun_id_slice = ndimage.find_objects(np.where(inun_id_arr > 0, inun_id_arr, 0))
+    for inun_id_ in np.unique(inun_id_arr.flatten()):
+        if inun_id_ > 0 and inun_id_slice[inun_id_ - 1] is not None:
+            y_slice, x_slice = inun_id_slice[inun_id_ - 1]
+            y_slice = slice(max(y_slice.start - 1, 0), y_slice.stop + 1)
+            x_slice = slice(max(x_slice.start - 1, 0), x_slice.stop + 1)
+            inun_id_t = inun_id_arr[y_slice, x_slice] != inun_id_
+            pw_t = permanent_water_arr[y_slice, x_slice] == 1
+
+            min_wl_arr_t = min_inun_wl_arr[y_slice, x_slice].astype(np.float32)
+            min_wl_arr_t[inun_id_t] = np.nan
+            min_wl_arr_t[pw_t] = -1
+            max_wl_arr_t = max_noninun_wl_arr[y_slice, x_slice].astype(np.float32)
+            max_wl_arr_t[inun_id_t] = np.nan
+            max_wl_arr_t[pw_t] = -1
+
+            min_wl_arr_refined_t = ru.refine_inundation_wl(min_wl_arr_t, max_wl_arr_t, water_level_data, doy_list, wl_refine=wl_refine)
+            min_wl_arr_refined_t[np.isnan(min_wl_arr_refined_t)] = 0
+            min_wl_arr_refined[y_slice, x_slice] += min_wl_arr_refined_t
+    min_wl_arr_refined[permanent_water_arr == 1] = -1
+    return min_wl_arr_refined
+
+
+def test_refine_inundation_wl_legacy():
+    basin = synthetic_basin()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        legacy = legacy_refine(*basin)
+        refined = engine_refine(*basin, wl_refine='legacy')
+    assert np.array_equal(legacy, refined)
+
+
+def test_refine_inundation_wl_nearest():
+
+    # The nearest lower pixel engine differs from the legacy surface, but stays between the lowest wl of the region and the wl of the pixel
+    basin = synthetic_basin()
+    min_inun_wl_arr, inun_id_arr = basin[0], basin[3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        legacy = legacy_refine(*basin)
+    nearest = engine_refine(*basin, wl_refine='nearest')
+    for inun_id_ in (1, 2):
+        region = np.logical_and(inun_id_arr == inun_id_, legacy > 0)
+        assert (nearest[region] <= min_inun_wl_arr[region] + 1e-4).all()
+        assert (nearest[region] >= min_inun_wl_arr[inun_id_arr == inun_id_].min() - 1e-4).all()
+
+    with pytest.raises(ValueError):
+        ru.refine_inundation_wl(basin[0][1: 4, 1: 4], basin[1][1: 4, 1: 4], basin[4], basin[5], wl_refine='window')